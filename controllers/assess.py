@@ -20,6 +20,7 @@ def index():
 def building_marker_fn(record):
     """
         Function to decide which Marker to use for Building Assessments Map
+        - returns the Marker name, GIS.get_markers() looks them up in bulk
         @ToDo: Legend
         @ToDo: Move to Templates
         @ToDo: Use Symbology
@@ -43,21 +44,6 @@ def building_marker_fn(record):
         # Low
         marker = "%s_green" % marker
 
-    mtable = db.gis_marker
-    try:
-        marker = db(mtable.name == marker).select(mtable.image,
-                                                  mtable.height,
-                                                  mtable.width,
-                                                  cache=s3db.cache,
-                                                  limitby=(0, 1)
-                                                  ).first()
-    except:
-        marker = db(mtable.name == "residence").select(mtable.image,
-                                                       mtable.height,
-                                                       mtable.width,
-                                                       cache=s3db.cache,
-                                                       limitby=(0, 1)
-                                                       ).first()
     return marker
 
 # -----------------------------------------------------------------------------
@@ -56,6 +56,7 @@ def create():
 def marker_fn(record):
     """
         Function to decide which Marker to use for Requests Map
+        - returns the Marker name, GIS.get_markers() looks them up in bulk
         @ToDo: Use Symbology
     """
 
@@ -85,12 +86,6 @@ def marker_fn(record):
     #    # Low
     #    marker = "%s_yellow" % marker
 
-    mtable = db.gis_marker
-    marker = db(mtable.name == marker).select(mtable.image,
-                                              mtable.height,
-                                              mtable.width,
-                                              cache=s3db.cache,
-                                              limitby=(0, 1)).first()
     return marker
 
 # -----------------------------------------------------------------------------
@@ -104,12 +104,19 @@ def sync():
         if "_" in tablename:
 
             # URL variables from peer:
-            # repository ID, msince and sync filters
+            # repository ID, msince, pagination, reconciliation
+            # and sync filters
             get_vars = Storage(include_deleted=True)
             
             _vars = request.get_vars
             for k, v in _vars.items():
-                if k in ("repository", "msince") or \
+                if k in ("repository",
+                         "msince",
+                         "start",
+                         "limit",
+                         "cursor",
+                         "checksums",
+                         "buckets") or \
                    k[0] == "[" and "]" in k:
                     get_vars[k] = v
 
@@ -194,6 +194,23 @@ def org_facility_geojson(user_id=None):
 
 tasks["org_facility_geojson"] = org_facility_geojson
 
+# -----------------------------------------------------------------------------
+def pr_rebuild_ancestors(user_id=None):
+    """
+        Build the materialised OU ancestors of all person entities
+            - started automatically when the table is found empty
+
+        @param user_id: calling request's auth.user.id or None
+    """
+    if user_id:
+        # Authenticate
+        auth.s3_impersonate(user_id)
+    # Run the Task
+    s3db.pr_rebuild_ancestors()
+    db.commit()
+
+tasks["pr_rebuild_ancestors"] = pr_rebuild_ancestors
+
 # -----------------------------------------------------------------------------
 if settings.has_module("msg"):
 
@@ -327,6 +344,23 @@ if settings.has_module("msg"):
 
     tasks["notify_notify"] = notify_notify
 
+    # -------------------------------------------------------------------------
+    def notify_batch(resource_ids, user_id=None):
+        """
+            Asynchronous task to notify a batch of subscribers about
+            resource updates. This task is created by
+            notify_check_subscriptions if settings.msg.notify_batch
+            is set.
+
+            @param resource_ids: JSON list of pr_subscription_resource record IDs
+        """
+        if user_id:
+            auth.s3_impersonate(user_id)
+        notify = s3base.S3Notifications
+        return notify.notify_batch(resource_ids)
+
+    tasks["notify_batch"] = notify_batch
+
 # -----------------------------------------------------------------------------
 if settings.has_module("req"):
 
@@ -489,6 +523,88 @@ if settings.has_module("sync"):
 
     tasks["sync_synchronize"] = sync_synchronize
 
+    # -----------------------------------------------------------------------------
+    def sync_run_tasks(repository_id, task_ids, user_id=None):
+        """
+            Run some tasks for a repository, to be called from scheduler
+            - started by S3Sync.synchronize to run independent tasks
+              concurrently
+
+            @param repository_id: the sync_repository record ID
+            @param task_ids: JSON list of sync_task record IDs
+            @param user_id: calling request's auth.user.id or None
+        """
+
+        if user_id:
+            auth.s3_impersonate(user_id)
+
+        if isinstance(task_ids, basestring):
+            task_ids = json.loads(task_ids)
+
+        rtable = s3db.sync_repository
+        query = (rtable.deleted != True) & \
+                (rtable.id == repository_id)
+        repository = db(query).select(limitby=(0, 1)).first()
+        if repository:
+            sync = s3base.S3Sync()
+            success = sync.run_tasks(repository, task_ids)
+        else:
+            success = False
+        db.commit()
+        if success:
+            return s3base.S3SyncLog.SUCCESS
+        else:
+            return s3base.S3SyncLog.ERROR
+
+    tasks["sync_run_tasks"] = sync_run_tasks
+
+    # -----------------------------------------------------------------------------
+    def sync_reconcile(repository_id, user_id=None, manual=False):
+        """
+            Reconcile the data of all tasks for a repository by checksums
+            rather than msince timestamps, to be called from scheduler
+            - to recover from clock skew or restored backups
+
+            @param repository_id: the sync_repository record ID
+            @param user_id: calling request's auth.user.id or None
+            @param manual: whether this is a manual run
+        """
+
+        auth.s3_impersonate(user_id)
+
+        rtable = s3db.sync_repository
+        query = (rtable.deleted != True) & \
+                (rtable.id == repository_id)
+        repository = db(query).select(limitby=(0, 1)).first()
+        success = False
+        if repository:
+            sync = s3base.S3Sync()
+            status = sync.get_status()
+            if status.running:
+                message = "Synchronization already active - skipping run"
+                sync.log.write(repository_id=repository.id,
+                               resource_name=None,
+                               transmission=None,
+                               mode=None,
+                               action="check",
+                               remote=False,
+                               result=sync.log.ERROR,
+                               message=message)
+                db.commit()
+                return sync.log.ERROR
+            sync.set_status(running=True, manual=manual)
+            try:
+                success = sync.reconcile(repository)
+            finally:
+                sync.set_status(running=False, manual=False)
+        db.commit()
+        if success:
+            return s3base.S3SyncLog.SUCCESS
+        else:
+            return s3base.S3SyncLog.ERROR
+
+    tasks["sync_reconcile"] = sync_reconcile
+
 # -----------------------------------------------------------------------------
 # Instantiate Scheduler instance with the list of tasks
 s3.tasks = tasks
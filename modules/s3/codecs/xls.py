@@ -87,17 +87,22 @@ class S3XLS(S3Codec):
         if orderby is None:
             orderby = resource.get_config("orderby", None)
 
-        result = resource.select(list_fields,
-                                 left=left,
-                                 limit=None,
-                                 count=True,
-                                 getids=True,
-                                 orderby=orderby,
-                                 represent=True,
-                                 show_links=False)
+        # Extract page by page
+        pages = resource.iterselect(list_fields,
+                                    left=left,
+                                    orderby=orderby,
+                                    represent=True,
+                                    show_links=False)
+        result = pages.next()
 
         rfields = result["rfields"]
-        rows = result["rows"]
+        def iterrows():
+            for row in result["rows"]:
+                yield row
+            for page in pages:
+                for row in page["rows"]:
+                    yield row
+        rows = iterrows()
         
         types = []
         lfields = []
@@ -183,7 +188,8 @@ class S3XLS(S3Codec):
             (title, types, lfields, headers, rows) = self.extractResource(data_source,
                                                                           list_fields)
         report_groupby = lfields[group] if group else None
-        if len(rows) > 0 and len(headers) != len(rows[0]):
+        if isinstance(rows, (list, tuple)) and \
+           len(rows) > 0 and len(headers) != len(rows[0]):
             from ..s3utils import s3_debug
             msg = """modules/s3/codecs/xls: There is an error in the list_items, a field doesn't exist"
 requesting url %s
@@ -297,6 +303,7 @@ List Fields %s""" % (request.url, len(headers), len(items[0]), headers, list_fie
         totalCols = colCnt
         #rowCnt = 2
         rowCnt = 0
+        flushed = 0
 
         subheading = None
         for row in rows:
@@ -395,6 +402,10 @@ List Fields %s""" % (request.url, len(headers), len(items[0]), headers, list_fie
                     fieldWidths[colCnt] = width
                     sheet1.col(writeCol).width = width
                 colCnt += 1
+            if rowCnt - flushed >= 1000:
+                # Release the memory for the rows written so far
+                sheet1.flush_row_data()
+                flushed = rowCnt
         sheet1.panes_frozen = True
         #sheet1.horz_split_pos = 3
         sheet1.horz_split_pos = 1
@@ -2769,13 +2769,10 @@ S3OptionsFilter({
                     # Realms include subsidiaries of the realm entities
 
                     # Get all entities in realms
-                    all_entities = []
-                    append = all_entities.append
+                    all_entities = set()
                     for realm in realms.values():
                         if realm is not None:
-                            for entity in realm:
-                                if entity not in all_entities:
-                                    append(entity)
+                            all_entities.update(realm)
 
                     # Lookup all delegations to any OU ancestor of the user
                     if self.permission.delegations and self.user.pe_id:
@@ -2810,7 +2807,7 @@ S3OptionsFilter({
                         partners = []
 
                     # Lookup the subsidiaries of all realms and extensions
-                    entities = all_entities + extensions + partners
+                    entities = all_entities.union(extensions, partners)
                     descendants = s3db.pr_descendants(entities)
 
                     pmap = {}
@@ -2818,7 +2815,7 @@ S3OptionsFilter({
                         if p in all_entities:
                             pmap[p] = [p]
                         elif p in descendants:
-                            d = descendants[p]
+                            d = set(descendants[p])
                             pmap[p] = [e for e in all_entities if e in d] or [p]
 
                     # Add the subsidiaries to the realms
@@ -2827,10 +2824,12 @@ S3OptionsFilter({
                         if realm is None:
                             continue
                         append = realm.append
+                        entities = set(realm)
                         for entity in list(realm):
                             if entity in descendants:
                                 for subsidiary in descendants[entity]:
-                                    if subsidiary not in realm:
+                                    if subsidiary not in entities:
+                                        entities.add(subsidiary)
                                         append(subsidiary)
 
                     # Process the delegations
@@ -28,7 +28,8 @@
 
     @group Data Views: S3DataTable,
                        S3DataList,
-                       S3PivotTable
+                       S3PivotTable,
+                       S3PivotCube
 """
 
 import datetime
@@ -37,6 +38,11 @@ import time
 
 from itertools import product, islice
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 try:
     import json # try stdlib (Python 2.6)
 except ImportError:
@@ -1252,7 +1258,8 @@ class S3PivotTable(object):
                #"std": "Standard Deviation"
                }
 
-    def __init__(self, resource, rows, cols, layers, strict=True):
+    def __init__(self, resource, rows, cols, layers, strict=True,
+                 records=True):
         """
             Constructor - extracts all unique records, generates a
             pivot table from them with the given dimensions and
@@ -1265,6 +1272,9 @@ class S3PivotTable(object):
                            for the value aggregation(s)
             @param strict: filter out dimension values which don't match
                            the resource filter
+            @param records: retain the records, False to compute the
+                            aggregates with GROUP BY queries instead if
+                            possible (cell records are then None)
         """
 
         # Initialize ----------------------------------------------------------
@@ -1291,6 +1301,10 @@ class S3PivotTable(object):
                 }
         """
 
+        self.numrecords = None
+        """ The number of records in the pivot table """
+        self.cube = None
+        """ The S3PivotCube of the records (None if aggregated in the DB) """
         self.empty = False
         """ Empty-flag (True if no records could be found) """
         self.numrows = None
@@ -1349,8 +1363,12 @@ class S3PivotTable(object):
 
         # Retrieve the records ------------------------------------------------
         #
-        data = resource.select(self.rfields.keys(), limit=None)
-        drows = data["rows"]
+        if not records and self._pivot_db():
+            # Aggregated in the database
+            drows = None
+        else:
+            data = resource.select(self.rfields.keys(), limit=None)
+            drows = data["rows"]
         if drows:
 
             key = str(resource.table._id)
@@ -1376,7 +1394,7 @@ class S3PivotTable(object):
             insert = dataframe.append
             expand = self._expand
 
-            for _id in records:
+            for _id in sorted(records):
                 row = records[_id]
                 item = {key: _id}
                 if rows_colname:
@@ -1386,6 +1404,7 @@ class S3PivotTable(object):
                 dataframe.extend(expand(item, axisfilter=axisfilter))
                 
             self.records = records
+            self.numrecords = len(records)
 
             #if DEBUG:
                 #duration = datetime.datetime.now() - _start
@@ -1394,10 +1413,15 @@ class S3PivotTable(object):
                 
             # Group the records -----------------------------------------------
             #
-            matrix, rnames, cnames = self._pivot(dataframe,
-                                                 pkey_colname,
-                                                 rows_colname,
-                                                 cols_colname)
+            cube = S3PivotCube(records,
+                               dataframe,
+                               pkey_colname,
+                               rows_colname,
+                               cols_colname,
+                               self._extract)
+            self.cube = cube
+            rnames = cube.rnames
+            cnames = cube.cnames
 
             #if DEBUG:
                 #duration = datetime.datetime.now() - _start
@@ -1423,16 +1447,15 @@ class S3PivotTable(object):
             # Add the layers --------------------------------------------------
             #
             add_layer = self._add_layer
-            layers = list(self.layers)
             for f, m in self.layers:
-                add_layer(matrix, f, m)
+                add_layer(f, m)
 
             #if DEBUG:
                 #duration = datetime.datetime.now() - _start
                 #duration = '{:.2f}'.format(duration.total_seconds())
                 #_debug("Layers complete after %s seconds" % duration)
 
-        else:
+        elif drows is not None:
             # No items to report on -------------------------------------------
             #
             self.empty = True
@@ -1450,7 +1473,7 @@ class S3PivotTable(object):
 
         items = self.records
         if items is None:
-            return 0
+            return self.numrecords or 0
         else:
             return len(self.records)
 
@@ -1780,7 +1803,9 @@ class S3PivotTable(object):
         """
             Render the pivot table data as JSON-serializable dict
 
-            @param layer: the layer
+            @param layer: the layer, can be a layer other than those
+                          of this pivot table if its fact field has
+                          been extracted (i.e. is in report_fields)
             @param maxrows: maximum number of rows (None for all)
             @param maxcols: maximum number of columns (None for all)
             @param least: render the least n rows/columns rather than
@@ -1814,6 +1839,10 @@ class S3PivotTable(object):
         # The layer
         if layer is None:
             layer = self.layers[0]
+        elif layer not in self.totals and self.cube is not None and \
+             layer[0] in self.rfields:
+            # Compute from the cube, without extracting the records again
+            self._add_layer(*layer)
         field, method = layer
         rows_dim = self.rows
         cols_dim = self.cols
@@ -1856,7 +1885,7 @@ class S3PivotTable(object):
                 if is_numeric is None:
                     is_numeric = numeric(total)
                 if not is_numeric:
-                    total = len(irow.records)
+                    total = self._numrecords(irow)
                 header = Storage(value = irow.value,
                                  text = irow.text if "text" in irow
                                                   else row_repr(irow.value))
@@ -1877,7 +1906,7 @@ class S3PivotTable(object):
                 if is_numeric is None:
                     is_numeric = numeric(total)
                 if not is_numeric:
-                    total = len(icol["records"])
+                    total = self._numrecords(icol)
                 header = Storage(value = icol.value,
                                 text = icol.text if "text" in icol
                                                  else col_repr(icol.value))
@@ -1904,9 +1933,13 @@ class S3PivotTable(object):
                     cidx = (j, OTHER) if cothers and j in cothers else (j,)
 
                     cell_records = cell["records"]
+                    if cell_records is None and method == "count":
+                        cell_fvalues = cell["fvalues"][field]
+                    else:
+                        cell_fvalues = None
                     items = cell[layer]
                     value = items if is_numeric \
-                                  else len(cell_records)
+                                  else self._numrecords(cell)
                                   
                     for ri in ridx:
                         if ri not in cells:
@@ -1923,11 +1956,18 @@ class S3PivotTable(object):
                                     ocell["value"] = value
                                     ocell["items"] = items
                                 ocell["records"] = cell_records
+                                if cell_fvalues is not None:
+                                    ocell["fvalues"] = list(cell_fvalues)
+                                else:
+                                    ocell["fvalues"] = None
                             else:
                                 ocell = orow[ci]
                                 ocell["value"].append(value)
                                 ocell["items"].append(items)
-                                ocell["records"].extend(cell_records)
+                                if cell_records is not None:
+                                    ocell["records"].extend(cell_records)
+                                if cell_fvalues is not None:
+                                    ocell["fvalues"].extend(cell_fvalues)
 
             # Aggregate the grouped values
             ctotals = True
@@ -1975,34 +2015,40 @@ class S3PivotTable(object):
                     # Build a lookup table for field values if counting
                     if method == "count":
                         keys = []
-                        for record_id in cell_records:
-                            record = self.records[record_id]
-                            try:
-                                fvalue = record[rfield.colname]
-                            except AttributeError:
-                                continue
-                            if fvalue is None:
-                                continue
-                            if type(fvalue) is not list:
-                                fvalue = [fvalue]
-                            for v in fvalue:
-                                if v is None:
+                        if cell_records is not None:
+                            fvalues = []
+                            for record_id in cell_records:
+                                record = self.records[record_id]
+                                try:
+                                    fvalue = record[rfield.colname]
+                                except AttributeError:
                                     continue
-                                if has_fk:
-                                    if v not in keys:
-                                        keys.append(v)
-                                    if v not in lookup:
-                                        lookup[v] = _repr(v)
+                                if fvalue is None:
+                                    continue
+                                if type(fvalue) is not list:
+                                    fvalue = [fvalue]
+                                fvalues.extend(fvalue)
+                        else:
+                            # Distinct values from the database
+                            fvalues = cell["fvalues"]
+                        for v in fvalues:
+                            if v is None:
+                                continue
+                            if has_fk:
+                                if v not in keys:
+                                    keys.append(v)
+                                if v not in lookup:
+                                    lookup[v] = _repr(v)
+                            else:
+                                if v not in value_map:
+                                    next_id = len(value_map)
+                                    value_map[v] = next_id
+                                    keys.append(next_id)
+                                    lookup[next_id] = _repr(v)
                                 else:
-                                    if v not in value_map:
-                                        next_id = len(value_map)
-                                        value_map[v] = next_id
-                                        keys.append(next_id)
-                                        lookup[next_id] = _repr(v)
-                                    else:
-                                        prev_id = value_map[v]
-                                        if prev_id not in keys:
-                                            keys.append(prev_id)
+                                    prev_id = value_map[v]
+                                    if prev_id not in keys:
+                                        keys.append(prev_id)
                         keys.sort(key=lambda i: lookup[i])
                     else:
                         keys = None
@@ -2168,7 +2214,7 @@ class S3PivotTable(object):
             if is_numeric is None:
                 is_numeric = numeric(total)
             if not is_numeric:
-                total = len(r["records"])
+                total = self._numrecords(r)
             header = Storage(value = r.value,
                              text = r.text
                                     if "text" in r else row_repr(r.value))
@@ -2191,7 +2237,7 @@ class S3PivotTable(object):
             if is_numeric is None:
                 is_numeric = numeric(total)
             if not is_numeric:
-                total = len(c["records"])
+                total = self._numrecords(c)
             header = Storage(value = c.value,
                              text = c.text
                                     if "text" in c else col_repr(c.value))
@@ -2219,7 +2265,7 @@ class S3PivotTable(object):
             for j in xrange(self.numcols):
                 cell = irow[j]
                 cidx = j if j in col_indices else OTHER
-                value = cell[layer] if is_numeric else len(cell["records"])
+                value = cell[layer] if is_numeric else self._numrecords(cell)
                 if cidx not in orow:
                     orow[cidx] = [value] if cidx == OTHER or ridx == OTHER else value
                 else:
@@ -2256,68 +2302,219 @@ class S3PivotTable(object):
     # -------------------------------------------------------------------------
     # Internal methods
     # -------------------------------------------------------------------------
-    def _pivot(self, items, pkey_colname, rows_colname, cols_colname):
+    def _pivot_db(self):
         """
-            2-dimensional pivoting of a list of unique items
-
-            @param items: list of unique items as dicts
-            @param pkey_colname: column name of the primary key
-            @param rows_colname: column name of the row dimension
-            @param cols_colname: column name of the column dimension
+            Compute the pivot table with GROUP BY queries in the database
+            instead of extracting all records, only possible if all layers
+            use count, min, max, sum or avg, and with fields that can be
+            aggregated in the database (see S3Resource.aggregate)
 
-            @return: tuple of (cell matrix, row headers, column headers),
-                     where cell matrix is a 2-dimensional array [rows[columns]]
-                     and row headers and column headers each are lists (in the
-                     same order as the cell matrix)
+            @return: True if successful, False if the pivot table must be
+                     computed from the records
         """
 
-        rvalues = Storage()
-        cvalues = Storage()
-        cells = Storage()
-
-        # All unique rows values
-        rindex = 0
-        cindex = 0
-        for item in items:
+        resource = self.resource
+        rfields = self.rfields
 
-            rvalue = item[rows_colname] if rows_colname else None
-            cvalue = item[cols_colname] if cols_colname else None
+        pkey = self.pkey
+        rows = self.rows
+        cols = self.cols
 
-            if rvalue not in rvalues:
-                r = rvalues[rvalue] = rindex
-                rindex += 1
+        # Aggregates for the layers
+        aggregates = [(pkey, "count")]
+        counts = []
+        for fact, method in self.layers:
+            if method not in ("count", "min", "max", "sum", "avg") or \
+               fact not in rfields:
+                return False
+            ftype = rfields[fact].ftype
+            if method == "count":
+                if fact not in counts:
+                    counts.append(fact)
+            elif method == "avg":
+                if ftype not in ("integer", "double"):
+                    return False
+                aggregates.extend([(fact, "sum"), (fact, "count")])
             else:
-                r = rvalues[rvalue]
+                if method == "sum" and \
+                   ftype not in ("integer", "double") and \
+                   ftype[:7] != "decimal":
+                    return False
+                aggregates.append((fact, method))
+
+        dims = [dim for dim in (rows, cols) if dim]
+        data = resource.aggregate(dims, aggregates)
+        if data is None:
+            return False
+
+        # Distinct values per cell for count layers
+        fdata = {}
+        for fact in counts:
+            items = resource.aggregate(dims + [fact], [(pkey, "count")])
+            if items is None:
+                return False
+            fdata[fact] = items
+
+        if not data:
+            self.empty = True
+            return True
+
+        # Index the dimension values in order of their first record
+        numdims = len(dims)
+        rvalues = {}
+        cvalues = {}
+        rnames = []
+        cnames = []
+        def index(item):
+            rvalue = item[0] if rows else None
+            cvalue = item[numdims - 1] if cols else None
+            if rvalue not in rvalues:
+                rvalues[rvalue] = len(rnames)
+                rnames.append(rvalue)
             if cvalue not in cvalues:
-                c = cvalues[cvalue] = cindex
-                cindex += 1
-            else:
-                c = cvalues[cvalue]
+                cvalues[cvalue] = len(cnames)
+                cnames.append(cvalue)
+            return rvalues[rvalue], cvalues[cvalue]
+
+        groups = {}
+        for item in data:
+            groups[index(item)] = item[numdims:]
+
+        fvalues = {}
+        for fact in counts:
+            values = fvalues[fact] = {}
+            for item in fdata[fact]:
+                value = item[numdims]
+                if value is None:
+                    continue
+                key = index(item)
+                if key not in values:
+                    values[key] = [value]
+                else:
+                    values[key].append(value)
+
+        numrows = len(rnames)
+        numcols = len(cnames)
+
+        # Partial aggregates per cell and layer
+        partials = {}
+        for key, values in groups.items():
+            i = 1
+            cell = {}
+            for fact, method in self.layers:
+                if method == "count":
+                    partial = len(fvalues[fact].get(key, ()))
+                elif method == "avg":
+                    partial = values[i:i + 2]
+                    i += 2
+                else:
+                    partial = values[i]
+                    i += 1
+                cell[(fact, method)] = partial
+            partials[key] = cell
+
+        # Initialize columns and rows
+        self.col = [Storage(value=v, records=None, numrecords=0)
+                    for v in cnames]
+        self.numcols = numcols
+        self.row = [Storage(value=v, records=None, numrecords=0)
+                    for v in rnames]
+        self.numrows = numrows
+
+        # Cells
+        combine = self._combine
+        layers = self.layers
+        rpartials = [dict((layer, []) for layer in layers)
+                     for r in xrange(numrows)]
+        cpartials = [dict((layer, []) for layer in layers)
+                     for c in xrange(numcols)]
+        tpartials = dict((layer, []) for layer in layers)
+        numrecords = 0
+
+        cells = []
+        for r in xrange(numrows):
+            row = self.row[r]
+            rcells = []
+            for c in xrange(numcols):
+                col = self.col[c]
+                key = (r, c)
+                if key in groups:
+                    num = groups[key][0]
+                else:
+                    num = 0
+                cell = Storage(records=None,
+                               numrecords=num,
+                               fvalues=dict((fact, fvalues[fact].get(key, []))
+                                            for fact in counts))
+                row.numrecords += num
+                col.numrecords += num
+                numrecords += num
+                if key in partials:
+                    for layer in layers:
+                        partial = partials[key][layer]
+                        cell[layer] = combine([partial], layer[1])
+                        rpartials[r][layer].append(partial)
+                        cpartials[c][layer].append(partial)
+                        tpartials[layer].append(partial)
+                else:
+                    for layer in layers:
+                        cell[layer] = combine([], layer[1])
+                rcells.append(cell)
+            cells.append(rcells)
+        self.cell = cells
 
-            if (r, c) not in cells:
-                cells[(r, c)] = [item[pkey_colname]]
-            else:
-                cells[(r, c)].append(item[pkey_colname])
+        # Totals
+        for layer in layers:
+            method = layer[1]
+            for r in xrange(numrows):
+                self.row[r][layer] = combine(rpartials[r][layer], method)
+            for c in xrange(numcols):
+                self.col[c][layer] = combine(cpartials[c][layer], method)
+            self.totals[layer] = combine(tpartials[layer], method)
 
-        matrix = []
-        for r in xrange(len(rvalues)):
-            row = []
-            for c in xrange(len(cvalues)):
-                row.append(cells[(r, c)])
-            matrix.append(row)
+        self.numrecords = numrecords
+        return True
 
-        rnames = [None] * len(rvalues)
-        for k, v in rvalues.items():
-            rnames[v] = k
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def _combine(partials, method):
+        """
+            Combine partial aggregates from the database into the
+            aggregate over all of them, same results as _aggregate
+            over the underlying values
 
-        cnames = [None] * len(cvalues)
-        for k, v in cvalues.items():
-            cnames[v] = k
+            @param partials: list of partial aggregates, i.e. the number
+                             of distinct values for count, tuples of
+                             (sum, count) for avg, otherwise the value
+                             returned by the database
+            @param method: the aggregation method
+        """
 
-        return matrix, rnames, cnames
+        if method == "count":
+            return sum(partials)
+
+        elif method == "sum":
+            return sum(p for p in partials if p is not None)
+
+        elif method in ("min", "max"):
+            values = [p for p in partials if p is not None]
+            if not values:
+                return None
+            return min(values) if method == "min" else max(values)
+
+        elif method == "avg":
+            total = sum(p[0] for p in partials if p[0] is not None)
+            numvalues = sum(p[1] for p in partials)
+            if numvalues:
+                return total / float(numvalues)
+            else:
+                return 0.0
+
+        else:
+            return None
 
     # -------------------------------------------------------------------------
-    def _add_layer(self, matrix, fact, method):
+    def _add_layer(self, fact, method):
         """
             Compute an aggregation layer, updates:
 
@@ -2326,7 +2523,6 @@ class S3PivotTable(object):
                 - self.col: the totals per column
                 - self.totals: the overall totals per layer
 
-            @param matrix: the cell matrix
             @param fact: the fact field
             @param method: the aggregation method
         """
@@ -2334,20 +2530,11 @@ class S3PivotTable(object):
         if method not in self.METHODS:
             raise SyntaxError("Unsupported aggregation method: %s" % method)
 
-        items = self.records
-        rfields = self.rfields
+        cube = self.cube
         rows = self.row
         cols = self.col
-        records = self.records
-        extract = self._extract
-        aggregate = self._aggregate
-        resource = self.resource
 
         RECORDS = "records"
-        VALUES = "values"
-
-        table = resource.table
-        pkey = table._id.name
 
         if method is None:
             method = "list"
@@ -2356,90 +2543,39 @@ class S3PivotTable(object):
         numcols = len(self.col)
         numrows = len(self.row)
 
-        # Initialize cells
+        # Initialize cells, rows and columns with the records
         if self.cell is None:
-            self.cell = [[Storage()
-                          for i in xrange(numcols)]
-                         for j in xrange(numrows)]
+            cells = []
+            for r in xrange(numrows):
+                row = rows[r]
+                row[RECORDS] = []
+                cells.append([Storage() for c in xrange(numcols)])
+            for c in xrange(numcols):
+                cols[c][RECORDS] = []
+            for r in xrange(numrows):
+                row_records = rows[r][RECORDS]
+                for c in xrange(numcols):
+                    ids = cube.cell_records(r, c)
+                    cells[r][c][RECORDS] = ids
+                    row_records.extend(ids)
+                    cols[c][RECORDS].extend(ids)
+            self.cell = cells
         cells = self.cell
 
-        all_values = []
-        for r in xrange(numrows):
-
-            # Initialize row header
-            row = rows[r]
-            row[RECORDS] = []
-            row[VALUES] = []
-
-            row_records = row[RECORDS]
-            row_values = row[VALUES]
+        # Aggregate the values
+        if fact is None:
+            fact = self.pkey
+        values, rtotals, ctotals, total = cube.aggregate(fact, method)
 
+        for r in xrange(numrows):
+            row_values = values[r]
+            row_cells = cells[r]
             for c in xrange(numcols):
-
-                # Initialize column header
-                col = cols[c]
-                if RECORDS not in col:
-                    col[RECORDS] = []
-                col_records = col[RECORDS]
-                if VALUES not in col:
-                    col[VALUES] = []
-                col_values = col[VALUES]
-
-                # Get the records
-                cell = cells[r][c]
-                if RECORDS in cell and cell[RECORDS] is not None:
-                    ids = cell[RECORDS]
-                else:
-                    data = matrix[r][c]
-                    if data:
-                        remove = data.remove
-                        while None in data:
-                            remove(None)
-                        ids = data
-                    else:
-                        ids = []
-                    cell[RECORDS] = ids
-                row_records.extend(ids)
-                col_records.extend(ids)
-
-                # Get the values
-                if fact is None:
-                    fact = pkey
-                    values = ids
-                    row_values = row_records
-                    col_values = row_records
-                    all_values = records.keys()
-                else:
-                    values = []
-                    append = values.append
-                    for i in ids:
-                        value = extract(records[i], fact)
-                        if value is None:
-                            continue
-                        append(value)
-                    values = list(s3_flatlist(values))
-                    if method in ("list", "count"):
-                        values =  list(set(values))
-                    row_values.extend(values)
-                    col_values.extend(values)
-                    all_values.extend(values)
-
-                # Aggregate values
-                value = aggregate(values, method)
-                cell[layer] = value
-
-            # Compute row total
-            row[layer] = aggregate(row_values, method)
-            del row[VALUES]
-
-        # Compute column total
+                row_cells[c][layer] = row_values[c]
+            rows[r][layer] = rtotals[r]
         for c in xrange(numcols):
-            col = cols[c]
-            col[layer] = aggregate(col[VALUES], method)
-            del col[VALUES]
-
-        # Compute overall total
-        self.totals[layer] = aggregate(all_values, method)
+            cols[c][layer] = ctotals[c]
+        self.totals[layer] = total
         return
 
     # -------------------------------------------------------------------------
@@ -2503,6 +2639,21 @@ class S3PivotTable(object):
         else:
             return None
 
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def _numrecords(item):
+        """
+            Get the number of records in a cell, row or column
+
+            @param item: the cell, row or column header
+        """
+
+        records = item["records"]
+        if records is None:
+            return item["numrecords"] or 0
+        else:
+            return len(records)
+
     # -------------------------------------------------------------------------
     @staticmethod
     def _sortdim(items, rfield, index=2):
@@ -2813,4 +2964,376 @@ class S3PivotTable(object):
         else:
             return None
 
+# =============================================================================
+class S3PivotCube(object):
+    """
+        Columnar in-memory data cube of the records in a pivot table:
+        dimension values are encoded as integer codes, and fact values
+        are extracted only once per record and kept in columns (typed
+        NumPy arrays where possible), so that every aggregation layer
+        is a group reduction over these columns.
+
+        Entries are kept in cell order (rows, then columns, then record
+        order), so that sums and averages are accumulated in the same
+        order as when aggregating the per-cell lists of values.
+    """
+
+    def __init__(self, records, items, pkey, rows, cols, extract):
+        """
+            Constructor
+
+            @param records: the records as Storage {record_id: Row}
+            @param items: the data frame, a list of dicts with the
+                          record ID and the dimension values (by
+                          column name), list:types already expanded
+            @param pkey: the column name of the record ID
+            @param rows: the column name of the rows dimension
+            @param cols: the column name of the columns dimension
+            @param extract: function to extract a fact value from a
+                            record, extract(row, fact)
+        """
+
+        self.records = records
+        self.extract = extract
+
+        # Encode the dimension values, in order of first appearance
+        rvalues = {}
+        cvalues = {}
+        rnames = []
+        cnames = []
+
+        ids = []
+        positions = {}
+
+        entries = []
+        append = entries.append
+        for item in items:
+            rvalue = item[rows] if rows else None
+            cvalue = item[cols] if cols else None
+            if rvalue not in rvalues:
+                rvalues[rvalue] = len(rnames)
+                rnames.append(rvalue)
+            if cvalue not in cvalues:
+                cvalues[cvalue] = len(cnames)
+                cnames.append(cvalue)
+            record_id = item[pkey]
+            if record_id is None:
+                continue
+            if record_id not in positions:
+                positions[record_id] = len(ids)
+                ids.append(record_id)
+            append((rvalues[rvalue], cvalues[cvalue], positions[record_id]))
+
+        self.rnames = rnames
+        self.cnames = cnames
+        self.numrows = numrows = len(rnames)
+        self.numcols = numcols = len(cnames)
+        self.ids = ids
+
+        # Sort the entries by cell (stable, i.e. keeps the record order)
+        cellcodes = [r * numcols + c for r, c, p in entries]
+        order = sorted(xrange(len(entries)), key=cellcodes.__getitem__)
+        self.cellcodes = [cellcodes[i] for i in order]
+        self.positions = [entries[i][2] for i in order]
+
+        # Record IDs per cell
+        cells = [[] for i in xrange(numrows * numcols)]
+        for code, pos in zip(self.cellcodes, self.positions):
+            cells[code].append(ids[pos])
+        self.cells = cells
+
+        if numpy is not None:
+            self._codes = numpy.array(self.cellcodes, dtype=numpy.int64)
+            self._positions = numpy.array(self.positions, dtype=numpy.int64)
+
+        self._columns = {}
+        self._typed = {}
+        self._factorized = {}
+
+    # -------------------------------------------------------------------------
+    def cell_records(self, r, c):
+        """
+            Get the record IDs in a cell
+
+            @param r: the row index
+            @param c: the column index
+        """
+
+        return self.cells[r * self.numcols + c]
+
+    # -------------------------------------------------------------------------
+    def column(self, fact):
+        """
+            Get the values of a fact for all records (extracted only once)
+
+            @param fact: the fact (field selector)
+
+            @return: list of values in record order (self.ids)
+        """
+
+        columns = self._columns
+        if fact not in columns:
+            records = self.records
+            extract = self.extract
+            columns[fact] = [extract(records[record_id], fact)
+                             for record_id in self.ids]
+        return columns[fact]
+
+    # -------------------------------------------------------------------------
+    def aggregate(self, fact, method):
+        """
+            Compute an aggregation layer, same results as aggregating
+            the lists of values per cell, row, column and for all records
+            with S3PivotTable._aggregate
+
+            @param fact: the fact (field selector)
+            @param method: the aggregation method
+
+            @return: tuple (cells, rows, cols, total), where cells is a
+                     list of rows with a list of values per column, and
+                     rows and cols are lists of the totals per row/column
+        """
+
+        if numpy is not None:
+            if method in ("sum", "avg", "min", "max"):
+                typed = self._typed_column(fact)
+                if typed is not None:
+                    return self._reduce(typed, method)
+            elif method == "count":
+                factorized = self._factorize(fact)
+                if factorized is not None:
+                    return self._count(factorized)
+
+        return self._aggregate_values(fact, method)
+
+    # -------------------------------------------------------------------------
+    def _aggregate_values(self, fact, method):
+        """
+            Compute an aggregation layer from the lists of values per
+            cell (for methods or types which can't be reduced with NumPy)
+
+            @param fact: the fact (field selector)
+            @param method: the aggregation method
+        """
+
+        aggregate = S3PivotTable._aggregate
+        column = self.column(fact)
+        numrows = self.numrows
+        numcols = self.numcols
+
+        # Values per cell
+        values = [[] for i in xrange(numrows * numcols)]
+        for code, pos in zip(self.cellcodes, self.positions):
+            value = column[pos]
+            if value is not None:
+                values[code].append(value)
+        distinct = method in ("list", "count")
+        for code in xrange(len(values)):
+            items = list(s3_flatlist(values[code]))
+            if distinct:
+                items = list(set(items))
+            values[code] = items
+
+        cells = []
+        col_values = [[] for c in xrange(numcols)]
+        all_values = []
+        rows = []
+        for r in xrange(numrows):
+            row = []
+            row_values = []
+            for c in xrange(numcols):
+                items = values[r * numcols + c]
+                row.append(aggregate(items, method))
+                row_values.extend(items)
+                col_values[c].extend(items)
+                all_values.extend(items)
+            cells.append(row)
+            rows.append(aggregate(row_values, method))
+        cols = [aggregate(items, method) for items in col_values]
+
+        return cells, rows, cols, aggregate(all_values, method)
+
+    # -------------------------------------------------------------------------
+    def _typed_column(self, fact):
+        """
+            Get the values of a numeric fact as typed array, only if all
+            values are either integers or floats
+
+            @param fact: the fact (field selector)
+
+            @return: tuple (values, mask) of arrays, where mask is True
+                     for values which are not None; or None if the column
+                     can not be typed
+        """
+
+        typed = self._typed
+        if fact in typed:
+            return typed[fact]
+
+        column = self.column(fact)
+        types = set(type(value) for value in column if value is not None)
+        if types and types <= set((int, long)):
+            # Integers, unless the sum could overflow
+            limit = max(abs(value) for value in column if value is not None)
+            if limit * len(self.positions) < 2 ** 63:
+                dtype = numpy.int64
+            else:
+                dtype = None
+        elif types == set((float,)):
+            dtype = numpy.float64
+        else:
+            dtype = None
+
+        if dtype is not None:
+            data = numpy.array([value if value is not None else 0
+                                for value in column], dtype=dtype)
+            mask = numpy.array([value is not None for value in column],
+                               dtype=bool)
+            result = (data, mask)
+        else:
+            result = None
+
+        typed[fact] = result
+        return result
+
+    # -------------------------------------------------------------------------
+    def _reduce(self, typed, method):
+        """
+            Compute a sum, avg, min or max layer for a typed fact column
+
+            @param typed: tuple (values, mask), see _typed_column
+            @param method: the aggregation method
+        """
+
+        numrows = self.numrows
+        numcols = self.numcols
+
+        data, mask = typed
+        positions = self._positions
+        valid = mask[positions]
+
+        # Values and cell codes of all entries in cell order
+        values = data[positions][valid]
+        codes = self._codes[valid]
+
+        if method in ("min", "max"):
+            if len(values):
+                # Start with the opposite extreme
+                fill = values.max() if method == "min" else values.min()
+            else:
+                fill = 0
+            ufunc = numpy.minimum if method == "min" else numpy.maximum
+
+        def reduce(keys, size):
+            counts = numpy.bincount(keys, minlength=size).tolist()
+            if method in ("sum", "avg"):
+                sums = numpy.zeros(size, dtype=values.dtype)
+                numpy.add.at(sums, keys, values)
+                sums = sums.tolist()
+                if method == "sum":
+                    return sums
+                return [s / float(n) if n else 0.0
+                        for s, n in zip(sums, counts)]
+            else:
+                result = numpy.empty(size, dtype=values.dtype)
+                result.fill(fill)
+                ufunc.at(result, keys, values)
+                return [v if n else None
+                        for v, n in zip(result.tolist(), counts)]
+
+        cells = reduce(codes, numrows * numcols)
+        cells = [cells[r * numcols:(r + 1) * numcols] for r in xrange(numrows)]
+        rows = reduce(codes // numcols, numrows)
+        cols = reduce(codes % numcols, numcols)
+        total = reduce(numpy.zeros(len(codes), dtype=numpy.int64), 1)[0]
+
+        return cells, rows, cols, total
+
+    # -------------------------------------------------------------------------
+    def _factorize(self, fact):
+        """
+            Encode the distinct values of a fact as integer codes
+
+            @param fact: the fact (field selector)
+
+            @return: tuple (starts, lengths, codes, numvalues), where
+                     codes is an array of the value codes of all records
+                     (flattened, without None), and starts and lengths
+                     are arrays with the offset and number of codes per
+                     record; or None if the values are not hashable
+        """
+
+        factorized = self._factorized
+        if fact in factorized:
+            return factorized[fact]
+
+        column = self.column(fact)
+        vcodes = {}
+        starts = []
+        lengths = []
+        codes = []
+        append = codes.append
+        try:
+            for value in column:
+                starts.append(len(codes))
+                if value is None:
+                    items = ()
+                else:
+                    items = s3_flatlist([value])
+                for item in items:
+                    if item is None:
+                        continue
+                    if item not in vcodes:
+                        vcodes[item] = len(vcodes)
+                    append(vcodes[item])
+                lengths.append(len(codes) - starts[-1])
+        except TypeError:
+            # Unhashable value
+            result = None
+        else:
+            result = (numpy.array(starts, dtype=numpy.int64),
+                      numpy.array(lengths, dtype=numpy.int64),
+                      numpy.array(codes, dtype=numpy.int64),
+                      len(vcodes))
+
+        factorized[fact] = result
+        return result
+
+    # -------------------------------------------------------------------------
+    def _count(self, factorized):
+        """
+            Compute a count layer (number of distinct values per cell)
+
+            @param factorized: the factorized fact, see _factorize
+        """
+
+        numrows = self.numrows
+        numcols = self.numcols
+        size = numrows * numcols
+
+        starts, lengths, vcodes, numvalues = factorized
+        positions = self._positions
+
+        # Expand the entries into one entry per value
+        numbers = lengths[positions]
+        total = int(numbers.sum())
+        if total and numvalues:
+            codes = numpy.repeat(self._codes, numbers)
+            offsets = numpy.repeat(starts[positions] -
+                                   (numpy.cumsum(numbers) - numbers), numbers)
+            values = vcodes[offsets + numpy.arange(total)]
+
+            # Distinct values per cell
+            keys = numpy.unique(codes * numvalues + values)
+            counts = numpy.bincount(keys // numvalues, minlength=size)
+        else:
+            counts = numpy.zeros(size, dtype=numpy.int64)
+
+        matrix = counts.reshape(numrows, numcols)
+        cells = matrix.tolist()
+        rows = matrix.sum(axis=1).tolist()
+        cols = matrix.sum(axis=0).tolist()
+
+        return cells, rows, cols, int(counts.sum())
+
 # END =========================================================================
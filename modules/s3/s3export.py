@@ -33,8 +33,11 @@
 
 __all__ = ["S3Exporter"]
 
+import tempfile
+
 from gluon import current
 from gluon.storage import Storage
+from gluon.streamer import DEFAULT_CHUNK_SIZE
 
 from s3codec import S3Codec
 
@@ -77,8 +80,25 @@ class S3Exporter(object):
             response.headers["Content-Type"] = contenttype(".csv")
             response.headers["Content-disposition"] = "attachment; filename=%s" % filename
 
-        rows = resource.select(None, as_rows=True)
-        return str(rows)
+        # Write page by page into a temporary file and stream that
+        output = tempfile.TemporaryFile()
+        header = True
+        for rows in resource.iterselect(None, as_rows=True):
+            data = str(rows)
+            if header:
+                header = False
+            else:
+                # Column names only in the first page
+                data = data.split("\r\n", 1)[-1]
+            output.write(data)
+        output.seek(0)
+
+        if response:
+            return response.stream(output,
+                                   chunk_size=DEFAULT_CHUNK_SIZE,
+                                   request=request)
+        else:
+            return output.read()
 
     # -------------------------------------------------------------------------
     def json(self, resource,
@@ -100,18 +120,42 @@ class S3Exporter(object):
         if fields is None:
             fields = [f.name for f in resource.table if f.readable]
 
-        # Get the rows and return as json
-        rows = resource.select(fields,
-                               start=start,
-                               limit=limit,
-                               orderby=orderby,
-                               as_rows=True)
-
         response = current.response
         if response:
             response.headers["Content-Type"] = "application/json"
 
-        return rows.json()
+        if limit:
+            # Get the rows and return as json
+            rows = resource.select(fields,
+                                   start=start,
+                                   limit=limit,
+                                   orderby=orderby,
+                                   as_rows=True)
+            return rows.json()
+
+        # Complete export: write page by page into a temporary file
+        # and stream that (joining the JSON arrays of all pages)
+        output = tempfile.TemporaryFile()
+        output.write("[")
+        empty = True
+        for rows in resource.iterselect(fields,
+                                        orderby=orderby,
+                                        as_rows=True):
+            data = rows.json()[1:-1]
+            if data:
+                if not empty:
+                    output.write(", ")
+                output.write(data)
+                empty = False
+        output.write("]")
+        output.seek(0)
+
+        if response:
+            return response.stream(output,
+                                   chunk_size=DEFAULT_CHUNK_SIZE,
+                                   request=current.request)
+        else:
+            return output.read()
 
     # -------------------------------------------------------------------------
     def pdf(self, *args, **kwargs):
@@ -31,9 +31,17 @@
 
 import datetime
 import sys
+import threading
+import time
 from itertools import chain
 from uuid import uuid4
 
+try:
+    from collections import OrderedDict
+except:
+    # Python 2.6
+    from gluon.contrib.simplejson.ordered_dict import OrderedDict
+
 from gluon import *
 # Here are dependencies listed for reference:
 #from gluon import current
@@ -188,6 +196,257 @@ class S3ReusableField(object):
         else:
             return Field(name, self.__type, **ia)
 
+# =============================================================================
+class S3RepresentCache(object):
+    """
+        Cache for looked-up field representations, shared between all
+        S3Represent instances and requests in the same process.
+
+        Entries are keyed by the representation key (see S3Represent,
+        starts with the lookup tablename) and the value, expire after
+        a time-to-live, and the least recently used entries get
+        discarded when the maximum size is exceeded.
+
+        Changes in a lookup table invalidate its entries immediately
+        (through table callbacks, see bind), changes made by other
+        processes or in other tables take effect after the TTL.
+    """
+
+    def __init__(self, size=10000, ttl=300):
+        """
+            Constructor
+
+            @param size: maximum number of entries
+            @param ttl: time-to-live of entries (seconds)
+        """
+
+        self.size = size
+        self.ttl = ttl
+
+        # {(rkey, value): (expires, representation)}
+        self.entries = OrderedDict()
+        # {tablename: {rkey: set of values}}
+        self.index = {}
+
+        self.lock = threading.Lock()
+        self.reset_stats()
+
+    # -------------------------------------------------------------------------
+    def reset_stats(self):
+        """ Reset the hit-rate counters """
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.invalidations = 0
+        # {tablename: [hits, misses]}
+        self.table_stats = {}
+
+    # -------------------------------------------------------------------------
+    def stats(self):
+        """
+            Get the current counters, e.g. to size the cache
+
+            @return: a dict with the counters, the overall hit rate and
+                     the hits/misses per lookup table
+        """
+
+        hits = self.hits
+        lookups = hits + self.misses
+        return {"size": len(self.entries),
+                "hits": hits,
+                "misses": self.misses,
+                "hit_rate": float(hits) / lookups if lookups else None,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+                "invalidations": self.invalidations,
+                "tables": dict((tn, {"hits": c[0], "misses": c[1]})
+                               for tn, c in self.table_stats.items()),
+                }
+
+    # -------------------------------------------------------------------------
+    def get(self, rkey, values):
+        """
+            Look up cached representations
+
+            @param rkey: the representation key, a tuple
+                         (tablename, hierarchy, key, ...), see S3Represent
+            @param values: the values to look up
+
+            @return: dict {value: representation} of the values found
+        """
+
+        items = {}
+
+        entries = self.entries
+        now = time.time()
+        with self.lock:
+            for value in values:
+                key = (rkey, value)
+                entry = entries.pop(key, None)
+                if entry is None:
+                    continue
+                if entry[0] < now:
+                    self.__unindex(key)
+                    self.expirations += 1
+                    continue
+                # Re-insert as most recently used
+                entries[key] = entry
+                items[value] = entry[1]
+
+            hits = len(items)
+            misses = len(values) - hits
+            self.hits += hits
+            self.misses += misses
+            counters = self.table_stats.get(rkey[0])
+            if counters is None:
+                counters = self.table_stats[rkey[0]] = [0, 0]
+            counters[0] += hits
+            counters[1] += misses
+        return items
+
+    # -------------------------------------------------------------------------
+    def put(self, rkey, items):
+        """
+            Add representations to the cache
+
+            @param rkey: the representation key
+            @param items: dict {value: representation}
+        """
+
+        size = self.size
+        if not size or not items:
+            return
+
+        entries = self.entries
+        expires = time.time() + self.ttl
+        with self.lock:
+            index = self.index.setdefault(rkey[0], {}) \
+                              .setdefault(rkey, set())
+            for value, representation in items.items():
+                if type(representation) is lazyT:
+                    # Translate now, the lazyT belongs to this request
+                    representation = s3_unicode(representation)
+                key = (rkey, value)
+                entries.pop(key, None)
+                entries[key] = (expires, representation)
+                index.add(value)
+            while len(entries) > size:
+                key = entries.popitem(last=False)[0]
+                self.__unindex(key)
+                self.evictions += 1
+        return
+
+    # -------------------------------------------------------------------------
+    def invalidate(self, tablename, values=None, pkey="id"):
+        """
+            Remove the representations of records in a lookup table
+
+            @param tablename: the lookup tablename
+            @param values: the record IDs (None for all records); all
+                           representations of the table which are keyed
+                           by another field, or which are hierarchical
+                           (contain the representations of the ancestors)
+                           are removed regardless
+            @param pkey: the name of the primary key of the table
+        """
+
+        entries = self.entries
+        with self.lock:
+            index = self.index.get(tablename)
+            if not index:
+                return
+            for rkey, keys in index.items():
+                if values is None or rkey[1] or rkey[2] != pkey:
+                    remove = list(keys)
+                else:
+                    remove = [v for v in values if v in keys]
+                for value in remove:
+                    if entries.pop((rkey, value), None) is not None:
+                        self.invalidations += 1
+                    keys.discard(value)
+                if not keys:
+                    del index[rkey]
+            if not index:
+                del self.index[tablename]
+        return
+
+    # -------------------------------------------------------------------------
+    def clear(self):
+        """ Remove all entries """
+
+        with self.lock:
+            self.entries.clear()
+            self.index.clear()
+        return
+
+    # -------------------------------------------------------------------------
+    def __unindex(self, key):
+        """
+            Remove an entry from the index (caller must hold the lock)
+
+            @param key: the entry key (rkey, value)
+        """
+
+        rkey, value = key
+        tablename = rkey[0]
+        index = self.index.get(tablename)
+        if index and rkey in index:
+            keys = index[rkey]
+            keys.discard(value)
+            if not keys:
+                del index[rkey]
+                if not index:
+                    del self.index[tablename]
+        return
+
+    # -------------------------------------------------------------------------
+    def bind(self, table):
+        """
+            Install table callbacks to invalidate the cached representations
+            of updated (incl. "deleted"-flagged) and deleted records (and of
+            inserted records, in case the database re-uses record IDs), can
+            be called repeatedly. Table callbacks are used rather than
+            onaccept/ondelete since those are not run on every write path
+            (e.g. direct DAL updates, merges).
+
+            @param table: the lookup table
+        """
+
+        for hook in table._before_update:
+            if getattr(hook, "s3represent", False):
+                # Already bound
+                return
+
+        tablename = table._tablename
+        pkey = table._id.name
+        invalidate = self.invalidate
+
+        def after_insert(fields, record_id):
+            if record_id and tablename in self.index:
+                invalidate(tablename, [record_id], pkey=pkey)
+        after_insert.s3represent = True
+
+        def before_write(dbset, fields=None):
+            if tablename in self.index:
+                # Invalidate before the update changes the set
+                rows = dbset.select(table._id)
+                invalidate(tablename,
+                           [row[table._id] for row in rows],
+                           pkey=pkey)
+            # Must not return True (would cancel the update/deletion)
+            return None
+        before_write.s3represent = True
+
+        table._after_insert.append(after_insert)
+        table._before_update.append(before_write)
+        table._before_delete.append(before_write)
+        return
+
+# Process-wide instance
+represent_cache = S3RepresentCache()
+
 # =============================================================================
 class S3Represent(object):
     """
@@ -204,8 +463,14 @@ class S3Represent(object):
                                                     represent_row,
                                                     link
         @group Internal Methods: _setup,
-                                 _lookup
+                                 _lookup,
+                                 _cachekey
     """
+
+    # Names of instance attributes (other than the constructor parameters
+    # of this class) which change the representation of a value; subclasses
+    # must declare these to share their representations via the cache
+    CACHE_OPTIONS = ()
     
     def __init__(self,
                  lookup=None,
@@ -220,7 +485,8 @@ class S3Represent(object):
                  hierarchy=False,
                  default=None,
                  none=None,
-                 field_sep=" "
+                 field_sep=" ",
+                 cache=None
                  ):
         """
             Constructor
@@ -244,6 +510,11 @@ class S3Represent(object):
             @param default: default representation for unknown options
             @param none: representation for empty fields (None or empty list)
             @param field_sep: separator to use to join fields
+            @param cache: share looked-up representations between requests
+                          (see S3RepresentCache), None to share them unless
+                          labels is a callable or the subclass does not
+                          declare its CACHE_OPTIONS, True to share them
+                          regardless, False to not share them
         """
 
         self.tablename = lookup
@@ -260,6 +531,8 @@ class S3Represent(object):
         self.default = default
         self.none = none
         self.field_sep = field_sep
+        self.cache = cache
+        self.rkey = None
         self.setup = False
         self.theset = None
         self.queries = 0
@@ -576,9 +849,60 @@ class S3Represent(object):
         else:
             self.htemplate = "%s > %s"
 
+        # Shared representation cache
+        self.rkey = self._cachekey()
+        if self.rkey:
+            represent_cache.bind(self.table)
+
         self.setup = True
         return
 
+    # -------------------------------------------------------------------------
+    def _cachekey(self):
+        """
+            Get the key for the representations of this instance in the
+            shared cache, to be called from _setup
+
+            @return: the key, or None if the representations can not be
+                     shared
+        """
+
+        cache = self.cache
+        table = self.table
+        if cache is False or table is None:
+            return None
+        cls = type(self)
+        if cache is None and \
+           (self.clabels or "CACHE_OPTIONS" not in cls.__dict__):
+            # Representation may depend on unknown parameters
+            return None
+
+        settings = current.deployment_settings
+        size = settings.get_base_represent_cache_size()
+        if not size:
+            return None
+        represent_cache.size = size
+        represent_cache.ttl = settings.get_base_represent_cache_ttl()
+
+        labels = self.labels
+        if self.clabels:
+            labels = getattr(labels, "__name__", None)
+        fields = self.fields
+        return (table._tablename,
+                self.htemplate if self.hierarchy else None,
+                self.key,
+                "%s.%s" % (cls.__module__, cls.__name__),
+                tuple(fields) if fields else None,
+                labels,
+                self.field_sep,
+                s3_unicode(self.default),
+                s3_unicode(self.none),
+                bool(self.translate),
+                current.T.accepted_language,
+                tuple(getattr(self, name, None)
+                      for name in cls.CACHE_OPTIONS),
+                )
+
     # -------------------------------------------------------------------------
     def _lookup(self, values, rows=None):
         """
@@ -607,23 +931,32 @@ class S3Represent(object):
         if table is None or not lookup:
             return items
 
+        # Check whether values are in the shared cache
+        rkey = self.rkey
+        if rkey:
+            cached = represent_cache.get(rkey, lookup.keys())
+            for k, v in cached.items():
+                items[k] = theset[k] = v
+                del lookup[k]
+            if not lookup:
+                return items
+
         if table and self.hierarchy:
             # Does the lookup table have a hierarchy?
             from s3hierarchy import S3Hierarchy
             h = S3Hierarchy(table._tablename)
             if h.config:
-                def lookup_parent(node_id):
-                    parent = h.parent(node_id)
-                    if parent and parent not in theset:
-                        lookup[parent] = True
-                        lookup_parent(parent)
-                    return
+                # Look up all ancestors which are not yet in theset
+                parents = h.parents(lookup.keys())
                 for node_id in lookup.keys():
-                    lookup_parent(node_id)
+                    parent = parents.get(node_id)
+                    while parent and parent not in theset:
+                        lookup[parent] = True
+                        parent = parents.get(parent)
             else:
-                h = None
+                parents = None
         else:
-            h = None
+            parents = None
 
         # Get the primary key
         pkey = self.key
@@ -660,17 +993,22 @@ class S3Represent(object):
             else:
                 fields = []
             rows = self.lookup_rows(key, lookup.keys(), fields=fields)
-            if h:
+            found = {}
+            if parents is not None:
                 rows = dict((row[key], row) for row in rows)
                 represent_path = self._represent_path
                 for k, row in rows.items():
                     lookup.pop(k, None)
-                    items[k] = represent_path(k, row, rows=rows, hierarchy=h)
+                    items[k] = found[k] = represent_path(k, row,
+                                                         rows=rows,
+                                                         parents=parents)
             else:
                 for row in rows:
                     k = row[key]
                     lookup.pop(k, None)
-                    items[k] = theset[k] = represent_row(row)
+                    items[k] = theset[k] = found[k] = represent_row(row)
+            if rkey:
+                represent_cache.put(rkey, found)
 
         if lookup:
             for k in lookup:
@@ -680,7 +1018,7 @@ class S3Represent(object):
         return items
 
     # -------------------------------------------------------------------------
-    def _represent_path(self, value, row, rows=None, hierarchy=None):
+    def _represent_path(self, value, row, rows=None, parents=None):
         """
             Recursive helper method to represent value as path in
             a hierarchy.
@@ -688,7 +1026,8 @@ class S3Represent(object):
             @param value: the value
             @param row: the row containing the value
             @param rows: all rows from _loopup as dict
-            @param hierarchy: the S3Hierarchy instance
+            @param parents: the parent nodes as dict {node_id: parent_id},
+                            see S3Hierarchy.parents
         """
 
         theset = self.theset
@@ -699,8 +1038,8 @@ class S3Represent(object):
         represent_row = self.represent_row
 
         prefix = None
-        parent = hierarchy.parent(value)
-        
+        parent = parents.get(value)
+
         if parent:
             if parent in theset:
                 prefix = theset[parent]
@@ -708,7 +1047,7 @@ class S3Represent(object):
                 prefix = self._represent_path(parent,
                                               rows[parent],
                                               rows=rows,
-                                              hierarchy=hierarchy)
+                                              parents=parents)
 
         result = self.represent_row(row, prefix=prefix)
         theset[value] = result
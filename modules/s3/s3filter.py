@@ -1505,7 +1505,9 @@ class S3HierarchyFilter(S3FilterWidget):
 
     _class = "hierarchy-filter"
 
-    operator = "belongs"
+    # Selected nodes include their descendants (the widget submits only
+    # the top-most selected nodes)
+    operator = "typeof"
 
     # -------------------------------------------------------------------------
     def widget(self, resource, values):
@@ -2591,9 +2593,11 @@ class S3FilterString(object):
             query.BELONGS: (query.NE, vor, T("%(label)s = %(values)s")),
             query.CONTAINS: ("notall", vand, T("%(label)s contains %(values)s")),
             query.ANYOF: ("notany", vor, T("%(label)s contains any of %(values)s")),
+            query.TYPEOF: ("nottypeof", vor, T("%(label)s is a type of %(values)s")),
             "notall": (query.CONTAINS, vand, T("%(label)s does not contain %(values)s")),
             "notany": (query.ANYOF, vor, T("%(label)s does not contain %(values)s")),
-            "notlike": (query.LIKE, vor, T("%(label)s not like %(values)s"))
+            "notlike": (query.LIKE, vor, T("%(label)s not like %(values)s")),
+            "nottypeof": (query.TYPEOF, vand, T("%(label)s is not a type of %(values)s"))
         }
 
         # Quote values as necessary
@@ -32,12 +32,22 @@
 __all__ = ["GIS",
            "S3Map",
            "S3ExportPOI",
+           "S3GeoJSONCache",
+           "S3GeoJSONEncoder",
            "S3ImportPOI",
+           "S3PostGIS",
+           "S3SpatialIndex",
            ]
 
+import cPickle
+import hashlib
+import math
 import os
 import re
 import sys
+import threading
+import time
+import weakref
 #import logging
 import urllib           # Needed for urlencoding
 import urllib2          # Needed for quoting & error handling on fetch
@@ -82,7 +92,7 @@ from s3fields import s3_all_meta_field_names
 from s3rest import S3Method
 from s3track import S3Trackable
 from s3track import S3Trackable
-from s3utils import s3_debug, s3_fullname, s3_fullname_bulk, s3_has_foreign_key, s3_include_ext, s3_unicode
+from s3utils import s3_debug, s3_fullname, s3_fullname_bulk, s3_get_foreign_key, s3_has_foreign_key, s3_include_ext, s3_unicode
 
 DEBUG = False
 if DEBUG:
@@ -1734,14 +1744,27 @@ class GIS(object):
             query &= (table.deleted == False)
         # @ToDo: Check AAA (do this as a resource filter?)
 
+        settings = current.deployment_settings
+        if settings.get_gis_spatialdb():
+            # Use PostGIS routine
+            query &= (locations.id.belongs(S3PostGIS(db).polygon(wkt)))
+            return db(query).select(locations.wkt,
+                                    locations.lat,
+                                    locations.lon,
+                                    table.ALL)
+
+        index = S3SpatialIndex.get()
+        if index is not None:
+            # Restrict to the candidates from the spatial index, and
+            # check only their geometries
+            query &= index.query(*polygon.bounds)
+            lon_min = None
+
         features = db(query).select(locations.wkt,
                                     locations.lat,
                                     locations.lon,
                                     table.ALL)
         output = Rows()
-        # @ToDo: provide option to use PostGIS/Spatialite
-        # settings = current.deployment_settings
-        # if settings.gis.spatialdb and settings.database.db_type == "postgres":
         if lon_min is None:
             # We have no BBOX so go straight to the full geometry check
             for row in features:
@@ -1805,71 +1828,35 @@ class GIS(object):
             Unused
         """
 
-        import math
-
         db = current.db
         settings = current.deployment_settings
 
+        # shortcut
+        locations = db.gis_location
+        fields = [locations.id,
+                  locations.name,
+                  locations.level,
+                  locations.lat,
+                  locations.lon,
+                  locations.lat_min,
+                  locations.lon_min,
+                  locations.lat_max,
+                  locations.lon_max,
+                  ]
+
         if settings.gis.spatialdb and settings.database.db_type == "postgres":
             # Use PostGIS routine
             # The ST_DWithin function call will automatically include a bounding box comparison that will make use of any indexes that are available on the geometries.
             # @ToDo: Support optional Category (make this a generic filter?)
 
-            import psycopg2
-            import psycopg2.extras
-
-            dbname = settings.database.database
-            username = settings.database.username
-            password = settings.database.password
-            host = settings.database.host
-            port = settings.database.port or "5432"
-
-            # Convert km to degrees (since we're using the_geom not the_geog)
-            radius = math.degrees(float(radius) / RADIUS_EARTH)
-
-            connection = psycopg2.connect("dbname=%s user=%s password=%s host=%s port=%s" % (dbname, username, password, host, port))
-            cursor = connection.cursor(cursor_factory=psycopg2.extras.DictCursor)
-            info_string = "SELECT column_name, udt_name FROM information_schema.columns WHERE table_name = 'gis_location' or table_name = '%s';" % tablename
-            cursor.execute(info_string)
-            # @ToDo: Look at more optimal queries for just those fields we need
+            query = (locations.id.belongs(S3PostGIS(db).radius(lat, lon, radius)))
             if tablename:
                 # Lookup the resource
-                query_string = cursor.mogrify("SELECT * FROM gis_location, %s WHERE %s.location_id = gis_location.id and ST_DWithin (ST_GeomFromText ('POINT (%s %s)', 4326), the_geom, %s);" % (tablename, tablename, lat, lon, radius))
-            else:
-                # Lookup the raw Locations
-                query_string = cursor.mogrify("SELECT * FROM gis_location WHERE ST_DWithin (ST_GeomFromText ('POINT (%s %s)', 4326), the_geom, %s);" % (lat, lon, radius))
-
-            cursor.execute(query_string)
-            # @ToDo: Export Rows?
-            features = []
-            for record in cursor:
-                d = dict(record.items())
-                row = Storage()
-                # @ToDo: Optional support for Polygons
-                if tablename:
-                    row.gis_location = Storage()
-                    row.gis_location.id = d["id"]
-                    row.gis_location.lat = d["lat"]
-                    row.gis_location.lon = d["lon"]
-                    row.gis_location.lat_min = d["lat_min"]
-                    row.gis_location.lon_min = d["lon_min"]
-                    row.gis_location.lat_max = d["lat_max"]
-                    row.gis_location.lon_max = d["lon_max"]
-                    row[tablename] = Storage()
-                    row[tablename].id = d["id"]
-                    row[tablename].name = d["name"]
-                else:
-                    row.name = d["name"]
-                    row.id = d["id"]
-                    row.lat = d["lat"]
-                    row.lon = d["lon"]
-                    row.lat_min = d["lat_min"]
-                    row.lon_min = d["lon_min"]
-                    row.lat_max = d["lat_max"]
-                    row.lon_max = d["lon_max"]
-                features.append(row)
-
-            return features
+                table = current.s3db[tablename]
+                query &= (table.location_id == locations.id)
+                fields.insert(0, table.ALL)
+            # @ToDo: Optional support for Polygons
+            return db(query).select(*fields)
 
         #elif settings.database.db_type == "mysql":
             # Do the calculation in MySQL to pull back only the relevant rows
@@ -1932,39 +1919,22 @@ class GIS(object):
             maxLat = degrees(maxLat)
             maxLon = degrees(maxLon)
 
-            # shortcut
-            locations = db.gis_location
-
             query = (locations.lat > minLat) & (locations.lat < maxLat) & (locations.lon > minLon) & (locations.lon < maxLon)
             deleted = (locations.deleted == False)
             empty = (locations.lat != None) & (locations.lon != None)
             query = deleted & empty & query
 
+            index = S3SpatialIndex.get()
+            if index is not None:
+                # Restrict to the candidates from the spatial index
+                query &= index.query(minLon, minLat, maxLon, maxLat)
+
             if tablename:
                 # Lookup the resource
                 table = current.s3db[tablename]
                 query &= (table.location_id == locations.id)
-                records = db(query).select(table.ALL,
-                                           locations.id,
-                                           locations.name,
-                                           locations.level,
-                                           locations.lat,
-                                           locations.lon,
-                                           locations.lat_min,
-                                           locations.lon_min,
-                                           locations.lat_max,
-                                           locations.lon_max)
-            else:
-                # Lookup the raw Locations
-                records = db(query).select(locations.id,
-                                           locations.name,
-                                           locations.level,
-                                           locations.lat,
-                                           locations.lon,
-                                           locations.lat_min,
-                                           locations.lon_min,
-                                           locations.lat_max,
-                                           locations.lon_max)
+                fields.insert(0, table.ALL)
+            records = db(query).select(*fields)
             features = Rows()
             for record in records:
                 # Calculate the Great Circle distance
@@ -2075,6 +2045,50 @@ class GIS(object):
 
         return marker
 
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def get_markers(resource, marker_fn):
+        """
+            Returns the per-feature Markers for the records of a resource
+            - called by get_location_data() for resources with a marker_fn
+
+            The marker_fn is called with each record and should return the
+            name of the Marker to use (the style key): all distinct names
+            get looked up together, in a single query, rather than once
+            per record. Marker dicts/Rows returned by the marker_fn (as by
+            older marker_fns) are used as they are.
+
+            @param resource: the S3Resource (with the records loaded)
+            @param marker_fn: the marker_fn configured for the table
+
+            @return: dict {record_id: marker}
+        """
+
+        pkey = resource.table._id.name
+
+        markers = {}
+        names = {}
+        for record in resource:
+            marker = marker_fn(record)
+            if isinstance(marker, basestring):
+                names[record[pkey]] = marker
+            else:
+                markers[record[pkey]] = marker
+
+        if names:
+            mtable = current.s3db.gis_marker
+            query = (mtable.name.belongs(set(names.values())))
+            rows = current.db(query).select(mtable.name,
+                                            mtable.image,
+                                            mtable.height,
+                                            mtable.width,
+                                            cache=current.s3db.cache)
+            lookup = dict((row.name, row) for row in rows)
+            for record_id, name in names.items():
+                markers[record_id] = lookup.get(name)
+
+        return markers
+
     # -------------------------------------------------------------------------
     @staticmethod
     def get_location_data(resource):
@@ -2248,8 +2262,7 @@ class GIS(object):
                 # Add a per-feature Marker
                 marker_fn = s3db.get_config(tablename, "marker_fn")
                 if marker_fn:
-                    for record in resource:
-                        markers[record[pkey]] = marker_fn(record)
+                    markers = GIS.get_markers(resource, marker_fn)
                 else:
                     # No configuration found so use default marker for all
                     c, f = tablename.split("_", 1)
@@ -2261,8 +2274,7 @@ class GIS(object):
             marker_fn = s3db.get_config(tablename, "marker_fn")
             if marker_fn:
                 # Add a per-feature Marker
-                for record in resource:
-                    markers[record[pkey]] = marker_fn(record)
+                markers = GIS.get_markers(resource, marker_fn)
             else:
                 # No configuration found so use default marker for all
                 c, f = tablename.split("_", 1)
@@ -2327,25 +2339,39 @@ class GIS(object):
                         for row in rows:
                             wkts[row[tablename].id] = row.wkt
                 else:
-                    rows = db(query).select(table.id,
-                                            gtable.wkt)
-                    simplify = GIS.simplify
+                    simplified = None
                     if format == "geojson":
-                        for row in rows:
-                            # Simplify the polygon to reduce download size
-                            geojson = simplify(row["gis_location"].wkt,
-                                               tolerance=tolerance,
-                                               output="geojson")
-                            if geojson:
-                                geojsons[row[tablename].id] = geojson
-                    else:
-                        for row in rows:
-                            # Simplify the polygon to reduce download size
-                            # & also to work around the recursion limit in libxslt
-                            # http://blog.gmane.org/gmane.comp.python.lxml.devel/day=20120309
-                            wkt = simplify(row["gis_location"].wkt)
-                            if wkt:
-                                wkts[row[tablename].id] = wkt
+                        # Use the precomputed simplified Polygons
+                        rows = db(query).select(table.id,
+                                                gtable.id)
+                        location_ids = [row["gis_location"].id for row in rows]
+                        simplified = GIS.get_simplified(location_ids,
+                                                        tolerance)
+                        if simplified is not None:
+                            for row in rows:
+                                geojson = simplified.get(row["gis_location"].id)
+                                if geojson:
+                                    geojsons[row[tablename].id] = geojson
+                    if simplified is None:
+                        rows = db(query).select(table.id,
+                                                gtable.wkt)
+                        simplify = GIS.simplify
+                        if format == "geojson":
+                            for row in rows:
+                                # Simplify the polygon to reduce download size
+                                geojson = simplify(row["gis_location"].wkt,
+                                                   tolerance=tolerance,
+                                                   output="geojson")
+                                if geojson:
+                                    geojsons[row[tablename].id] = geojson
+                        else:
+                            for row in rows:
+                                # Simplify the polygon to reduce download size
+                                # & also to work around the recursion limit in libxslt
+                                # http://blog.gmane.org/gmane.comp.python.lxml.devel/day=20120309
+                                wkt = simplify(row["gis_location"].wkt)
+                                if wkt:
+                                    wkts[row[tablename].id] = wkt
 
             else:
                 # Points
@@ -2388,6 +2414,10 @@ class GIS(object):
 
             Called by S3REST: S3Resource.export_tree()
 
+            The simplified polygons of all features in the layer are kept
+            in an S3GeoJSONCache, which gets a new version whenever the
+            layer is updated.
+
             @ToDo: Vary simplification level & precision by Zoom level
                    - store this in the style?
         """
@@ -2400,45 +2430,62 @@ class GIS(object):
         fields = []
         fappend = fields.append
         for f in table.fields:
-            if f not in ("layer_id", "lat", "lon"):
+            if f not in ("layer_id", "lat", "lon", "wkt", "the_geom"):
                 fappend(f)
 
-        attributes = {}
-        geojsons = {}
         settings = current.deployment_settings
         tolerance = settings.get_gis_simplify_tolerance()
-        if settings.get_gis_spatialdb():
-            # Do the Simplify & GeoJSON direct from the DB
-            fields.remove("the_geom")
-            fields.remove("wkt")
-            _fields = [table[f] for f in fields]
-            rows = db(query).select(table.the_geom.st_simplify(tolerance).st_asgeojson(precision=4).with_alias("geojson"),
-                                    *_fields)
-            for row in rows:
-                _row = row[tablename]
-                id = _row.id
-                geojsons[id] = row.geojson
-                _attributes = {}
-                for f in fields:
-                    if f not in ("id"):
-                        _attributes[f] = _row[f]
-                attributes[id] = _attributes
-        else:
-            _fields = [table[f] for f in fields]
-            rows = db(query).select(*_fields)
-            simplify = GIS.simplify
-            for row in rows:
-                # Simplify the polygon to reduce download size
-                geojson = simplify(row.wkt, tolerance=tolerance,
-                                   output="geojson")
-                id = row.id
-                if geojson:
-                    geojsons[id] = geojson
-                _attributes = {}
-                for f in fields:
-                    if f not in ("id", "wkt"):
-                        _attributes[f] = row[f]
-                attributes[id] = _attributes
+        spatial = settings.get_gis_spatialdb()
+
+        ltable = current.s3db.gis_layer_shapefile
+        layer = db(ltable.id == id).select(ltable.modified_on,
+                                           limitby=(0, 1)).first()
+        cache = S3GeoJSONCache(tablename,
+                               layer and layer.modified_on,
+                               db(table.id > 0).count(),
+                               tolerance,
+                               spatial)
+        cache.check_etag()
+        geojsons = cache.get()
+
+        if geojsons is None:
+            # Simplify the polygons of all features in the layer (not just
+            # those matching the query, since the version is the same for
+            # all queries)
+            geojsons = {}
+            everything = (table.id > 0)
+            if spatial:
+                # Do the Simplify & GeoJSON direct from the DB
+                geojson = table.the_geom.st_simplify(tolerance) \
+                                        .st_asgeojson(precision=4) \
+                                        .with_alias("geojson")
+                rows = db(everything).select(table.id, geojson)
+                for row in rows:
+                    if row.geojson:
+                        geojsons[row[tablename].id] = row.geojson
+            else:
+                simplify = GIS.simplify
+                rows = db(everything).select(table.id, table.wkt)
+                for row in rows:
+                    # Simplify the polygon to reduce download size
+                    geojson = simplify(row.wkt, tolerance=tolerance,
+                                       output="geojson")
+                    if geojson:
+                        geojsons[row.id] = geojson
+            cache.put(geojsons)
+
+        # Attributes of the features matching the query
+        rows = db(query).select(*[table[f] for f in fields])
+        attributes = {}
+        for row in rows:
+            id = row.id
+            _attributes = {}
+            for f in fields:
+                if f not in ("id"):
+                    _attributes[f] = row[f]
+            attributes[id] = _attributes
+        geojsons = dict((id, geojsons[id])
+                        for id in attributes if id in geojsons)
 
         _attributes = {}
         _attributes[tablename] = attributes
@@ -2457,31 +2504,24 @@ class GIS(object):
 
             Called by S3REST: S3Resource.export_tree()
 
+            Uses the precomputed simplified polygons (see update_simplified),
+            and keeps the result in an S3GeoJSONCache per layer, which gets
+            a new version whenever the selection of theme data, the theme
+            data or their locations are updated.
+
             @ToDo: Vary precision by Lx
                    - store this (& tolerance map) in the style?
         """
 
+        db = current.db
         s3db = current.s3db
         tablename = "gis_theme_data"
         table = s3db.gis_theme_data
         gtable = s3db.gis_location
-        query = (table.id.belongs(resource._ids)) & \
+        ids = sorted(resource._ids)
+        query = (table.id.belongs(ids)) & \
                 (table.location_id == gtable.id)
 
-        geojsons = {}
-        # @ToDo: How to get the tolerance to vary by level?
-        #        - add Stored Procedure?
-        #if current.deployment_settings.get_gis_spatialdb():
-        #    # Do the Simplify & GeoJSON direct from the DB
-        #    rows = current.db(query).select(table.id,
-        #                                    gtable.the_geom.st_simplify(0.01).st_asgeojson(precision=4).with_alias("geojson"))
-        #    for row in rows:
-        #        geojsons[row["gis_theme_data.id"]] = row.geojson
-        #else:
-        rows = current.db(query).select(table.id,
-                                        gtable.level,
-                                        gtable.wkt)
-        simplify = GIS.simplify
         tolerance = {"L0": 0.01,
                      "L1": 0.005,
                      "L2": 0.00125,
@@ -2489,14 +2529,70 @@ class GIS(object):
                      "L4": 0.0003125,
                      "L5": 0.00015625,
                      }
-        for row in rows:
-            grow = row.gis_location
-            # Simplify the polygon to reduce download size
-            geojson = simplify(grow.wkt,
-                               tolerance=tolerance[grow.level],
-                               output="geojson")
-            if geojson:
-                geojsons[row["gis_theme_data.id"]] = geojson
+
+        data_modified = table.modified_on.max()
+        location_modified = gtable.modified_on.max()
+        first_layer = table.layer_theme_id.min()
+        last_layer = table.layer_theme_id.max()
+        row = db(query).select(data_modified,
+                               location_modified,
+                               first_layer,
+                               last_layer).first()
+
+        # One cache file per layer (the selected records are part
+        # of the version, so other selections overwrite the file)
+        if row and row[first_layer] and row[first_layer] == row[last_layer]:
+            name = "%s_%s" % (tablename, row[first_layer])
+        else:
+            name = tablename
+        digest = hashlib.md5(",".join(str(i) for i in ids)).hexdigest()
+        cache = S3GeoJSONCache(name,
+                               digest,
+                               row and row[data_modified],
+                               row and row[location_modified],
+                               current.deployment_settings.get_gis_simplify_tiers())
+        cache.check_etag()
+        geojsons = cache.get()
+
+        if geojsons is None:
+            # @ToDo: How to get the tolerance to vary by level?
+            #        - add Stored Procedure?
+            #if current.deployment_settings.get_gis_spatialdb():
+            #    # Do the Simplify & GeoJSON direct from the DB
+            #    rows = current.db(query).select(table.id,
+            #                                    gtable.the_geom.st_simplify(0.01).st_asgeojson(precision=4).with_alias("geojson"))
+            #    for row in rows:
+            #        geojsons[row["gis_theme_data.id"]] = row.geojson
+            #else:
+            rows = db(query).select(table.id,
+                                    gtable.id,
+                                    gtable.level)
+            levels = {}
+            for row in rows:
+                levels.setdefault(row.gis_location.level, []).append(row)
+
+            geojsons = {}
+            simplify = GIS.simplify
+            get_simplified = GIS.get_simplified
+            for level, rows in levels.items():
+                _tolerance = tolerance[level]
+                location_ids = [row.gis_location.id for row in rows]
+                simplified = get_simplified(location_ids, _tolerance)
+                if simplified is None:
+                    # No precomputed tier available
+                    simplified = {}
+                    wkts = db(gtable.id.belongs(location_ids)).select(gtable.id,
+                                                                      gtable.wkt)
+                    for grow in wkts:
+                        # Simplify the polygon to reduce download size
+                        simplified[grow.id] = simplify(grow.wkt,
+                                                       tolerance=_tolerance,
+                                                       output="geojson")
+                for row in rows:
+                    geojson = simplified.get(row.gis_location.id)
+                    if geojson:
+                        geojsons[row["gis_theme_data.id"]] = geojson
+            cache.put(geojsons)
 
         _geojsons = {}
         _geojsons[tablename] = geojsons
@@ -3449,6 +3545,7 @@ class GIS(object):
         parentEdenCodeField = layer["parentEdenCodeField"]
         parentCodeQuery = (ttable.tag == parentEdenCodeField)
         count = 0
+        new_ids = []
         for row in rows:
             # Read Attributes
             feat = lyr[count]
@@ -3501,6 +3598,7 @@ class GIS(object):
                                       lat=lat,
                                       lon=lon,
                                       parent=parent.id)
+                    new_ids.append(id)
                     ttable.insert(location_id = id,
                                   tag = edenCodeField,
                                   value = code)
@@ -3526,6 +3624,7 @@ class GIS(object):
                                       gis_feature_type=gis_feature_type,
                                       wkt=wkt,
                                       parent=parent.id)
+                    new_ids.append(id)
                     ttable.insert(location_id = id,
                                   tag = edenCodeField,
                                   value = code)
@@ -3544,7 +3643,7 @@ class GIS(object):
 
         s3_debug("Updating Location Tree...")
         try:
-            self.update_location_tree()
+            self.update_location_tree_bulk(new_ids)
         except MemoryError:
             # If doing all L2s, it can break memory limits
             # @ToDo: Check now that we're doing by level
@@ -3851,6 +3950,7 @@ class GIS(object):
 
         # Parse File
         current_row = 0
+        new_ids = []
         for line in f:
             current_row += 1
             # Format of file: http://download.geonames.org/export/dump/readme.txt
@@ -3918,12 +4018,19 @@ class GIS(object):
                                       lon_max=lon_max,
                                       lat_min=lat_min,
                                       lat_max=lat_max)
+                new_ids.append(new_id)
                 ttable.insert(location_id=new_id,
                               tag="geonames",
                               value=geonames_id)
             else:
                 continue
 
+        db.commit()
+
+        s3_debug("Updating Location Tree...")
+        self.update_location_tree_bulk(new_ids)
+        db.commit()
+
         s3_debug("All done!")
         return
 
@@ -4028,26 +4135,8 @@ class GIS(object):
                 db(table.id == feature.id).update(**_vars)
 
         if not feature:
-            # Do the whole database
-            # Do in chunks to save memory and also do in correct order
-            fields = [table.id, table.name, table.gis_feature_type,
-                      table.L0, table.L1, table.L2, table.L3, table.L4,
-                      table.lat, table.lon, table.wkt, table.inherited,
-                      # Handle Countries which start with Bounds set, yet are Points
-                      table.lat_min, table.lon_min, table.lat_max, table.lon_max,
-                      table.path, table.parent]
-            update_location_tree = GIS.update_location_tree
-            for level in ["L0", "L1", "L2", "L3", "L4", "L5", None]:
-                features = db(table.level == level).select(*fields)
-                for feature in features:
-                    feature["level"] = level
-                    wkt = feature["wkt"]
-                    if wkt and not wkt.startswith("POI"):
-                        # Polygons aren't inherited
-                        feature["inherited"] = False
-                    update_location_tree(feature)
-                    # Also do the Bounds/Centroid/WKT
-                    bounds_centroid_wkt(feature)
+            # Do the whole database, in bulk
+            GIS.update_location_tree_bulk()
             return
 
         # Single Feature
@@ -5218,6 +5307,226 @@ class GIS(object):
 
         return _path
 
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def update_location_tree_bulk(location_ids=None):
+        """
+            Bulk version of update_location_tree, for imports and for
+            rebuilding the whole tree: loads the affected part of the tree
+            once, calculates Materialized paths, Lx names, inherited
+            Lat/Lon, Centroids and Bounds in memory (parents before
+            children), and writes back only what has changed, in batches
+
+            @param location_ids: list of gis_location record IDs to update
+                                 (including their descendants and ancestors)
+                                 - if not provided then update the whole tree
+
+            @return: the number of updated locations
+        """
+
+        db = current.db
+        try:
+            table = db.gis_location
+        except:
+            table = current.s3db.gis_location
+        spatial = current.deployment_settings.get_gis_spatialdb()
+
+        CHUNK_SIZE = 1000
+        LEVELS = ("L0", "L1", "L2", "L3", "L4", "L5")
+        BOUNDS = ("lat_min", "lat_max", "lon_min", "lon_max")
+
+        fields = [table.id, table.name, table.level, table.parent, table.path,
+                  table.lat, table.lon, table.inherited, table.gis_feature_type,
+                  table.lat_min, table.lat_max, table.lon_min, table.lon_max,
+                  ] + [table[level] for level in LEVELS]
+        not_deleted = (table.deleted != True)
+
+        def chunks(ids):
+            ids = list(ids)
+            for i in xrange(0, len(ids), CHUNK_SIZE):
+                yield ids[i:i + CHUNK_SIZE]
+
+        # Load the locations (without WKT)
+        nodes = {}
+        if location_ids is None:
+            for row in db(not_deleted).select(*fields):
+                nodes[row.id] = row
+        else:
+            # The locations themselves, then their descendants level by level
+            frontier = [int(i) for i in set(location_ids) if i]
+            key = table.id
+            while frontier:
+                found = []
+                for chunk in chunks(frontier):
+                    query = key.belongs(chunk) & not_deleted
+                    for row in db(query).select(*fields):
+                        if row.id not in nodes:
+                            nodes[row.id] = row
+                            found.append(row.id)
+                frontier = found
+                key = table.parent
+            # The ancestors, to inherit from
+            missing = set(row.parent for row in nodes.values()
+                          if row.parent and row.parent not in nodes)
+            while missing:
+                found = set()
+                for chunk in chunks(missing):
+                    query = table.id.belongs(chunk) & not_deleted
+                    for row in db(query).select(*fields):
+                        nodes[row.id] = row
+                        parent = row.parent
+                        if parent and parent not in nodes:
+                            found.add(parent)
+                missing = found - set(nodes)
+        if not nodes:
+            return 0
+
+        # Find out which locations are Points without WKT and which ones
+        # are Shapes (Polygons aren't inherited)
+        no_wkt = set()
+        shapes = set()
+        empty = (table.wkt == None) | (table.wkt == "")
+        shape = (table.wkt != None) & (table.wkt != "") & \
+                (~(table.wkt.startswith("POI")))
+        if location_ids is None:
+            queries = [not_deleted]
+        else:
+            queries = [table.id.belongs(chunk) for chunk in chunks(nodes)]
+        for query in queries:
+            no_wkt.update(row.id for row in db(query & empty).select(table.id))
+            shapes.update(row.id for row in db(query & shape).select(table.id))
+
+        # Centroids & Bounds of Shapes which don't have them yet
+        centroids = {}
+        pending = [i for i in shapes
+                   if nodes[i].lat is None or nodes[i].lon is None or
+                      any(nodes[i][b] is None for b in BOUNDS)]
+        if pending:
+            try:
+                from shapely.wkt import loads as wkt_loads
+            except ImportError:
+                s3_debug("S3GIS", "Upgrade Shapely for Performance enhancements")
+            else:
+                for chunk in chunks(pending):
+                    rows = db(table.id.belongs(chunk)).select(table.id,
+                                                              table.wkt)
+                    for row in rows:
+                        try:
+                            geom = wkt_loads(row.wkt)
+                        except:
+                            continue
+                        centroid = geom.centroid
+                        lon_min, lat_min, lon_max, lat_max = geom.bounds
+                        centroids[row.id] = {"lat": centroid.y,
+                                             "lon": centroid.x,
+                                             "lat_min": lat_min,
+                                             "lat_max": lat_max,
+                                             "lon_min": lon_min,
+                                             "lon_max": lon_max,
+                                             "gis_feature_type":
+                                                GEOM_TYPES.get(geom.type.lower()),
+                                             }
+
+        # Process the tree top-down
+        children = {}
+        order = []
+        for node_id, row in nodes.iteritems():
+            parent = row.parent
+            if parent and parent != node_id and parent in nodes:
+                children.setdefault(parent, []).append(node_id)
+            else:
+                order.append(node_id)
+        values = {}
+        updates = {}
+        index = 0
+        while index < len(order):
+            node_id = order[index]
+            index += 1
+            order.extend(children.get(node_id, ()))
+
+            row = nodes[node_id]
+            level = row.level
+            parent = values.get(row.parent) if row.parent != node_id else None
+
+            new = {}
+            if parent:
+                new["path"] = "%s/%s" % (parent["path"], node_id)
+                for L in LEVELS:
+                    new[L] = parent[L]
+            else:
+                new["path"] = str(node_id)
+                for L in LEVELS:
+                    new[L] = None
+            if level in LEVELS:
+                new[level] = row.name
+                # Levels below this one are not inherited
+                for L in LEVELS[LEVELS.index(level) + 1:]:
+                    new[L] = None
+
+            lat = row.lat
+            lon = row.lon
+            if node_id in shapes:
+                new["inherited"] = False
+                if node_id in centroids:
+                    new.update(centroids[node_id])
+                    lat = new["lat"]
+                    lon = new["lon"]
+            elif level != "L0":
+                if row.inherited or lat is None or lon is None:
+                    if parent:
+                        lat = parent["lat"]
+                        lon = parent["lon"]
+                    else:
+                        lat = lon = None
+                    new["inherited"] = True
+                    new["lat"] = lat
+                    new["lon"] = lon
+                else:
+                    new["inherited"] = False
+                if lat is not None and lon is not None:
+                    moved = lat != row.lat or lon != row.lon
+                    if moved or node_id in no_wkt:
+                        new["wkt"] = "POINT(%s %s)" % (lon, lat)
+                        new["gis_feature_type"] = 1
+                    if moved or new["inherited"]:
+                        bounds = {"lat_min": lat, "lat_max": lat,
+                                  "lon_min": lon, "lon_max": lon}
+                    else:
+                        bounds = dict((b, row[b] if row[b] is not None else
+                                          (lat if b[:3] == "lat" else lon))
+                                      for b in BOUNDS)
+                    new.update(bounds)
+            elif lat is not None and lon is not None and node_id in no_wkt:
+                # Country without a Polygon
+                new["wkt"] = "POINT(%s %s)" % (lon, lat)
+                new["gis_feature_type"] = 1
+
+            values[node_id] = {"path": new["path"],
+                               "lat": lat,
+                               "lon": lon,
+                               }
+            for L in LEVELS:
+                values[node_id][L] = new[L]
+
+            changed = dict((k, v) for k, v in new.iteritems()
+                           if k == "wkt" or row[k] != v)
+            if changed:
+                if spatial and "wkt" in changed:
+                    changed["the_geom"] = changed["wkt"]
+                updates[node_id] = changed
+
+        # Write back, one query for all locations with the same changes
+        groups = {}
+        for node_id, changed in updates.iteritems():
+            key = tuple(sorted(changed.items()))
+            groups.setdefault(key, []).append(node_id)
+        for key, ids in groups.iteritems():
+            changed = dict(key)
+            for chunk in chunks(ids):
+                db(table.id.belongs(chunk)).update(**changed)
+
+        return len(updates)
+
     # -------------------------------------------------------------------------
     @staticmethod
     def wkt_centroid(form):
@@ -5347,6 +5656,11 @@ class GIS(object):
                 (table.lat_max >= lat_min) & \
                 (table.lon_min <= lon_max) & \
                 (table.lon_max >= lon_min)
+
+        index = S3SpatialIndex.get()
+        if index is not None:
+            # Restrict to the candidates from the spatial index
+            query = index.query(lon_min, lat_min, lon_max, lat_max) & query
         return query
 
     # -------------------------------------------------------------------------
@@ -5356,11 +5670,17 @@ class GIS(object):
             Returns Rows of Locations whose shape intersects the given bbox.
         """
 
-        query = current.gis.query_features_by_bbox(lon_min,
-                                                   lat_min,
-                                                   lon_max,
-                                                   lat_max)
-        return current.db(query).select()
+        db = current.db
+        if current.deployment_settings.get_gis_spatialdb():
+            # Use PostGIS routine
+            ids = S3PostGIS(db).bbox(lon_min, lat_min, lon_max, lat_max)
+            query = (current.s3db.gis_location.id.belongs(ids))
+        else:
+            query = current.gis.query_features_by_bbox(lon_min,
+                                                       lat_min,
+                                                       lon_max,
+                                                       lat_max)
+        return db(query).select()
 
     # -------------------------------------------------------------------------
     @staticmethod
@@ -5566,6 +5886,121 @@ class GIS(object):
 
         return output
 
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def update_simplified(location_ids):
+        """
+            (Re-)generate the precomputed simplified geometries of Polygons,
+            at all tolerances in settings.gis.simplify_tiers
+            - called onaccept of locations, and for locations which don't
+              have them yet when they are requested
+
+            @param location_ids: list of gis_location record IDs
+
+            @return: dict {location_id: {tolerance: geojson}}
+        """
+
+        tiers = current.deployment_settings.get_gis_simplify_tiers()
+
+        db = current.db
+        s3db = current.s3db
+        table = s3db.gis_location
+        stable = s3db.gis_location_simplified
+
+        simplify = GIS.simplify
+        simplified = {}
+        # Points are not stored (nothing to simplify)
+        shape = (table.wkt != None) & (table.wkt != "") & \
+                (~(table.wkt.startswith("POI")))
+        location_ids = list(set(location_ids))
+        for i in xrange(0, len(location_ids), 100):
+            chunk = location_ids[i:i + 100]
+            db(stable.location_id.belongs(chunk)).delete()
+            if not tiers:
+                continue
+            rows = db(table.id.belongs(chunk) & shape).select(table.id,
+                                                             table.wkt)
+            records = []
+            for row in rows:
+                wkt = row.wkt
+                geojsons = simplified[row.id] = {}
+                for tolerance in tiers:
+                    geojson = simplify(wkt,
+                                       tolerance=tolerance,
+                                       output="geojson")
+                    if not geojson:
+                        break
+                    geojsons[tolerance] = geojson
+                    records.append({"location_id": row.id,
+                                    "tolerance": tolerance,
+                                    "geojson": geojson,
+                                    })
+            if records:
+                stable.bulk_insert(records)
+
+        return simplified
+
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def get_simplified(location_ids, tolerance):
+        """
+            Get the simplified GeoJSON of locations from the precomputed
+            tier closest to (but not coarser than) the given tolerance,
+            generating it for locations which don't have it yet
+
+            @param location_ids: list of gis_location record IDs
+            @param tolerance: the tolerance for the simplification
+
+            @return: dict {location_id: geojson}, or None if there is no
+                     suitable tier (caller has to simplify the WKT)
+        """
+
+        tiers = current.deployment_settings.get_gis_simplify_tiers()
+        if not tiers:
+            return None
+        tiers = [t for t in tiers if t <= tolerance]
+        if not tiers:
+            return None
+        tier = tiers[-1]
+
+        db = current.db
+        s3db = current.s3db
+        table = s3db.gis_location
+        stable = s3db.gis_location_simplified
+
+        geojsons = {}
+        location_ids = list(set(location_ids))
+        for i in xrange(0, len(location_ids), 1000):
+            chunk = location_ids[i:i + 1000]
+            query = (stable.location_id.belongs(chunk)) & \
+                    (stable.tolerance == tier)
+            rows = db(query).select(stable.location_id,
+                                    stable.geojson)
+            for row in rows:
+                geojsons[row.location_id] = row.geojson
+
+        missing = [i for i in location_ids if i not in geojsons]
+        if missing:
+            simplified = GIS.update_simplified(missing)
+            for location_id, tolerances in simplified.iteritems():
+                if tier in tolerances:
+                    geojsons[location_id] = tolerances[tier]
+            missing = [i for i in missing if i not in geojsons]
+
+        # Points
+        simplify = GIS.simplify
+        point = table.wkt.startswith("POI")
+        for i in xrange(0, len(missing), 1000):
+            chunk = missing[i:i + 1000]
+            rows = db(table.id.belongs(chunk) & point).select(table.id,
+                                                             table.wkt)
+            for row in rows:
+                geojson = simplify(row.wkt, tolerance=tier, output="geojson")
+                if geojson:
+                    geojsons[row.id] = geojson
+
+        return geojsons
+
     # -------------------------------------------------------------------------
     def show_map(self,
                  id = "default_map",
@@ -5747,6 +6182,1183 @@ class GIS(object):
                    plugins = plugins,
                    )
 
+# =============================================================================
+class S3PostGIS(object):
+    """
+        Spatial queries of gis_location in PostGIS through the DAL
+        connection, i.e. using the DAL connection pool and the current
+        transaction rather than a separate connection for every call.
+
+        Statements are prepared once per database connection (and then
+        re-used by all requests which get the same connection from the
+        pool).
+    """
+
+    # Statements {name: (parameter types, SQL)}
+    NOT_DELETED = "deleted IS NOT TRUE AND the_geom IS NOT NULL"
+    STATEMENTS = {
+        "s3_gis_radius": (("float8", "float8", "float8"),
+            "SELECT id FROM gis_location WHERE %s AND "
+            "ST_DWithin(the_geom, ST_SetSRID(ST_MakePoint($1, $2), 4326), $3)" %
+            NOT_DELETED),
+        "s3_gis_polygon": (("text",),
+            "SELECT id FROM gis_location WHERE %s AND "
+            "ST_Intersects(the_geom, ST_GeomFromText($1, 4326))" %
+            NOT_DELETED),
+        "s3_gis_bbox": (("float8", "float8", "float8", "float8"),
+            "SELECT id FROM gis_location WHERE %s AND "
+            "the_geom && ST_MakeEnvelope($1, $2, $3, $4, 4326)" %
+            NOT_DELETED),
+        "s3_gis_nearest": (("float8", "float8", "int4"),
+            "SELECT id, ST_Distance(the_geom::geography, "
+            "ST_SetSRID(ST_MakePoint($1, $2), 4326)::geography) "
+            "FROM gis_location WHERE %s "
+            "ORDER BY the_geom <-> ST_SetSRID(ST_MakePoint($1, $2), 4326) "
+            "LIMIT $3" % NOT_DELETED),
+        }
+
+    # Names of the statements prepared per connection
+    prepared = weakref.WeakKeyDictionary()
+
+    def __init__(self, db=None):
+        """
+            Constructor
+
+            @param db: the database (default: current.db)
+        """
+
+        self.db = db if db is not None else current.db
+
+    # -------------------------------------------------------------------------
+    def execute(self, name, *args):
+        """
+            Execute a statement
+
+            @param name: the statement name (key in STATEMENTS)
+            @param args: the statement parameters
+            @return: list of result tuples
+        """
+
+        db = self.db
+        connection = db._adapter.connection
+
+        try:
+            prepared = self.prepared.get(connection)
+            if prepared is None:
+                prepared = self.prepared[connection] = set()
+        except TypeError:
+            # Connection can not be tracked: run the statement unprepared
+            sql = re.sub(r"\$(\d+)", r"%(p\1)s", self.STATEMENTS[name][1])
+            placeholders = dict(("p%s" % (i + 1), arg)
+                                for i, arg in enumerate(args))
+            return db.executesql(sql, placeholders=placeholders)
+
+        if name not in prepared:
+            # Prepared statements are not transactional, so remain
+            # prepared even if this transaction gets rolled back
+            types, sql = self.STATEMENTS[name]
+            db.executesql("PREPARE %s (%s) AS %s" % (name,
+                                                     ", ".join(types),
+                                                     sql))
+            prepared.add(name)
+
+        sql = "EXECUTE %s (%s)" % (name, ", ".join(["%s"] * len(args)))
+        return db.executesql(sql, placeholders=args)
+
+    # -------------------------------------------------------------------------
+    def radius(self, lat, lon, radius):
+        """
+            Find all locations within a radius of a point
+
+            @param lat: the latitude of the point
+            @param lon: the longitude of the point
+            @param radius: the radius (km)
+            @return: list of location record IDs
+        """
+
+        # Convert km to degrees (since we're using the_geom not the_geog)
+        radius = math.degrees(float(radius) / RADIUS_EARTH)
+        rows = self.execute("s3_gis_radius", lon, lat, radius)
+        return [row[0] for row in rows]
+
+    # -------------------------------------------------------------------------
+    def polygon(self, wkt):
+        """
+            Find all locations intersecting a polygon
+
+            @param wkt: the polygon as WKT
+            @return: list of location record IDs
+        """
+
+        rows = self.execute("s3_gis_polygon", wkt)
+        return [row[0] for row in rows]
+
+    # -------------------------------------------------------------------------
+    def bbox(self, lon_min, lat_min, lon_max, lat_max):
+        """
+            Find all locations whose bounding box intersects a bounding box
+
+            @return: list of location record IDs
+        """
+
+        rows = self.execute("s3_gis_bbox", lon_min, lat_min, lon_max, lat_max)
+        return [row[0] for row in rows]
+
+    # -------------------------------------------------------------------------
+    def nearest(self, lat, lon, limit=1):
+        """
+            Find the locations nearest to a point
+
+            @param lat: the latitude of the point
+            @param lon: the longitude of the point
+            @param limit: the maximum number of locations
+            @return: list of tuples (location record ID, distance in km),
+                     nearest first
+        """
+
+        rows = self.execute("s3_gis_nearest", lon, lat, limit)
+        return [(row[0], row[1] / 1000.0) for row in rows]
+
+# =============================================================================
+class S3SpatialIndex(object):
+    """
+        Grid index of the bounding boxes of all locations, to find the
+        candidates for spatial queries without a table scan of gis_location
+        in databases without spatial extensions.
+
+        The index is shared by all requests in a process, persisted in the
+        cache folder, updated by gis_location_onaccept and caught up with
+        all other changes (e.g. by other processes, or DAL updates) by their
+        modified_on timestamp at most every REFRESH seconds.
+
+        Spatial queries must include the locations modified since the last
+        catch-up (see query()), since changes made by other processes can
+        be up to REFRESH seconds late, and still check the actual geometries
+        (or the bounds in the database) of the candidates.
+    """
+
+    # Maximum number of grid cells per location, larger locations
+    # (e.g. countries) are checked individually
+    MAX_CELLS = 64
+
+    # Target average number of locations per grid cell
+    CELL_LOAD = 16
+
+    # Seconds between catch-ups with the database
+    REFRESH = 60
+
+    # Number of changes before saving the index to disk
+    SAVE_AFTER = 100
+
+    # Number of records to read from the database at a time
+    CHUNK_SIZE = 10000
+
+    # Process-wide instance
+    instance = None
+    lock = threading.Lock()
+
+    def __init__(self, cellsize=1.0):
+        """
+            Constructor
+
+            @param cellsize: the cell size of the grid (degrees)
+        """
+
+        self.cellsize = cellsize
+
+        # {(x, y): set of location IDs}
+        self.cells = {}
+        # {location_id: (lon_min, lat_min, lon_max, lat_max)}
+        self.bounds = {}
+        # IDs of locations spanning more than MAX_CELLS cells
+        self.large = set()
+
+        # Latest modified_on of the locations in the index
+        self.stamp = None
+        # Time of the last catch-up with the database
+        self.checked = 0
+        # Number of changes not yet saved to disk
+        self.changes = 0
+
+    # -------------------------------------------------------------------------
+    # Index operations
+    # -------------------------------------------------------------------------
+    def __cells(self, lon_min, lat_min, lon_max, lat_max):
+        """
+            Get the ranges of grid cells covering a bounding box
+
+            @return: tuple (xrange, yrange)
+        """
+
+        cellsize = self.cellsize
+        return (xrange(int(math.floor(lon_min / cellsize)),
+                       int(math.floor(lon_max / cellsize)) + 1),
+                xrange(int(math.floor(lat_min / cellsize)),
+                       int(math.floor(lat_max / cellsize)) + 1))
+
+    # -------------------------------------------------------------------------
+    def add(self, location_id, bbox):
+        """
+            Add a location to the index (or move it)
+
+            @param location_id: the location record ID
+            @param bbox: the bounding box (lon_min, lat_min, lon_max, lat_max)
+        """
+
+        if location_id in self.bounds:
+            self.remove(location_id)
+
+        self.bounds[location_id] = bbox
+        xcells, ycells = self.__cells(*bbox)
+        if len(xcells) * len(ycells) > self.MAX_CELLS:
+            self.large.add(location_id)
+        else:
+            cells = self.cells
+            for x in xcells:
+                for y in ycells:
+                    cell = cells.get((x, y))
+                    if cell is None:
+                        cells[(x, y)] = set([location_id])
+                    else:
+                        cell.add(location_id)
+        return
+
+    # -------------------------------------------------------------------------
+    def remove(self, location_id):
+        """
+            Remove a location from the index
+
+            @param location_id: the location record ID
+        """
+
+        bbox = self.bounds.pop(location_id, None)
+        if bbox is None:
+            return
+        if location_id in self.large:
+            self.large.discard(location_id)
+        else:
+            cells = self.cells
+            xcells, ycells = self.__cells(*bbox)
+            for x in xcells:
+                for y in ycells:
+                    cell = cells.get((x, y))
+                    if cell is not None:
+                        cell.discard(location_id)
+                        if not cell:
+                            del cells[(x, y)]
+        return
+
+    # -------------------------------------------------------------------------
+    def search(self, lon_min, lat_min, lon_max, lat_max):
+        """
+            Find all locations whose bounding box intersects a bounding box
+
+            @return: set of location record IDs
+        """
+
+        with self.lock:
+            return self.__search(lon_min, lat_min, lon_max, lat_max)
+
+    # -------------------------------------------------------------------------
+    def query(self, lon_min, lat_min, lon_max, lat_max):
+        """
+            Get a query for the candidates of a spatial query: all
+            locations in the index whose bounding box intersects a
+            bounding box, and all locations modified since the last
+            catch-up with the database (which may not be in the index)
+
+            @return: a Query on gis_location
+        """
+
+        table = current.s3db.gis_location
+        with self.lock:
+            ids = self.__search(lon_min, lat_min, lon_max, lat_max)
+            stamp = self.stamp
+        if stamp is None:
+            # Nothing indexed yet
+            return (table.id > 0)
+        # >= to not miss changes within the same second
+        return (table.id.belongs(list(ids))) | \
+               (table.modified_on >= stamp)
+
+    # -------------------------------------------------------------------------
+    def __search(self, lon_min, lat_min, lon_max, lat_max):
+        """
+            Find all locations whose bounding box intersects a bounding
+            box, without locking the index (see search())
+
+            @return: set of location record IDs
+        """
+
+        if lon_min > lon_max:
+            # Bounding box crosses the 180th meridian
+            return self.__search(lon_min, lat_min, 180.0, lat_max) | \
+                   self.__search(-180.0, lat_min, lon_max, lat_max)
+
+        bounds = self.bounds
+        def intersects(location_id):
+            l = bounds[location_id]
+            return l[0] <= lon_max and l[2] >= lon_min and \
+                   l[1] <= lat_max and l[3] >= lat_min
+
+        candidates = set()
+        cells = self.cells
+        xcells, ycells = self.__cells(lon_min, lat_min, lon_max, lat_max)
+        if len(xcells) * len(ycells) > len(cells):
+            # Fewer cells in the index than in the box
+            for cell in cells.values():
+                candidates |= cell
+        else:
+            for x in xcells:
+                for y in ycells:
+                    cell = cells.get((x, y))
+                    if cell is not None:
+                        candidates |= cell
+        candidates |= self.large
+        return set(i for i in candidates if intersects(i))
+
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def bbox(location):
+        """
+            Get the bounding box of a location record
+
+            @param location: the gis_location Row
+            @return: tuple (lon_min, lat_min, lon_max, lat_max), or None
+                     if the location has no coordinates
+        """
+
+        lon_min = location.lon_min
+        lat_min = location.lat_min
+        lon_max = location.lon_max
+        lat_max = location.lat_max
+        if None in (lon_min, lat_min, lon_max, lat_max):
+            lon = location.lon
+            lat = location.lat
+            if lon is None or lat is None:
+                return None
+            return (lon, lat, lon, lat)
+        return (lon_min, lat_min, lon_max, lat_max)
+
+    # -------------------------------------------------------------------------
+    # Database
+    # -------------------------------------------------------------------------
+    @classmethod
+    def __select(cls, query):
+        """
+            Read locations from the database, in chunks to limit the memory
+            needed for large tables
+
+            @param query: the query
+            @return: generator of gis_location Rows
+        """
+
+        db = current.db
+        table = current.s3db.gis_location
+
+        fields = (table.id,
+                  table.deleted,
+                  table.modified_on,
+                  table.lat,
+                  table.lon,
+                  table.lat_min,
+                  table.lat_max,
+                  table.lon_min,
+                  table.lon_max,
+                  )
+        size = cls.CHUNK_SIZE
+        last = 0
+        while True:
+            rows = db(query & (table.id > last)).select(orderby=table.id,
+                                                        limitby=(0, size),
+                                                        cacheable=True,
+                                                        *fields)
+            for row in rows:
+                yield row
+            if len(rows) < size:
+                break
+            last = rows.last().id
+
+    # -------------------------------------------------------------------------
+    @classmethod
+    def build(cls):
+        """
+            Build the index from all locations in the database
+
+            @return: the S3SpatialIndex
+        """
+
+        table = current.s3db.gis_location
+        query = (table.deleted != True)
+
+        get_bbox = cls.bbox
+        bounds = {}
+        stamp = None
+        for row in cls.__select(query):
+            bbox = get_bbox(row)
+            if bbox is not None:
+                bounds[row.id] = bbox
+            if stamp is None or row.modified_on > stamp:
+                stamp = row.modified_on
+
+        # Choose the cell size to get about CELL_LOAD locations per
+        # cell, assuming that they are evenly spread across their extent
+        cellsize = 1.0
+        if bounds:
+            lons = [(b[0] + b[2]) / 2.0 for b in bounds.values()]
+            lats = [(b[1] + b[3]) / 2.0 for b in bounds.values()]
+            area = (max(lons) - min(lons)) * (max(lats) - min(lats))
+            if area:
+                cells = max(len(bounds) / float(cls.CELL_LOAD), 1)
+                cellsize = min(max(math.sqrt(area / cells), 0.0001), 10.0)
+
+        index = cls(cellsize=cellsize)
+        add = index.add
+        for location_id, bbox in bounds.items():
+            add(location_id, bbox)
+        index.stamp = stamp
+        index.checked = time.time()
+        index.changes = len(bounds)
+        return index
+
+    # -------------------------------------------------------------------------
+    def refresh(self):
+        """
+            Catch up with all changes in the database since the last
+            modification of a location in the index
+        """
+
+        table = current.s3db.gis_location
+        if self.stamp is None:
+            query = (table.id > 0)
+        else:
+            # >= to not miss changes within the same second
+            query = (table.modified_on >= self.stamp)
+
+        get_bbox = self.bbox
+        for row in self.__select(query):
+            bbox = get_bbox(row) if not row.deleted else None
+            if bbox is None:
+                if row.id in self.bounds:
+                    self.remove(row.id)
+                    self.changes += 1
+            elif self.bounds.get(row.id) != bbox:
+                self.add(row.id, bbox)
+                self.changes += 1
+            if self.stamp is None or row.modified_on > self.stamp:
+                self.stamp = row.modified_on
+        self.checked = time.time()
+        return
+
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def path():
+        """ The path of the index file """
+
+        return os.path.join(current.request.folder, "cache", "gis_location.idx")
+
+    # -------------------------------------------------------------------------
+    def save(self):
+        """ Save the index to disk """
+
+        path = self.path()
+        folder = os.path.dirname(path)
+        if not os.access(folder, os.W_OK):
+            s3_debug("Folder not writable", folder)
+            return
+
+        data = {"cellsize": self.cellsize,
+                "bounds": self.bounds,
+                "stamp": self.stamp,
+                }
+        # Write to a temporary file first, so that other processes
+        # never read an incomplete index
+        tmp = "%s.%s" % (path, os.getpid())
+        try:
+            f = open(tmp, "wb")
+            try:
+                cPickle.dump(data, f, cPickle.HIGHEST_PROTOCOL)
+            finally:
+                f.close()
+            try:
+                os.rename(tmp, path)
+            except OSError:
+                # Windows can not rename onto an existing file
+                os.remove(path)
+                os.rename(tmp, path)
+        except (IOError, OSError), e:
+            s3_debug("Could not save spatial index", e)
+        else:
+            self.changes = 0
+        return
+
+    # -------------------------------------------------------------------------
+    @classmethod
+    def load(cls):
+        """
+            Load the index from disk
+
+            @return: the S3SpatialIndex, or None if there is no valid
+                     index file
+        """
+
+        try:
+            f = open(cls.path(), "rb")
+            try:
+                data = cPickle.load(f)
+            finally:
+                f.close()
+        except:
+            return None
+
+        index = cls(cellsize=data["cellsize"])
+        add = index.add
+        for location_id, bbox in data["bounds"].items():
+            add(location_id, bbox)
+        index.stamp = data["stamp"]
+        return index
+
+    # -------------------------------------------------------------------------
+    # API
+    # -------------------------------------------------------------------------
+    @classmethod
+    def get(cls):
+        """
+            Get the current index (loading or building it as necessary)
+
+            @return: the S3SpatialIndex, or None if not enabled
+        """
+
+        if not current.deployment_settings.get_gis_spatial_index():
+            return None
+
+        with cls.lock:
+            index = cls.instance
+            if index is None:
+                index = cls.load()
+                if index is None:
+                    index = cls.build()
+                else:
+                    index.refresh()
+                cls.instance = index
+            elif time.time() - index.checked > cls.REFRESH:
+                index.refresh()
+            if index.changes >= cls.SAVE_AFTER:
+                index.save()
+        return index
+
+    # -------------------------------------------------------------------------
+    @classmethod
+    def update(cls, location_id):
+        """
+            Update a location in the index, called onaccept
+
+            @param location_id: the location record ID
+        """
+
+        index = cls.instance
+        if index is None or \
+           not current.deployment_settings.get_gis_spatial_index():
+            # Not loaded in this process: will catch up when loaded
+            return
+
+        table = current.s3db.gis_location
+        row = current.db(table.id == location_id).select(table.id,
+                                                         table.deleted,
+                                                         table.modified_on,
+                                                         table.lat,
+                                                         table.lon,
+                                                         table.lat_min,
+                                                         table.lat_max,
+                                                         table.lon_min,
+                                                         table.lon_max,
+                                                         limitby=(0, 1)
+                                                         ).first()
+        with cls.lock:
+            if row and not row.deleted:
+                bbox = cls.bbox(row)
+            else:
+                bbox = None
+            if bbox is None:
+                index.remove(location_id)
+            else:
+                index.add(row.id, bbox)
+            index.changes += 1
+            if index.changes >= cls.SAVE_AFTER:
+                index.save()
+        return
+
+# =============================================================================
+class S3GeoJSONCache(object):
+    """
+        Versioned on-disk cache for the simplified GeoJSON of map layers
+        (Shapefile and Theme Layers), with ETag support
+
+        The version is a hash of whatever determines the cached data
+        (e.g. last modification of the layer), so that any change makes
+        a new version; outdated versions are simply overwritten.
+    """
+
+    def __init__(self, name, *version):
+        """
+            Constructor
+
+            @param name: the name of the cache file
+            @param version: the values determining the version
+        """
+
+        self.name = name
+        self.version = hashlib.md5(repr(version)).hexdigest()
+
+    # -------------------------------------------------------------------------
+    def path(self):
+        """ The path of the cache file """
+
+        return os.path.join(current.request.folder,
+                            "cache", "geojson", "%s.json" % self.name)
+
+    # -------------------------------------------------------------------------
+    def etag(self):
+        """ The ETag for the current request and version """
+
+        env = current.request.env
+        # Different URLs for the same layer produce different output
+        tag = "%s?%s:%s" % (env.path_info, env.query_string, self.version)
+        return '"%s"' % hashlib.md5(tag).hexdigest()
+
+    # -------------------------------------------------------------------------
+    def check_etag(self):
+        """
+            Set the ETag header of the response, and respond with 304 Not
+            Modified if the client already has this version
+        """
+
+        etag = self.etag()
+        current.response.headers["ETag"] = etag
+
+        if_none_match = current.request.env.http_if_none_match
+        if if_none_match:
+            tags = [t.strip() for t in if_none_match.split(",")]
+            if etag in tags or "*" in tags:
+                raise HTTP(304, ETag=etag)
+        return
+
+    # -------------------------------------------------------------------------
+    def get(self):
+        """
+            Read the cache
+
+            @return: dict {record_id: geojson}, or None if there is no
+                     cached data for this version
+        """
+
+        try:
+            f = open(self.path(), "rb")
+            try:
+                data = json.load(f)
+            finally:
+                f.close()
+        except:
+            return None
+
+        if data.get("version") != self.version:
+            return None
+        return dict((int(k), v) for k, v in data["geojsons"].iteritems())
+
+    # -------------------------------------------------------------------------
+    def put(self, geojsons):
+        """
+            Write the cache
+
+            @param geojsons: dict {record_id: geojson}
+        """
+
+        path = self.path()
+        folder = os.path.dirname(path)
+        try:
+            if not os.path.exists(folder):
+                os.makedirs(folder)
+        except OSError:
+            pass
+        if not os.access(folder, os.W_OK):
+            s3_debug("Folder not writable", folder)
+            return
+
+        data = {"version": self.version,
+                "geojsons": geojsons,
+                }
+        # Write to a temporary file first, so that other processes
+        # never read an incomplete file
+        tmp = "%s.%s" % (path, os.getpid())
+        try:
+            f = open(tmp, "wb")
+            try:
+                json.dump(data, f, separators=SEPARATORS)
+            finally:
+                f.close()
+            try:
+                os.rename(tmp, path)
+            except OSError:
+                # Windows can not rename onto an existing file
+                os.remove(path)
+                os.rename(tmp, path)
+        except (IOError, OSError), e:
+            s3_debug("Could not write GeoJSON cache", e)
+        return
+
+# =============================================================================
+class S3GeoJSONEncoder(object):
+    """
+        Native GeoJSON serializer for Feature Layers
+
+        Produces the same output as the S3XML export transformed with the
+        GeoJSON stylesheet (static/formats/geojson/export.xsl), but writes
+        the features directly from the records and the data prepared by
+        GIS.get_location_data(), without building an element tree and
+        without XSLT.
+
+        Only plain Feature Layers (resources with a location_id) are
+        supported - for anything else (e.g. Shapefile and Theme Layers,
+        or resources which are mapped by their site), encode() returns
+        None and the caller falls back to the XSLT export.
+    """
+
+    # Tables which have their own templates in the stylesheet
+    SPECIAL = ("gis_location",
+               "gis_cache",
+               "gis_feature_query",
+               "gis_theme_data",
+               )
+
+    # Names which the stylesheet can use for property elements
+    NAME = re.compile(r"^[^\W\d][\w\-.]*$", re.UNICODE)
+
+    # XPath whitespace
+    SPACE = re.compile(r"[\x20\t\r\n]+")
+
+    def __init__(self, resource, xmlformat):
+        """
+            Constructor
+
+            @param resource: the S3Resource to export
+            @param xmlformat: the S3XMLFormat of the export
+        """
+
+        self.resource = resource
+        self.xmlformat = xmlformat
+
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def stylesheet():
+        """ The path of the stylesheet which this class replaces """
+
+        return os.path.join(current.request.folder,
+                            "static", "formats", "geojson", "export.xsl")
+
+    # -------------------------------------------------------------------------
+    def supported(self):
+        """
+            Check whether the resource can be encoded natively, i.e.
+            whether the stylesheet would apply the Feature template to
+            the location_id reference of the master records only
+
+            @return: the (include, exclude) fields to load, or None if
+                     the resource is not supported
+        """
+
+        xmlformat = self.xmlformat
+        entry = xmlformat.entry
+        if entry is None or \
+           os.path.abspath(entry.path) != os.path.abspath(self.stylesheet()):
+            return None
+
+        resource = self.resource
+        table = resource.table
+        tablename = resource.tablename
+
+        if tablename in self.SPECIAL or \
+           tablename.startswith("gis_layer_shapefile"):
+            return None
+        if "location_id" not in table.fields:
+            return None
+        if "site_id" in table.fields and \
+           tablename not in current.auth.org_site_types:
+            # Mapped by the location of the site if there is no location_id
+            return None
+        if current.manager.show_ids or \
+           resource.get_config("xml_post_render"):
+            return None
+
+        fields = xmlformat.get_fields(tablename)
+        if not fields:
+            return None
+        include, exclude = fields
+        if not include or "location_id" not in include or \
+           [f for f in include if f not in ("location_id", "site_id")]:
+            # Other references could bring in records of this table
+            return None
+
+        # Super-keys are always loaded: links to other instance records
+        # could bring in records of this table, too
+        s3db = current.s3db
+        super_entity = resource.get_config("super_entity")
+        if not isinstance(super_entity, (list, tuple)):
+            super_entity = [super_entity]
+        rfields = resource.split_fields()[0]
+        for f in rfields:
+            ktablename = s3_get_foreign_key(table[f], m2m=False)[0]
+            if not ktablename or ktablename in super_entity:
+                continue
+            ktable = s3db.table(ktablename)
+            if ktable and "instance_type" in ktable.fields:
+                return None
+
+        return include, exclude
+
+    # -------------------------------------------------------------------------
+    def encode(self, start=None, limit=None, pretty_print=False):
+        """
+            Encode the resource as GeoJSON
+
+            @param start: index of the first record to export
+            @param limit: maximum number of records to export
+            @param pretty_print: insert newlines/indentation in the output
+
+            @return: the GeoJSON as string, or None if the resource can
+                     not be encoded natively
+        """
+
+        fields = self.supported()
+        if fields is None:
+            return None
+        include, exclude = fields
+
+        db = current.db
+        xml = current.xml
+        auth = current.auth
+        s3db = current.s3db
+        request = current.request
+        settings = current.deployment_settings
+
+        resource = self.resource
+        table = resource.table
+        tablename = resource.tablename
+        pkey = table._id
+
+        # Same filters and limits as in S3Resource.export_tree()
+        if xml.filter_mci and "mci" in table.fields:
+            resource.add_filter(table.mci >= 0)
+        results = resource.count()
+
+        resource.muntil = None
+        resource.results = 0
+        resource.cursor = None
+
+        resource.load(fields=include,
+                      skip=exclude,
+                      start=start,
+                      limit=limit,
+                      virtual=False,
+                      cacheable=True)
+
+        if results > settings.get_gis_max_features():
+            headers = {"Content-Type": "application/json"}
+            message = "Too Many Records"
+            status = 509
+            raise HTTP(status,
+                       body=xml.json_message(success=False,
+                                             statuscode=status,
+                                             message=message),
+                       web2py_error=message,
+                       **headers)
+
+        locations = current.gis.get_location_data(resource)
+        if locations is None:
+            return None
+        latlons = locations["latlons"].get(tablename)
+        geojsons = locations["geojsons"].get(tablename)
+        markers = locations["markers"].get(tablename)
+        tooltips = locations["tooltips"].get(tablename)
+        attributes = locations["attributes"].get(tablename)
+
+        rows = resource._rows
+
+        # Referenced locations must be accessible (as in S3XML.rmap)
+        gtable = s3db.gis_location
+        location_ids = set([row.location_id for row in rows if row.location_id])
+        if location_ids:
+            query = auth.s3_accessible_query("read", gtable) & \
+                    (gtable.id.belongs(location_ids))
+            query = (gtable.deleted != True) & query
+            if xml.filter_mci:
+                query = (gtable.mci >= 0) & query
+            gis_locations = db(query).select(gtable.id,
+                                             gtable.lat,
+                                             gtable.lon).as_dict()
+        else:
+            gis_locations = {}
+
+        UID = xml.UID
+        MTIME = xml.MTIME
+        export_uid = xml.export_uid
+        audit = current.audit
+        prefix, name = resource.prefix, resource.name
+
+        if markers is not None and markers.get("image", None):
+            # Single Marker for all features
+            marker = markers
+        else:
+            marker = None
+        marker_url = "/%s/static/img/markers" % request.application
+        popup_url = URL(request.controller, request.function).split(".", 1)[0]
+
+        feature = self.feature
+        features = []
+        append = features.append
+        for row in rows:
+            record_id = row[pkey]
+
+            if MTIME in row and \
+               (not resource.muntil or row[MTIME] > resource.muntil):
+                resource.muntil = row[MTIME]
+            audit("read", prefix, name,
+                  record=record_id, representation="xml")
+
+            if UID in table.fields:
+                uid = str(table[UID].formatter(row[UID])).decode("utf-8")
+                uid = export_uid(uid)
+            else:
+                uid = None
+
+            location = gis_locations.get(row.location_id)
+            if location is None:
+                # No reference => not a feature
+                append(None)
+                continue
+
+            # Location as encoded by S3XML.gis_encode()
+            attr = {}
+            geometry = None
+            LatLon = None
+            polygon = False
+            if latlons is not None:
+                LatLon = latlons.get(record_id, None)
+                if LatLon:
+                    lat, lon = LatLon
+            elif geojsons is not None:
+                polygon = True
+                geometry = geojsons.get(record_id, None)
+            if not LatLon and not polygon:
+                LatLon = location
+                lat, lon = location["lat"], location["lon"]
+
+            if LatLon:
+                if lat is None or lon is None:
+                    # Cannot display on Map
+                    append(None)
+                    continue
+                attr["lat"] = "%.4f" % lat
+                attr["lon"] = "%.4f" % lon
+
+                if markers is not None:
+                    m = marker or markers[record_id]
+                    if m:
+                        attr["marker_url"] = "%s/%s" % (marker_url, m["image"])
+                        attr["marker_height"] = str(m["height"])
+                        attr["marker_width"] = str(m["width"])
+
+            if LatLon or polygon:
+                attr["popup_url"] = "%s/%i.plain" % (popup_url, record_id)
+                if tooltips is not None:
+                    tooltip = tooltips[record_id]
+                    if type(tooltip) is unicode:
+                        attr["popup"] = tooltip
+                if attributes is not None:
+                    _attr = ""
+                    attrs = attributes.get(record_id, [])
+                    for a in attrs:
+                        if _attr:
+                            _attr = "%s,[%s]=[%s]" % (_attr, a, attrs[a])
+                        else:
+                            _attr = "[%s]=[%s]" % (a, attrs[a])
+                    if _attr:
+                        attr["attributes"] = _attr
+
+            item = feature(uid, geometry, attr)
+            if item is False:
+                # Can't produce the same output as the stylesheet
+                return None
+            append(item)
+
+        # Assemble the output as the stylesheet does
+        children = []
+        if results > 0:
+            if len(rows) == 1:
+                if features[0]:
+                    children = features[0]
+            else:
+                children.append(("type", "FeatureCollection", None, []))
+                for item in features:
+                    children.append(("features", None, None, item or []))
+        obj = self.__json(("GeoJSON", None, None, children))
+
+        resource.results = results
+
+        if pretty_print:
+            js = json.dumps(obj, indent=4)
+            return "\n".join([l.rstrip() for l in js.splitlines()])
+        else:
+            return json.dumps(obj)
+
+    # -------------------------------------------------------------------------
+    def feature(self, uid, geometry, attr):
+        """
+            Build a Feature (Feature template of the stylesheet)
+
+            @param uid: the UID of the record
+            @param geometry: the pre-prepared GeoJSON of the geometry
+            @param attr: the attributes of the location reference
+
+            @return: list of nodes (tag, text, value, children), None if
+                     the record is not a feature, or False if the
+                     stylesheet would fail for this record
+        """
+
+        if geometry is not None and geometry != "null":
+            geometry = ("geometry", None, geometry, [])
+        elif "lon" in attr:
+            geometry = ("geometry", None, None,
+                        [("type", "Point", None, []),
+                         ("coordinates", attr["lon"], None, []),
+                         ("coordinates", attr["lat"], None, []),
+                         ])
+        else:
+            return None
+
+        # Properties template
+        if uid and "urn:uuid:" in uid:
+            uid = uid.split("urn:uuid:", 1)[1]
+        else:
+            uid = ""
+        properties = [("id", uid, None, [])]
+        append = properties.append
+        popup = attr.get("popup")
+        if popup:
+            append(("popup", popup, None, []))
+        url = attr.get("popup_url")
+        if url:
+            append(("url", url, None, []))
+        if "marker_url" in attr:
+            append(("marker_url", attr["marker_url"], None, []))
+            append(("marker_height", attr["marker_height"], None, []))
+            append(("marker_width", attr["marker_width"], None, []))
+        attributes = attr.get("attributes")
+        if attributes:
+            # Attributes template
+            for key, value in self.parse_attributes(attributes):
+                if not self.NAME.match(key):
+                    return False
+                append((key, value, None, []))
+
+        return [("type", "Feature", None, []),
+                geometry,
+                ("properties", None, None, properties),
+                ]
+
+    # -------------------------------------------------------------------------
+    @classmethod
+    def parse_attributes(cls, attributes):
+        """
+            Split an attributes string "[key]=[value],[key]=[value]" into
+            (key, value) tuples, exactly like the Attributes template of
+            the stylesheet does (i.e. with the same limitations)
+
+            @param attributes: the attributes string
+        """
+
+        space = cls.SPACE
+        normalize = lambda s: space.sub(" ", s).strip("\x20\t\r\n")
+
+        def before(s, sep):
+            i = s.find(sep)
+            return s[:i] if i != -1 else ""
+        def after(s, sep):
+            i = s.find(sep)
+            return s[i + len(sep):] if i != -1 else ""
+
+        items = []
+        while True:
+            if "],[" in attributes:
+                attribute = before(attributes, ",[")
+                attributes = normalize(after(attributes, "],"))
+            else:
+                attribute = attributes
+                attributes = None
+            key = after(before(attribute, "]=["), "[")
+            value = normalize(before(after(attribute, "]=["), "]"))
+            items.append((key, value))
+            if attributes is None:
+                break
+        return items
+
+    # -------------------------------------------------------------------------
+    @classmethod
+    def __json(cls, node):
+        """
+            Convert a node (tag, text, value, children) into a JSON-
+            serializable object, following the same rules as
+            S3XML.tree2json() for non-S3XML trees
+
+            @param node: the node
+        """
+
+        tag, text, value, children = node
+
+        json_obj = cls.__json
+        if tag == "list":
+            obj = []
+            for child in children:
+                child_obj = json_obj(child)
+                if child_obj:
+                    obj.append(child_obj)
+            return obj
+
+        obj = {}
+        if children:
+            counts = {}
+            for child in children:
+                t = child[0]
+                counts[t] = counts.get(t, 0) + 1
+            for child in children:
+                t = child[0]
+                child_obj = json_obj(child)
+                if child_obj:
+                    if t not in obj:
+                        if counts[t] == 1:
+                            obj[t] = child_obj
+                        else:
+                            obj[t] = [child_obj]
+                    else:
+                        if type(obj[t]) is not list:
+                            obj[t] = [obj[t]]
+                        obj[t].append(child_obj)
+
+        skip_text = False
+        if value is not None:
+            try:
+                obj["item"] = json.loads(value)
+            except:
+                pass
+            else:
+                skip_text = True
+        if text and not skip_text:
+            obj["$"] = current.xml.xml_decode(text)
+
+        if len(obj) == 1 and obj.keys()[0] in ("$", "item", "list"):
+            obj = obj[obj.keys()[0]]
+
+        return obj
+
 # =============================================================================
 class MAP(DIV):
     """
@@ -44,6 +44,9 @@ from s3utils import s3_unicode
 
 DEFAULT = lambda: None
 
+# Number of stored deltas after which load() compacts the stored hierarchy
+COMPACT = 200
+
 # =============================================================================
 class S3Hierarchy(object):
     """ Class representing an object hierarchy """
@@ -92,6 +95,7 @@ class S3Hierarchy(object):
             self.__connect()
         if self.__status("dirty"):
             self.read()
+            self.save()
         return self.__nodes
 
     # -------------------------------------------------------------------------
@@ -116,6 +120,39 @@ class S3Hierarchy(object):
                 return s3db.get_config(tablename, "hierarchy")
         return None
 
+    # -------------------------------------------------------------------------
+    @property
+    def closure(self):
+        """
+            Whether the closure index is enabled for the target table,
+            configured like:
+
+                s3db.configure(tablename, hierarchy_closure=True)
+        """
+
+        if self.config:
+            return bool(current.s3db.get_config(self.tablename,
+                                                "hierarchy_closure"))
+        return False
+
+    # -------------------------------------------------------------------------
+    def __indexed(self):
+        """
+            Check whether the closure index can be used, i.e. whether
+            it is enabled and the stored hierarchy is clean and indexed
+
+            @return: True|False
+        """
+
+        if not self.closure:
+            return False
+        htable = current.s3db.s3_hierarchy
+        query = (htable.tablename == self.tablename)
+        row = current.db(query).select(htable.dirty,
+                                       htable.closure,
+                                       limitby=(0, 1)).first()
+        return bool(row and not row.dirty and row.closure)
+
     # -------------------------------------------------------------------------
     def __connect(self):
         """ Connect this instance to the hierarchy """
@@ -182,23 +219,44 @@ class S3Hierarchy(object):
         htable = current.s3db.s3_hierarchy
         query = (htable.tablename == tablename)
         row = current.db(query).select(htable.dirty,
-                                        htable.hierarchy,
-                                        limitby=(0, 1)).first()
+                                       htable.closure,
+                                       htable.version,
+                                       limitby=(0, 1)).first()
         if row and not row.dirty:
-            data = row.hierarchy
-            nodes = self.__nodes
-            nodes.clear()
-            for node_id, item in data["nodes"].items():
-                nodes[long(node_id)] = {"p": item["p"],
-                                        "c": item["c"],
-                                        "s": set(item["s"]) \
-                                             if item["s"] else set()}
-            roots = self.__roots
-            roots.clear()
-            roots.update(set(data["roots"]))
+            version = row.version
+            cache = self.__cache()
+            if cache is not None:
+                # Use the shared cache if it holds the current version
+                key = "s3hierarchy_%s" % tablename
+                read = lambda: self.__read_stored(tablename)
+                data = cache(key, read, time_expire=None)
+                if data is None or data[0] != version:
+                    cache(key, None)
+                    data = cache(key, read, time_expire=None)
+            else:
+                data = self.__read_stored(tablename)
+            if data is None:
+                # Stored hierarchy has been marked dirty meanwhile
+                self.__status(dirty=True, dbupdate=None, dbstatus=False)
+                return
+            version, roots, nodes, deltas, last = data
+
+            # Copy the maps, not the nodes (cached nodes are shared, so
+            # they must be copied before changing them, see _update_node)
+            self.__nodes.clear()
+            self.__nodes.update(nodes)
+            self.__roots.clear()
+            self.__roots.update(roots)
+
+            # Compact the stored hierarchy if there are too many deltas,
+            # and build the closure index if it is enabled but missing
+            dbupdate = deltas >= COMPACT or self.closure and not row.closure
             self.__status(dirty=False,
-                                 dbupdate=None,
-                                 dbstatus=True)
+                          dbupdate=True if dbupdate else None,
+                          dbstatus=True,
+                          delta=last)
+            if self.__status("dbupdate"):
+                self.save()
             return
         else:
             self.__status(dirty=True,
@@ -206,6 +264,69 @@ class S3Hierarchy(object):
                           dbstatus=False if row else None)
         return
 
+    # -------------------------------------------------------------------------
+    @classmethod
+    def __read_stored(cls, tablename):
+        """
+            Read the stored hierarchy from s3_hierarchy and apply the
+            stored deltas
+
+            @param tablename: the tablename
+            @return: tuple (version, roots, nodes, number of deltas,
+                     ID of the last delta), or None if no clean hierarchy
+                     is stored
+        """
+
+        db = current.db
+        s3db = current.s3db
+
+        htable = s3db.s3_hierarchy
+        query = (htable.tablename == tablename)
+        row = db(query).select(htable.dirty,
+                               htable.version,
+                               htable.hierarchy,
+                               limitby=(0, 1)).first()
+        if not row or row.dirty:
+            return None
+
+        data = row.hierarchy
+        nodes = {}
+        for node_id, item in data["nodes"].items():
+            nodes[long(node_id)] = {"p": item["p"],
+                                    "c": item["c"],
+                                    "s": set(item["s"]) \
+                                         if item["s"] else set()}
+        roots = set(data["roots"])
+
+        # Apply the changes made since the hierarchy was stored
+        dtable = s3db.s3_hierarchy_delta
+        query = (dtable.tablename == tablename)
+        deltas = db(query).select(dtable.id, dtable.delta, orderby=dtable.id)
+        update_node = cls._update_node
+        for delta in deltas:
+            update_node(roots, nodes, delta.delta)
+        last = deltas.last().id if deltas else 0
+
+        return (row.version, roots, nodes, len(deltas), last)
+
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def __cache():
+        """
+            Get the cache backend for stored hierarchies
+
+            @return: a web2py cache object (or compatible callable),
+                     or None if hierarchies shall not be cached
+        """
+
+        backend = current.deployment_settings.get_base_hierarchy_cache()
+        if not backend:
+            return None
+        elif isinstance(backend, basestring):
+            return getattr(current.cache, backend, None)
+        else:
+            return backend
+
     # -------------------------------------------------------------------------
     def save(self):
         """ Save this hierarchy in s3_hierarchy """
@@ -238,18 +359,81 @@ class S3Hierarchy(object):
         htable = current.s3db.s3_hierarchy
         query = (htable.tablename == tablename)
         row = current.db(query).select(htable.id,
+                                       htable.dirty,
+                                       htable.closure,
+                                       htable.version,
                                        limitby=(0, 1)).first()
 
+        # Build the closure index unless it is current (it is maintained
+        # along with the deltas as long as the stored hierarchy is clean)
+        if self.closure:
+            if not row or row.dirty or not row.closure:
+                self.__build_closure()
+            data["closure"] = True
+        elif row and row.closure:
+            ctable = current.s3db.s3_hierarchy_closure
+            current.db(ctable.tablename == tablename).delete()
+            data["closure"] = False
+
         if row:
-            # Update record
-            row.update_record(**data)
+            # Update record, increment the version
+            data["version"] = self._next_version(htable, row)
+            current.db(htable.id == row.id).update(**data)
         else:
             # Create new record
+            data["version"] = 1
             htable.insert(**data)
 
+        # Remove the stored deltas which are now included in the hierarchy
+        # (but not those stored by other processes meanwhile)
+        last = self.__status("delta")
+        if last is not None:
+            dtable = current.s3db.s3_hierarchy_delta
+            query = (dtable.tablename == tablename) & \
+                    (dtable.id <= last)
+            current.db(query).delete()
+
         # Update status
         self.__status(dirty=False, dbupdate=None, dbstatus=True)
         return
+
+    # -------------------------------------------------------------------------
+    def __build_closure(self):
+        """ Rebuild the closure index for this hierarchy """
+
+        tablename = self.tablename
+
+        ctable = current.s3db.s3_hierarchy_closure
+        current.db(ctable.tablename == tablename).delete()
+
+        nodes = self.__nodes
+        items = []
+        append = items.append
+        insert = ctable.bulk_insert
+
+        # Walk the tree depth-first, carrying the path from the root
+        stack = [(root_id, ()) for root_id in self.__roots]
+        pop = stack.pop
+        while stack:
+            node_id, path = pop()
+            path = path + (node_id,)
+            depth = len(path) - 1
+            for i, ancestor_id in enumerate(path):
+                append({"tablename": tablename,
+                        "ancestor": ancestor_id,
+                        "descendant": node_id,
+                        "depth": depth - i,
+                        })
+            node = nodes.get(node_id)
+            if node and node["s"]:
+                stack.extend((child_id, path) for child_id in node["s"]
+                                              if child_id not in path)
+            if len(items) >= 1000:
+                insert(items)
+                del items[:]
+        if items:
+            insert(items)
+        return
         
     # -------------------------------------------------------------------------
     @classmethod
@@ -295,27 +479,369 @@ class S3Hierarchy(object):
         return
 
     # -------------------------------------------------------------------------
-    def read(self):
-        """ Rebuild this hierarchy from the target table """
+    @classmethod
+    def bind(cls, table):
+        """
+            Install table callbacks to apply all inserts, updates and
+            deletions in the target table incrementally to the hierarchy
+            (rather than marking it dirty), so that no full rebuild is
+            needed after changes. Called by S3Model.configure when a
+            hierarchy gets configured, can be called repeatedly.
 
-        tablename = self.tablename
-        if not tablename:
-            return
+            @param table: the target table
+        """
+
+        for hook in table._after_insert:
+            if getattr(hook, "s3hierarchy", False):
+                # Already bound
+                return
+
+        tablename = table._tablename
+
+        def after_insert(fields, record_id):
+            if record_id:
+                cls.updated(tablename, [record_id], fields=fields)
+        after_insert.s3hierarchy = True
+
+        def after_update(dbset, fields):
+            config = current.s3db.get_config(tablename, "hierarchy")
+            if not config:
+                return
+            parent, category = cls.__keys(table, config)
+            if parent in fields or \
+               category and category in fields or \
+               "deleted" in fields:
+                rows = dbset.select(table._id)
+                cls.updated(tablename, [row[table._id] for row in rows])
+        after_update.s3hierarchy = True
+
+        def before_delete(dbset):
+            rows = dbset.select(table._id)
+            cls.deleted(tablename, [row[table._id] for row in rows])
+            # Must not return True (would cancel the deletion)
+            return None
+        before_delete.s3hierarchy = True
+
+        table._after_insert.append(after_insert)
+        table._after_update.append(after_update)
+        table._before_delete.append(before_delete)
+        return
+
+    # -------------------------------------------------------------------------
+    @classmethod
+    def updated(cls, tablename, record_ids, fields=None):
+        """
+            Apply inserted or updated records to the hierarchy
+
+            @param tablename: the tablename
+            @param record_ids: the record IDs
+            @param fields: the field values of an insert (saves the
+                           lookup of the record, only with a single ID)
+        """
 
         s3db = current.s3db
-        table = s3db[tablename]
-        
+
         config = s3db.get_config(tablename, "hierarchy")
-        if not config:
+        if not config or not record_ids:
             return
-            
+        table = s3db.table(tablename)
+        if table is None:
+            return
+        parent, category = cls.__keys(table, config)
+
+        deltas = []
+        if fields is not None and len(record_ids) == 1:
+            if fields.get("deleted"):
+                deltas.append({"o": "d", "n": long(record_ids[0])})
+            else:
+                if category:
+                    c = fields.get(category, table[category].default)
+                else:
+                    c = None
+                p = fields.get(parent)
+                deltas.append({"o": "u",
+                               "n": long(record_ids[0]),
+                               "p": long(p) if p else None,
+                               "c": c,
+                               })
+        else:
+            pkey = table._id
+            qfields = [pkey, table[parent]]
+            if category:
+                qfields.append(table[category])
+            if "deleted" in table.fields:
+                qfields.append(table.deleted)
+            rows = current.db(pkey.belongs(record_ids)).select(*qfields)
+            for row in rows:
+                if row.get("deleted"):
+                    deltas.append({"o": "d", "n": long(row[pkey])})
+                else:
+                    p = row[parent]
+                    deltas.append({"o": "u",
+                                   "n": long(row[pkey]),
+                                   "p": long(p) if p else None,
+                                   "c": row[category] if category else None,
+                                   })
+        cls.__apply(tablename, deltas)
+        return
+
+    # -------------------------------------------------------------------------
+    @classmethod
+    def deleted(cls, tablename, record_ids):
+        """
+            Remove deleted records from the hierarchy
+
+            @param tablename: the tablename
+            @param record_ids: the record IDs
+        """
+
+        config = current.s3db.get_config(tablename, "hierarchy")
+        if not config or not record_ids:
+            return
+        cls.__apply(tablename, [{"o": "d", "n": long(record_id)}
+                                for record_id in record_ids])
+        return
+
+    # -------------------------------------------------------------------------
+    @classmethod
+    def __apply(cls, tablename, deltas):
+        """
+            Apply changes to the hierarchy in memory (if it is loaded
+            and clean), and store them as deltas (if a clean hierarchy
+            is stored)
+
+            @param tablename: the tablename
+            @param deltas: list of deltas, like:
+                           {"o": "u", "n": <node_id>,
+                            "p": <parent_id>, "c": <category>}
+                           for inserts/updates, and
+                           {"o": "d", "n": <node_id>}
+                           for deletions
+        """
+
+        if not deltas:
+            return
+
+        # Update the hierarchy in memory
+        hierarchies = current.model.hierarchies
+        if tablename in hierarchies:
+            hierarchy = hierarchies[tablename]
+            if not hierarchy["flags"].get("dirty"):
+                roots = hierarchy["roots"]
+                nodes = hierarchy["nodes"]
+                update_node = cls._update_node
+                for delta in deltas:
+                    update_node(roots, nodes, delta)
+
+        # Store the deltas
+        db = current.db
+        s3db = current.s3db
+        htable = s3db.s3_hierarchy
+        query = (htable.tablename == tablename)
+        row = db(query).select(htable.id,
+                               htable.dirty,
+                               htable.closure,
+                               htable.version,
+                               limitby=(0, 1)).first()
+        if row and not row.dirty:
+            dtable = s3db.s3_hierarchy_delta
+            for delta in deltas:
+                dtable.insert(tablename=tablename, delta=delta)
+            # Increment the version (invalidates cached hierarchies)
+            data = {"version": cls._next_version(htable, row)}
+            if row.closure:
+                if s3db.get_config(tablename, "hierarchy_closure"):
+                    # Update the closure index
+                    update_closure = cls._update_closure
+                    for delta in deltas:
+                        update_closure(tablename, delta)
+                else:
+                    # Closure index is outdated from here
+                    data["closure"] = False
+            db(htable.id == row.id).update(**data)
+        return
+
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def _update_closure(tablename, delta):
+        """
+            Apply a single delta to the closure index, mirrors
+            _update_node
+
+            @param tablename: the tablename
+            @param delta: the delta (see __apply)
+        """
+
+        db = current.db
+        ctable = current.s3db.s3_hierarchy_closure
+
+        base = (ctable.tablename == tablename)
+        node_id = delta["n"]
+
+        # Current subtree of the node (including the node itself)
+        query = base & (ctable.ancestor == node_id)
+        rows = db(query).select(ctable.descendant, ctable.depth)
+        subtree = dict((row.descendant, row.depth) for row in rows)
+
+        # Current ancestors of the node
+        query = base & (ctable.descendant == node_id) & (ctable.depth > 0)
+        rows = db(query).select(ctable.ancestor, ctable.depth)
+        ancestors = dict((row.ancestor, row.depth) for row in rows)
+
+        def detach():
+            if ancestors and subtree:
+                query = base & \
+                        (ctable.ancestor.belongs(ancestors.keys())) & \
+                        (ctable.descendant.belongs(subtree.keys()))
+                db(query).delete()
+
+        if delta["o"] == "d":
+            if not subtree:
+                return
+            detach()
+            if len(subtree) == 1:
+                query = base & (ctable.ancestor == node_id)
+                db(query).delete()
+            # else: keep as root node for its children (like _update_node)
+            return
+
+        parent_id = delta.get("p")
+        previous = None
+        for ancestor_id, depth in ancestors.items():
+            if depth == 1:
+                previous = ancestor_id
+                break
+        if subtree and previous == parent_id:
+            # Position in the tree unchanged
+            return
+
+        if not subtree:
+            ctable.insert(tablename=tablename,
+                          ancestor=node_id,
+                          descendant=node_id,
+                          depth=0)
+            subtree = {node_id: 0}
+        else:
+            detach()
+
+        if parent_id and parent_id not in subtree:
+            # Ancestors of the new parent (including the parent itself)
+            query = base & (ctable.descendant == parent_id)
+            rows = db(query).select(ctable.ancestor, ctable.depth)
+            upper = dict((row.ancestor, row.depth) for row in rows)
+            if not upper:
+                ctable.insert(tablename=tablename,
+                              ancestor=parent_id,
+                              descendant=parent_id,
+                              depth=0)
+                upper = {parent_id: 0}
+            items = [{"tablename": tablename,
+                      "ancestor": ancestor_id,
+                      "descendant": descendant_id,
+                      "depth": adepth + ddepth + 1,
+                      }
+                     for ancestor_id, adepth in upper.items()
+                     for descendant_id, ddepth in subtree.items()]
+            ctable.bulk_insert(items)
+        return
+
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def _next_version(htable, row):
+        """
+            Get the next version number for a stored hierarchy
+
+            @param htable: the s3_hierarchy table
+            @param row: the s3_hierarchy row (including the version)
+
+            @return: an expression incrementing the version in the
+                     database (to not miss concurrent increments)
+        """
+
+        if row.version is None:
+            return 1
+        return htable.version + 1
+
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def _update_node(roots, nodes, delta):
+        """
+            Apply a single delta to a nodes dict; nodes are replaced by
+            copies before changing them since they may be shared with
+            the hierarchy cache
+
+            @param roots: the set of root node IDs
+            @param nodes: the nodes dict
+            @param delta: the delta (see __apply)
+        """
+
+        def own(node_id):
+            node = nodes[node_id]
+            node = nodes[node_id] = dict(node, s=set(node["s"]))
+            return node
+
+        node_id = delta["n"]
+
+        if delta["o"] == "d":
+            if node_id not in nodes:
+                return
+            node = own(node_id)
+            # Detach from parent
+            parent_id = node["p"]
+            if parent_id and parent_id in nodes:
+                own(parent_id)["s"].discard(node_id)
+            if node["s"]:
+                # Keep as root node for its children (like read() does)
+                node["p"] = None
+                node["c"] = None
+                roots.add(node_id)
+            else:
+                del nodes[node_id]
+                roots.discard(node_id)
+            return
+
+        parent_id = delta.get("p")
+        category = delta.get("c")
+        if node_id not in nodes:
+            node = nodes[node_id] = {"s": set(), "c": category, "p": None}
+        else:
+            node = own(node_id)
+            node["c"] = category
+            # Detach from previous parent
+            previous = node["p"]
+            if previous and previous != parent_id and previous in nodes:
+                own(previous)["s"].discard(node_id)
+
+        if parent_id:
+            if parent_id not in nodes:
+                nodes[parent_id] = {"s": set(), "c": None, "p": None}
+                roots.add(parent_id)
+            own(parent_id)["s"].add(node_id)
+            roots.discard(node_id)
+        else:
+            roots.add(node_id)
+        node["p"] = parent_id
+        return
+
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def __keys(table, config):
+        """
+            Get the names of the parent and category fields in a table
+
+            @param table: the table
+            @param config: the hierarchy configuration of the table
+            @return: tuple (parent, category), with parent=None if no
+                     parent field could be found
+        """
+
         if isinstance(config, tuple):
             parent, category = config[:2]
         else:
             parent, category = config, None
         if parent is None:
+            tablename = table._tablename
             pkey = table._id.name
-            parent_field = None
             for field in table:
                 ftype = str(field.type)
                 if ftype[:9] == "reference":
@@ -323,22 +849,45 @@ class S3Hierarchy(object):
                     if key[0] == tablename and \
                        (len(key) == 1 or key[1] == pkey):
                         parent = field.name
-                        parent_field = field
                         break
-        else:
-            parent_field = table[parent]
-        if not parent_field:
+        return parent, category
+
+    # -------------------------------------------------------------------------
+    def read(self):
+        """ Rebuild this hierarchy from the target table """
+
+        tablename = self.tablename
+        if not tablename:
+            return
+
+        s3db = current.s3db
+        table = s3db[tablename]
+        
+        config = s3db.get_config(tablename, "hierarchy")
+        if not config:
+            return
+            
+        parent, category = self.__keys(table, config)
+        if not parent:
             raise AttributeError
+        parent_field = table[parent]
             
         fields = [table._id, parent_field]
         if category is not None:
             fields.append(table[category])
 
+        # Deltas stored so far are included in the rebuilt hierarchy
+        db = current.db
+        dtable = s3db.s3_hierarchy_delta
+        last = dtable.id.max()
+        row = db(dtable.tablename == tablename).select(last).first()
+        last = row[last] or 0 if row else 0
+
         if "deleted" in table:
             query = (table.deleted != True)
         else:
             query = (table.id > 0)
-        rows = current.db(query).select(*fields)
+        rows = db(query).select(*fields)
 
         self.__nodes.clear()
         self.__roots.clear()
@@ -354,7 +903,7 @@ class S3Hierarchy(object):
             add(n, parent_id=p, category=c)
 
         # Update status: memory is clean, db needs update
-        self.__status(dirty=False, dbupdate=True)
+        self.__status(dirty=False, dbupdate=True, delta=last)
         return
 
     # -------------------------------------------------------------------------
@@ -622,6 +1171,81 @@ class S3Hierarchy(object):
                 result.add(this)
         return result
 
+    # -------------------------------------------------------------------------
+    def subtree_query(self, field, node_ids, inclusive=True):
+        """
+            Get a query for all records with a value of field in the
+            subtrees of the given nodes. Uses the closure index (single
+            sub-select) if available, otherwise the node IDs are looked
+            up from the hierarchy.
+
+            @param field: the Field (primary key of the target table, or
+                          a foreign key referencing it)
+            @param node_ids: the node ID (can be an iterable of node IDs)
+            @param inclusive: include the start node(s)
+
+            @return: the query
+        """
+
+        if not hasattr(node_ids, "__iter__"):
+            node_ids = [node_ids]
+        start = set()
+        for node_id in node_ids:
+            try:
+                start.add(long(node_id))
+            except (TypeError, ValueError):
+                continue
+
+        if self.__indexed():
+            ctable = current.s3db.s3_hierarchy_closure
+            query = (ctable.tablename == self.tablename) & \
+                    (ctable.ancestor.belongs(list(start)))
+            if not inclusive:
+                query &= (ctable.depth > 0)
+            return field.belongs(current.db(query)._select(ctable.descendant))
+        else:
+            node_ids = self.findall(start, inclusive=inclusive)
+            return field.belongs(list(node_ids))
+
+    # -------------------------------------------------------------------------
+    def parents(self, node_ids):
+        """
+            Get the parents of nodes and of all their ancestors, uses
+            the closure index (single query) if available
+
+            @param node_ids: the node IDs
+
+            @return: a dict {node_id: parent_id} (parent_id None for
+                     root nodes)
+        """
+
+        result = {}
+
+        if self.__indexed():
+            ctable = current.s3db.s3_hierarchy_closure
+            query = (ctable.tablename == self.tablename) & \
+                    (ctable.descendant.belongs(list(set(node_ids))))
+            rows = current.db(query).select(ctable.ancestor,
+                                            ctable.descendant,
+                                            ctable.depth)
+            paths = {}
+            for row in rows:
+                path = paths.setdefault(row.descendant, {})
+                path[row.depth] = row.ancestor
+            for path in paths.values():
+                for depth, node_id in path.items():
+                    result[node_id] = path.get(depth + 1)
+        else:
+            nodes = self.nodes
+            for node_id in node_ids:
+                while node_id in nodes and node_id not in result:
+                    parent_id = nodes[node_id]["p"]
+                    if parent_id not in nodes:
+                        parent_id = None
+                    result[node_id] = parent_id
+                    node_id = parent_id
+        return result
+
     # -------------------------------------------------------------------------
     def _represent(self, node_ids=None, renderer=None):
         """
@@ -662,14 +1286,15 @@ class S3Hierarchy(object):
             labels = renderer.bulk(list(pending), list_type = False)
             for node_id, label in labels.items():
                 if node_id in nodes:
-                    nodes[node_id][LABEL] = label
+                    # Copy the node (may be shared with the cache)
+                    nodes[node_id] = dict(nodes[node_id], l=label)
         else:
             for node_id in pending:
                 try:
                     label = renderer(node_id)
                 except:
                     label = s3_unicode(node_id)
-                nodes[node_id][LABEL] = label
+                nodes[node_id] = dict(nodes[node_id], l=label)
         return
 
     # -------------------------------------------------------------------------
@@ -690,6 +1315,7 @@ class S3Hierarchy(object):
                 return node[LABEL]
             else:
                 self._represent(node_ids=[node_id], renderer=represent)
+                node = nodes.get(node_id)
             if LABEL in node:
                 return node[LABEL]
         return None
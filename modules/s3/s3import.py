@@ -1778,6 +1778,7 @@ class S3ImportItem(object):
         self.accepted = None
         self.permitted = False
         self.committed = False
+        self.deduplicated = False
 
         # Writeback hook for circular references:
         # Items which need a second write to update references
@@ -1825,8 +1826,8 @@ class S3ImportItem(object):
         self.tablename = table._tablename
 
         if original is None:
-            original = S3Resource.original(table, element,
-                                           mandatory=self._mandatory_fields())
+            original = self.job.original(table, element,
+                                         mandatory=self._mandatory_fields())
         postprocess = s3db.get_config(self.tablename, "xml_post_parse")
         data = xml.record(table, element,
                           files=files,
@@ -1892,8 +1893,8 @@ class S3ImportItem(object):
         if self.original is not None:
             original = self.original
         elif self.data:
-            original = S3Resource.original(table, self.data,
-                                           mandatory=mandatory)
+            original = self.job.original(table, self.data,
+                                         mandatory=mandatory)
         else:
             original = None
 
@@ -1921,8 +1922,13 @@ class S3ImportItem(object):
             else:
                 resolve = current.s3db.get_config(self.tablename, RESOLVER)
                 if data and resolve:
-                    resolve(self)
-                if self.id and self.method in (UPDATE, DELETE, MERGE):
+                    if not self.deduplicated:
+                        # Try batch deduplication first
+                        self.job.deduplicate(self)
+                    if not self.deduplicated:
+                        resolve(self)
+                if self.id and self.method in (UPDATE, DELETE, MERGE) and \
+                   self.original is None:
                     fields = S3Resource.import_fields(table, data,
                                                       mandatory=mandatory)
                     self.original = current.db(table._id == self.id) \
@@ -2375,6 +2381,11 @@ class S3ImportItem(object):
                 if MCI in table.fields:
                     data[MCI] = self.mci
 
+                # Defer the insert to a bulk insert?
+                if self.job.defer(self, data):
+                    _debug("Deferred: %s" % tablename)
+                    return True
+
                 # Insert the new record
                 try:
                     success = table.insert(**dict(data))
@@ -2420,6 +2431,7 @@ class S3ImportItem(object):
                     self.error = resource.error
                     self.skip = True
                     return ignore_errors
+                self.job.written(self)
 
             _debug("Success: %s, id=%s %sd" % (tablename, self.id,
                                                self.skip and "skippe" or \
@@ -2463,6 +2475,8 @@ class S3ImportItem(object):
                         return ignore_errors
                     if success:
                         self.committed = True
+                        self.job.written(self)
+                        self.job.written(self, record_id=original_id)
                 else:
                     self.skip = True
 
@@ -2474,8 +2488,33 @@ class S3ImportItem(object):
         else:
             raise RuntimeError("unknown import method: %s" % method)
 
+        return self._postcommit()
+
+    # -------------------------------------------------------------------------
+    def _postcommit(self, record=None, super_keys=None):
+        """
+            Audit, super-entity links, record owner and onaccept for a
+            committed item, and update of the items referencing it
+
+            @param record: the record (bulk commit: already loaded)
+            @param super_keys: the super-keys of the record (bulk commit:
+                               super-entity links already created)
+        """
+
+        db = current.db
+        s3db = current.s3db
+
+        method = self.method
+        METHOD = self.METHOD
+        CREATE = METHOD.CREATE
+        UPDATE = METHOD.UPDATE
+
+        table = self.table
+        tablename = self.tablename
+
         # Audit + onaccept on successful commits
         if self.committed:
+            self.job.written(self, data=self.data)
             form = Storage()
             form.method = method
             form.vars = self.data
@@ -2487,10 +2526,17 @@ class S3ImportItem(object):
                           record=self.id,
                           representation="xml")
             # Update super entity links
-            s3db.update_super(table, form.vars)
+            if super_keys is None:
+                s3db.update_super(table, form.vars)
+            else:
+                form.vars.update(super_keys)
             if method == CREATE:
                 # Set record owner
-                current.auth.s3_set_record_owner(table, self.id)
+                if record is not None:
+                    record.update(super_keys or {})
+                    current.auth.s3_set_record_owner(table, record)
+                else:
+                    current.auth.s3_set_record_owner(table, self.id)
             elif method == UPDATE:
                 # Update realm
                 update_realm = s3db.get_config(table, "update_realm")
@@ -2644,6 +2690,27 @@ class S3ImportItem(object):
                 if item:
                     item.update.append(dict(item=self, field=fkey))
 
+    # -------------------------------------------------------------------------
+    def _resolvable(self):
+        """
+            Check whether all references of this item can be resolved
+            now, i.e. neither the parent item nor any of the referenced
+            items is still pending
+        """
+
+        parent = self.parent
+        if parent is not None and not parent.id:
+            return False
+        items = self.job.items
+        for reference in self.references:
+            entry = reference.entry
+            if not entry or entry.id or not entry.item_id:
+                continue
+            item = items[entry.item_id]
+            if item and not item.id:
+                return False
+        return True
+
     # -------------------------------------------------------------------------
     def _update_reference(self, field, value):
         """
@@ -2812,6 +2879,12 @@ class S3ImportJob():
     JOB_TABLE_NAME = "s3_import_job"
     ITEM_TABLE_NAME = "s3_import_item"
 
+    # Maximum number of values per query when indexing originals
+    INDEX_CHUNK_SIZE = 500
+
+    # Maximum number of records per bulk insert
+    BULK_INSERT_SIZE = 200
+
     # -------------------------------------------------------------------------
     def __init__(self, table,
                  tree=None,
@@ -2850,6 +2923,24 @@ class S3ImportJob():
         self.items = Storage()
         self.references = []
 
+        # Index of original records {tablename: index}
+        self.originals = {}
+        # Items deduplicated in bulk {tablename: set of item_ids}
+        self.batches = {}
+
+        # Index of the resource elements in the tree
+        # {(tablename, attribute, uid): element}
+        self.element_index = None
+        # Record IDs for UIDs {(tablename, uid): id}
+        self.uid_index = {}
+        # Reference resolution counters
+        self.reset_stats()
+
+        # Pending bulk inserts [(item, data)], None outside of commit
+        self.pending = None
+        # Unique keys of the pending bulk inserts
+        self.pending_keys = set()
+
         self.job_table = None
         self.item_table = None
 
@@ -3108,7 +3199,6 @@ class S3ImportJob():
                               (will be filled in by this function)
         """
 
-        db = current.db
         s3db = current.s3db
         xml = current.xml
         import_uid = xml.import_uid
@@ -3187,11 +3277,7 @@ class S3ImportJob():
             # Create a UID<->ID map
             id_map = Storage()
             if attr == UID and uids:
-                _uids = map(import_uid, uids)
-                query = ktable[UID].belongs(_uids)
-                records = db(query).select(ktable.id,
-                                           ktable[UID])
-                id_map = dict([(r[UID], r.id) for r in records])
+                id_map = self.lookup_uids(ktable, map(import_uid, uids))
 
             if not uids:
                 # Anonymous reference: <resource> inside the element
@@ -3204,22 +3290,22 @@ class S3ImportJob():
 
             elif root is not None:
 
+                index = self.index_elements(root)
+                stats = self.stats
+
                 for uid in uids:
 
+                    stats.lookups += 1
                     entry = None
                     # Entry already in directory?
                     if directory is not None:
                         entry = directory.get((tablename, attr, uid), None)
                     if not entry:
-                        expr = './/%s[@%s="%s" and @%s=$uid]' % (
-                                    TAG.resource,
-                                    ATTRIBUTE.name,
-                                    tablename,
-                                    attr)
-                        e = root.xpath(expr, uid=uid)
-                        if e:
+                        e = index.get((tablename, attr, uid))
+                        if e is not None:
                             # Element in the source => append to relements
-                            relements.append(e[0])
+                            stats.elements += 1
+                            relements.append(e)
                         else:
                             # No element found, see if original record exists
                             _uid = import_uid(uid)
@@ -3230,12 +3316,15 @@ class S3ImportJob():
                                                 uid=uid,
                                                 id=_id,
                                                 item_id=None)
+                                stats.records += 1
                                 reference_list.append(Storage(field=field,
                                                               element=reference,
                                                               entry=entry))
                             else:
+                                stats.unresolved += 1
                                 continue
                     else:
+                        stats.directory += 1
                         reference_list.append(Storage(field=field,
                                                       element=reference,
                                                       entry=entry))
@@ -3264,6 +3353,118 @@ class S3ImportJob():
 
         return reference_list
 
+    # -------------------------------------------------------------------------
+    def index_elements(self, root):
+        """
+            Index all resource elements in the tree by tablename and
+            UID/TUID in a single pass, to look up referenced elements
+
+            @param root: the root element of the tree
+
+            @return: dict {(tablename, attribute, uid): element}, with the
+                     first element in document order for each key
+        """
+
+        index = self.element_index
+        if index is not None and index[0] is root:
+            return index[1]
+
+        start = datetime.now()
+
+        xml = current.xml
+        ATTRIBUTE = xml.ATTRIBUTE
+        NAME = ATTRIBUTE.name
+        attributes = (xml.UID, ATTRIBUTE.tuid)
+
+        elements = {}
+        for element in root.iterdescendants(xml.TAG.resource):
+            tablename = element.get(NAME)
+            if not tablename:
+                continue
+            for attr in attributes:
+                uid = element.get(attr)
+                if uid is not None:
+                    key = (tablename, attr, uid)
+                    if key not in elements:
+                        elements[key] = element
+
+        self.element_index = (root, elements)
+
+        stats = self.stats
+        stats.indexed = len(elements)
+        stats.index_time += (datetime.now() - start).total_seconds()
+
+        return elements
+
+    # -------------------------------------------------------------------------
+    def lookup_uids(self, table, uids):
+        """
+            Look up the record IDs for UIDs, remembering the results so
+            that every UID is looked up in the database only once
+
+            @param table: the table
+            @param uids: the UIDs (with the domain prefix removed)
+
+            @return: dict {uid: record_id} of the UIDs found
+        """
+
+        tablename = table._tablename
+        index = self.uid_index
+
+        missing = set(uid for uid in uids
+                      if uid and (tablename, uid) not in index)
+        if missing:
+            UID = current.xml.UID
+            query = table[UID].belongs(missing)
+            rows = current.db(query).select(table._id, table[UID])
+            self.stats.queries += 1
+            pkey = table._id.name
+            for row in rows:
+                index[(tablename, row[UID])] = row[pkey]
+            for uid in missing:
+                if (tablename, uid) not in index:
+                    index[(tablename, uid)] = None
+
+        id_map = {}
+        for uid in uids:
+            record_id = index.get((tablename, uid))
+            if record_id is not None:
+                id_map[uid] = record_id
+        return id_map
+
+    # -------------------------------------------------------------------------
+    def reset_stats(self):
+        """ Reset the reference resolution counters """
+
+        self.stats = Storage(indexed = 0,
+                             index_time = 0.0,
+                             lookups = 0,
+                             directory = 0,
+                             elements = 0,
+                             records = 0,
+                             unresolved = 0,
+                             queries = 0,
+                             )
+
+    # -------------------------------------------------------------------------
+    def reference_stats(self):
+        """
+            Get the reference resolution counters of this job, e.g. to
+            profile imports
+
+            @return: a dict with the counters:
+                     indexed: number of keys in the element index
+                     index_time: time spent indexing the tree (seconds)
+                     lookups: number of UID/TUID references looked up
+                     directory: lookups resolved from the directory
+                     elements: lookups resolved to elements in the tree
+                     records: lookups resolved to existing records
+                     unresolved: lookups which could not be resolved
+                     queries: number of UID queries to the database
+        """
+
+        return dict(self.stats)
+
     # -------------------------------------------------------------------------
     def load_item(self, row):
         """
@@ -3317,6 +3518,8 @@ class S3ImportJob():
         ATTRIBUTE = current.xml.ATTRIBUTE
         METHOD = S3ImportItem.METHOD
 
+        _debug("Reference resolution: %s" % self.reference_stats())
+
         # Resolve references
         import_list = []
         for item_id in self.items:
@@ -3334,21 +3537,35 @@ class S3ImportJob():
         tablename = self.table._tablename
         
         failed = False
+        logged = set()
+        self.pending = []
+        self.pending_keys = set()
         for item_id in import_list:
             item = items[item_id]
-            error = None
-            
+
+            # Complete pending bulk inserts which this item could depend on
+            # or be a duplicate of
+            if self.pending and not self.defer_ok(item):
+                if not self.commit_bulk(ignore_errors=ignore_errors):
+                    failed = True
+
             if item.accepted is not False:
-                logged = False
                 success = item.commit(ignore_errors=ignore_errors)
             else:
                 # Field validation failed
-                logged = True
+                logged.add(item_id)
                 success = ignore_errors
 
             if not success:
                 failed = True
-                
+
+        if self.pending:
+            if not self.commit_bulk(ignore_errors=ignore_errors):
+                failed = True
+        self.pending = None
+
+        for item_id in import_list:
+            item = items[item_id]
             error = item.error
             if error:
                 self.error = error
@@ -3356,7 +3573,7 @@ class S3ImportJob():
                 if element is not None:
                     if not element.get(ATTRIBUTE.error, False):
                         element.set(ATTRIBUTE.error, str(self.error))
-                    if not logged:
+                    if item_id not in logged:
                         self.error_tree.append(deepcopy(element))
                     
             elif item.tablename == tablename:
@@ -3381,6 +3598,469 @@ class S3ImportJob():
         self.deleted = deleted
         return True
 
+    # -------------------------------------------------------------------------
+    def defer(self, item, data):
+        """
+            Defer the insert of a new record to a bulk insert, if the
+            table is configured for bulk inserts (s3db.configure with
+            bulk_insert=True)
+
+            NB items of tables with a deduplicate resolver can only be
+               deferred together if they have been deduplicated in the
+               same batch (i.e. with a bulk_deduplicate resolver)
+
+            @param item: the S3ImportItem
+            @param data: the record data
+
+            @return: True if the insert has been deferred, otherwise False
+        """
+
+        pending = self.pending
+        if pending is None or \
+           not current.s3db.get_config(item.tablename, "bulk_insert") or \
+           item.update or not self.defer_ok(item):
+            return False
+        pending.append((item, data))
+        self.pending_keys.update(self._record_keys(item.table, data).values())
+        return True
+
+    # -------------------------------------------------------------------------
+    def defer_ok(self, item):
+        """
+            Check whether an item can be committed while there are pending
+            bulk inserts, i.e. if it is of the same table, does not
+            reference any of the pending items, and can not be a duplicate
+            of any of them (which would only be found once they are
+            inserted)
+
+            @param item: the S3ImportItem
+        """
+
+        pending = self.pending
+        if not pending:
+            return True
+        tablename = item.tablename
+        if tablename != pending[0][0].tablename or \
+           len(pending) >= self.BULK_INSERT_SIZE:
+            return False
+        pending_ids = set(i.item_id for i, d in pending)
+        for reference in item.references:
+            entry = reference.entry
+            if entry and entry.item_id in pending_ids:
+                return False
+
+        # Same UID or unique key as a pending item?
+        if item.data:
+            keys = self._record_keys(item.table, item.data)
+            if self.pending_keys.intersection(keys.values()):
+                return False
+
+        # The deduplicate resolver could find the item to be a duplicate
+        # of a pending item, unless the item and all pending items have
+        # been deduplicated in the same batch (i.e. have different keys)
+        if current.s3db.get_config(tablename, "deduplicate"):
+            batch = self.batches.get(tablename)
+            if not batch or item.item_id not in batch or \
+               not pending_ids.issubset(batch):
+                return False
+        return True
+
+    # -------------------------------------------------------------------------
+    def commit_bulk(self, ignore_errors=False):
+        """
+            Complete the pending bulk inserts: insert all records (with
+            multi-row INSERTs where possible), create their super-entity
+            links in bulk, then set the record owners and run the onaccept
+            callbacks in import order
+
+            @param ignore_errors: skip items which can not be inserted
+
+            @return: True if successful, otherwise False
+        """
+
+        pending = self.pending
+        if not pending:
+            return True
+        self.pending = []
+        self.pending_keys = set()
+
+        items = [i for i, d in pending]
+        table = items[0].table
+
+        # Insert the records with multi-row INSERTs, records which can
+        # not be inserted are reported with their error
+        errors = {}
+        ids = current.s3db.insert_rows(table, [d for i, d in pending],
+                                       errors=errors)
+        for index, error in errors.items():
+            item = items[index]
+            item.error = error
+            item.skip = True
+
+        success = True
+        for item, record_id in zip(items, ids):
+            if record_id:
+                item.id = record_id
+                item.committed = True
+            elif not item.skip:
+                item.skip = True
+            if item.error and not ignore_errors:
+                success = False
+
+        # Super-entity links
+        ids = [item.id for item in items if item.committed]
+        super_keys = current.s3db.update_super_bulk(table, ids)
+
+        # Reload the records (to set the record owners)
+        query = table._id.belongs(ids)
+        rows = current.db(query).select(*[table[fn] for fn in table.fields])
+        pkey = table._id.name
+        records = dict((row[pkey], row) for row in rows)
+
+        for item in items:
+            if item.committed:
+                item._postcommit(record=records.get(item.id),
+                                 super_keys=super_keys.get(item.id, {}))
+
+        return success
+
+    # -------------------------------------------------------------------------
+    def original(self, table, record, mandatory=None):
+        """
+            Find the original record for a possible duplicate, same as
+            S3Resource.original, but looked up in an index of the
+            originals for all elements of the same table in the import
+            tree (built with set-based queries) rather than with one
+            query per item.
+
+            @param table: the table
+            @param record: the record as dict or S3XML Element
+            @param mandatory: the mandatory fields of the table
+        """
+
+        index = self._index(table)
+        if index is None:
+            return S3Resource.original(table, record, mandatory=mandatory)
+
+        UID = current.xml.UID
+        keys = self._record_keys(table, record)
+
+        covered = index.covered
+        for k in keys.values():
+            if k not in covered:
+                # Value not in the index
+                return S3Resource.original(table, record, mandatory=mandatory)
+
+        rows = index.rows
+
+        # Try to find exactly one match by non-UID unique keys
+        matches = set()
+        for f in keys:
+            if f != UID:
+                matches |= rows.get(keys[f], set())
+        if len(matches) == 1:
+            return self._index_record(index, table, list(matches)[0])
+
+        # If no match, then try to find a UID-match
+        if UID in keys:
+            matches = rows.get(keys[UID])
+            if matches:
+                return self._index_record(index, table, min(matches))
+
+        # No match or multiple matches
+        return None
+
+    # -------------------------------------------------------------------------
+    def _index(self, table):
+        """
+            Get the index of original records for a table, build it from
+            the elements in the import tree at the first call
+
+            @param table: the table
+
+            @return: the index as Storage, or None if there is no tree
+        """
+
+        tree = self.tree
+        if tree is None:
+            return None
+
+        tablename = table._tablename
+        indexes = self.originals
+        if tablename in indexes:
+            return indexes[tablename]
+
+        db = current.db
+        xml = current.xml
+        UID = xml.UID
+
+        if isinstance(tree, etree._Element):
+            root = tree
+        else:
+            root = tree.getroot()
+
+        # Collect the keys of all elements of this table
+        expr = ".//%s[@%s='%s']" % (xml.TAG.resource,
+                                    xml.ATTRIBUTE.name,
+                                    tablename)
+        values = {}
+        original_keys = S3Resource.original_keys
+        for element in root.xpath(expr):
+            pvalues = original_keys(table, element)
+            for f in pvalues:
+                v = pvalues[f]
+                if f == UID:
+                    v = xml.import_uid(v)
+                if f not in values:
+                    values[f] = set()
+                values[f].add(v)
+
+        # Select all fields, as the items may contain any of them
+        fields = [table[f] for f in table.fields]
+
+        index = Storage(rows={},
+                        records={},
+                        keys={},
+                        covered=set(),
+                        fields=fields)
+        add = self._index_add
+        key = self._key
+        pkey = table._id.name
+        for f in values:
+            items = list(values[f])
+            for i in xrange(0, len(items), self.INDEX_CHUNK_SIZE):
+                chunk = items[i:i + self.INDEX_CHUNK_SIZE]
+                query = (table[f].belongs(chunk))
+                for row in db(query).select(*fields):
+                    if row[pkey] not in index.records:
+                        add(index, table, row)
+                        index.records[row[pkey]] = row
+            index.covered.update(key(f, v) for v in items)
+
+        indexes[tablename] = index
+        return index
+
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def _key(fieldname, value):
+        """
+            Get the index key for a unique field value
+
+            @param fieldname: the field name
+            @param value: the value (UIDs with the domain prefix removed)
+        """
+
+        return (fieldname, s3_unicode(value))
+
+    # -------------------------------------------------------------------------
+    def _record_keys(self, table, record):
+        """
+            Get the index keys for the unique field values of a record
+
+            @param table: the table
+            @param record: the record as dict or S3XML Element
+
+            @return: dict {fieldname: key}
+        """
+
+        xml = current.xml
+        UID = xml.UID
+        key = self._key
+
+        pvalues = S3Resource.original_keys(table, record)
+        if UID in pvalues:
+            pvalues[UID] = xml.import_uid(pvalues[UID])
+        return dict((f, key(f, pvalues[f])) for f in pvalues)
+
+    # -------------------------------------------------------------------------
+    def _index_add(self, index, table, record, record_id=None):
+        """
+            Add the keys of a record to an index of originals
+
+            @param index: the index
+            @param table: the table
+            @param record: the record (Row or dict)
+            @param record_id: the record ID (if not in the record)
+        """
+
+        if record_id is None:
+            record_id = record[table._id.name]
+
+        key = self._key
+        rows = index.rows
+        keys = index.keys.get(record_id)
+        if keys is None:
+            keys = index.keys[record_id] = set()
+
+        for f in table.fields:
+            if not table[f].unique or f not in record:
+                continue
+            # Remove the previous key for this field
+            for k in [k for k in keys if k[0] == f]:
+                keys.discard(k)
+                if k in rows:
+                    rows[k].discard(record_id)
+            value = record[f]
+            if value:
+                k = key(f, value)
+                keys.add(k)
+                if k in rows:
+                    rows[k].add(record_id)
+                else:
+                    rows[k] = set([record_id])
+        return
+
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def _index_record(index, table, record_id):
+        """
+            Get a record from an index of originals, (re-)loading it from
+            the database if it has been written during this import
+
+            @param index: the index
+            @param table: the table
+            @param record_id: the record ID
+        """
+
+        records = index.records
+        record = records.get(record_id)
+        if record is None:
+            query = (table._id == record_id)
+            record = current.db(query).select(limitby=(0, 1),
+                                              *index.fields).first()
+            records[record_id] = record
+        return record
+
+    # -------------------------------------------------------------------------
+    def written(self, item, record_id=None, data=None):
+        """
+            Keep track of records written by this job, to update the index
+            of originals and to invalidate bulk deduplication results
+
+            @param item: the S3ImportItem
+            @param record_id: the record ID (default: item.id)
+            @param data: the data written to the record
+        """
+
+        if record_id is None:
+            record_id = item.id
+        if not record_id:
+            return
+
+        table = item.table
+        tablename = item.tablename
+
+        index = self.originals.get(tablename)
+        if index is not None:
+            # Key values from this import are known to the index now
+            if data:
+                self._index_add(index, table, data, record_id=record_id)
+                for k in index.keys[record_id]:
+                    index.covered.add(k)
+            # Reload on next access
+            index.records[record_id] = None
+
+        # Writing a record which was not part of the bulk deduplication
+        # could create a duplicate for any item found to be new there,
+        # so these have to be deduplicated again
+        batch = self.batches.get(tablename)
+        if batch and item.item_id not in batch:
+            for item_id in batch:
+                bitem = self.items.get(item_id)
+                if bitem and not bitem.committed:
+                    bitem.deduplicated = False
+            del self.batches[tablename]
+        return
+
+    # -------------------------------------------------------------------------
+    def deduplicate(self, item):
+        """
+            Batch deduplication: run the bulk variant of the deduplicate
+            resolver of the item's table (configured as "bulk_deduplicate")
+            for all pending items of that table at once, rather than the
+            deduplicate resolver for each item separately.
+
+            The bulk resolver receives a list of items and returns a list
+            of tuples (item, key, record_id), with the deduplication key of
+            the item and the ID of its duplicate in the database (or None if
+            there is no duplicate). Items it returns no key for are left
+            to the deduplicate resolver.
+
+            Items with the same key which do not have a duplicate in the
+            database are left to the deduplicate resolver as well, so that
+            the later ones are found as duplicates of the first one when
+            that has been written.
+
+            @param item: the S3ImportItem to deduplicate
+        """
+
+        tablename = item.tablename
+        resolve = current.s3db.get_config(tablename, "bulk_deduplicate")
+        if not resolve:
+            return
+
+        DELETED = current.xml.DELETED
+        UPDATE = item.METHOD.UPDATE
+
+        # Pending items of this table (all references resolvable now)
+        pending = []
+        batch = self.batches.get(tablename)
+        for i in self.items.values():
+            if i.tablename != tablename or \
+               i.id or i.original is not None or \
+               i.deduplicated or i.committed or \
+               i.accepted is False or \
+               not i.data or i.data[DELETED] or \
+               batch and i.item_id in batch or \
+               not i._resolvable():
+                continue
+            pending.append(i)
+        if not pending:
+            return
+
+        items = []
+        for i in pending:
+            i._resolve_references()
+            original = self.original(i.table, i.data,
+                                     mandatory=i._mandatory_fields())
+            if original is None:
+                items.append(i)
+        if not items:
+            return
+
+        results = resolve(items)
+        if not results:
+            return
+
+        counts = {}
+        for i, key, record_id in results:
+            counts[key] = counts.get(key, 0) + 1
+
+        # Load all originals at once
+        table = item.table
+        record_ids = set(r[2] for r in results if r[2])
+        if record_ids:
+            fields = [table[f] for f in table.fields]
+            query = (table._id.belongs(record_ids))
+            pkey = table._id.name
+            originals = dict((row[pkey], row)
+                             for row in current.db(query).select(*fields))
+        else:
+            originals = {}
+
+        if batch is None:
+            batch = self.batches[tablename] = set()
+        for i, key, record_id in results:
+            if record_id:
+                i.id = record_id
+                i.method = UPDATE
+                i.original = originals.get(record_id)
+            elif counts[key] > 1:
+                continue
+            i.deduplicated = True
+            batch.add(i.item_id)
+        return
+
     # -------------------------------------------------------------------------
     def __define_tables(self):
         """
@@ -3507,8 +4187,31 @@ class S3ImportJob():
             from the item table
         """
 
-        db = current.db
         UID = current.xml.UID
+        s3db = current.s3db
+
+        # Look up the UIDs of all record references at once
+        uids = {}
+        for item in self.items.values():
+            for ritem in item.load_references:
+                if "item_id" in ritem:
+                    continue
+                uid = ritem.get("uid", None)
+                tablename = ritem.get("tablename", None)
+                if tablename and uid:
+                    if tablename in uids:
+                        uids[tablename].add(uid)
+                    else:
+                        uids[tablename] = set([uid])
+        id_maps = {}
+        for tablename in uids:
+            try:
+                table = s3db[tablename]
+            except:
+                continue
+            if UID not in table.fields:
+                continue
+            id_maps[tablename] = self.lookup_uids(table, uids[tablename])
 
         for item in self.items.values():
             for citem_id in item.load_components:
@@ -3533,18 +4236,15 @@ class S3ImportJob():
                     uid = ritem.get("uid", None)
                     tablename = ritem.get("tablename", None)
                     if tablename and uid:
-                        try:
-                            table = current.s3db[tablename]
-                        except:
-                            continue
-                        if UID not in table.fields:
+                        id_map = id_maps.get(tablename)
+                        if id_map is None:
                             continue
-                        query = table[UID] == uid
-                        row = db(query).select(table._id,
-                                               limitby=(0, 1)).first()
-                        if row:
-                            _id = row[table._id.name]
+                        self.stats.lookups += 1
+                        _id = id_map.get(uid)
+                        if _id:
+                            self.stats.records += 1
                         else:
+                            self.stats.unresolved += 1
                             continue
                         entry = Storage(tablename = ritem["tablename"],
                                         element=None,
@@ -29,8 +29,10 @@
 
 __all__ = ["S3Model", "S3ModelExtensions"]
 
+import sys
+
 from gluon import *
-from gluon.dal import Table
+from gluon.dal import Row, Table
 # Here are dependencies listed for reference:
 #from gluon import current
 #from gluon.dal import Field
@@ -45,7 +47,6 @@ DEFAULT = lambda: None
 
 DEBUG = False
 if DEBUG:
-    import sys
     print >> sys.stderr, "S3MODEL: DEBUG MODE"
     def _debug(m):
         print >> sys.stderr, m
@@ -64,6 +65,9 @@ class S3Model(object):
     LOAD = "s3_model_load"
     DELETED = "deleted"
 
+    # Maximum size of the VALUES of a multi-row INSERT (characters)
+    MAX_INSERT_SIZE = 500000
+
     def __init__(self, module=None):
         """ Constructor """
 
@@ -381,6 +385,13 @@ class S3Model(object):
         if tn not in config:
             config[tn] = Storage()
         config[tn].update(attr)
+
+        # Update hierarchies incrementally on changes in the table
+        if attr.get("hierarchy"):
+            db = current.db
+            if tn in db:
+                from s3hierarchy import S3Hierarchy
+                S3Hierarchy.bind(db[tn])
         return
 
     # -------------------------------------------------------------------------
@@ -1071,6 +1082,238 @@ class S3Model(object):
         record.update(super_keys)
         return True
 
+    # -------------------------------------------------------------------------
+    @classmethod
+    def update_super_bulk(cls, table, ids):
+        """
+            Creates the super-entity links for multiple new instance
+            records at once (bulk variant of update_super, e.g. for
+            imports): inserts the super-entity records of each super-table
+            with multi-row INSERTs (see insert_rows), and runs their
+            onaccept in record order
+
+            @param table: the instance table
+            @param ids: the IDs of the instance records
+
+            @return: dict {id: Storage(super_keys)}
+        """
+
+        get_config = cls.get_config
+
+        # Get all super-entities of this table
+        tablename = table._tablename
+        supertables = get_config(tablename, "super_entity")
+        if not supertables or not ids:
+            return {}
+
+        # Find all super-tables, super-keys and shared fields
+        if not isinstance(supertables, (list, tuple)):
+            supertables = [supertables]
+        updates = []
+        fields = []
+        has_deleted = "deleted" in table.fields
+        has_uuid = "uuid" in table.fields
+        for s in supertables:
+            if type(s) is not Table:
+                s = cls.table(s)
+            if s is None:
+                continue
+            tn = s._tablename
+            key = cls.super_key(s)
+            shared = get_config(tablename, "%s_fields" % tn)
+            if not shared:
+                shared = dict([(fn, fn)
+                               for fn in s.fields
+                               if fn != key and fn in table.fields])
+            else:
+                shared = dict([(fn, shared[fn])
+                               for fn in shared
+                               if fn != key and fn in s.fields and fn in table.fields])
+            fields.extend(shared.values())
+            fields.append(key)
+            updates.append((tn, s, key, shared))
+
+        # Get the record data
+        db = current.db
+        if has_deleted:
+            fields.append("deleted")
+        if has_uuid:
+            fields.append("uuid")
+        fields = [ogetattr(table, fn) for fn in list(set(fields))]
+        fields.append(table.id)
+        rows = db(table.id.belongs(ids)).select(*fields)
+        records = dict((row.id, row) for row in rows)
+
+        result = {}
+        new = []
+        for id in ids:
+            _record = records.get(id)
+            if not _record:
+                continue
+            if any(ogetattr(_record, key) for tn, s, key, shared in updates):
+                # Already linked => update individually
+                record = Storage(id=id)
+                cls.update_super(table, record)
+                del record["id"]
+                result[id] = record
+            else:
+                result[id] = Storage()
+                new.append(_record)
+
+        for tn, s, key, shared in updates:
+            data = []
+            for _record in new:
+                row = Storage([(fn, _record[shared[fn]]) for fn in shared])
+                row.instance_type = tablename
+                if has_deleted:
+                    row.deleted = _record.get("deleted", False)
+                if has_uuid:
+                    row.uuid = _record.get("uuid", None)
+                data.append(row)
+            if not data:
+                continue
+            keys = cls.insert_rows(s, data)
+            onaccept = get_config(tn, "create_onaccept",
+                       get_config(tn, "onaccept", None))
+            for _record, row, k in zip(new, data, keys):
+                if k:
+                    result[_record.id][key] = k
+                    row[key] = k
+                    if onaccept:
+                        onaccept(Storage(vars=row))
+
+        # Update the super_keys in the records
+        for _record in new:
+            super_keys = result[_record.id]
+            if super_keys:
+                db(table.id == _record.id).update(**super_keys)
+
+        return result
+
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def insert_rows(table, rows, errors=None):
+        """
+            Insert multiple records with multi-row INSERT statements where
+            the database can return the new record IDs for them (PostgreSQL
+            and SQLite), otherwise one record at a time (like bulk_insert)
+
+            Each statement inserts either all of its records or none (a
+            failing statement is rolled back to a savepoint in PostgreSQL,
+            so that the transaction can continue).
+
+            @param table: the Table
+            @param rows: the records, list of dicts
+            @param errors: dict to collect the errors {index: exception}
+                           for records which can not be inserted (these
+                           get None for ID), None to raise the exception
+
+            @return: list of the new record IDs, in the order of rows
+        """
+
+        if not rows:
+            return []
+
+        db = current.db
+        dbname = db._dbname
+        executesql = db.executesql
+        pkey = table._id.name
+
+        def insert(index, row):
+            # Insert a single record
+            if errors is None:
+                return table.insert(**dict(row))
+            if dbname == "postgres":
+                executesql("SAVEPOINT s3_insert_rows;")
+            try:
+                record_id = table.insert(**dict(row))
+            except:
+                if dbname == "postgres":
+                    executesql("ROLLBACK TO SAVEPOINT s3_insert_rows;")
+                errors[index] = sys.exc_info()[1]
+                return None
+            if dbname == "postgres":
+                executesql("RELEASE SAVEPOINT s3_insert_rows;")
+            return record_id
+
+        if dbname not in ("postgres", "sqlite") or table._before_insert or \
+           any(table[fn].type == "upload" for fn in table.fields) or \
+           any(pkey in row for row in rows):
+            return [insert(index, row) for index, row in enumerate(rows)]
+
+        # Build the VALUES of each record (including defaults and computed
+        # fields), records with different sets of fields go into separate
+        # statements
+        expand = db._adapter.expand
+        statements = []
+        columns = None
+        values = []
+        size = 0
+        for index, row in enumerate(rows):
+            fields = table._listify(dict(row))
+            names = [f.name for f, v in fields]
+            if names != columns or size > S3Model.MAX_INSERT_SIZE:
+                if values:
+                    statements.append((columns, values, first))
+                columns = names
+                values = []
+                size = 0
+                first = index
+            value = "(%s)" % ",".join(expand(v, f.type) for f, v in fields)
+            values.append(value)
+            size += len(value)
+        if values:
+            statements.append((columns, values, first))
+
+        ids = []
+        inserted = []
+        for columns, values, first in statements:
+            sql = "INSERT INTO %s(%s) VALUES %s" % (table._tablename,
+                                                   ",".join(columns),
+                                                   ",".join(values))
+            if dbname == "postgres":
+                executesql("SAVEPOINT s3_insert_rows;")
+                try:
+                    result = executesql("%s RETURNING %s;" % (sql, pkey))
+                except:
+                    executesql("ROLLBACK TO SAVEPOINT s3_insert_rows;")
+                    if errors is None:
+                        raise
+                    result = None
+                else:
+                    executesql("RELEASE SAVEPOINT s3_insert_rows;")
+                if result is not None:
+                    # IDs are drawn from the sequence in VALUES order
+                    ids.extend(sorted(row[0] for row in result))
+                    inserted.extend(xrange(first, first + len(values)))
+                    continue
+            else:
+                try:
+                    executesql("%s;" % sql)
+                except:
+                    if errors is None:
+                        raise
+                else:
+                    # SQLite assigns consecutive IDs (database is locked)
+                    last = executesql("SELECT last_insert_rowid();")[0][0]
+                    ids.extend(xrange(last - len(values) + 1, last + 1))
+                    inserted.extend(xrange(first, first + len(values)))
+                    continue
+            # Statement failed: insert the records one by one to find
+            # out which of them can not be inserted
+            for index in xrange(first, first + len(values)):
+                ids.append(insert(index, rows[index]))
+
+        # Run the after-insert hooks for the records inserted with
+        # multi-row INSERTs (Table.insert runs them for the others)
+        after_insert = table._after_insert
+        if after_insert:
+            for index in inserted:
+                fields = Row(dict(rows[index]))
+                for hook in after_insert:
+                    hook(fields, ids[index])
+        return ids
+
     # -------------------------------------------------------------------------
     @classmethod
     def delete_super(cls, table, record):
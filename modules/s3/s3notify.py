@@ -29,6 +29,7 @@
 
 import datetime
 import os
+import string
 import sys
 import urlparse
 import urllib2
@@ -81,13 +82,36 @@ class S3Notifications(object):
 
         subscriptions = cls._subscriptions(now)
         if subscriptions:
+            db = current.db
             async = current.s3task.async
-            for row in subscriptions:
-                # Create asynchronous notification task.
-                row.update_record(locked=True)
-                async("notify_notify", args=[row.id])
+            batch_size = current.deployment_settings.get_msg_notify_batch()
+            if batch_size:
+                # Lock all due subscriptions at once
+                rtable = db.pr_subscription_resource
+                ids = [row.id for row in subscriptions]
+                db(rtable.id.belongs(ids)).update(locked=True)
+
+                # Create one asynchronous batch task per resource
+                # (and per batch_size subscriptions)
+                batches = {}
+                for row in subscriptions:
+                    tablename = row.resource
+                    if tablename in batches:
+                        batches[tablename].append(row.id)
+                    else:
+                        batches[tablename] = [row.id]
+                for tablename in batches:
+                    ids = batches[tablename]
+                    for i in xrange(0, len(ids), batch_size):
+                        async("notify_batch",
+                              args=[json.dumps(ids[i:i + batch_size])])
+            else:
+                for row in subscriptions:
+                    # Create asynchronous notification task.
+                    row.update_record(locked=True)
+                    async("notify_notify", args=[row.id])
             message = "%s notifications scheduled." % len(subscriptions)
-            current.db.commit()
+            db.commit()
         else:
             message = "No notifications to schedule."
 
@@ -244,6 +268,322 @@ class S3Notifications(object):
         # Done
         return message
 
+    # -------------------------------------------------------------------------
+    @classmethod
+    def notify_batch(cls, resource_ids):
+        """
+            Asynchronous task to notify a batch of subscribers about
+            updates in-process (i.e. without a POST?format=msg request
+            per subscription): subscriptions are grouped by resource,
+            URL, filter and the permissions of the subscriber, and each
+            group runs its lookup only once, then each subscriber is
+            sent the records which have been updated since their last
+            check (see send()).
+
+            @param resource_ids: list of pr_subscription_resource record IDs
+                                 (or a JSON string with such a list)
+            @return: status message
+        """
+
+        _debug("S3Notifications.notify_batch(resource_ids=%s)" % resource_ids)
+
+        if isinstance(resource_ids, basestring):
+            resource_ids = json.loads(resource_ids)
+
+        db = current.db
+        s3db = current.s3db
+        auth = current.auth
+
+        stable = s3db.pr_subscription
+        rtable = db.pr_subscription_resource
+        ftable = s3db.pr_filter
+        utable = s3db.pr_person_user
+
+        # Extract the subscription data
+        join = stable.on(rtable.subscription_id == stable.id)
+        left = [ftable.on(ftable.id == stable.filter_id),
+                utable.on(utable.pe_id == stable.pe_id),
+                ]
+        rows = db(rtable.id.belongs(resource_ids)).select(stable.id,
+                                                          stable.pe_id,
+                                                          stable.frequency,
+                                                          stable.notify_on,
+                                                          stable.method,
+                                                          stable.email_format,
+                                                          rtable.id,
+                                                          rtable.resource,
+                                                          rtable.url,
+                                                          rtable.last_check_time,
+                                                          ftable.query,
+                                                          utable.user_id,
+                                                          join=join,
+                                                          left=left)
+        if not rows:
+            return "No subscriptions found."
+
+        # Remember the current user to restore it afterwards
+        user = auth.user
+        user_id = user.id if user else None
+
+        # Group the subscriptions by lookup
+        groups = {}
+        signatures = {}
+        unlock = []
+        seen = set()
+        for row in rows:
+            r = row.pr_subscription_resource
+            if r.id in seen:
+                continue
+            seen.add(r.id)
+            s = row.pr_subscription
+            if not s.notify_on or not s.method:
+                # Nothing to notify
+                unlock.append(r.id)
+                continue
+            subscriber = row.pr_person_user.user_id
+            if subscriber not in signatures:
+                try:
+                    auth.s3_impersonate(subscriber)
+                except ValueError:
+                    auth.s3_impersonate(None)
+                    subscriber = None
+                signatures[subscriber] = cls._auth_signature()
+            key = (r.resource,
+                   r.url,
+                   row.pr_filter.query,
+                   "upd" in s.notify_on,
+                   signatures[subscriber],
+                   )
+            item = Storage(user_id=subscriber, subscription=s, resource=r)
+            if key in groups:
+                groups[key].append(item)
+            else:
+                groups[key] = [item]
+
+        if unlock:
+            db(rtable.id.belongs(unlock)).update(locked=False)
+            db.commit()
+
+        # Process all groups
+        intervals = s3db.pr_subscription_check_intervals
+        sent = 0
+        errors = 0
+        for key, subscribers in groups.items():
+            try:
+                results = cls._notify_group(key, subscribers)
+            except:
+                exc_info = sys.exc_info()[:2]
+                _debug("%s: %s" % (exc_info[0].__name__, exc_info[1]))
+                db.rollback()
+                results = [(item, False) for item in subscribers]
+
+            # Update time stamps and unlock
+            for item, success in results:
+                r = item.resource
+                if success:
+                    frequency = item.subscription.frequency
+                    interval = datetime.timedelta(
+                                    minutes=intervals.get(frequency, 0))
+                    last_check_time = datetime.datetime.utcnow()
+                    db(rtable.id == r.id).update(
+                                    locked=False,
+                                    last_check_time=last_check_time,
+                                    next_check_time=last_check_time + interval)
+                    sent += 1
+                else:
+                    db(rtable.id == r.id).update(locked=False)
+                    errors += 1
+            db.commit()
+
+        # Restore the original user
+        auth.s3_impersonate(user_id)
+
+        message = "%s notifications sent, %s failed (%s lookups)." % \
+                  (sent, errors, len(groups))
+        _debug(message)
+        return message
+
+    # -------------------------------------------------------------------------
+    @classmethod
+    def _notify_group(cls, key, subscribers):
+        """
+            Run the lookup for a group of subscriptions and send the
+            notifications to all subscribers in the group
+
+            @param key: the group key as built by notify_batch
+            @param subscribers: the subscriptions in the group, list of
+                                Storages {user_id, subscription, resource}
+            @return: list of tuples (subscriber, success)
+        """
+
+        tablename, url, fquery, upd, signature = key
+
+        s3db = current.s3db
+        auth = current.auth
+
+        # Act as the first subscriber in the group
+        auth.s3_impersonate(subscribers[0].user_id)
+        if len(subscribers) > 1 and auth.user:
+            # Subscribers in this group share roles and realms, but not
+            # records which are accessible through individual ownership
+            # => look up only records accessible through roles and realms
+            auth.user = Storage(auth.user, id=None)
+
+        # URL query parameters
+        purl = urlparse.urlparse(url)
+        get_vars = {}
+        for k, v in urlparse.parse_qs(purl.query).items():
+            get_vars[k] = v if len(v) > 1 else v[0]
+
+        # Filters
+        if fquery:
+            from s3filter import S3FilterString
+            fstring = S3FilterString(s3db.resource(tablename), fquery)
+            for k, v in fstring.get_vars.iteritems():
+                if v is not None:
+                    if k in get_vars:
+                        value = get_vars[k]
+                        if type(value) is list:
+                            value.append(v)
+                        else:
+                            get_vars[k] = [value, v]
+                    else:
+                        get_vars[k] = v
+            filter_query = s3_unicode(fstring.represent())
+        else:
+            filter_query = None
+
+        # Authorize for the subscribed controller
+        permission = auth.permission
+        controller, function = permission.controller, permission.function
+        path = [p for p in purl.path.split("/") if p]
+        if path:
+            permission.controller = path[0]
+            permission.function = path[1] if len(path) > 1 else "index"
+
+        # Extract the data for all subscribers at once
+        timestamp = "modified_on" if upd else "created_on"
+        try:
+            resource = s3db.resource(tablename, vars=get_vars)
+
+            last_check_times = [item.resource.last_check_time
+                                for item in subscribers]
+            if None not in last_check_times:
+                from s3resource import S3FieldSelector as FS
+                resource.add_filter(FS(timestamp) >= min(last_check_times))
+
+            fields = resource.list_fields(key="notify_fields")
+            if "created_on" not in fields:
+                fields.append("created_on")
+            hide_timestamp = timestamp not in fields
+            if hide_timestamp:
+                fields.append(timestamp)
+
+            data = resource.select(fields,
+                                   represent=True,
+                                   raw_data=True)
+        finally:
+            permission.controller = controller
+            permission.function = function
+
+        rows = data["rows"]
+        rfields = data["rfields"]
+
+        # Column to distribute the rows by
+        colname = None
+        selector = resource.prefix_selector(timestamp)
+        for rfield in rfields:
+            if rfield.selector == selector:
+                colname = rfield.colname
+                break
+        if hide_timestamp:
+            rfields = [rfield for rfield in rfields
+                       if rfield.colname != colname]
+
+        settings = current.deployment_settings
+        page_url = "%s/%s/%s" % (settings.get_base_public_url(),
+                                 current.request.application,
+                                 url.lstrip("/"))
+
+        # Send each subscriber the records updated since their last check
+        as_utc = current.xml.as_utc
+        results = []
+        for item in subscribers:
+            s = item.subscription
+            r = item.resource
+            if r.last_check_time:
+                last_check_time = as_utc(r.last_check_time)
+                if colname:
+                    subset = []
+                    for row in rows:
+                        value = as_utc(row["_row"][colname])
+                        if value and value >= last_check_time:
+                            subset.append(row)
+                else:
+                    subset = rows
+            else:
+                last_check_time = as_utc(datetime.datetime.min)
+                subset = rows
+            if not subset:
+                # Nothing new for this subscriber
+                results.append((item, True))
+                continue
+
+            subscription = {"pe_id": s.pe_id,
+                            "notify_on": s.notify_on,
+                            "method": s.method,
+                            "email_format": s.email_format,
+                            "resource": tablename,
+                            "last_check_time": last_check_time,
+                            "filter_query": filter_query,
+                            "page_url": page_url,
+                            "item_url": None,
+                            }
+            success, message = cls._send(resource,
+                                         {"rows": subset,
+                                          "rfields": rfields,
+                                          "numrows": len(subset),
+                                          },
+                                         subscription)
+            _debug("PE #%s: %s" % (s.pe_id, message))
+            results.append((item, success))
+
+        return results
+
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def _auth_signature():
+        """
+            Get a hashable signature of the roles, realms, delegations
+            and language of the current user, subscribers with the same
+            signature can share their notification lookups
+
+            @return: tuple
+        """
+
+        auth = current.auth
+        user = auth.user
+
+        roles = tuple(sorted(current.session.s3.roles or []))
+        if not user:
+            return (roles, None, None, None)
+
+        def freeze(realms):
+            items = []
+            for k, v in (realms or {}).items():
+                if isinstance(v, dict):
+                    v = freeze(v)
+                elif v is not None:
+                    v = tuple(sorted(v))
+                items.append((k, v))
+            return tuple(sorted(items))
+
+        return (roles,
+                freeze(user.realms),
+                freeze(user.delegations),
+                user.language,
+                )
+
     # -------------------------------------------------------------------------
     @classmethod
     def send(cls, r, resource):
@@ -304,6 +644,37 @@ class S3Notifications(object):
 
         #_debug("%s rows:" % numrows)
 
+        last_check_time = subscription["last_check_time"]
+        if last_check_time:
+            subscription["last_check_time"] = \
+                current.xml.decode_iso_datetime(last_check_time)
+
+        success, message = cls._send(resource, data, subscription)
+        return json_message(success=success,
+                            statuscode=200 if success else 403,
+                            message=message)
+
+    # -------------------------------------------------------------------------
+    @classmethod
+    def _send(cls, resource, data, subscription):
+        """
+            Render the notification message for a subscriber and send it
+
+            @param resource: the S3Resource
+            @param data: the data returned from S3Resource.select (must
+                         contain at least one row)
+            @param subscription: the subscription data (dict), with
+                                 last_check_time as datetime
+            @return: tuple (success, message)
+        """
+
+        rows = data["rows"]
+        numrows = len(rows)
+
+        notify_on = subscription["notify_on"]
+        methods = subscription["method"]
+        pe_id = subscription["pe_id"]
+
         # Prepare meta-data
         get_config = resource.get_config
         settings = current.deployment_settings
@@ -316,8 +687,7 @@ class S3Notifications(object):
         else:
             resource_name = string.capwords(resource.name, "_")
 
-        last_check_time = current.xml.decode_iso_datetime(
-                                subscription["last_check_time"])
+        last_check_time = subscription["last_check_time"]
 
         email_format = subscription["email_format"]
         if not email_format:
@@ -398,7 +768,7 @@ class S3Notifications(object):
                 path = join("views", "msg")
                 template = get_template(path, filenames)
             if template is None:
-                template = StringIO(T("New updates are available."))
+                template = StringIO(current.T("New updates are available."))
 
             # Select contents format
             if method == "EMAIL" and email_format == "html":
@@ -445,9 +815,7 @@ class S3Notifications(object):
             message = ", ".join(errors)
         else:
             message = "Success"
-        return json_message(success=success,
-                            statuscode=200 if success else 403,
-                            message=message)
+        return success, message
 
     # -------------------------------------------------------------------------
     @classmethod
@@ -524,7 +892,7 @@ class S3Notifications(object):
                     ((rtable.next_check_time == None) | \
                      (rtable.next_check_time <= now)) & \
                     query
-            return db(query).select(rtable.id, join=join)
+            return db(query).select(rtable.id, rtable.resource, join=join)
         else:
             return None
 
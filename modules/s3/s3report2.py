@@ -137,7 +137,8 @@ class S3Report2(S3Method):
                 get_vars["cols"] = prefix(cols) if cols else None
                 get_vars["fact"] = "%s(%s)" % (method, selector)
 
-                pivottable = resource.pivottable(rows, cols, [layer])
+                pivottable = resource.pivottable(rows, cols, [layer],
+                                                 records=False)
         else:
             pivottable = None
 
@@ -277,7 +278,8 @@ class S3Report2(S3Method):
                 get_vars["fact"] = "%s(%s)" % (method, selector)
 
                 if visible:
-                    pivottable = resource.pivottable(rows, cols, [layer])
+                    pivottable = resource.pivottable(rows, cols, [layer],
+                                                     records=False)
                 else:
                     pivottable = None
         else:
@@ -78,7 +78,7 @@ from s3data import S3DataTable, S3DataList, S3PivotTable
 from s3fields import S3Represent, S3RepresentLazy, s3_all_meta_field_names
 from s3utils import s3_has_foreign_key, s3_flatlist, s3_get_foreign_key, s3_unicode, S3MarkupStripper, S3TypeConverter
 from s3validators import IS_ONE_OF
-from s3xml import S3XMLFormat
+from s3xml import S3XMLFormat, S3XMLStreamWriter
 
 DEBUG = False
 if DEBUG:
@@ -261,6 +261,10 @@ class S3Resource(object):
         self._uids = []
         self._length = None
 
+        # Component rows by join key (export)
+        self._export_index = None
+        self._export_filtered = False
+
         # Request attributes --------------------------------------------------
 
         self.vars = None # set during build_query
@@ -322,6 +326,7 @@ class S3Resource(object):
         # Export meta data
         self.muntil = None      # latest mtime of the exported records
         self.results = None     # number of exported records
+        self.cursor = None      # position of the last record of a page
 
         # Standard methods ----------------------------------------------------
 
@@ -734,12 +739,20 @@ class S3Resource(object):
                     vf = table.virtualfields
                     osetattr(table, "virtualfields", [])
 
+                # Without count or getids, only the IDs of the current
+                # page are needed
+                if getids or count:
+                    id_limitby = None
+                else:
+                    id_limitby = limitby
+
                 # Retrieve the ordered record IDs (or number of rows)
                 rows = db(filter_query).select(field,
                                                left=filter_joins,
                                                distinct=fdistinct,
                                                orderby=orderby_aggregate,
                                                groupby=fgroupby,
+                                               limitby=id_limitby,
                                                cacheable=True)
                                                
                 # Restore the virtual fields
@@ -748,11 +761,14 @@ class S3Resource(object):
 
                 if getids or left_joins:
                     ids = [row[pkey] for row in rows]
-                    totalrows = len(ids)
-                    if limitby:
-                        page = ids[limitby[0]:limitby[1]]
-                    else:
+                    if id_limitby:
                         page = ids
+                    else:
+                        totalrows = len(ids)
+                        if limitby:
+                            page = ids[limitby[0]:limitby[1]]
+                        else:
+                            page = ids
                     # Use simplified master query
                     master_query = table._id.belongs(page)
                     orderby = None
@@ -1125,6 +1141,254 @@ class S3Resource(object):
         output["rows"] = [results[record_id] for record_id in page]
         return output
         
+    # -------------------------------------------------------------------------
+    def iterselect(self,
+                   fields,
+                   pagesize=None,
+                   left=None,
+                   orderby=None,
+                   distinct=False,
+                   virtual=True,
+                   as_rows=False,
+                   represent=False,
+                   show_links=True,
+                   raw_data=False):
+        """
+            Extract data from this resource page by page, so that the
+            memory needed is bounded by the page size rather than by the
+            number of records (e.g. for exports).
+
+            Pages are retrieved by primary key ranges if the result is
+            unordered or ordered by primary key, otherwise by offset.
+            Virtual field filters can only be applied to the complete
+            result, so with such filters there is only one page.
+
+            @param fields: the fields to extract (selector strings)
+            @param pagesize: maximum number of records per page
+                             (default: manager.PAGESIZE)
+            @param left: additional left joins required for filters
+            @param orderby: orderby-expression for DAL
+            @param distinct: select distinct rows
+            @param virtual: include mandatory virtual fields
+            @param as_rows: return the rows (don't extract)
+            @param represent: render field value representations
+            @param show_links: render links in representations
+            @param raw_data: include raw data in the result
+
+            @return: a generator yielding the select() result for each
+                     page (at least one)
+        """
+
+        if pagesize is None:
+            pagesize = current.manager.PAGESIZE
+        if fields is None:
+            fields = [f.name for f in self.readable_fields()]
+
+        select = self.select
+        attr = {"left": left,
+                "distinct": distinct,
+                "virtual": virtual,
+                "as_rows": as_rows,
+                "represent": represent,
+                "show_links": show_links,
+                "raw_data": raw_data,
+                }
+
+        if self.get_filter() is not None:
+            yield select(fields, orderby=orderby, **attr)
+            return
+
+        table = self.table
+        pkey = table._id
+        colname = str(pkey)
+        if orderby is None:
+            keyset = True
+        elif isinstance(orderby, Field):
+            keyset = str(orderby) == colname
+        elif isinstance(orderby, str):
+            keyset = orderby.strip().lower() in (colname.lower(),
+                                                 "%s asc" % colname.lower())
+        else:
+            keyset = False
+
+        if not keyset:
+            # Pages by offset
+            start = 0
+            while True:
+                page = select(fields,
+                              start=start,
+                              limit=pagesize,
+                              orderby=orderby,
+                              **attr)
+                yield page
+                if len(page if as_rows else page["rows"]) < pagesize:
+                    break
+                start += pagesize
+            return
+
+        # Pages by primary key ranges
+        strip = False
+        if not as_rows:
+            rfields = self.resolve_selectors(fields, extra_fields=False)[0]
+            if colname not in [rfield.colname for rfield in rfields]:
+                # Extract the primary key, but remove it from the result
+                fields = list(fields) + [pkey.name]
+                strip = True
+
+        rfilter = self.rfilter
+        query = rfilter.get_query()
+        last = None
+        while True:
+            if last is not None:
+                rfilter.query = query & (pkey > last)
+            try:
+                page = select(fields,
+                              start=0,
+                              limit=pagesize,
+                              orderby=pkey,
+                              **attr)
+            finally:
+                rfilter.query = query
+            rows = page if as_rows else page["rows"]
+            if rows:
+                last = max(row[colname] for row in rows)
+            if strip:
+                page["rfields"] = [rfield for rfield in page["rfields"]
+                                          if rfield.colname != colname]
+                for row in rows:
+                    del row[colname]
+                    if raw_data:
+                        row["_row"].pop(colname, None)
+            yield page
+            if len(rows) < pagesize:
+                break
+        return
+
+    # -------------------------------------------------------------------------
+    def aggregate(self, groupby, aggregates):
+        """
+            Compute aggregates of fields in this resource, grouped by
+            other fields, in a single GROUP BY query rather than by
+            extracting all records
+
+            @param groupby: list of field selectors to group by
+            @param aggregates: list of tuples (field selector, method),
+                               method can be "count", "min", "max" or "sum"
+
+            @return: list of tuples (group values..., aggregate values...),
+                     ordered by the lowest record ID per group, or None if
+                     the aggregation can not be done in the database (i.e.
+                     with virtual fields, list:types, fields in components
+                     or virtual filters)
+
+            @note: "count" counts the non-null values of the field within
+                   the group, "sum", "min" and "max" return None for groups
+                   without any non-null values
+        """
+
+        if self.get_filter() is not None:
+            return None
+
+        db = current.db
+        s3db = current.s3db
+
+        table = self.table
+        tablename = table._tablename
+        alias = self.alias
+
+        # Resolve the selectors, only fields in the master table or in
+        # tables referenced by it (many-to-one) are supported
+        rfields = {}
+        selectors = list(groupby) + [s for s, m in aggregates]
+        for selector in selectors:
+            if selector in rfields:
+                continue
+            path = selector.split("$")
+            head = path[0]
+            if "." in head:
+                tn, head = head.split(".", 1)
+                if tn not in ("~", alias):
+                    return None
+            path[0] = head
+            t = table
+            for hop in path[:-1]:
+                if hop not in t.fields:
+                    return None
+                ktablename = s3_get_foreign_key(t[hop], m2m=False)[0]
+                t = s3db.table(ktablename) if ktablename else None
+                if t is None:
+                    return None
+            if path[-1] not in t.fields:
+                return None
+            try:
+                rfield = S3ResourceField(self, "~.%s" % "$".join(path))
+            except (AttributeError, SyntaxError):
+                return None
+            if rfield.field is None or rfield.virtual or \
+               rfield.ftype[:5] == "list:":
+                return None
+            rfields[selector] = rfield
+
+        # Filter query, with the left joins of the resource filter
+        # resolved in a subquery so they can't multiply the records
+        query = self.get_query()
+        filter_joins = self.rfilter.get_left_joins()
+        if filter_joins:
+            filter_joins = S3LeftJoins(tablename, filter_joins)
+            subquery = db(query)._select(table._id,
+                                         left=filter_joins.as_list(aqueries={}),
+                                         distinct=True)
+            query = table._id.belongs(subquery)
+
+        # Left joins for the fields
+        left_joins = S3LeftJoins(tablename)
+        for rfield in rfields.values():
+            left_joins.extend(rfield.left)
+        left = left_joins.as_list(aqueries={})
+
+        # Group fields
+        gfields = []
+        for selector in groupby:
+            field = rfields[selector].field
+            if str(field) not in [str(f) for f in gfields]:
+                gfields.append(field)
+
+        # Aggregate expressions
+        expressions = []
+        for selector, method in aggregates:
+            field = rfields[selector].field
+            if method == "count":
+                expression = field.count()
+            elif method == "min":
+                expression = field.min()
+            elif method == "max":
+                expression = field.max()
+            elif method == "sum":
+                expression = field.sum()
+            else:
+                raise SyntaxError("Unsupported aggregation method: %s" % method)
+            expressions.append(expression)
+
+        first = table._id.min()
+        fields = [first] + gfields + expressions
+        rows = db(query).select(groupby=gfields if gfields else None,
+                                left=left if left else None,
+                                *fields)
+
+        result = []
+        append = result.append
+        for row in rows:
+            first_id = row[first]
+            if first_id is None:
+                # Empty result without GROUP BY
+                continue
+            values = [rfields[selector].extract(row) for selector in groupby]
+            values.extend(row[expression] for expression in expressions)
+            append((first_id, tuple(values)))
+        result.sort(key=lambda item: item[0])
+
+        return [item[1] for item in result]
+
     # -------------------------------------------------------------------------
     @staticmethod
     def __extract(rows,
@@ -1852,7 +2116,7 @@ class S3Resource(object):
         return dl, numrows, data["ids"]
 
     # -------------------------------------------------------------------------
-    def pivottable(self, rows, cols, layers, strict=True):
+    def pivottable(self, rows, cols, layers, strict=True, records=True):
         """
             Generate a pivot table of this resource.
 
@@ -1862,13 +2126,18 @@ class S3Resource(object):
                            the aggregation layers
             @param strict: filter out dimension values which don't match
                            the resource filter
+            @param records: retain the records of the pivot table cells,
+                            False to compute the aggregates in the database
+                            where possible (sufficient for json())
 
             @return: an S3PivotTable instance
 
             Supported methods: see S3PivotTable
         """
 
-        return S3PivotTable(self, rows, cols, layers, strict=strict)
+        return S3PivotTable(self, rows, cols, layers,
+                            strict=strict,
+                            records=records)
 
     # -------------------------------------------------------------------------
     def json(self,
@@ -2031,6 +2300,7 @@ class S3Resource(object):
         self._length = None
         self._ids = None
         self._uids = None
+        self._export_index = None
         self.files = Storage()
 
         if self.components:
@@ -2276,6 +2546,7 @@ class S3Resource(object):
                    start=None,
                    limit=None,
                    msince=None,
+                   cursor=None,
                    fields=None,
                    dereference=True,
                    mcomponents=[],
@@ -2287,6 +2558,7 @@ class S3Resource(object):
                    maxbounds=False,
                    filters=None,
                    pretty_print=False,
+                   stream=None,
                    **args):
         """
             Export this resource as S3XML
@@ -2295,6 +2567,10 @@ class S3Resource(object):
             @param limit: maximum number of records to export (slicing)
             @param msince: export only records which have been modified
                             after this datetime
+            @param cursor: export a page of records in (modified_on, id)
+                           order, starting after this (modified_on, id)
+                           tuple (or from the first record if True), see
+                           export_tree
             @param dereference: include referenced resources
             @param mcomponents: components of the master resource to
                                 include (list of tablenames), empty list
@@ -2308,6 +2584,11 @@ class S3Resource(object):
             @param filters: additional URL filters (Sync), as dict
                             {tablename: {url_var: string}}
             @param pretty_print: insert newlines/indentation in the output
+            @param stream: file-like object to write the output to (returned
+                           instead of a string); exports as S3XML/S3JSON or
+                           with a streaming stylesheet (see S3XMLStreamWriter)
+                           are written incrementally while the tree is being
+                           built
             @param args: dict of arguments to pass to the XSLT stylesheet
         """
 
@@ -2319,6 +2600,45 @@ class S3Resource(object):
 
         xmlformat = S3XMLFormat(stylesheet) if stylesheet else None
 
+        # Native GeoJSON for Feature Layers?
+        if as_json and not as_tree and xmlformat is not None and \
+           not args and fields is None and references is None and \
+           msince is None and cursor is None and not filters and \
+           current.auth.permission.format == "geojson" and \
+           current.deployment_settings.get_gis_geojson_native():
+            from s3gis import S3GeoJSONEncoder
+            encoder = S3GeoJSONEncoder(self, xmlformat)
+            output = encoder.encode(start=start,
+                                    limit=limit,
+                                    pretty_print=pretty_print)
+            if output is not None:
+                if stream is not None:
+                    stream.write(output)
+                    output = stream
+                return output
+
+        # XSLT parameters
+        if xmlformat is not None:
+            import uuid
+            tfmt = xml.ISOFORMAT
+            args.update(domain=manager.domain,
+                        base_url=manager.s3.base_url,
+                        prefix=self.prefix,
+                        name=self.name,
+                        utcnow=datetime.datetime.utcnow().strftime(tfmt),
+                        msguid=uuid.uuid4().urn)
+
+        # Incremental export?
+        if stream is not None and not as_tree and \
+           (xmlformat is None or xmlformat.streaming and not as_json):
+            writer = S3XMLStreamWriter(stream,
+                                       as_json=as_json,
+                                       pretty_print=pretty_print,
+                                       xmlformat=xmlformat,
+                                       args=args)
+        else:
+            writer = None
+
         # Export as element tree
         #if DEBUG:
             #_start = datetime.datetime.now()
@@ -2327,6 +2647,7 @@ class S3Resource(object):
         tree = self.export_tree(start=start,
                                 limit=limit,
                                 msince=msince,
+                                cursor=cursor,
                                 fields=fields,
                                 dereference=dereference,
                                 mcomponents=mcomponents,
@@ -2334,7 +2655,8 @@ class S3Resource(object):
                                 references=references,
                                 filters=filters,
                                 maxbounds=maxbounds,
-                                xmlformat=xmlformat)
+                                xmlformat=xmlformat,
+                                writer=writer)
         #if DEBUG:
             #end = datetime.datetime.now()
             #duration = end - _start
@@ -2342,18 +2664,13 @@ class S3Resource(object):
             #_debug("export_tree of %s completed in %s seconds" % \
                     #(tablename, duration))
 
+        if writer is not None:
+            return writer.close(tree)
+
         # XSLT transformation
         if tree and xmlformat is not None:
             #if DEBUG:
             #    _start = datetime.datetime.now()
-            import uuid
-            tfmt = xml.ISOFORMAT
-            args.update(domain=manager.domain,
-                        base_url=manager.s3.base_url,
-                        prefix=self.prefix,
-                        name=self.name,
-                        utcnow=datetime.datetime.utcnow().strftime(tfmt),
-                        msguid=uuid.uuid4().urn)
             tree = xmlformat.transform(tree, **args)
             #if DEBUG:
                 #end = datetime.datetime.now()
@@ -2380,6 +2697,10 @@ class S3Resource(object):
             else:
                 output = xml.tostring(tree, pretty_print=pretty_print)
 
+        if stream is not None and output:
+            stream.write(output)
+            output = stream
+
         return output
 
     # -------------------------------------------------------------------------
@@ -2387,6 +2708,7 @@ class S3Resource(object):
                     start=0,
                     limit=None,
                     msince=None,
+                    cursor=None,
                     fields=None,
                     references=None,
                     dereference=True,
@@ -2394,13 +2716,20 @@ class S3Resource(object):
                     rcomponents=None,
                     filters=None,
                     maxbounds=False,
-                    xmlformat=None):
+                    xmlformat=None,
+                    writer=None):
         """
             Export the resource as element tree
 
             @param start: index of the first record to export
             @param limit: maximum number of records to export
             @param msince: minimum modification date of the records
+            @param cursor: export a page of records in (modified_on, id)
+                           order, starting after this (modified_on, id)
+                           tuple (or from the first record if True); if
+                           the page is full (limit), self.cursor will be
+                           set to the position of its last record so that
+                           the next page can be requested with it
             @param fields: data fields to include (default: all)
             @param references: foreign keys to include (default: all)
             @param dereference: also export referenced records
@@ -2414,6 +2743,10 @@ class S3Resource(object):
                             {tablename: {url_var: string}}
             @param maxbounds: include lat/lon boundaries in the top
                               level element (off by default)
+            @param xmlformat: the S3XMLFormat to export for
+            @param writer: S3XMLStreamWriter to write the <resource>
+                           elements to page by page (the returned tree
+                           contains only the root element then)
         """
 
         xml = current.xml
@@ -2440,15 +2773,27 @@ class S3Resource(object):
             queries = S3URLQuery.parse(self, filters[tablename])
             [self.add_filter(q) for a in queries for q in queries[a]]
 
+        # Keyset pagination (Sync)
+        if cursor is not None and "modified_on" not in table.fields:
+            cursor = None
+        if cursor is not None and cursor is not True:
+            mtime, record_id = cursor
+            modified_on = table.modified_on
+            self.add_filter((modified_on > mtime) | \
+                            ((modified_on == mtime) & \
+                             (table._id > record_id)))
+
         # Total number of results
         results = self.count()
 
         # Initialize export metadata
         self.muntil = None
         self.results = 0
+        self.cursor = None
 
         # Load slice
-        if msince is not None and "modified_on" in table.fields:
+        if (msince is not None or cursor is not None) and \
+           "modified_on" in table.fields:
             orderby = "%s ASC" % table["modified_on"]
         else:
             orderby = None
@@ -2458,15 +2803,25 @@ class S3Resource(object):
             include, exclude = xmlformat.get_fields(self.tablename)
         else:
             include, exclude = None, None
-        self.load(fields=include,
-                  skip=exclude,
-                  start=start,
-                  limit=limit,
-                  orderby=orderby,
-                  virtual=False,
-                  cacheable=True)
 
         format = current.auth.permission.format
+        if format in ("geojson", "georss", "kml", "gpx"):
+            # Location lookups need all records at once
+            self.load(fields=include,
+                      skip=exclude,
+                      start=start,
+                      limit=limit,
+                      orderby=orderby,
+                      virtual=False,
+                      cacheable=True)
+            pages = [self._rows]
+        else:
+            pages = self.__load_pages(fields=include,
+                                      skip=exclude,
+                                      start=start,
+                                      limit=limit,
+                                      orderby=orderby)
+
         if format == "geojson":
             if results > current.deployment_settings.get_gis_max_features():
                 headers = {"Content-Type": "application/json"}
@@ -2515,24 +2870,44 @@ class S3Resource(object):
         current.auth_user_represent = S3Represent(lookup="auth_user",
                                                   fields=["email"])
 
+        def flush():
+            # Render all pending lazy representations, then hand over
+            # the exported elements to the writer
+            if lazy:
+                for renderer, element, attr, f in lazy:
+                    renderer.render_node(element, attr, f)
+                del lazy[:]
+            writer.write(root)
+
         export_resource = self.__export_resource
 
-        for record in self._rows:
-            element = export_resource(record,
-                                      rfields=rfields,
-                                      dfields=dfields,
-                                      parent=root,
-                                      base_url=url,
-                                      reference_map=reference_map,
-                                      export_map=export_map,
-                                      lazy=lazy,
-                                      components=mcomponents,
-                                      filters=filters,
-                                      msince=msince,
-                                      locations=locations,
-                                      xmlformat=xmlformat)
-            if element is None:
-                results -= 1
+        pkey = table._id
+        scanned = 0
+        last = None
+        for rows in pages:
+            for record in rows:
+                scanned += 1
+                last = record
+                element = export_resource(record,
+                                          rfields=rfields,
+                                          dfields=dfields,
+                                          parent=root,
+                                          base_url=url,
+                                          reference_map=reference_map,
+                                          export_map=export_map,
+                                          lazy=lazy,
+                                          components=mcomponents,
+                                          filters=filters,
+                                          msince=msince,
+                                          locations=locations,
+                                          xmlformat=xmlformat)
+                if element is None:
+                    results -= 1
+            if writer is not None:
+                flush()
+        if cursor is not None and limit and scanned >= limit:
+            # More pages to come
+            self.cursor = (last[table.modified_on], last[pkey])
         #if DEBUG:
         #    end = datetime.datetime.now()
         #    duration = end - _start
@@ -2626,6 +3001,8 @@ class S3Resource(object):
                     # Mark as referenced element (for XSLT)
                     if element is not None:
                         element.set(REF, "True")
+                if writer is not None:
+                    flush()
         #if DEBUG:
         #    end = datetime.datetime.now()
         #    duration = end - _start
@@ -2653,6 +3030,115 @@ class S3Resource(object):
 
         return tree
 
+    # -------------------------------------------------------------------------
+    def __load_pages(self,
+                     fields=None,
+                     skip=None,
+                     start=None,
+                     limit=None,
+                     orderby=None):
+        """
+            Load the records of this resource page by page (for export),
+            replacing the previous page in the instance each time
+
+            @param fields: list of field names to include
+            @param skip: list of field names to skip
+            @param start: the index of the first record to load
+            @param limit: the maximum number of records to load
+            @param orderby: orderby-expression for the query
+
+            @return: a generator yielding the records of each page
+        """
+
+        pagesize = current.manager.PAGESIZE
+        if start is None:
+            start = 0
+
+        # Paging by offset requires a deterministic order
+        pkey = str(self.table._id)
+        if orderby is None:
+            orderby = pkey
+        elif isinstance(orderby, str) and pkey not in orderby:
+            orderby = "%s, %s" % (orderby, pkey)
+
+        while limit is None or limit > 0:
+            size = pagesize if limit is None else min(pagesize, limit)
+            rows = self.load(fields=fields,
+                             skip=skip,
+                             start=start,
+                             limit=size,
+                             orderby=orderby,
+                             virtual=False,
+                             cacheable=True)
+            yield rows
+            if len(rows) < size:
+                break
+            start += size
+            if limit is not None:
+                limit -= size
+        return
+
+    # -------------------------------------------------------------------------
+    def _prefetch(self, rows, fields=None, skip=None):
+        """
+            Load the records of this component (or link table) for a set
+            of master records with a single query, and index them by join
+            key (for export)
+
+            @param rows: the master records
+            @param fields: list of field names to include
+            @param skip: list of field names to skip
+
+            @return: the component records as dict {join key: [Row]}
+        """
+
+        pkey, fkey = self.pkey, self.fkey
+
+        if rows:
+            keys = set(row[pkey] for row in rows if row[pkey] is not None)
+        else:
+            keys = set()
+
+        index = {}
+        if keys:
+            # Restrict the component query to these master records
+            # (temporarily, the component is reloaded for every page)
+            if self.rfilter is None:
+                self.build_query()
+            rfilter = self.rfilter
+            queries = rfilter.queries
+            restriction = self.table[fkey].belongs(keys)
+            queries.append(restriction)
+            rfilter.query = None
+            self._length = None
+            try:
+                crows = self.load(fields=fields,
+                                  skip=skip,
+                                  limit=None,
+                                  virtual=False,
+                                  cacheable=True)
+            finally:
+                for i, q in enumerate(queries):
+                    if q is restriction:
+                        del queries[i]
+                        break
+                rfilter.query = None
+                self._length = None
+
+            for crow in crows:
+                key = crow[fkey]
+                if key in index:
+                    index[key].append(crow)
+                else:
+                    index[key] = [crow]
+        else:
+            self._rows = []
+            self._ids = []
+            self._uids = []
+
+        self._export_index = index
+        return index
+
     # -------------------------------------------------------------------------
     def __export_resource(self,
                           record,
@@ -2744,31 +3230,32 @@ class S3Resource(object):
 
                 # Before loading the component: add filters
                 if c._rows is None:
-                    
-                    # MCI filter
-                    ctable = c.table
-                    if xml.filter_mci and xml.MCI in ctable.fields:
-                        mci_filter = S3FieldSelector(xml.MCI) >= 0
-                        c.add_filter(mci_filter)
-
-                    # Sync filters
-                    ctablename = c.tablename
-                    if filters and ctablename in filters:
-                        queries = S3URLQuery.parse(self, filters[ctablename])
-                        [c.add_filter(q) for a in queries for q in queries[a]]
+
+                    if not c._export_filtered:
+                        # MCI filter
+                        ctable = c.table
+                        if xml.filter_mci and xml.MCI in ctable.fields:
+                            mci_filter = S3FieldSelector(xml.MCI) >= 0
+                            c.add_filter(mci_filter)
+
+                        # Sync filters
+                        ctablename = c.tablename
+                        if filters and ctablename in filters:
+                            queries = S3URLQuery.parse(self, filters[ctablename])
+                            [c.add_filter(q) for a in queries for q in queries[a]]
+                        c._export_filtered = True
 
                     # Fields to load
                     if xmlformat:
                         include, exclude = xmlformat.get_fields(c.tablename)
                     else:
                         include, exclude = None, None
-                        
-                    # Load the records
-                    c.load(fields=include,
-                           skip=exclude,
-                           limit=None,
-                           virtual=False,
-                           cacheable=True)
+
+                    # Load the records for all currently loaded master
+                    # records at once, and index them by join key
+                    c._prefetch(self._rows,
+                                fields=include,
+                                skip=exclude)
 
                 # Split fields
                 crfields, cdfields = c.split_fields(skip=[c.fkey])
@@ -2780,7 +3267,11 @@ class S3Resource(object):
                     component_url = None
 
                 # Find related records
-                crecords = self.get(record[pkey], component=c.alias)
+                index = c._export_index
+                if index is not None:
+                    crecords = index.get(record[c.pkey], [])
+                else:
+                    crecords = self.get(record[pkey], component=c.alias)
                 # @todo: load() should limit this automatically:
                 if not c.multiple and len(crecords):
                     crecords = [crecords[0]]
@@ -2820,9 +3311,7 @@ class S3Resource(object):
         if add:
             self.__map_record(record, rmap, reference_map, export_map)
         elif parent is not None and element is not None:
-            idx = parent.index(element)
-            if idx:
-                del parent[idx]
+            parent.remove(element)
             return None
 
         return element
@@ -3574,6 +4063,54 @@ class S3Resource(object):
         """
 
         db = current.db
+        xml = current.xml
+        UID = xml.UID
+
+        pvalues = cls.original_keys(table, record)
+
+        # Build match query
+        query = None
+        for f in pvalues:
+            if f == UID:
+                continue
+            _query = (table[f] == pvalues[f])
+            if query is not None:
+                query = query | _query
+            else:
+                query = _query
+
+        fields = cls.import_fields(table, pvalues, mandatory=mandatory)
+
+        # Try to find exactly one match by non-UID unique keys
+        if query is not None:
+            original = db(query).select(limitby=(0, 2), *fields)
+            if len(original) == 1:
+                return original.first()
+
+        # If no match, then try to find a UID-match
+        if UID in pvalues:
+            uid = xml.import_uid(pvalues[UID])
+            query = (table[UID] == uid)
+            original = db(query).select(limitby=(0, 1), *fields).first()
+            if original:
+                return original
+
+        # No match or multiple matches
+        return None
+
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def original_keys(table, record):
+        """
+            Get the values for unique fields from a record, i.e. the
+            keys to find the original record of a possible duplicate
+
+            @param table: the table
+            @param record: the record as dict or S3XML Element
+
+            @return: Storage {fieldname: value}
+        """
+
         xml = current.xml
         xml_decode = xml.xml_decode
 
@@ -3610,35 +4147,7 @@ class S3Resource(object):
         else:
             raise TypeError
 
-        # Build match query
-        query = None
-        for f in pvalues:
-            if f == UID:
-                continue
-            _query = (table[f] == pvalues[f])
-            if query is not None:
-                query = query | _query
-            else:
-                query = _query
-
-        fields = cls.import_fields(table, pvalues, mandatory=mandatory)
-
-        # Try to find exactly one match by non-UID unique keys
-        if query is not None:
-            original = db(query).select(limitby=(0, 2), *fields)
-            if len(original) == 1:
-                return original.first()
-
-        # If no match, then try to find a UID-match
-        if UID in pvalues:
-            uid = xml.import_uid(pvalues[UID])
-            query = (table[UID] == uid)
-            original = db(query).select(limitby=(0, 1), *fields).first()
-            if original:
-                return original
-
-        # No match or multiple matches
-        return None
+        return pvalues
 
     # -------------------------------------------------------------------------
     @staticmethod
@@ -4671,6 +5180,10 @@ class S3FieldSelector(object):
     def anyof(self, value):
         return S3ResourceQuery(S3ResourceQuery.ANYOF, self, value)
 
+    # -------------------------------------------------------------------------
+    def typeof(self, value):
+        return S3ResourceQuery(S3ResourceQuery.TYPEOF, self, value)
+
     # -------------------------------------------------------------------------
     def lower(self):
         self.op = self.LOWER
@@ -5342,10 +5855,11 @@ class S3ResourceQuery(object):
     BELONGS = "belongs"
     CONTAINS = "contains"
     ANYOF = "anyof"
+    TYPEOF = "typeof"
 
     OPERATORS = [NOT, AND, OR,
                  LT, LE, EQ, NE, GE, GT,
-                 LIKE, BELONGS, CONTAINS, ANYOF]
+                 LIKE, BELONGS, CONTAINS, ANYOF, TYPEOF]
 
     # -------------------------------------------------------------------------
     def __init__(self, op, left=None, right=None):
@@ -5599,7 +6113,7 @@ class S3ResourceQuery(object):
             elif op == self.NE:
                 op = self.BELONGS
                 invert = True
-            elif op != self.BELONGS:
+            elif op not in (self.BELONGS, self.TYPEOF):
                 query = None
                 for v in rfield:
                     q = query_bare(op, lfield, v)
@@ -5637,6 +6151,8 @@ class S3ResourceQuery(object):
             q = l.contains(r, all=True)
         elif op == self.ANYOF:
             q = l.contains(r, all=False)
+        elif op == self.TYPEOF:
+            q = self._query_typeof(l, r)
         elif op == self.BELONGS:
             if type(r) is not list:
                 r = [r]
@@ -5670,6 +6186,51 @@ class S3ResourceQuery(object):
             q = None
         return q
 
+    # -------------------------------------------------------------------------
+    def _query_typeof(self, l, r):
+        """
+            Translate a TYPEOF-expression (value is any of r or any of
+            their descendants in the hierarchy of the lookup table) into
+            a DAL query, falls back to BELONGS if the lookup table has
+            no hierarchy configured
+
+            @param l: the left operand (Field)
+            @param r: the right operand (node ID or list of node IDs)
+        """
+
+        if type(r) is not list:
+            r = [r]
+        include_none = None in r
+        if include_none:
+            r = [item for item in r if item is not None]
+
+        ftype = str(l.type)
+        if ftype == "id":
+            lookup = l.tablename
+        elif ftype[:9] == "reference" or ftype[:14] == "list:reference":
+            lookup = s3_get_foreign_key(l)[0]
+        else:
+            lookup = None
+
+        from s3hierarchy import S3Hierarchy
+        h = S3Hierarchy(lookup) if lookup else None
+        if h is None or not h.config:
+            q = self._query_bare(self.BELONGS, l, r)
+        elif ftype[:4] == "list":
+            start = []
+            for node_id in r:
+                try:
+                    start.append(long(node_id))
+                except (TypeError, ValueError):
+                    continue
+            node_ids = list(h.findall(start, inclusive=True))
+            q = l.contains(node_ids, all=False)
+        else:
+            q = h.subtree_query(l, r, inclusive=True)
+        if include_none:
+            q |= (l == None)
+        return q
+
     # -------------------------------------------------------------------------
     def __call__(self, resource, row, virtual=True):
         """
@@ -5760,7 +6321,7 @@ class S3ResourceQuery(object):
             elif op == self.NE:
                 op = self.BELONGS
                 invert = True
-            elif op != self.BELONGS:
+            elif op not in (self.BELONGS, self.TYPEOF):
                 for v in r:
                     try:
                         r = probe(op, l, v)
@@ -5804,7 +6365,9 @@ class S3ResourceQuery(object):
                 elif l == r:
                     return True
             return False
-        elif op == self.BELONGS:
+        elif op in (self.BELONGS, self.TYPEOF):
+            # TYPEOF can not be resolved here (virtual fields have
+            # no lookup table), so treat as BELONGS
             if not isinstance(r, (list, tuple)):
                 r = [r]
             r = convert(l, r)
@@ -5901,6 +6464,8 @@ class S3ResourceQuery(object):
                 return "(%s in %s)" % (l, r)
             elif op == self.ANYOF:
                 return "(%s contains any of %s)" % (l, r)
+            elif op == self.TYPEOF:
+                return "(%s is a type of %s)" % (l, r)
             elif op == self.LIKE:
                 return "(%s like %s)" % (l, r)
             elif op == self.LT:
@@ -31,6 +31,7 @@ import datetime
 import os
 import re
 import sys
+import tempfile
 import time
 import types
 try:
@@ -61,6 +62,7 @@ from gluon import *
 #from gluon.validators import IS_EMPTY_OR, IS_NOT_IN_DB, IS_DATE, IS_TIME
 from gluon.dal import Row
 from gluon.storage import Storage
+from gluon.streamer import DEFAULT_CHUNK_SIZE
 from gluon.tools import callback
 
 from s3resource import S3Resource
@@ -87,6 +89,9 @@ class S3RequestManager(object):
 
     MAX_DEPTH = 10
 
+    # Number of records per page for paged extraction (S3Resource.iterselect)
+    PAGESIZE = 1000
+
     # Prefixes of resources that must not be manipulated from remote
     # Can be amended from CLI using: s3mgr.PROTECTED = []
     PROTECTED = ("admin",)
@@ -1282,6 +1287,12 @@ class S3Request(object):
         headers["Content-Type"] = manager.content_type.get(representation,
                                                            default)
 
+        # Write large exports incrementally into a temporary file?
+        if current.deployment_settings.get_base_xml_export_stream():
+            stream = tempfile.TemporaryFile()
+        else:
+            stream = None
+
         # Export the resource
         output = r.resource.export_xml(start=start,
                                        limit=limit,
@@ -1294,11 +1305,17 @@ class S3Request(object):
                                        stylesheet=stylesheet,
                                        as_json=as_json,
                                        maxbounds=maxbounds,
+                                       stream=stream,
                                        **args)
         # Transformation error?
         if not output:
             r.error(400, "XSLT Transformation Error: %s " % current.xml.error)
 
+        if stream is not None:
+            stream.seek(0)
+            return current.response.stream(stream,
+                                           chunk_size=DEFAULT_CHUNK_SIZE,
+                                           request=current.request)
         return output
 
     # -------------------------------------------------------------------------
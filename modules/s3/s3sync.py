@@ -29,9 +29,20 @@
 
 import sys
 import urllib, urllib2
+import bisect
+import calendar
 import datetime
+import hashlib
 import time
 import traceback
+import zlib
+
+from email.utils import formatdate, mktime_tz, parsedate_tz
+
+try:
+    from cStringIO import StringIO    # Faster, where available
+except:
+    from StringIO import StringIO
 
 try:
     from lxml import etree
@@ -67,6 +78,15 @@ else:
 class S3Sync(S3Method):
     """ Synchronization Handler """
 
+    # Minimum size of a response body to compress (bytes)
+    COMPRESS_MIN_SIZE = 512
+
+    # Seconds between checks whether concurrent tasks have completed
+    POLL_INTERVAL = 2
+
+    # Maximum run time of concurrent tasks (seconds)
+    TASK_TIMEOUT = 21600
+
     # -------------------------------------------------------------------------
     def __init__(self):
         """ Constructor """
@@ -194,38 +214,284 @@ class S3Sync(S3Method):
                       message=error)
             return False
 
+        # Run the tasks in dependency order, tasks for independent
+        # resources concurrently (in scheduler workers, as each task
+        # needs its own DB connection and transaction)
+        workers = self.max_workers()
         success = True
-        for task in tasks:
-            
-            # Pull
-            mtime = None
-            if task.mode in (1, 3):
-                error, mtime = connector.pull(task,
-                                              onconflict=self.onconflict)
-            if error:
+        for group in self.task_groups(tasks):
+            if workers > 1 and len(group) > 1:
+                results = self.run_tasks_async(repository, group, workers)
+            else:
+                results = [self.run_task(connector, task) for task in group]
+            if not all(results):
                 success = False
-                _debug("S3Sync.synchronize: %s PULL error: %s" %
-                                    (task.resource_name, error))
-                continue
-            if mtime is not None:
-                task.update_record(last_pull=mtime)
 
-            # Push
-            mtime = None
-            if task.mode in (2, 3):
-                error, mtime = connector.push(task)
-            if error:
+        return success
+
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def max_workers():
+        """
+            Get the maximum number of sync tasks to run concurrently, i.e.
+            the sync.max_workers setting, limited by the number of active
+            scheduler workers (one of which may be running the calling
+            task itself)
+
+            @return: the number of concurrent tasks (1 = run sequentially)
+        """
+
+        workers = current.deployment_settings.get_sync_max_workers()
+        db = current.db
+        if not workers or workers < 2 or db._dbname == "sqlite":
+            # SQLite doesn't support concurrent writes
+            return 1
+
+        table = db.scheduler_worker
+        now = datetime.datetime.now()
+        query = (table.last_heartbeat > (now - datetime.timedelta(minutes=1)))
+        alive = db(query).count()
+
+        return max(min(workers, alive - 1), 1)
+
+    # -------------------------------------------------------------------------
+    def run_tasks_async(self, repository, tasks, workers):
+        """
+            Run independent synchronization tasks concurrently, as
+            scheduler tasks (sync_run_tasks) which get their own DB
+            connection, and wait for them to complete
+
+            NB this commits the current transaction, so that the scheduler
+               tasks can see the data of the previous tasks
+
+            @param repository: the repository Row
+            @param tasks: the tasks (list of sync_task Rows)
+            @param workers: the maximum number of concurrent tasks
+
+            @return: list of results (True/False) in the order of tasks
+        """
+
+        db = current.db
+        s3task = current.s3task
+
+        # Distribute the tasks over the workers
+        workers = min(workers, len(tasks))
+        chunks = [tasks[i::workers] for i in xrange(workers)]
+
+        records = []
+        for chunk in chunks:
+            task_ids = json.dumps([task.id for task in chunk])
+            record = s3task.async("sync_run_tasks",
+                                  vars={"repository_id": repository.id,
+                                        "task_ids": task_ids,
+                                        },
+                                  timeout=self.TASK_TIMEOUT)
+            records.append(record)
+        db.commit()
+
+        # Wait for the scheduler tasks to complete
+        ttable = db.scheduler_task
+        record_ids = [record for record in records if record]
+        query = (ttable.id.belongs(record_ids)) & \
+                (ttable.status.belongs(("QUEUED", "ASSIGNED", "RUNNING")))
+        # (or until the timeout, in case a worker has died)
+        deadline = time.time() + self.TASK_TIMEOUT
+        while record_ids and not db(query).isempty() and \
+              time.time() < deadline:
+            db.commit()
+            time.sleep(self.POLL_INTERVAL)
+        db.commit()
+
+        # Collect the results
+        rtable = db.scheduler_run
+        query = (rtable.task_id.belongs(record_ids)) & \
+                (rtable.status == "COMPLETED")
+        rows = db(query).select(rtable.task_id, rtable.run_result)
+        completed = dict((row.task_id, row.run_result) for row in rows)
+
+        results = {}
+        for chunk, record in zip(chunks, records):
+            if not record:
+                # Has been run synchronously (no active worker)
+                success = True
+            else:
+                result = completed.get(record)
+                success = result is not None and \
+                          json.loads(result) == S3SyncLog.SUCCESS
+            for task in chunk:
+                results[task.id] = success
+
+        return [results[task.id] for task in tasks]
+
+    # -------------------------------------------------------------------------
+    def run_tasks(self, repository, task_ids):
+        """
+            Run synchronization tasks for a repository, to be called
+            from the sync_run_tasks scheduler task (see run_tasks_async)
+
+            @param repository: the repository Row
+            @param task_ids: the sync_task record IDs
+
+            @return: True if successful, False if there was an error
+        """
+
+        ttable = current.s3db.sync_task
+        query = (ttable.id.belongs(task_ids)) & \
+                (ttable.repository_id == repository.id) & \
+                (ttable.deleted != True)
+        tasks = current.db(query).select()
+
+        connector = S3SyncRepository.factory(repository)
+        if connector.login():
+            return False
+
+        success = True
+        for task in tasks:
+            if not self.run_task(connector, task):
                 success = False
-                _debug("S3Sync.synchronize: %s PUSH error: %s" %
-                                    (task.resource_name, error))
-                continue
-            if mtime is not None:
-                task.update_record(last_push=mtime)
+        return success
+
+    # -------------------------------------------------------------------------
+    def reconcile(self, repository, resource_names=None):
+        """
+            Reconcile the data of all tasks for a repository by checksums,
+            in order to recover from clock skew or restored backups without
+            resynchronizing whole tables (see S3SyncChecksum)
+
+            @param repository: the repository Row
+            @param resource_names: reconcile only these resources (list)
+
+            @return: True if successful, False if there was an error
+        """
+
+        _debug("S3Sync.reconcile(%s)" % repository.url)
+
+        if not repository.url:
+            return False
+
+        ttable = current.s3db.sync_task
+        query = (ttable.repository_id == repository.id) & \
+                (ttable.deleted != True)
+        if resource_names:
+            query &= (ttable.resource_name.belongs(resource_names))
+        tasks = current.db(query).select()
 
-            _debug("S3Sync.synchronize: %s done" % task.resource_name)
+        # Only supported between Sahana Eden instances
+        if repository.apitype != "eden":
+            return False
+        connector = S3SyncRepository.factory(repository)
+        if connector.login():
+            return False
 
+        success = True
+        for group in self.task_groups(tasks):
+            for task in group:
+                error = connector.reconcile(task, onconflict=self.onconflict)
+                if error:
+                    _debug("S3Sync.reconcile: %s error: %s" %
+                           (task.resource_name, error))
+                    success = False
         return success
 
+    # -------------------------------------------------------------------------
+    def run_task(self, connector, task):
+        """
+            Run a synchronization task (pull and/or push)
+
+            @param connector: the repository connector (S3SyncRepository)
+            @param task: the task (sync_task Row)
+
+            @return: True if successful, False if there was an error
+        """
+
+        # Pull
+        error = None
+        mtime = None
+        if task.mode in (1, 3):
+            error, mtime = connector.pull(task,
+                                          onconflict=self.onconflict)
+        if error:
+            _debug("S3Sync.synchronize: %s PULL error: %s" %
+                                (task.resource_name, error))
+            return False
+        if mtime is not None:
+            task.update_record(last_pull=mtime)
+
+        # Push
+        mtime = None
+        if task.mode in (2, 3):
+            error, mtime = connector.push(task)
+        if error:
+            _debug("S3Sync.synchronize: %s PUSH error: %s" %
+                                (task.resource_name, error))
+            return False
+        if mtime is not None:
+            task.update_record(last_push=mtime)
+
+        _debug("S3Sync.synchronize: %s done" % task.resource_name)
+        return True
+
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def task_groups(tasks):
+        """
+            Group synchronization tasks by foreign key dependencies
+            between their resources, so that referenced resources get
+            synchronized before the resources referencing them
+
+            @param tasks: the tasks (sync_task Rows)
+
+            @return: list of lists of tasks, where the tasks in each group
+                     only depend on tasks in previous groups
+        """
+
+        s3db = current.s3db
+
+        tablenames = set(task.resource_name for task in tasks)
+
+        # Find the dependencies between the synchronized tables
+        dependencies = {}
+        for tablename in tablenames:
+            required = set()
+            table = s3db.table(tablename)
+            if table is not None:
+                for field in table:
+                    ftype = str(field.type)
+                    if ftype[:10] == "reference ":
+                        ktablename = ftype[10:].split(".", 1)[0]
+                    elif ftype[:15] == "list:reference ":
+                        ktablename = ftype[15:].split(".", 1)[0]
+                    else:
+                        continue
+                    if ktablename != tablename and ktablename in tablenames:
+                        required.add(ktablename)
+            dependencies[tablename] = required
+
+        groups = []
+        done = set()
+        pending = list(tasks)
+        while pending:
+            group = []
+            names = set()
+            deferred = []
+            for task in pending:
+                tablename = task.resource_name
+                if tablename in names or dependencies[tablename] - done:
+                    # Tasks for the same resource go into separate groups
+                    deferred.append(task)
+                else:
+                    group.append(task)
+                    names.add(tablename)
+            if not group:
+                # Circular dependencies => run the rest one by one
+                groups.extend([task] for task in pending)
+                break
+            groups.append(group)
+            done |= names
+            pending = deferred
+
+        return groups
+
     # -------------------------------------------------------------------------
     def __register(self, r, **attr):
         """
@@ -300,6 +566,8 @@ class S3Sync(S3Method):
 
         _debug("S3Sync.__send")
 
+        start_time = time.time()
+
         resource = r.resource
         
         # Identify the requesting repository
@@ -347,6 +615,9 @@ class S3Sync(S3Method):
                 msince = datetime.datetime(y, m, d, hh, mm, ss)
             except ValueError:
                 msince = None
+        cursor = _vars.get("cursor", None)
+        if cursor is not None:
+            cursor = self.decode_cursor(cursor)
 
         # Sync filters from peer
         filters = {}
@@ -367,25 +638,79 @@ class S3Sync(S3Method):
         if not filters:
             filters = None
 
+        log = self.log
+
+        # Reconciliation: checksums of buckets
+        checksums = _vars.get("checksums", None)
+        if checksums is not None:
+            if filters and resource.tablename in filters:
+                queries = S3URLQuery.parse(resource,
+                                           filters[resource.tablename])
+                [resource.add_filter(q) for a in queries for q in queries[a]]
+            prefixes = [p for p in checksums.split(",") if p.isalnum()] or [""]
+            output = S3SyncChecksum.from_resource(resource).checksums(prefixes)
+            current.response.headers["Content-Type"] = "application/json"
+            return json.dumps({"checksums": output}, separators=(",", ":"))
+
+        # Reconciliation: export only the records in these buckets
+        buckets = _vars.get("buckets", None)
+        if buckets is not None:
+            prefixes = [p for p in buckets.split(",") if p.isalnum()]
+            uids = S3SyncChecksum.from_resource(resource).uids(prefixes)
+            import_uid = current.xml.import_uid
+            table = resource.table
+            resource.add_filter(table[current.xml.UID].belongs(
+                                    [import_uid(uid) for uid in uids]))
+
+        # Conditional request: skip the export if nothing has changed
+        since = self.parse_http_date(r.env.http_if_modified_since)
+        if since is not None and not self.changed(resource, since):
+            log.write(repository_id=repository_id,
+                      resource_name=r.resource.tablename,
+                      transmission=log.IN,
+                      mode=log.PULL,
+                      result=log.SUCCESS,
+                      message="no changes since %s" % since,
+                      bytes_out=0,
+                      duration=time.time() - start_time)
+            raise HTTP(304)
+
         # Export the resource
         output = resource.export_xml(start=start,
                                      limit=limit,
                                      filters=filters,
-                                     msince=msince)
+                                     msince=msince,
+                                     cursor=cursor,
+                                     as_tree=cursor is not None)
         count = resource.results
 
+        if cursor is not None:
+            # Tell the peer where the next page starts ("" = no more pages)
+            root = output.getroot()
+            root.set(current.xml.ATTRIBUTE.cursor,
+                     self.encode_cursor(resource.cursor))
+            output = current.xml.tostring(output, pretty_print=False)
+
         # Set content type header
         headers = current.response.headers
         headers["Content-Type"] = "text/xml"
 
+        # Compress the response if the peer accepts that
+        if self.accepts_encoding(r.env.http_accept_encoding) and \
+           len(output) > self.COMPRESS_MIN_SIZE:
+            output = self.compress(output)
+            headers["Content-Encoding"] = "gzip"
+            headers["Vary"] = "Accept-Encoding"
+
         # Log the operation
-        log = self.log
         log.write(repository_id=repository_id,
                   resource_name=r.resource.tablename,
                   transmission=log.IN,
                   mode=log.PULL,
                   result=log.SUCCESS,
-                  message="data sent to peer (%s records)" % count)
+                  message="data sent to peer (%s records)" % count,
+                  bytes_out=len(output),
+                  duration=time.time() - start_time)
 
         return output
 
@@ -400,6 +725,8 @@ class S3Sync(S3Method):
 
         _debug("S3Sync.__receive")
 
+        start_time = time.time()
+
         s3db = current.s3db
         db = current.db
 
@@ -471,6 +798,30 @@ class S3Sync(S3Method):
         # Get the source
         source = r.read_body()
 
+        # Decompress the source if required
+        bytes_in = 0
+        encoding = r.env.http_content_encoding
+        decompressed = []
+        for item in source:
+            if isinstance(item, tuple):
+                # Multipart upload
+                name, s = item
+            else:
+                name, s = None, item
+            data = s.read() if hasattr(s, "read") else s
+            bytes_in += len(data)
+            if encoding:
+                try:
+                    data = self.decompress(data, encoding)
+                except ValueError:
+                    r.error(415, sys.exc_info()[1])
+                except zlib.error:
+                    r.error(400, "Invalid %s content: %s" %
+                                 (encoding, sys.exc_info()[1]))
+            s = StringIO(data)
+            decompressed.append(s if name is None else (name, s))
+        source = decompressed
+
         # Import resource
         resource = r.resource
         onconflict = lambda item: self.onconflict(item, repository, resource)
@@ -527,7 +878,9 @@ class S3Sync(S3Method):
                   transmission=log.IN,
                   mode=log.PUSH,
                   result=result,
-                  message=message)
+                  message=message,
+                  bytes_in=bytes_in,
+                  duration=time.time() - start_time)
 
         return output
 
@@ -599,6 +952,207 @@ class S3Sync(S3Method):
                 _debug("Accept because no rule found")
                 item.conflict = False
 
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def encode_cursor(cursor):
+        """
+            Encode a pagination cursor for a peer
+
+            @param cursor: tuple (modified_on, id) of the last record
+                           of a page, or None for the last page
+
+            @return: the cursor as string
+        """
+
+        if not cursor:
+            return ""
+        mtime, record_id = cursor
+        return "%s/%s" % (mtime.isoformat(), record_id)
+
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def decode_cursor(cursor):
+        """
+            Decode a pagination cursor from a peer
+
+            @param cursor: the cursor as string, see encode_cursor
+
+            @return: tuple (modified_on, id), or True to start with the
+                     first page
+        """
+
+        try:
+            mtime, record_id = cursor.rsplit("/", 1)
+            record_id = long(record_id)
+            if "." in mtime:
+                fmt = "%Y-%m-%dT%H:%M:%S.%f"
+            else:
+                fmt = "%Y-%m-%dT%H:%M:%S"
+            mtime = datetime.datetime.strptime(mtime, fmt)
+        except ValueError:
+            return True
+        return (mtime, record_id)
+
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def accepts_encoding(header, encoding="gzip"):
+        """
+            Check whether an Accept-Encoding header accepts an encoding
+
+            @param header: the Accept-Encoding header value
+            @param encoding: the content encoding
+
+            @return: True if the encoding is acceptable, else False
+        """
+
+        if not header:
+            return False
+
+        qvalues = {}
+        for item in header.split(","):
+            parts = item.split(";")
+            name = parts[0].strip().lower()
+            q = 1.0
+            for param in parts[1:]:
+                k, v = (param.split("=", 1) + [""])[:2]
+                if k.strip().lower() == "q":
+                    try:
+                        q = float(v)
+                    except ValueError:
+                        q = 0.0
+            qvalues[name] = q
+
+        if encoding in qvalues:
+            return qvalues[encoding] > 0
+        return qvalues.get("*", 0) > 0
+
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def compress(data):
+        """
+            Compress a message body (gzip)
+
+            @param data: the data (str or unicode)
+
+            @return: the gzip-compressed data
+        """
+
+        if isinstance(data, unicode):
+            data = data.encode("utf-8")
+        compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        return compressor.compress(data) + compressor.flush()
+
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def decompress(data, encoding):
+        """
+            Decompress a message body
+
+            @param data: the data as received
+            @param encoding: the Content-Encoding (gzip, deflate or identity)
+
+            @return: the decompressed data
+
+            @raise ValueError: for unsupported content encodings
+            @raise zlib.error: if the data can not be decompressed
+        """
+
+        encoding = (encoding or "").strip().lower()
+        if not encoding or encoding == "identity":
+            return data
+        elif encoding in ("gzip", "x-gzip"):
+            return zlib.decompress(data, 16 + zlib.MAX_WBITS)
+        elif encoding == "deflate":
+            try:
+                return zlib.decompress(data)
+            except zlib.error:
+                # Some clients send raw deflate streams without zlib header
+                return zlib.decompress(data, -zlib.MAX_WBITS)
+        else:
+            raise ValueError("Unsupported content encoding: %s" % encoding)
+
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def http_date(dt):
+        """
+            Format a datetime as HTTP date (e.g. for If-Modified-Since)
+
+            @param dt: the datetime (UTC)
+        """
+
+        return formatdate(calendar.timegm(dt.utctimetuple()), usegmt=True)
+
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def parse_http_date(value):
+        """
+            Parse an HTTP date (e.g. from If-Modified-Since)
+
+            @param value: the header value
+
+            @return: the datetime (UTC), or None if value is invalid
+        """
+
+        if not value:
+            return None
+        try:
+            timetuple = parsedate_tz(value)
+            if timetuple is None:
+                return None
+            return datetime.datetime.utcfromtimestamp(mktime_tz(timetuple))
+        except (TypeError, ValueError, OverflowError):
+            return None
+
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def changed(resource, msince):
+        """
+            Check whether a resource has any records or component records
+            which have been modified after msince, as a cheap alternative
+            to a full export (conditional requests). Sync filters are not
+            applied here, so the answer is on the safe side.
+
+            @param resource: the S3Resource
+            @param msince: the datetime
+
+            @return: False if nothing has been modified after msince,
+                     otherwise True
+        """
+
+        if msince is None:
+            return True
+
+        MTIME = current.xml.MTIME
+        table = resource.table
+        if MTIME not in table.fields:
+            return True
+
+        db = current.db
+        query = resource.get_query()
+        left = resource.rfilter.get_left_joins()
+
+        row = db(query & (table[MTIME] > msince)).select(table._id,
+                                                         left=left,
+                                                         limitby=(0, 1)).first()
+        if row:
+            return True
+
+        # Modified components cause their master record to be exported
+        components = resource.components
+        for alias in components:
+            component = components[alias]
+            ctable = component.table
+            if MTIME not in ctable.fields:
+                return True
+            cquery = query & component.get_join() & (ctable[MTIME] > msince)
+            row = db(cquery).select(table._id,
+                                    left=left,
+                                    limitby=(0, 1)).first()
+            if row:
+                return True
+
+        return False
+
     # -------------------------------------------------------------------------
     @staticmethod
     def get_filters(task_id):
@@ -703,7 +1257,10 @@ class S3SyncLog(S3Method):
               action=None,
               result=None,
               remote=False,
-              message=None):
+              message=None,
+              bytes_in=None,
+              bytes_out=None,
+              duration=None):
         """
             Writes a new entry to the log
 
@@ -716,6 +1273,9 @@ class S3SyncLog(S3Method):
                            (SUCCESS, WARNING, ERROR or FATAL)
             @param remote: boolean, True if this is a remote error
             @param message: clear text message
+            @param bytes_in: number of bytes received (as transmitted)
+            @param bytes_out: number of bytes sent (as transmitted)
+            @param duration: duration of the transaction (seconds)
         """
 
         if result not in (cls.SUCCESS,
@@ -742,7 +1302,10 @@ class S3SyncLog(S3Method):
                         action=action,
                         result=result,
                         remote=remote,
-                        message=message)
+                        message=message,
+                        bytes_in=bytes_in,
+                        bytes_out=bytes_out,
+                        duration=duration)
 
         table = current.s3db[cls.TABLENAME]
 
@@ -758,6 +1321,175 @@ class S3SyncLog(S3Method):
         else:
             return None
 
+# =============================================================================
+class S3SyncChecksum(object):
+    """
+        Checksums over (uuid, modified_on) of a synchronized table, for
+        reconciliation independently of msince timestamps (e.g. after
+        clock skew or a restored backup).
+
+        Records are assigned to buckets by the MD5 hex digest of their
+        UID, so that both sides use the same buckets. A bucket is
+        identified by a prefix of the digest, and its checksum is the
+        XOR of the hashes of its records. Both sides exchange the
+        checksums of the sub-buckets of all differing buckets, level
+        by level, until the differing buckets are small enough to be
+        transferred (as S3XML).
+    """
+
+    # Digits per level (sub-buckets per bucket = 16 ** LEVEL_DIGITS)
+    LEVEL_DIGITS = 1
+
+    # Maximum prefix length (=depth of the bucket tree)
+    MAX_DEPTH = 4
+
+    # Buckets with not more than this number of records are not split
+    MIN_SPLIT = 64
+
+    # -------------------------------------------------------------------------
+    def __init__(self, rows):
+        """
+            Constructor
+
+            @param rows: iterable of tuples (uid, modified_on), with the
+                         UIDs in their exported form (domain prefixed)
+        """
+
+        entries = []
+        for uid, mtime in rows:
+            if not uid:
+                continue
+            if mtime is not None:
+                mtime = mtime.replace(microsecond=0).isoformat()
+            if isinstance(uid, unicode):
+                uid = uid.encode("utf-8")
+            digest = hashlib.md5(uid).hexdigest()
+            value = long(hashlib.md5("%s|%s" % (uid, mtime)).hexdigest(), 16)
+            entries.append((digest, value, uid))
+        entries.sort()
+        self.entries = entries
+
+    # -------------------------------------------------------------------------
+    @classmethod
+    def from_resource(cls, resource):
+        """
+            Compute the checksums for all records in a resource
+
+            @param resource: the S3Resource (should include deleted records)
+        """
+
+        db = current.db
+        xml = current.xml
+
+        table = resource.table
+        UID = xml.UID
+        MTIME = xml.MTIME
+        if UID not in table.fields:
+            return cls([])
+        fields = [table[UID]]
+        if MTIME in table.fields:
+            fields.append(table[MTIME])
+
+        query = resource.get_query()
+        left = resource.rfilter.get_left_joins()
+        rows = db(query).select(left=left, *fields)
+
+        export_uid = xml.export_uid
+        if MTIME in table.fields:
+            data = ((export_uid(row[UID]), row[MTIME]) for row in rows)
+        else:
+            data = ((export_uid(row[UID]), None) for row in rows)
+        return cls(data)
+
+    # -------------------------------------------------------------------------
+    def checksums(self, prefixes):
+        """
+            Get the checksums of all (non-empty) sub-buckets of buckets
+
+            @param prefixes: the prefixes of the buckets ("" for the root)
+
+            @return: dict {prefix: [checksum, count]} of the sub-buckets
+        """
+
+        result = {}
+        for prefix in prefixes:
+            length = len(prefix) + self.LEVEL_DIGITS
+            for digest, value, uid in self._bucket(prefix):
+                key = digest[:length]
+                if key in result:
+                    bucket = result[key]
+                    bucket[0] ^= value
+                    bucket[1] += 1
+                else:
+                    result[key] = [value, 1]
+        for key in result:
+            result[key][0] = "%032x" % result[key][0]
+        return result
+
+    # -------------------------------------------------------------------------
+    def uids(self, prefixes):
+        """
+            Get the UIDs of all records in buckets
+
+            @param prefixes: the prefixes of the buckets
+
+            @return: list of UIDs (in their exported form)
+        """
+
+        uids = []
+        for prefix in prefixes:
+            uids.extend(uid for digest, value, uid in self._bucket(prefix))
+        return uids
+
+    # -------------------------------------------------------------------------
+    def _bucket(self, prefix):
+        """
+            Get all entries in a bucket
+
+            @param prefix: the prefix of the bucket
+        """
+
+        entries = self.entries
+        index = bisect.bisect_left(entries, (prefix,))
+        length = len(prefix)
+        for entry in entries[index:]:
+            if entry[0][:length] != prefix:
+                break
+            yield entry
+
+    # -------------------------------------------------------------------------
+    @classmethod
+    def diff(cls, local, remote):
+        """
+            Find the differing buckets between local and remote records
+
+            @param local: the local S3SyncChecksum
+            @param remote: function to get the remote checksums, receiving
+                           a list of bucket prefixes and returning a dict
+                           like S3SyncChecksum.checksums
+
+            @return: list of prefixes of the differing buckets
+        """
+
+        differing = []
+        prefixes = [""]
+        while prefixes:
+            local_checksums = local.checksums(prefixes)
+            remote_checksums = remote(prefixes)
+            split = []
+            for key in set(local_checksums) | set(remote_checksums):
+                l = local_checksums.get(key)
+                r = remote_checksums.get(key)
+                if l == r:
+                    continue
+                count = max(l[1] if l else 0, r[1] if r else 0)
+                if count <= cls.MIN_SPLIT or len(key) >= cls.MAX_DEPTH:
+                    differing.append(key)
+                else:
+                    split.append(key)
+            prefixes = sorted(split)
+        return sorted(differing)
+
 # =============================================================================
 class S3SyncRepository(object):
     """
@@ -814,6 +1546,10 @@ class S3SyncRepository(object):
         self.site_key = repository.site_key
         self.proxy = repository.proxy
 
+        # Whether to compress pushed data (False once the peer
+        # has rejected a compressed request)
+        self.compress = True
+
     # -------------------------------------------------------------------------
     def get_config(self):
         """ Read the sync settings, avoid repeated DB lookups """
@@ -936,6 +1672,12 @@ class S3SyncRepository(object):
         """
             Outgoing pull
 
+            If a page size is configured (settings.sync.pull_page_size),
+            the data are requested page by page and every page is imported
+            and committed separately. The position of the last imported
+            page is kept in task.pull_cursor, so that an interrupted pull
+            can be resumed from there rather than from last_pull.
+
             @param task: the task (sync_task Row)
         """
 
@@ -963,9 +1705,103 @@ class S3SyncRepository(object):
             for k, v in filters[tablename].items():
                 urlfilter = "[%s]%s=%s" % (prefix, k, v)
                 url += "&%s" % urlfilter
-                
+
+        # Pagination
+        page_size = current.deployment_settings.get_sync_pull_page_size()
+        if page_size:
+            cursor = task.pull_cursor or ""
+        else:
+            cursor = None
+
+        # Ask the peer to skip the export if nothing has changed
+        # since the last pull (unless resuming an interrupted pull)
+        if last_pull and task.update_policy not in ("THIS", "OTHER") and \
+           not cursor:
+            since = last_pull
+        else:
+            since = None
+
+        mtime = None
+        while True:
+
+            if cursor is not None:
+                page_url = "%s&limit=%s&cursor=%s" % \
+                           (url, page_size, urllib.quote(cursor))
+            else:
+                page_url = url
+
+            output, page_mtime, next_cursor = self._pull(task,
+                                                         page_url,
+                                                         last_pull,
+                                                         onconflict=onconflict,
+                                                         paged=cursor is not None,
+                                                         since=since)
+            since = None
+            if output is not None:
+                # Error (task.pull_cursor remains at the last imported page)
+                return (output, None)
+
+            if page_mtime is not None and (mtime is None or page_mtime > mtime):
+                mtime = page_mtime
+
+            if cursor is None:
+                break
+            elif next_cursor is None:
+                # Peer does not support pagination => pull everything
+                # (can only happen with the first page)
+                _debug("S3SyncRepository.pull: peer does not support paging")
+                cursor = None
+                continue
+            elif next_cursor:
+                # Checkpoint
+                cursor = next_cursor
+                task.update_record(pull_cursor=cursor)
+                current.db.commit()
+            else:
+                # Last page
+                break
+
+        if task.pull_cursor:
+            task.update_record(pull_cursor=None)
+        return (output, mtime)
+
+    # -------------------------------------------------------------------------
+    def _pull(self,
+              task,
+              url,
+              last_pull,
+              onconflict=None,
+              paged=False,
+              since=None):
+        """
+            Pull and import the data from a URL (helper for pull)
+
+            Responses are requested gzip-compressed; peers which support
+            conditional requests respond with 304 Not Modified (instead of
+            an export) if nothing has been modified since the "since" date.
+
+            @param task: the task (sync_task Row)
+            @param url: the URL
+            @param last_pull: the time of the last pull (msince)
+            @param onconflict: the conflict resolver
+            @param paged: a page of data has been requested
+            @param since: send If-Modified-Since with this datetime
+
+            @return: tuple (output, mtime, cursor), output being None
+                     if successful, mtime being the latest modification
+                     time of the imported records, cursor being the
+                     position of the next page ("" for the last page)
+                     or None if the peer doesn't support pagination
+        """
+
+        xml = current.xml
+        config = self.get_config()
+        resource_name = task.resource_name
+
         _debug("...pull from URL %s" % url)
 
+        start_time = time.time()
+
         # Figure out the protocol from the URL
         url_split = url.split("://", 1)
         if len(url_split) == 2:
@@ -975,6 +1811,9 @@ class S3SyncRepository(object):
 
         # Create the request
         req = urllib2.Request(url=url)
+        req.add_header("Accept-Encoding", "gzip")
+        if since is not None:
+            req.add_header("If-Modified-Since", S3Sync.http_date(since))
         handlers = []
 
         # Proxy handling
@@ -1011,10 +1850,18 @@ class S3SyncRepository(object):
         remote = False
         output = None
         response = None
+        unchanged = False
+        bytes_in = None
         log = self.log
         try:
             f = urllib2.urlopen(req)
+            data = f.read()
+            bytes_in = len(data)
+            data = S3Sync.decompress(data, f.info().get("Content-Encoding"))
         except urllib2.HTTPError, e:
+            if e.code == 304:
+                # Not modified
+                unchanged = True
             result = log.ERROR
             remote = True # Peer error
             code = e.code
@@ -1046,10 +1893,36 @@ class S3SyncRepository(object):
             output = xml.json_message(False, code, message)
         else:
             result = log.SUCCESS
-            response = f
+            response = StringIO(data)
 
         # Process the response
         mtime = None
+        cursor = None
+        if unchanged:
+            result = log.SUCCESS
+            remote = False
+            message = "no changes on peer since %s" % since
+            output = None
+            if paged:
+                cursor = ""
+
+        elif response and paged:
+            # Parse the page to find the cursor for the next page
+            tree = xml.parse(response)
+            if tree is None:
+                result = log.FATAL
+                remote = True
+                message = "invalid data received from peer: %s" % xml.error
+                output = xml.json_message(False, 400, message)
+                response = None
+            else:
+                cursor = tree.getroot().get(xml.ATTRIBUTE.cursor)
+                if cursor is None:
+                    # Peer does not support pagination => do not import
+                    # (incomplete), but let the caller pull everything
+                    return (None, None, None)
+                response = tree
+
         if response:
 
             # Get import strategy and update policy
@@ -1120,7 +1993,7 @@ class S3SyncRepository(object):
             elif not message:
                 message = "data imported successfully (%s records)" % count
 
-        elif result == log.SUCCESS:
+        elif result == log.SUCCESS and not unchanged:
             # No data received from peer
             result = log.ERROR
             remote = True
@@ -1134,17 +2007,142 @@ class S3SyncRepository(object):
                   action=None,
                   remote=remote,
                   result=result,
-                  message=message)
+                  message=message,
+                  bytes_in=bytes_in,
+                  duration=time.time() - start_time)
 
         _debug("S3SyncRepository.pull import %s: %s" % (result, message))
-        return (output, mtime)
+        return (output, mtime, cursor)
 
     # -------------------------------------------------------------------------
-    def push(self, task):
+    def reconcile(self, task, onconflict=None):
+        """
+            Reconcile the data of a task with the peer by comparing
+            checksums (see S3SyncChecksum) rather than msince timestamps,
+            and transfer the records in the differing buckets only
+
+            @param task: the task (sync_task Row)
+            @param onconflict: the conflict resolver for pulls
+
+            @return: the error message (JSON), or None if successful
+        """
+
+        xml = current.xml
+        config = self.get_config()
+        resource_name = task.resource_name
+
+        _debug("S3SyncRepository.reconcile(%s, %s)" % (self.url, resource_name))
+
+        # Construct the URL
+        url = "%s/sync/sync.xml?resource=%s&repository=%s" % \
+              (self.url, resource_name, config.uuid)
+        url += "&include_deleted=True"
+        filters = current.sync.get_filters(task.id)
+        for tablename in filters:
+            prefix = "~" if not tablename or tablename == resource_name \
+                            else tablename
+            for k, v in filters[tablename].items():
+                url += "&[%s]%s=%s" % (prefix, k, v)
+
+        # Compare local and remote checksums
+        resource = current.s3db.resource(resource_name, include_deleted=True)
+        local = S3SyncChecksum.from_resource(resource)
+        checksums_url = "%s&checksums=" % url.replace("sync.xml", "sync.json")
+        def remote(prefixes):
+            f = self._open(checksums_url + ",".join(prefixes))
+            return json.loads(f.read())["checksums"]
+        try:
+            buckets = S3SyncChecksum.diff(local, remote)
+        except:
+            message = "reconciliation failed: %s" % sys.exc_info()[1]
+            log = self.log
+            log.write(repository_id=self.id,
+                      resource_name=resource_name,
+                      transmission=log.OUT,
+                      mode=None,
+                      action="reconcile",
+                      remote=True,
+                      result=log.ERROR,
+                      message=message)
+            return xml.json_message(False, 400, message)
+
+        _debug("...%s differing buckets" % len(buckets))
+        if not buckets:
+            return None
+
+        # Pull the records in the differing buckets
+        if task.mode in (1, 3):
+            bucket_url = "%s&buckets=%s" % (url, ",".join(buckets))
+            output, mtime, cursor = self._pull(task,
+                                               bucket_url,
+                                               None,
+                                               onconflict=onconflict)
+            if output is not None:
+                return output
+
+        # Push the local records in the differing buckets
+        if task.mode in (2, 3):
+            import_uid = xml.import_uid
+            uids = [import_uid(uid) for uid in local.uids(buckets)]
+            if uids:
+                output, mtime = self.push(task, uids=uids)
+                if output is not None:
+                    return output
+
+        return None
+
+    # -------------------------------------------------------------------------
+    def _open(self, url):
+        """
+            Open a URL at the peer (helper for reconcile)
+
+            @param url: the URL
+
+            @return: the response (file-like object)
+        """
+
+        config = self.get_config()
+
+        if "://" in url:
+            protocol = url.split("://", 1)[0]
+        else:
+            protocol = "http"
+
+        req = urllib2.Request(url=url)
+        handlers = []
+
+        # Proxy handling
+        proxy = self.proxy or config.proxy or None
+        if proxy:
+            handlers.append(urllib2.ProxyHandler({protocol: proxy}))
+
+        # Authentication
+        username = self.username
+        password = self.password
+        if username and password:
+            import base64
+            base64string = base64.encodestring('%s:%s' %
+                                               (username, password))[:-1]
+            req.add_header("Authorization", "Basic %s" % base64string)
+
+        if handlers:
+            opener = urllib2.build_opener(*handlers)
+            urllib2.install_opener(opener)
+
+        return urllib2.urlopen(req)
+
+    # -------------------------------------------------------------------------
+    def push(self, task, uids=None):
         """
             Outgoing push
 
+            The data are sent gzip-compressed, falling back to uncompressed
+            transmission if the peer doesn't accept that. Nothing is exported
+            if no records have been modified since the last push.
+
             @param task: the sync_task Row
+            @param uids: push only the records with these UIDs, regardless
+                         of their modification date (reconciliation)
         """
 
         xml = current.xml
@@ -1166,7 +2164,8 @@ class S3SyncRepository(object):
         if conflict_policy:
             url += "&conflict_policy=%s" % conflict_policy
         last_push = task.last_push
-        if last_push and update_policy not in ("THIS", "OTHER"):
+        if last_push and update_policy not in ("THIS", "OTHER") and \
+           uids is None:
             url += "&msince=%s" % xml.encode_iso_datetime(last_push)
         else:
             last_push = None
@@ -1174,20 +2173,29 @@ class S3SyncRepository(object):
 
         # Define the resource
         resource = current.s3db.resource(resource_name,
+                                         uid=uids,
                                          include_deleted=True)
 
+        start_time = time.time()
+
         # Apply sync filters for this task
         filters = current.sync.get_filters(task.id)
-        
-        # Export the resource as S3XML
-        data = resource.export_xml(filters=filters,
-                                   msince=last_push)
-        count = resource.results or 0
-        mtime = resource.muntil
+
+        # Export the resource as S3XML (unless nothing has changed)
+        if last_push is None or S3Sync.changed(resource, last_push):
+            data = resource.export_xml(filters=filters,
+                                       msince=last_push)
+            count = resource.results or 0
+            mtime = resource.muntil
+        else:
+            data = None
+            count = 0
+            mtime = None
 
         # Transmit the data via HTTP
         remote = False
         output = None
+        bytes_out = None
         log = self.log
         if data and count:
 
@@ -1198,10 +2206,11 @@ class S3SyncRepository(object):
             else:
                 protocol, path = "http", None
 
-            # Generate the request
-            import urllib2
-            req = urllib2.Request(url=url, data=data)
-            req.add_header('Content-Type', "text/xml")
+            # Compress the data
+            if isinstance(data, unicode):
+                data = data.encode("utf-8")
+            compressed = S3Sync.compress(data)
+
             handlers = []
 
             # Proxy handling
@@ -1219,7 +2228,6 @@ class S3SyncRepository(object):
                 import base64
                 base64string = base64.encodestring('%s:%s' %
                                                    (username, password))[:-1]
-                req.add_header("Authorization", "Basic %s" % base64string)
                 # Just in case the peer does not accept that
                 # => add a 401 handler:
                 passwd_manager = urllib2.HTTPPasswordMgrWithDefaultRealm()
@@ -1236,29 +2244,46 @@ class S3SyncRepository(object):
                 urllib2.install_opener(opener)
 
             # Execute the request
-            try:
-                f = urllib2.urlopen(req)
-            except urllib2.HTTPError, e:
-                result = log.FATAL
-                remote = True # Peer error
-                code = e.code
-                message = e.read()
+            while True:
+                compress = self.compress and len(compressed) < len(data)
+                body = compressed if compress else data
+                req = urllib2.Request(url=url, data=body)
+                req.add_header("Content-Type", "text/xml")
+                if compress:
+                    req.add_header("Content-Encoding", "gzip")
+                if username and password:
+                    req.add_header("Authorization", "Basic %s" % base64string)
+                bytes_out = len(body)
                 try:
-                    # Sahana-Eden sends a JSON message,
-                    # try to extract the actual error message:
-                    message_json = json.loads(message)
-                    message = message_json.get("message", message)
+                    f = urllib2.urlopen(req)
+                except urllib2.HTTPError, e:
+                    code = e.code
+                    if compress and code in (400, 415):
+                        # Peer may not accept compressed data => retry
+                        # uncompressed, and do not compress any further
+                        _debug("S3SyncRepository.push: retry uncompressed")
+                        self.compress = False
+                        continue
+                    result = log.FATAL
+                    remote = True # Peer error
+                    message = e.read()
+                    try:
+                        # Sahana-Eden sends a JSON message,
+                        # try to extract the actual error message:
+                        message_json = json.loads(message)
+                        message = message_json.get("message", message)
+                    except:
+                        pass
+                    output = xml.json_message(False, code, message)
                 except:
-                    pass
-                output = xml.json_message(False, code, message)
-            except:
-                result = log.FATAL
-                code = 400
-                message = sys.exc_info()[1]
-                output = xml.json_message(False, code, message)
-            else:
-                result = log.SUCCESS
-                message = "data sent successfully (%s records)" % count
+                    result = log.FATAL
+                    code = 400
+                    message = sys.exc_info()[1]
+                    output = xml.json_message(False, code, message)
+                else:
+                    result = log.SUCCESS
+                    message = "data sent successfully (%s records)" % count
+                break
 
         else:
             # No data to send
@@ -1273,7 +2298,9 @@ class S3SyncRepository(object):
                   action=None,
                   remote=remote,
                   result=result,
-                  message=message)
+                  message=message,
+                  bytes_out=bytes_out,
+                  duration=time.time() - start_time)
 
         if output is not None:
             mtime = None
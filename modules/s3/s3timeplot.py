@@ -29,6 +29,10 @@
     OTHER DEALINGS IN THE SOFTWARE.
 """
 
+import datetime
+
+from calendar import timegm
+
 try:
     import json # try stdlib (Python 2.6)
 except ImportError:
@@ -41,12 +45,16 @@ from gluon import current
 from gluon.storage import Storage
 from gluon.html import *
 
+from s3data import S3PivotCube
 from s3rest import S3Method
 
 # =============================================================================
 class S3TimePlot(S3Method):
     """ RESTful method for time plot reports """
 
+    #: Supported time intervals for server-side aggregation
+    INTERVALS = ("hours", "days", "weeks", "months", "years")
+
     # -------------------------------------------------------------------------
     def apply_method(self, r, **attr):
         """
@@ -78,10 +86,10 @@ class S3TimePlot(S3Method):
 
         # Extract the relevant GET vars
         get_vars = dict((k, v) for k, v in r.get_vars.iteritems()
-                        if k in ("timestamp",))
+                        if k in ("timestamp", "interval"))
 
         # Fall back to report options defaults
-        if not any (k in get_vars for k in ("timestamp",)):
+        if not any (k in get_vars for k in ("timestamp", "interval")):
             timeplot_options = resource.get_config("timeplot_options", {})
             get_vars = timeplot_options.get("defaults", {})
 
@@ -131,19 +139,29 @@ class S3TimePlot(S3Method):
         data = resource.select(fields)
         rows = data["rows"]
 
-        items = []
-        for row in rows:
-            item = [row[str(resource._id)]]
-            if start_colname:
-                item.append(str(row[start_colname]))
-            else:
-                item.append(None)
-            if end_colname:
-                item.append(str(row[end_colname]))
-            else:
+        interval = get_vars.get("interval", None)
+        if interval and interval in self.INTERVALS:
+            # Aggregate per time interval on the server
+            items = {"series": self.series(rows,
+                                           str(resource._id),
+                                           start_colname,
+                                           end_colname,
+                                           interval)}
+        else:
+            # Send the items, the widget aggregates them
+            items = []
+            for row in rows:
+                item = [row[str(resource._id)]]
+                if start_colname:
+                    item.append(str(row[start_colname]))
+                else:
+                    item.append(None)
+                if end_colname:
+                    item.append(str(row[end_colname]))
+                else:
+                    item.append(None)
                 item.append(None)
-            item.append(None)
-            items.append(item)
+                items.append(item)
         items = json.dumps(items)
 
         widget_id = "timeplot"
@@ -180,4 +198,86 @@ class S3TimePlot(S3Method):
 
         return output
 
+    # -------------------------------------------------------------------------
+    @classmethod
+    def series(cls, rows, pkey, start, end, interval):
+        """
+            Aggregate the number of records active over time, by time
+            interval: records are counted from the interval of their
+            start date until the interval of their end date
+
+            @param rows: the records (from S3Resource.select)
+            @param pkey: the column name of the record ID
+            @param start: the column name of the start date
+            @param end: the column name of the end date
+            @param interval: the time interval, one of INTERVALS
+
+            @return: list of [timestamp (milliseconds), number of records],
+                     same format as the series generated by the widget
+        """
+
+        slot = cls.slot
+        records = Storage([(row[pkey], row) for row in rows])
+
+        starts = []
+        ends = []
+        for row in rows:
+            record_id = row[pkey]
+            starts.append({pkey: record_id,
+                           "slot": slot(row[start] if start else None,
+                                        interval)})
+            if end and row[end]:
+                ends.append({pkey: record_id,
+                             "slot": slot(row[end], interval)})
+
+        # Number of records starting and ending per interval
+        deltas = {}
+        extract = lambda row, fact: row[fact]
+        for items, sign in ((starts, 1), (ends, -1)):
+            cube = S3PivotCube(records, items, pkey, "slot", None, extract)
+            counts = cube.aggregate(pkey, "count")[1]
+            for value, count in zip(cube.rnames, counts):
+                deltas[value] = deltas.get(value, 0) + sign * count
+
+        # Records without start date are active from the beginning
+        # (None can not be sorted together with datetimes)
+        active = deltas.pop(None, 0)
+        if not deltas:
+            return [[0, active]] if active else []
+
+        series = []
+        for value in sorted(deltas):
+            active += deltas[value]
+            timestamp = timegm(value.utctimetuple()) * 1000
+            series.append([timestamp, active])
+        return series
+
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def slot(value, interval):
+        """
+            Get the start of the time interval for a date/time
+
+            @param value: the date/time (date or datetime)
+            @param interval: the time interval, one of INTERVALS
+
+            @return: the start of the interval as datetime
+        """
+
+        if not value:
+            return None
+        if not isinstance(value, datetime.datetime):
+            value = datetime.datetime.combine(value, datetime.time())
+
+        if interval == "hours":
+            return value.replace(minute=0, second=0, microsecond=0)
+        value = value.replace(hour=0, minute=0, second=0, microsecond=0)
+        if interval == "weeks":
+            return value - datetime.timedelta(days=value.weekday())
+        elif interval == "months":
+            return value.replace(day=1)
+        elif interval == "years":
+            return value.replace(month=1, day=1)
+        return value
+
 # END =========================================================================
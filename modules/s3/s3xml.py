@@ -38,6 +38,9 @@ import datetime
 import os
 import re
 import sys
+import tempfile
+import threading
+import time
 import urllib2
 
 try:
@@ -163,6 +166,7 @@ class S3XML(S3Codec):
         limit="limit",
         success="success",
         results="results",
+        cursor="cursor",
         lat="lat",
         latmin="latmin",
         latmax="latmax",
@@ -242,7 +246,10 @@ class S3XML(S3Codec):
             Transform an element tree with XSLT
 
             @param tree: the element tree
-            @param stylesheet_path: pathname of the XSLT stylesheet
+            @param stylesheet_path: pathname of the XSLT stylesheet (compiled
+                                    stylesheets of files are cached, see
+                                    S3XSLTCache), or the pre-parsed or
+                                    compiled stylesheet
             @param args: dict of arguments to pass to the stylesheet
         """
 
@@ -252,17 +259,34 @@ class S3XML(S3Codec):
             _args = dict([(k, "'%s'" % args[k]) for k in args])
         else:
             _args = None
-            
-        if isinstance(stylesheet_path, (etree._ElementTree, etree._Element)):
+
+        transformer = None
+        if isinstance(stylesheet_path, etree.XSLT):
+            # Compiled stylesheet
+            transformer = stylesheet_path
+            stylesheet = None
+        elif isinstance(stylesheet_path, (etree._ElementTree, etree._Element)):
             # Pre-parsed stylesheet
             stylesheet = stylesheet_path
+        elif isinstance(stylesheet_path, basestring) and \
+             os.path.isfile(stylesheet_path):
+            # Stylesheet file => use the cache
+            try:
+                transformer = xslt_cache.get(stylesheet_path).transformer
+            except:
+                e = sys.exc_info()[1]
+                self.error = e
+                return None
+            stylesheet = None
         else:
             stylesheet = self.parse(stylesheet_path)
 
-        if stylesheet is not None:
+        if transformer is not None or stylesheet is not None:
             try:
-                ac = etree.XSLTAccessControl(read_file=True, read_network=True)
-                transformer = etree.XSLT(stylesheet, access_control=ac)
+                if transformer is None:
+                    ac = etree.XSLTAccessControl(read_file=True,
+                                                 read_network=True)
+                    transformer = etree.XSLT(stylesheet, access_control=ac)
                 if _args:
                     result = transformer(tree, **_args)
                 else:
@@ -2086,6 +2110,19 @@ class S3XML(S3Codec):
 
             return obj
 
+    # -------------------------------------------------------------------------
+    @classmethod
+    def element2json(cls, element, native=False):
+        """
+            Converts a single element into a JSON-serializable object
+            (as in tree2json, e.g. for incremental export)
+
+            @param element: the element
+            @param native: use native mode for attributes
+        """
+
+        return cls.__element2json(element, native=native)
+
     # -------------------------------------------------------------------------
     @classmethod
     def tree2json(cls, tree, pretty_print=False, native=False):
@@ -2476,10 +2513,38 @@ class S3XMLFormat(object):
             @param stylesheet: the stylesheet (pathname or stream)
         """
 
-        self.tree = current.xml.parse(stylesheet)
-        
-        self.select = None
-        self.skip = None
+        # Use the cached stylesheet for files
+        entry = None
+        if isinstance(stylesheet, basestring) and os.path.isfile(stylesheet):
+            try:
+                entry = xslt_cache.get(stylesheet)
+            except etree.LxmlError:
+                # Report the error in transform
+                pass
+        self.entry = entry
+
+        if entry is not None:
+            self.tree = entry.tree
+            info = entry.info
+        else:
+            self.tree = current.xml.parse(stylesheet)
+            info = {}
+        self.info = info
+
+        self.select = info.get("select")
+        self.skip = info.get("skip")
+
+        # Can the stylesheet be applied per chunk of records?
+        streaming = info.get("streaming")
+        if streaming is None:
+            tree = self.tree
+            if tree:
+                ns = {"s3": "http://eden.sahanafoundation.org/wiki/S3"}
+                streaming = bool(tree.xpath("./s3:streaming", namespaces=ns))
+            else:
+                streaming = False
+            info["streaming"] = streaming
+        self.streaming = streaming
 
     # -------------------------------------------------------------------------
     def get_fields(self, tablename):
@@ -2499,6 +2564,15 @@ class S3XMLFormat(object):
         if not tree:
             return default
 
+        # Cached?
+        fields = self.info.get("fields")
+        if fields is None:
+            fields = self.info["fields"] = {}
+        elif tablename in fields:
+            include, exclude = fields[tablename]
+            return (list(include) if include is not None else None,
+                    list(exclude))
+
         if self.select is None:
             self.__inspect()
 
@@ -2534,7 +2608,10 @@ class S3XMLFormat(object):
         else:
             include = list(select) if select else None
             exclude = []
-        return (include, exclude)
+
+        fields[tablename] = (include, exclude)
+        return (list(include) if include is not None else None,
+                list(exclude))
 
     # -------------------------------------------------------------------------
     def __inspect(self):
@@ -2569,8 +2646,8 @@ class S3XMLFormat(object):
                 if exclude:
                     skip[tablename] = exclude
                 
-        self.select = select
-        self.skip = skip
+        self.select = self.info["select"] = select
+        self.skip = self.info["skip"] = skip
         return
 
     # -------------------------------------------------------------------------
@@ -2582,6 +2659,544 @@ class S3XMLFormat(object):
             @param args: parameters for the stylesheet
         """
 
-        return current.xml.transform(tree, self.tree, **args)
+        entry = self.entry
+        if entry is not None:
+            stylesheet = entry.transformer
+        else:
+            stylesheet = self.tree
+        return current.xml.transform(tree, stylesheet, **args)
+
+# =============================================================================
+class S3XSLTCache(object):
+    """
+        Cache for compiled XSLT stylesheets, shared between all requests
+        in the same process.
+
+        Entries are keyed by the path of the stylesheet file, and get
+        re-compiled when the file or any of the stylesheets it includes
+        or imports has been modified. Besides the parsed and the compiled
+        stylesheet, every entry has an "info" dict for S3XMLFormat to
+        store information extracted from the stylesheet (e.g. the field
+        include/exclude maps).
+    """
+
+    XSL = "{http://www.w3.org/1999/XSL/Transform}"
+
+    def __init__(self):
+        """ Constructor """
+
+        # {path: entry}
+        self.entries = {}
+
+        self.lock = threading.Lock()
+        self.reset_stats()
+
+    # -------------------------------------------------------------------------
+    def reset_stats(self):
+        """ Reset the counters """
+
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        # Time spent (re-)compiling stylesheets, and time saved by using
+        # compiled stylesheets from the cache instead (in seconds)
+        self.compile_time = 0.0
+        self.saved_time = 0.0
+
+    # -------------------------------------------------------------------------
+    def stats(self):
+        """
+            Get the current counters
+
+            @return: a dict with the counters and the overall hit rate
+        """
+
+        hits = self.hits
+        lookups = hits + self.misses
+        return {"size": len(self.entries),
+                "hits": hits,
+                "misses": self.misses,
+                "hit_rate": float(hits) / lookups if lookups else None,
+                "invalidations": self.invalidations,
+                "compile_time": self.compile_time,
+                "saved_time": self.saved_time,
+                }
+
+    # -------------------------------------------------------------------------
+    def get(self, path):
+        """
+            Get the cache entry for a stylesheet file, compile the
+            stylesheet if it isn't cached or has been modified
+
+            @param path: the path of the stylesheet file
+
+            @return: the entry, a Storage with the parsed (tree) and
+                     the compiled stylesheet (transformer)
+
+            @raises: etree.LxmlError (or a subclass) if the stylesheet
+                     can not be parsed or compiled
+        """
+
+        path = os.path.abspath(path)
+
+        entry = self.entries.get(path)
+        if entry is not None:
+            if self.__modified(entry):
+                with self.lock:
+                    if self.entries.get(path) is entry:
+                        del self.entries[path]
+                        self.invalidations += 1
+                entry = None
+            else:
+                with self.lock:
+                    self.hits += 1
+                    self.saved_time += entry.duration
+                return entry
+
+        entry = self.__compile(path)
+        with self.lock:
+            self.misses += 1
+            self.compile_time += entry.duration
+            self.entries[path] = entry
+        return entry
+
+    # -------------------------------------------------------------------------
+    def clear(self):
+        """ Remove all entries """
+
+        with self.lock:
+            self.entries.clear()
+        return
+
+    # -------------------------------------------------------------------------
+    def __compile(self, path):
+        """
+            Parse and compile a stylesheet
+
+            @param path: the absolute path of the stylesheet file
+
+            @return: the cache entry
+        """
+
+        start = time.time()
+
+        # Modification times before parsing, so that any modifications
+        # during parsing lead to re-compilation
+        mtimes = self.__mtimes(path)
+
+        parser = etree.XMLParser(no_network=False)
+        tree = etree.parse(path, parser)
+        ac = etree.XSLTAccessControl(read_file=True, read_network=True)
+        transformer = etree.XSLT(tree, access_control=ac)
+
+        return Storage(path = path,
+                       mtimes = mtimes,
+                       tree = tree,
+                       transformer = transformer,
+                       duration = time.time() - start,
+                       info = {},
+                       )
+
+    # -------------------------------------------------------------------------
+    def __mtimes(self, path):
+        """
+            Get the modification times of a stylesheet file and of all
+            stylesheet files it includes or imports (recursively)
+
+            @param path: the absolute path of the stylesheet file
+
+            @return: dict {path: mtime}
+        """
+
+        XSL = self.XSL
+        tags = (XSL + "include", XSL + "import")
+
+        mtimes = {}
+        pending = [path]
+        while pending:
+            filename = pending.pop()
+            if filename in mtimes:
+                continue
+            try:
+                mtimes[filename] = os.path.getmtime(filename)
+                root = etree.parse(filename).getroot()
+            except (EnvironmentError, etree.LxmlError):
+                continue
+            folder = os.path.dirname(filename)
+            for element in root:
+                if element.tag not in tags:
+                    continue
+                href = element.get("href")
+                if href and "://" not in href:
+                    pending.append(os.path.normpath(os.path.join(folder, href)))
+        return mtimes
+
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def __modified(entry):
+        """
+            Check whether any of the stylesheet files of a cache entry
+            has been modified (or removed) since it has been compiled
+
+            @param entry: the cache entry
+        """
+
+        getmtime = os.path.getmtime
+        for filename, mtime in entry.mtimes.items():
+            try:
+                if getmtime(filename) != mtime:
+                    return True
+            except EnvironmentError:
+                return True
+        return False
+
+# Process-wide instance
+xslt_cache = S3XSLTCache()
+
+# =============================================================================
+class S3XMLStreamWriter(object):
+    """
+        Helper class to serialize an S3XML export tree incrementally:
+        the <resource> elements are serialized chunk by chunk while the
+        tree is being built (and then removed from the tree), so that
+        only the current chunk needs to be held in memory. The output is
+        the same as S3XML.tostring/tree2json would produce for the complete
+        tree.
+
+        Stylesheets can be applied per chunk if they declare it with a
+        top-level <s3:streaming/> element. Such a stylesheet must transform
+        every <resource> independently of any other resources in the tree
+        into children of the output root element, and must not use any
+        attributes of the <s3xml> element other than domain and url.
+    """
+
+    BLOCKSIZE = 65536
+
+    def __init__(self,
+                 stream,
+                 as_json=False,
+                 pretty_print=False,
+                 xmlformat=None,
+                 args=None):
+        """
+            Constructor
+
+            @param stream: the stream (file-like object) to write to
+            @param as_json: write S3JSON instead of S3XML (not possible
+                            with stylesheets)
+            @param pretty_print: insert newlines/indentation in the output
+            @param xmlformat: the S3XMLFormat to apply per chunk
+            @param args: dict of arguments to pass to the XSLT stylesheet
+        """
+
+        self.stream = stream
+        self.as_json = as_json
+        self.pretty_print = pretty_print
+        self.xmlformat = xmlformat
+        self.args = args or {}
+
+        # The serialized chunks, as list of (key, offset, length)
+        self.body = tempfile.TemporaryFile()
+        self.chunks = []
+
+        # JSON keys in order of first appearance
+        self.keys = []
+
+        self.failed = False
+
+    # -------------------------------------------------------------------------
+    def write(self, root):
+        """
+            Serialize the current children of the root element, and
+            remove them from the tree
+
+            @param root: the root element of the export tree
+        """
+
+        if not len(root):
+            return
+
+        if self.as_json:
+            self.__write_json(root)
+        elif self.xmlformat is not None:
+            self.__write_xslt(root)
+        else:
+            self.__append(None, self.inner(root, self.pretty_print))
+
+        del root[:]
+
+    # -------------------------------------------------------------------------
+    def close(self, tree):
+        """
+            Write the complete output into the stream
+
+            @param tree: the export tree (with all root attributes,
+                         but without the elements already written)
+
+            @return: the stream, or None if a transformation failed
+        """
+
+        if not self.failed:
+            if self.as_json:
+                self.__close_json(tree)
+            else:
+                self.__close_xml(tree)
+
+        self.body.close()
+
+        return None if self.failed else self.stream
+
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def inner(element, pretty_print=False):
+        """
+            Serialize the children of an element (as they appear in the
+            serialization of the element)
+
+            @param element: the element
+            @param pretty_print: insert newlines/indentation in the output
+        """
+
+        if not len(element):
+            return ""
+
+        xml = etree.tostring(element,
+                             xml_declaration=False,
+                             encoding="utf-8",
+                             pretty_print=pretty_print)
+
+        # Attribute values are escaped, so the first ">" closes the
+        # start tag and the last "</" opens the end tag
+        inner = xml[xml.index(">") + 1:xml.rindex("</")]
+        if pretty_print and inner[:1] == "\n":
+            # Newline after the start tag is written only once (in close)
+            inner = inner[1:]
+        return inner
+
+    # -------------------------------------------------------------------------
+    def __append(self, key, data):
+        """
+            Store a serialized chunk
+
+            @param key: the JSON key of the chunk (None for XML)
+            @param data: the serialized chunk
+        """
+
+        if data:
+            body = self.body
+            self.chunks.append((key, body.tell(), len(data)))
+            body.write(data)
+
+    # -------------------------------------------------------------------------
+    def __copy(self, key, separator=None):
+        """
+            Copy all stored chunks for a key into the stream
+
+            @param key: the JSON key (None for XML)
+            @param separator: the separator to write between chunks
+        """
+
+        body = self.body
+        write = self.stream.write
+        blocksize = self.BLOCKSIZE
+
+        first = True
+        for k, offset, length in self.chunks:
+            if k != key:
+                continue
+            if separator and not first:
+                write(separator)
+            first = False
+            body.seek(offset)
+            while length > 0:
+                data = body.read(min(length, blocksize))
+                if not data:
+                    break
+                write(data)
+                length -= len(data)
+
+    # -------------------------------------------------------------------------
+    def __write_xslt(self, root):
+        """
+            Transform the current children of the root element, and store
+            the serialized children of the output root element
+
+            @param root: the root element of the export tree
+        """
+
+        if self.failed:
+            return
+
+        xml = current.xml
+        manager = current.manager
+
+        # Root attributes available to the stylesheet
+        if manager.show_urls:
+            url = manager.s3.base_url
+        else:
+            url = None
+        tree = xml.tree(None, root=root, domain=manager.domain, url=url)
+
+        result = self.xmlformat.transform(tree, **self.args)
+        root.attrib.clear()
+
+        if result is None:
+            self.failed = True
+            return
+        rroot = result.getroot()
+        if rroot is not None:
+            self.__append(None, self.inner(rroot, self.pretty_print))
+
+    # -------------------------------------------------------------------------
+    def __close_xml(self, tree):
+        """
+            Write the root element (from the complete export tree) with all
+            stored chunks into the stream
+
+            @param tree: the export tree
+        """
+
+        xml = current.xml
+        pretty_print = self.pretty_print
+
+        xmlformat = self.xmlformat
+        if xmlformat is not None:
+            tree = xmlformat.transform(tree, **self.args)
+            if tree is None:
+                self.failed = True
+                return
+
+        output = xml.tostring(tree, pretty_print=pretty_print)
+
+        write = self.stream.write
+        if not self.chunks or tree.getroot() is None:
+            write(output)
+            return
+
+        content = output.rstrip()
+        if content[-2:] == "/>":
+            # Empty root element => expand
+            start = content.rindex("<")
+            tag = re.match(r"<([^\s/>]+)", content[start:]).group(1)
+            head = "%s>" % content[:-2]
+            if pretty_print:
+                head = "%s\n" % head
+            foot = "</%s>" % tag
+        else:
+            # Append the chunks to the other contents of the root element
+            end = content.rindex("</")
+            head, foot = content[:end], content[end:]
+
+        write(head)
+        self.__copy(None)
+        write(foot)
+        write(output[len(content):])
+
+    # -------------------------------------------------------------------------
+    def __write_json(self, root):
+        """
+            Convert the current children of the root element into JSON,
+            and store them grouped by key
+
+            @param root: the root element of the export tree
+        """
+
+        xml = current.xml
+        TAG = xml.TAG
+        NAME = xml.ATTRIBUTE.name
+        PREFIX = xml.PREFIX.resource
+        element2json = xml.element2json
+
+        pretty_print = self.pretty_print
+
+        items = {}
+        keys = []
+        for element in root:
+            if element.tag != TAG.resource:
+                continue
+            obj = element2json(element, native=True)
+            if not obj:
+                continue
+            if pretty_print:
+                # Indentation as list item in the root object
+                js = json.dumps(obj, indent=4)
+                item = "\n".join(["        %s" % l.rstrip()
+                                  for l in js.splitlines()])
+            else:
+                item = json.dumps(obj)
+            key = "%s_%s" % (PREFIX, element.get(NAME))
+            if key in items:
+                items[key].append(item)
+            else:
+                items[key] = [item]
+                keys.append(key)
+
+        separator = ",\n" if pretty_print else ", "
+        for key in keys:
+            if key not in self.keys:
+                self.keys.append(key)
+            self.__append(key, separator.join(items[key]))
+
+    # -------------------------------------------------------------------------
+    def __close_json(self, tree):
+        """
+            Write the root object (from the complete export tree) with all
+            stored chunks into the stream
+
+            @param tree: the export tree
+        """
+
+        xml = current.xml
+        pretty_print = self.pretty_print
+
+        write = self.stream.write
+        if not self.keys:
+            write(xml.tree2json(tree, pretty_print=pretty_print))
+            return
+
+        # Construct the root object with placeholders for the resource
+        # lists, inserting the keys in the same order as tree2json (so
+        # that the key order in the output is the same)
+        obj = {}
+        placeholders = {}
+        for index, key in enumerate(self.keys):
+            placeholder = "\x00%s" % index
+            obj[key] = placeholder
+            placeholders[json.dumps(placeholder)] = key
+        root = tree.getroot()
+        attributes = xml.element2json(root, native=True)
+        PREFIX = xml.PREFIX.attribute
+        for name in root.attrib:
+            key = "%s%s" % (PREFIX, name)
+            obj[key] = attributes[key]
+
+        if pretty_print:
+            js = json.dumps(obj, indent=4)
+            lines = [l.rstrip() for l in js.splitlines()]
+            separator = ",\n"
+            start, end = "[\n", "\n    ]"
+        else:
+            lines = [json.dumps(obj)]
+            separator = ", "
+            start, end = "[", "]"
+
+        # Write the root object, replacing the placeholders by the chunks
+        marker = json.dumps("\x00")[:-1]
+        copy = self.__copy
+        for number, line in enumerate(lines):
+            if number:
+                write("\n")
+            pos = 0
+            while True:
+                index = line.find(marker, pos)
+                if index < 0:
+                    write(line[pos:])
+                    break
+                close = line.index('"', index + 1) + 1
+                write(line[pos:index])
+                write(start)
+                copy(placeholders[line[index:close]], separator=separator)
+                write(end)
+                pos = close
 
 # End =========================================================================
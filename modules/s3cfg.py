@@ -75,6 +75,7 @@ class S3Config(Storage):
         self.supply = Storage()
         self.search = Storage()
         self.security = Storage()
+        self.sync = Storage()
         self.ui = Storage()
 
     # -------------------------------------------------------------------------
@@ -494,6 +495,43 @@ class S3Config(Storage):
         """
         return self.base.get("session_memcache", False)
 
+    def get_base_hierarchy_cache(self):
+        """
+            Cache backend to share stored object hierarchies between
+            requests (and, depending on the backend, between processes):
+            name of a web2py cache ("ram", "disk", "memcache"), a cache
+            object, or False to disable
+        """
+        return self.base.get("hierarchy_cache", "ram")
+
+    def get_base_represent_cache_size(self):
+        """
+            Maximum number of field representations to share between
+            requests in each process (least recently used are discarded
+            first), 0 to disable the representation cache
+
+            NB other processes may show outdated representations for up
+               to represent_cache_ttl seconds after a change
+        """
+        return self.base.get("represent_cache_size", 0)
+
+    def get_base_represent_cache_ttl(self):
+        """
+            Time (in seconds) for which shared field representations
+            remain valid, limits the delay until changes made by other
+            processes (or in other tables) become visible
+        """
+        return self.base.get("represent_cache_ttl", 300)
+
+    def get_base_xml_export_stream(self):
+        """
+            Write S3XML/S3JSON exports (and exports with streaming
+            stylesheets) incrementally into a temporary file, rather than
+            building the complete element tree in memory - for large
+            exports (the output is the same)
+        """
+        return self.base.get("xml_export_stream", False)
+
     def get_base_solr_url(self):
         """
             URL to connect to solr server
@@ -632,6 +670,14 @@ class S3Config(Storage):
         " Should Addresses imported from CSV be passed to a Geocoder to try and automate Lat/Lon? "
         return self.gis.get("geocode_imported_addresses", False)
 
+    def get_gis_geojson_native(self):
+        """
+            Serialize GeoJSON for Feature Layers natively rather than by
+            transforming the S3XML export with XSLT (same output, but much
+            faster for large layers)
+        """
+        return self.gis.get("geojson_native", True)
+
     def get_gis_geoserver_url(self):
         return self.gis.get("geoserver_url", "")
     def get_gis_geoserver_username(self):
@@ -788,6 +834,22 @@ class S3Config(Storage):
         """
         return self.gis.get("simplify_tolerance", 0.01)
 
+    def get_gis_simplify_tiers(self):
+        """
+            Tolerances at which simplified versions of Polygons are
+            precomputed and stored with the Location, so that map layers
+            don't have to simplify them on every request
+            - the default Simplify Tolerance is always included
+            - empty list to disable
+        """
+        tiers = self.gis.get("simplify_tiers",
+                             [0.01, 0.005, 0.00125, 0.000625, 0.0003125, 0.00015625])
+        if tiers:
+            tiers = set(tiers)
+            tiers.add(self.get_gis_simplify_tolerance())
+            tiers = sorted(tiers)
+        return tiers
+
     def get_gis_scaleline(self):
         """
             Should the Map display a ScaleLine control?
@@ -805,6 +867,16 @@ class S3Config(Storage):
         else:
             return self.gis.get("spatialdb", False)
 
+    def get_gis_spatial_index(self):
+        """
+            Use a spatial index of location bounds (kept in memory and in
+            the cache folder) to speed up spatial queries if the database
+            has no spatial extensions
+        """
+        if self.get_gis_spatialdb():
+            return False
+        return self.gis.get("spatial_index", False)
+
     def get_gis_toolbar(self):
         """
             Should the main Map display a Toolbar?
@@ -1242,6 +1314,16 @@ class S3Config(Storage):
         """
         return self.msg.get("notify_renderer", None)
 
+    def get_msg_notify_batch(self):
+        """
+            Process update notifications in-process, in batches of up
+            to this number of subscriptions per task, sharing lookups
+            between subscribers with the same resource, filter and
+            permissions (0 = send one lookup request to the server
+            per subscription)
+        """
+        return self.msg.get("notify_batch", 0)
+
     # =========================================================================
     # Search
 
@@ -1288,6 +1370,29 @@ class S3Config(Storage):
         """ Text for saved filter load-button """
         return self.search.get("filter_manager_load", None)
 
+    # =========================================================================
+    # Sync
+
+    # -------------------------------------------------------------------------
+    def get_sync_pull_page_size(self):
+        """
+            The maximum number of records to request from the peer per
+            page in a sync pull; every page is imported and committed
+            separately, so that an interrupted pull can be resumed from
+            the last page (0 = pull everything at once)
+        """
+        return self.sync.get("pull_page_size", 500)
+
+    def get_sync_max_workers(self):
+        """
+            The maximum number of sync tasks for a repository to run
+            concurrently (tasks for independent resources only), each in
+            a scheduler worker - requires at least 2 active workers, and
+            commits the data of each group of tasks before the next group
+            (always 1 with SQLite which doesn't support concurrent writes)
+        """
+        return self.sync.get("max_workers", 1)
+
     # =========================================================================
     # Modules
 
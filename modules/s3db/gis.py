@@ -32,6 +32,7 @@ from __future__ import division
 __all__ = ["S3LocationModel",
            "S3LocationNameModel",
            "S3LocationTagModel",
+           "S3LocationSimplifiedModel",
            "S3LocationGroupModel",
            "S3LocationHierarchyModel",
            "S3GISConfigModel",
@@ -403,6 +404,13 @@ class S3LocationModel(S3Model):
             db = current.db
             db(db.gis_location.id == id).update(path=None)
 
+        # Update the spatial index
+        S3SpatialIndex.update(id)
+
+        if "wkt" in vars:
+            # Regenerate the simplified Polygons
+            current.gis.update_simplified([id])
+
         if not auth.override and \
            not auth.rollback:
             # Update the Path (async if-possible)
@@ -1172,6 +1180,32 @@ class S3LocationTagModel(S3Model):
                 job.id = _duplicate.id
                 job.method = job.METHOD.UPDATE
 
+# =============================================================================
+class S3LocationSimplifiedModel(S3Model):
+    """
+        Simplified Geometries model
+        - Polygons precomputed at the tolerances used by the map layers
+          (settings.gis.simplify_tiers), as GeoJSON
+        - maintained by GIS.update_simplified()
+    """
+
+    names = ["gis_location_simplified"]
+
+    def model(self):
+
+        # ---------------------------------------------------------------------
+        # Simplified Geometries
+        #
+        tablename = "gis_location_simplified"
+        table = self.define_table(tablename,
+                                  self.gis_location_id(ondelete = "CASCADE"),
+                                  Field("tolerance", "double"),
+                                  Field("geojson", "text"),
+                                  *s3_meta_fields())
+
+        # Pass names back to global scope (s3.*)
+        return dict()
+
 # =============================================================================
 class S3LocationGroupModel(S3Model):
     """
@@ -4716,6 +4750,8 @@ def gis_location_filter(r):
 class gis_LocationRepresent(S3Represent):
     """ Representation of Locations """
 
+    CACHE_OPTIONS = ("address_only", "sep", "show_name", "multi_country")
+
     def __init__(self,
                  show_link = False,
                  multiple = False,
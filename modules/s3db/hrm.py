@@ -3987,6 +3987,8 @@ def hrm_training_event_represent(id, row=None):
 class org_OrganisationRepresent(S3Represent):
     """ Representation of Organisations """
 
+    CACHE_OPTIONS = ("acronym", "parent")
+
     def __init__(self,
                  translate=False,
                  show_link=False,
@@ -3897,6 +3897,8 @@ def org_region_options(zones=False):
 class org_OrganisationRepresent(S3Represent):
     """ Representation of Organisations """
 
+    CACHE_OPTIONS = ("acronym", "parent")
+
     def __init__(self,
                  translate=False,
                  show_link=False,
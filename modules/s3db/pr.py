@@ -79,6 +79,9 @@ __all__ = ["S3PersonEntity",
            # Internal Path Tools
            "pr_rebuild_path",
            "pr_role_rebuild_path",
+           "pr_update_ancestors",
+           "pr_update_role_ancestors",
+           "pr_rebuild_ancestors",
            # Helpers for ImageLibrary
            "pr_image_modify",
            "pr_image_resize",
@@ -111,12 +114,16 @@ from s3layouts import S3AddResourceLink
 OU = 1 # role type which indicates hierarchy, see role_types
 OTHER_ROLE = 9
 
+# Rebuild all materialised ancestors rather than updating more entities
+ANCESTORS_MAX_UPDATE = 5000
+
 # =============================================================================
 class S3PersonEntity(S3Model):
     """ Person Super-Entity """
 
     names = ["pr_pentity",
              "pr_affiliation",
+             "pr_ancestor",
              "pr_person_user",
              "pr_role",
              "pr_role_types",
@@ -190,6 +197,7 @@ class S3PersonEntity(S3Model):
                   deletable=False,
                   listadd=False,
                   onaccept=self.pr_pentity_onaccept,
+                  ondelete=self.pr_pentity_ondelete,
                   #search_method=pentity_search,
                   referenced_by=[(auth_settings.table_membership_name, "for_pe")]
                   )
@@ -318,7 +326,8 @@ class S3PersonEntity(S3Model):
 
         # Resource configuration
         configure(tablename,
-                  onvalidation=self.pr_role_onvalidation)
+                  onvalidation=self.pr_role_onvalidation,
+                  onaccept=self.pr_role_onaccept)
 
         # Reusable fields
         pr_role_represent = pr_RoleRepresent()
@@ -369,6 +378,16 @@ class S3PersonEntity(S3Model):
                   onaccept=self.pr_affiliation_onaccept,
                   ondelete=self.pr_affiliation_ondelete)
 
+        # ---------------------------------------------------------------------
+        # Ancestors
+        # - materialised OU hierarchy (all OU ancestors of each entity, plus
+        #   the entity itself), maintained by pr_update_ancestors
+        #
+        tablename = "pr_ancestor"
+        table = define_table(tablename,
+                             Field("pe_id", "integer"),
+                             Field("ancestor_id", "integer"))
+
         # ---------------------------------------------------------------------
         # Pass names back to global scope (s3.*)
         #
@@ -572,6 +591,21 @@ class S3PersonEntity(S3Model):
                 current.s3db.pr_role_rebuild_path(role_id, clear=True)
         return
 
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def pr_role_onaccept(form):
+        """
+            Update the materialised ancestors of all affiliates of a role
+            (role type or entity may have changed)
+
+            @param form: the CRUD form
+        """
+
+        role_id = form.vars.id
+        if role_id:
+            current.s3db.pr_update_role_ancestors(role_id)
+        return
+
     # -------------------------------------------------------------------------
     @staticmethod
     def pr_pentity_onaccept(form):
@@ -599,6 +633,34 @@ class S3PersonEntity(S3Model):
                     s3db.org_update_affiliations("org_site", instance)
         return
 
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def pr_pentity_ondelete(row):
+        """
+            Remove the materialised OU ancestors of a deleted entity, and
+            update those of its former descendants
+
+            @param row: the deleted Row
+        """
+
+        pe_id = row.pe_id if row else None
+        if not pe_id:
+            return
+
+        db = current.db
+        ctable = current.s3db.pr_ancestor
+        query = (ctable.ancestor_id == pe_id) & \
+                (ctable.pe_id != pe_id)
+        rows = db(query).select(ctable.pe_id)
+        descendants = set(row.pe_id for row in rows)
+
+        query = (ctable.pe_id == pe_id) | \
+                (ctable.ancestor_id == pe_id)
+        db(query).delete()
+        if descendants:
+            pr_update_ancestors(descendants)
+        return
+
     # -------------------------------------------------------------------------
     @staticmethod
     def pr_affiliation_onaccept(form):
@@ -4285,6 +4347,8 @@ class pr_PersonRepresent(S3Represent):
                             either HRM, Vol or PR controllers
     """
 
+    CACHE_OPTIONS = ()
+
     def __init__(self,
                  lookup="pr_person",
                  key=None,
@@ -5120,7 +5184,10 @@ def pr_define_role(pe_id,
             if str(role_type) != str(OU):
                 data["path"] = None
             s3db.pr_role_rebuild_path(duplicate.id, clear=True)
-        duplicate.update_record(**data)
+            duplicate.update_record(**data)
+            pr_update_role_ancestors(duplicate.id)
+        else:
+            duplicate.update_record(**data)
         record_id = duplicate.id
     else:
         record_id = rtable.insert(**data)
@@ -5343,40 +5410,33 @@ def pr_get_path(pe_id):
 def pr_get_ancestors(pe_id):
     """
         Find all ancestor entities of a person entity in the OU hierarchy
-        (performs a path lookup where paths are available, otherwise rebuilds
-        paths).
+        (looks up the materialised ancestors, see pr_update_ancestors).
 
         @param pe_id: the person entity ID
 
-        @return: a list of PE-IDs
+        @return: a list of PE-IDs (as strings)
     """
 
-    s3db = current.s3db
-    atable = s3db.pr_affiliation
-    rtable = s3db.pr_role
-    query = (atable.deleted != True) & \
-            (atable.role_id == rtable.id) & \
-            (atable.pe_id == pe_id) & \
-            (rtable.deleted != True) & \
-            (rtable.role_type == OU)
+    if not pe_id:
+        return []
 
-    roles = current.db(query).select(rtable.id,
-                                     rtable.pe_id,
-                                     rtable.path,
-                                     rtable.role_type)
-    paths = []
-    append = paths.append
-    for role in roles:
-        path = S3MultiPath([role.pe_id])
-        if role.path is None:
-            ppath = pr_role_rebuild_path(role)
-        else:
-            ppath = S3MultiPath(role.path)
-        path.extend(role.pe_id, ppath, cut=pe_id)
-        append(path)
-    ancestors = S3MultiPath.all_nodes(paths)
+    ctable = current.s3db.pr_ancestor
+    query = (ctable.pe_id == pe_id)
+    rows = current.db(query).select(ctable.ancestor_id)
+    if rows:
+        pe_id = long(pe_id)
+        ancestors = [row.ancestor_id for row in rows
+                                     if row.ancestor_id != pe_id]
+    elif _pr_ancestors_ready():
+        # Entity not materialised yet
+        ancestors = pr_update_ancestors(pe_id, descendants=False)
+        ancestors = ancestors.get(long(pe_id), [])
+    else:
+        # Table not built yet => path lookup
+        pe_id = long(pe_id)
+        ancestors = pr_ancestors([pe_id])[pe_id]
 
-    return ancestors
+    return [str(ancestor) for ancestor in ancestors]
 
 # =============================================================================
 def pr_realm(entity):
@@ -5499,7 +5559,61 @@ def pr_ancestors(entities):
 def pr_descendants(pe_ids, skip=None, root=True):
     """
         Find descendant entities of a person entity in the OU hierarchy
-        (performs a real search, not a path lookup), grouped by root PE
+        (looks up the materialised ancestors, see pr_update_ancestors),
+        grouped by root PE
+
+        @param pe_ids: set/list of pe_ids
+        @param skip: list of person entity IDs to skip
+        @param root: not used (deprecated)
+
+        @return: a dict of lists of descendant PEs (except persons)
+                 per root PE
+    """
+
+    if skip:
+        # We still need to support Py 2.6
+        #pe_ids = {i for i in pe_ids if i not in skip}
+        pe_ids = set(i for i in pe_ids if i not in skip)
+    else:
+        pe_ids = set(pe_ids)
+    if not pe_ids:
+        return {}
+
+    db = current.db
+    s3db = current.s3db
+    etable = s3db.pr_pentity
+    ctable = s3db.pr_ancestor
+
+    if not _pr_ancestors_ready():
+        # Table not built yet => real search
+        return _pr_search_descendants(pe_ids)
+
+    q = (ctable.ancestor_id.belongs(pe_ids)) \
+        if len(pe_ids) > 1 else (ctable.ancestor_id == list(pe_ids)[0])
+
+    query = q & (ctable.pe_id != ctable.ancestor_id) & \
+            (etable.pe_id == ctable.pe_id) & \
+            (etable.instance_type != "pr_person")
+
+    rows = db(query).select(ctable.ancestor_id,
+                            ctable.pe_id)
+
+    result = dict()
+    for row in rows:
+        ancestor = row.ancestor_id
+        if ancestor in result:
+            result[ancestor].append(row.pe_id)
+        else:
+            result[ancestor] = [row.pe_id]
+
+    return result
+
+# =============================================================================
+def _pr_search_descendants(pe_ids, skip=None, root=True):
+    """
+        Find descendant entities of person entities in the OU hierarchy
+        by a real search (fallback for pr_descendants as long as the
+        materialised ancestors have not been built)
 
         @param pe_ids: set/list of pe_ids
         @param skip: list of person entity IDs to skip during
@@ -5541,7 +5655,7 @@ def pr_descendants(pe_ids, skip=None, root=True):
     ogetattr = object.__getattribute__
 
     result = dict()
-    
+
     skip.update(pe_ids)
     for row in rows:
 
@@ -5556,7 +5670,7 @@ def pr_descendants(pe_ids, skip=None, root=True):
             nodes.add(child)
 
     if nodes:
-        descendants = pr_descendants(nodes, skip=skip, root=False)
+        descendants = _pr_search_descendants(nodes, skip=skip, root=False)
         for child, nodes in descendants.iteritems():
             for parent, children in result.iteritems():
                 if child in children:
@@ -5663,7 +5777,7 @@ def pr_rebuild_path(pe_id, clear=False):
     """
 
     if isinstance(pe_id, Row):
-        pe_id = row.pe_id
+        pe_id = pe_id.pe_id
 
     rtable = current.s3db.pr_role
     query = (rtable.pe_id == pe_id) & \
@@ -5678,6 +5792,9 @@ def pr_rebuild_path(pe_id, clear=False):
     for role in roles:
         if role.path is None:
             pr_role_rebuild_path(role, clear=clear)
+
+    # Update the materialised ancestors of this entity and its descendants
+    pr_update_ancestors(pe_id)
     return
 
 # =============================================================================
@@ -5745,6 +5862,213 @@ def pr_role_rebuild_path(role_id, skip=[], clear=False):
 
     return path
 
+# =============================================================================
+def pr_update_ancestors(pe_ids, descendants=True):
+    """
+        Update the materialised OU ancestors (pr_ancestor) of person
+        entities, and those of all their descendants
+
+        @param pe_ids: person entity ID or list of IDs
+        @param descendants: also update the descendants
+
+        @return: dict {pe_id: set of ancestor pe_ids} of all updated
+                 entities
+    """
+
+    if not pe_ids:
+        return {}
+    if not isinstance(pe_ids, (list, tuple, set)):
+        pe_ids = [pe_ids]
+
+    if not _pr_ancestors_ready():
+        # Not built yet => the pr_rebuild_ancestors task includes this
+        return {}
+
+    db = current.db
+    ctable = current.s3db.pr_ancestor
+
+    pending = set(long(pe_id) for pe_id in pe_ids)
+    if descendants:
+        # The descendants of an entity do not change with its ancestors
+        query = (ctable.ancestor_id.belongs(pending))
+        rows = db(query).select(ctable.pe_id)
+        pending |= set(row.pe_id for row in rows)
+        if len(pending) > ANCESTORS_MAX_UPDATE:
+            return pr_rebuild_ancestors()
+
+    # Get the OU parents of all pending entities, level by level up to
+    # the parents with materialised ancestors
+    parents = {}
+    known = {}
+    frontier = pending
+    while frontier:
+        for pe_id in frontier:
+            parents[pe_id] = set()
+        for parent, child in _pr_ou_affiliations(frontier):
+            parents[child].add(parent)
+        unknown = set(parent for child in frontier
+                             for parent in parents[child]
+                             if parent not in pending and parent not in known)
+        if not unknown:
+            break
+        query = (ctable.pe_id.belongs(unknown))
+        rows = db(query).select(ctable.pe_id, ctable.ancestor_id)
+        for row in rows:
+            pe_id = row.pe_id
+            if pe_id not in known:
+                known[pe_id] = set()
+            if row.ancestor_id != pe_id:
+                known[pe_id].add(row.ancestor_id)
+        frontier = set(pe_id for pe_id in unknown if pe_id not in known)
+        pending |= frontier
+
+    return _pr_write_ancestors(pending, parents, known, delete=True)
+
+# =============================================================================
+def pr_update_role_ancestors(role_id):
+    """
+        Update the materialised OU ancestors of all affiliates of a role
+        (e.g. after a change of the role type)
+
+        @param role_id: the role ID
+    """
+
+    atable = current.s3db.pr_affiliation
+    query = (atable.role_id == role_id) & \
+            (atable.deleted != True)
+    rows = current.db(query).select(atable.pe_id)
+    affiliates = set(row.pe_id for row in rows)
+    if affiliates:
+        pr_update_ancestors(affiliates)
+    return
+
+# =============================================================================
+def pr_rebuild_ancestors():
+    """
+        Rebuild the materialised OU ancestors (pr_ancestor) of all
+        person entities
+        - run by the pr_rebuild_ancestors scheduler task, which is
+          started when the table is found empty
+
+        @return: dict {pe_id: set of ancestor pe_ids}
+    """
+
+    db = current.db
+    s3db = current.s3db
+    etable = s3db.pr_pentity
+
+    rows = db(etable.deleted != True).select(etable.pe_id)
+    pending = set(row.pe_id for row in rows)
+    parents = dict((pe_id, set()) for pe_id in pending)
+    for parent, child in _pr_ou_affiliations():
+        if child in parents:
+            parents[child].add(parent)
+
+    db(s3db.pr_ancestor.id > 0).delete()
+    return _pr_write_ancestors(pending, parents, {})
+
+# =============================================================================
+def _pr_ancestors_ready():
+    """
+        Check whether the materialised OU ancestors have been built,
+        and otherwise start the pr_rebuild_ancestors task (if there is
+        a worker alive, so that it never runs inside the request)
+
+        @return: True if the ancestors have been built, else False
+    """
+
+    db = current.db
+    ctable = current.s3db.pr_ancestor
+    if not db(ctable.id > 0).isempty():
+        return True
+
+    s3task = current.s3task
+    if s3task._is_alive():
+        # Start the rebuild unless it is already pending
+        ttable = db[s3task.TASK_TABLENAME]
+        query = (ttable.function_name == "pr_rebuild_ancestors") & \
+                (ttable.status.belongs(("QUEUED", "ASSIGNED", "RUNNING")))
+        if db(query).isempty():
+            s3task.async("pr_rebuild_ancestors")
+    return False
+
+# =============================================================================
+def _pr_ou_affiliations(pe_ids=None):
+    """
+        Get OU affiliations (helper for pr_update_ancestors)
+
+        @param pe_ids: the affiliates (None for all)
+
+        @return: list of tuples (parent pe_id, affiliate pe_id)
+    """
+
+    s3db = current.s3db
+    atable = s3db.pr_affiliation
+    rtable = s3db.pr_role
+
+    query = (atable.deleted != True) & \
+            (atable.role_id == rtable.id) & \
+            (rtable.deleted != True) & \
+            (rtable.role_type == OU)
+    if pe_ids is not None:
+        query &= (atable.pe_id.belongs(pe_ids))
+    rows = current.db(query).select(rtable.pe_id, atable.pe_id)
+
+    r = rtable._tablename
+    a = atable._tablename
+    return [(row[r].pe_id, row[a].pe_id) for row in rows]
+
+# =============================================================================
+def _pr_write_ancestors(pe_ids, parents, known, delete=False):
+    """
+        Compute and store the ancestors of person entities (helper for
+        pr_update_ancestors and pr_rebuild_ancestors)
+
+        @param pe_ids: the person entity IDs
+        @param parents: dict {pe_id: set of OU parent pe_ids} for all
+                        entities which have no materialised ancestors
+        @param known: dict {pe_id: set of ancestor pe_ids} for all
+                      other entities
+        @param delete: delete the current ancestors of the entities
+
+        @return: dict {pe_id: set of ancestor pe_ids}
+    """
+
+    ancestors = {}
+    def resolve(pe_id, path):
+        if pe_id in ancestors:
+            return ancestors[pe_id]
+        path.add(pe_id)
+        result = set()
+        for parent in parents.get(pe_id, ()):
+            if parent in path:
+                # Circular affiliation
+                continue
+            result.add(parent)
+            if parent in known:
+                result |= known[parent]
+            else:
+                result |= resolve(parent, path)
+        path.discard(pe_id)
+        result.discard(pe_id)
+        ancestors[pe_id] = result
+        return result
+
+    records = []
+    append = records.append
+    for pe_id in pe_ids:
+        append({"pe_id": pe_id, "ancestor_id": pe_id})
+        for ancestor in resolve(pe_id, set()):
+            append({"pe_id": pe_id, "ancestor_id": ancestor})
+
+    ctable = current.s3db.pr_ancestor
+    if delete:
+        current.db(ctable.pe_id.belongs(pe_ids)).delete()
+    if records:
+        ctable.bulk_insert(records)
+
+    return dict((pe_id, ancestors[pe_id]) for pe_id in pe_ids)
+
 # =============================================================================
 def pr_image_represent(image_name,
                        format = None,
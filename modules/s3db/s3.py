@@ -36,7 +36,10 @@ from ..s3 import *
 class S3HierarchyModel(S3Model):
     """ Model for stored object hierarchies, experimental """
 
-    names = ["s3_hierarchy"]
+    names = ["s3_hierarchy",
+             "s3_hierarchy_delta",
+             "s3_hierarchy_closure",
+             ]
 
     def model(self):
 
@@ -52,7 +55,35 @@ class S3HierarchyModel(S3Model):
                              Field("dirty", "boolean",
                                    default=False),
                              Field("hierarchy", "json"),
+                             Field("closure", "boolean",
+                                   default=False),
+                             Field("version", "integer",
+                                   default=0),
+                             *s3_timestamp())
+
+        # -------------------------------------------------------------------------
+        # Changes to stored object hierarchies since they have been stored,
+        # compacted into s3_hierarchy when loading
+        #
+        tablename = "s3_hierarchy_delta"
+        table = define_table(tablename,
+                             Field("tablename",
+                                   length=64),
+                             Field("delta", "json"),
                              *s3_timestamp())
+
+        # -------------------------------------------------------------------------
+        # Closure index for stored object hierarchies (optional, one entry
+        # per ancestor/descendant pair incl. each node with itself at depth 0)
+        #
+        tablename = "s3_hierarchy_closure"
+        table = define_table(tablename,
+                             Field("tablename",
+                                   length=64),
+                             Field("ancestor", "integer"),
+                             Field("descendant", "integer"),
+                             Field("depth", "integer"))
+
         # ---------------------------------------------------------------------
         # Return global names to s3.*
         #
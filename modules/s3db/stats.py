@@ -286,6 +286,7 @@ class S3StatsDemographicModel(S3Model):
         configure(tablename,
                   super_entity = "stats_parameter",
                   deduplicate = self.stats_demographic_duplicate,
+                  bulk_deduplicate = self.stats_demographic_duplicate_bulk,
                   requires_approval = True,
                   )
 
@@ -352,6 +353,7 @@ class S3StatsDemographicModel(S3Model):
         configure(tablename,
                   super_entity = "stats_data",
                   deduplicate = self.stats_demographic_data_duplicate,
+                  bulk_deduplicate = self.stats_demographic_data_duplicate_bulk,
                   requires_approval=True,
                   )
 
@@ -462,6 +464,32 @@ class S3StatsDemographicModel(S3Model):
                 item.id = duplicate.id
                 item.method = item.METHOD.UPDATE
 
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def stats_demographic_duplicate_bulk(items):
+        """ Import item de-duplication, bulk variant """
+
+        keys = {}
+        for item in items:
+            name = item.data.get("name", None)
+            if name:
+                keys[item] = name.lower()
+        if not keys:
+            return None
+
+        table = current.s3db.stats_demographic
+        names = list(set(keys.values()))
+        query = (table.name.lower().belongs(names))
+        rows = current.db(query).select(table.id, table.name)
+        duplicates = {}
+        for row in rows:
+            name = row.name.lower()
+            if name not in duplicates:
+                duplicates[name] = row.id
+
+        return [(item, key, duplicates.get(key))
+                for item, key in keys.items()]
+
     # -------------------------------------------------------------------------
     @staticmethod
     def stats_demographic_data_duplicate(item):
@@ -482,6 +510,40 @@ class S3StatsDemographicModel(S3Model):
                 item.id = duplicate.id
                 item.method = item.METHOD.UPDATE
 
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def stats_demographic_data_duplicate_bulk(items):
+        """ Import item de-duplication, bulk variant """
+
+        keys = {}
+        for item in items:
+            data = item.data
+            key = (data.get("date", None),
+                   data.get("location_id", None),
+                   data.get("parameter_id", None))
+            if all(key):
+                keys[item] = key
+        if not keys:
+            return None
+
+        table = current.s3db.stats_demographic_data
+        dates, locations, parameters = [set(k) for k in zip(*keys.values())]
+        query = (table.date.belongs(dates)) & \
+                (table.location_id.belongs(locations)) & \
+                (table.parameter_id.belongs(parameters))
+        rows = current.db(query).select(table.id,
+                                        table.date,
+                                        table.location_id,
+                                        table.parameter_id)
+        duplicates = {}
+        for row in rows:
+            key = (row.date, row.location_id, row.parameter_id)
+            if key not in duplicates:
+                duplicates[key] = row.id
+
+        return [(item, key, duplicates.get(key))
+                for item, key in keys.items()]
+
     # -------------------------------------------------------------------------
     @staticmethod
     def stats_demographic_rebuild_all_aggregates():
@@ -310,6 +310,10 @@ class SyncDataModel(S3Model):
                                    readable=True,
                                    writable=False,
                                    label=T("Last push on")),
+                             # Position of an unfinished paged pull
+                             Field("pull_cursor",
+                                   readable=False,
+                                   writable=False),
                              Field("mode", "integer",
                                    requires = IS_IN_SET(sync_mode,
                                                         zero=None),
@@ -485,6 +489,13 @@ class SyncDataModel(S3Model):
                                    represent=lambda opt: opt and T("yes") or ("no")),
                              Field("message", "text",
                                    represent=s3_strip_markup),
+                             # Transfer statistics
+                             Field("bytes_in", "integer",
+                                   label=T("Bytes Received")),
+                             Field("bytes_out", "integer",
+                                   label=T("Bytes Sent")),
+                             Field("duration", "double",
+                                   label=T("Duration (sec)")),
                              *s3_meta_fields())
 
         # CRUD Strings
@@ -804,9 +815,15 @@ def sync_now(r, **attr):
                 r.error(404, current.manager.ERROR.BAD_RECORD)
             form = FORM(TABLE(
                         TR(TD(T("Click 'Start' to synchronize with this repository now:"))),
+                        TR(TD(INPUT(_type="checkbox", _name="reconcile"),
+                              LABEL(T("Reconcile all records by checksums (slow)")))),
                         TR(TD(INPUT(_type="submit", _value=T("Start"))))))
             if form.accepts(r.post_vars, current.session):
-                task_id = s3task.async("sync_synchronize",
+                if form.vars.reconcile:
+                    function = "sync_reconcile"
+                else:
+                    function = "sync_synchronize"
+                task_id = s3task.async(function,
                                        args = [repository.id],
                                        vars = dict(user_id=auth.user.id,
                                                    manual=True))
@@ -4,6 +4,8 @@ from unit_tests.s3.s3crud import *
 from unit_tests.s3.s3datatable import *
 from unit_tests.s3.s3validators import *
 from unit_tests.s3.s3fields import *
+from unit_tests.s3.s3gis import *
+from unit_tests.s3.s3hierarchy import *
 from unit_tests.s3.s3import import *
 from unit_tests.s3.s3model import *
 from unit_tests.s3.s3msg import *
@@ -12,5 +14,6 @@ from unit_tests.s3.s3search import *
 from unit_tests.s3.s3filter import *
 from unit_tests.s3.s3rest import *
 from unit_tests.s3.s3sync import *
+from unit_tests.s3.s3timeplot import *
 from unit_tests.s3.s3widgets import *
 from unit_tests.s3.s3xml import *
@@ -43,8 +43,11 @@
 # If you get FAIL messages, then the overall performance of Sahana Eden in
 # your enviroment is likely to be completely unacceptable.
 #
+import os
 import unittest
+import datetime
 import timeit
+import time
 
 # =============================================================================
 #@unittest.skip("Comment or remove this line in modules/unit_tests/eden/benchmark.py to activate this test")
@@ -277,6 +280,713 @@ class S3PerformanceTests(unittest.TestCase):
 
         current.auth.override = False
 
+    def testS3NotificationsBatch(self):
+        """ In-process batch notifications """
+
+        db = current.db
+        s3db = current.s3db
+
+        current.auth.override = True
+        current.db.rollback()
+
+        print ""
+
+        # Create an update to notify about
+        otable = s3db.org_organisation
+        organisation_id = otable.insert(name="Notification Benchmark Organisation")
+
+        # Create subscriptions for some existing person entities
+        ptable = s3db.pr_person
+        pe_ids = [row.pe_id for row in db(ptable.deleted != True).select(
+                                                        ptable.pe_id,
+                                                        limitby=(0, 100))]
+        if not pe_ids:
+            current.auth.override = False
+            return
+
+        stable = s3db.pr_subscription
+        rtable = s3db.pr_subscription_resource
+        last_check_time = datetime.datetime.utcnow() - \
+                          datetime.timedelta(hours=1)
+        resource_ids = []
+        for i in xrange(1000):
+            subscription_id = stable.insert(pe_id=pe_ids[i % len(pe_ids)],
+                                            notify_on=["new", "upd"],
+                                            method=["EMAIL"],
+                                            frequency="immediately")
+            resource_ids.append(rtable.insert(subscription_id=subscription_id,
+                                              resource="org_organisation",
+                                              url="org/organisation",
+                                              locked=True,
+                                              last_check_time=last_check_time))
+
+        # Count the messages rather than sending them
+        msg = current.msg
+        send_by_pe_id = msg.send_by_pe_id
+        sent = []
+        msg.send_by_pe_id = lambda pe_id, **attr: sent.append(pe_id) or True
+
+        from s3.s3notify import S3Notifications
+        notify_batch = lambda: S3Notifications.notify_batch(resource_ids)
+        try:
+            mlt = timeit.Timer(notify_batch).timeit(number=1)
+        finally:
+            msg.send_by_pe_id = send_by_pe_id
+            # notify_batch commits, so remove the test records explicitly
+            query = (rtable.id.belongs(resource_ids))
+            subscription_ids = [row.subscription_id
+                                for row in db(query).select(rtable.subscription_id)]
+            db(query).delete()
+            db(stable.id.belongs(subscription_ids)).delete()
+            db(otable.id == organisation_id).delete()
+            db.commit()
+
+        print "S3Notifications.notify_batch = %s ms/notification (=%s notifications/min)" % \
+              (mlt * 1000 / len(resource_ids), int(len(sent) * 60 / mlt))
+        self.assertEqual(len(sent), len(resource_ids))
+
+        current.auth.override = False
+
+    def testS3HierarchyUpdate(self):
+        """ Hierarchy rebuild vs. incremental update """
+
+        db = current.db
+        s3db = current.s3db
+
+        print ""
+        from s3.s3fields import s3_meta_fields
+        from s3.s3hierarchy import S3Hierarchy
+
+        tablename = "s3hierarchy_benchmark"
+        table = db.define_table(tablename,
+                                Field("parent", "reference %s" % tablename),
+                                *s3_meta_fields())
+        try:
+            s3db.configure(tablename, hierarchy="parent")
+
+            # Synthetic tree with 10 children per node
+            node_ids = [table.insert()]
+            for i in xrange(1, 10000):
+                node_ids.append(table.insert(parent=node_ids[(i - 1) / 10]))
+            S3Hierarchy.dirty(tablename)
+
+            def rebuild():
+                S3Hierarchy.dirty(tablename)
+                return S3Hierarchy(tablename).nodes
+            mlt = timeit.Timer(rebuild).timeit(number=5) / 5
+            print "S3Hierarchy rebuild = %s ms (%s nodes)" % \
+                  (mlt * 1000, len(node_ids))
+
+            # Load the stored hierarchy (as in a new request)
+            settings = current.deployment_settings
+            backend = settings.base.get("hierarchy_cache")
+            def load():
+                current.model.hierarchies.pop(tablename, None)
+                return S3Hierarchy(tablename).nodes
+            try:
+                settings.base.hierarchy_cache = False
+                mlt = timeit.Timer(load).timeit(number=5) / 5
+                print "S3Hierarchy load (no cache) = %s ms" % (mlt * 1000)
+                settings.base.hierarchy_cache = "ram"
+                load()
+                mlt = timeit.Timer(load).timeit(number=5) / 5
+                print "S3Hierarchy load (cached) = %s ms" % (mlt * 1000)
+            finally:
+                if backend is None:
+                    settings.base.pop("hierarchy_cache", None)
+                else:
+                    settings.base.hierarchy_cache = backend
+
+            h = S3Hierarchy(tablename)
+            nodes = h.nodes
+            parents = iter(node_ids * 2)
+            def update():
+                record_id = table.insert(parent=parents.next())
+                db(table.id == record_id).update(parent=parents.next())
+            mlt = timeit.Timer(update).timeit(number=100) * 10
+            print "S3Hierarchy incremental update = %s ms (insert+update)" % mlt
+            self.assertEqual(len(h.nodes), len(node_ids) + 100)
+        finally:
+            db.rollback()
+            s3db.clear_config(tablename)
+            current.model.hierarchies.pop(tablename, None)
+            table.drop()
+            db.commit()
+
+    def testS3HierarchyClosure(self):
+        """ Subtree queries with and without closure index """
+
+        db = current.db
+        s3db = current.s3db
+
+        print ""
+        from s3.s3fields import s3_meta_fields
+        from s3.s3hierarchy import S3Hierarchy
+
+        tablename = "s3hierarchy_benchmark"
+        table = db.define_table(tablename,
+                                Field("parent", "reference %s" % tablename),
+                                *s3_meta_fields())
+        try:
+            s3db.configure(tablename,
+                           hierarchy="parent",
+                           hierarchy_closure=True)
+
+            # Synthetic organisation tree: 200k nodes, 8 children per node
+            node_ids = [table.insert()]
+            for i in xrange(1, 200000):
+                node_ids.append(table.insert(parent=node_ids[(i - 1) / 8]))
+            S3Hierarchy.dirty(tablename)
+
+            start = time.time()
+            S3Hierarchy(tablename).nodes
+            print "S3Hierarchy rebuild incl. closure index = %s ms (%s nodes)" % \
+                  ((time.time() - start) * 1000, len(node_ids))
+
+            # Subtrees of ~37k nodes (level 1) and ~4.7k nodes (level 2)
+            for node_id in (node_ids[1], node_ids[9]):
+                def subtree():
+                    current.model.hierarchies.pop(tablename, None)
+                    h = S3Hierarchy(tablename)
+                    query = h.subtree_query(table.id, node_id)
+                    return db(query).count()
+                for closure in (False, True):
+                    s3db.configure(tablename, hierarchy_closure=closure)
+                    mlt = timeit.Timer(subtree).timeit(number=5) / 5
+                    print "S3Hierarchy subtree query (%s nodes, %s) = %s ms" % \
+                          (subtree(),
+                           "closure" if closure else "findall",
+                           mlt * 1000)
+
+            # Ancestors of 100 leaf nodes (as in S3Represent._lookup)
+            leaves = node_ids[-100:]
+            def parents():
+                current.model.hierarchies.pop(tablename, None)
+                return S3Hierarchy(tablename).parents(leaves)
+            for closure in (False, True):
+                s3db.configure(tablename, hierarchy_closure=closure)
+                mlt = timeit.Timer(parents).timeit(number=5) / 5
+                print "S3Hierarchy ancestors (100 nodes, %s) = %s ms" % \
+                      ("closure" if closure else "in-memory", mlt * 1000)
+        finally:
+            db.rollback()
+            s3db.clear_config(tablename)
+            current.model.hierarchies.pop(tablename, None)
+            table.drop()
+            db.commit()
+
+    # -------------------------------------------------------------------------
+    def testS3ResourceIterSelect(self):
+        """ Memory footprint of paged vs. complete extraction """
+
+        db = current.db
+        s3db = current.s3db
+
+        print ""
+        from resource import getrusage, RUSAGE_SELF
+        from s3.s3fields import s3_meta_fields
+
+        tablename = "s3resource_benchmark"
+        table = db.define_table(tablename,
+                                Field("name"),
+                                Field("comments", "text"),
+                                *s3_meta_fields())
+        try:
+            # Synthetic table: 50k records
+            comments = "x" * 200
+            for i in xrange(50000):
+                table.insert(name="Record %s" % i, comments=comments)
+            db.commit()
+
+            fields = ["id", "name", "comments", "created_on"]
+            resource = s3db.resource(tablename)
+
+            # Paged extraction first: peak RSS can only grow
+            rss = getrusage(RUSAGE_SELF).ru_maxrss
+            start = time.time()
+            numrows = 0
+            for page in resource.iterselect(fields, represent=True):
+                numrows += len(page["rows"])
+            print "S3Resource.iterselect (%s rows) = %s ms, peak RSS +%s kB" % \
+                  (numrows,
+                   (time.time() - start) * 1000,
+                   getrusage(RUSAGE_SELF).ru_maxrss - rss)
+
+            rss = getrusage(RUSAGE_SELF).ru_maxrss
+            start = time.time()
+            data = resource.select(fields, represent=True)
+            print "S3Resource.select (%s rows) = %s ms, peak RSS +%s kB" % \
+                  (len(data["rows"]),
+                   (time.time() - start) * 1000,
+                   getrusage(RUSAGE_SELF).ru_maxrss - rss)
+        finally:
+            db.rollback()
+            table.drop()
+            db.commit()
+
+    # -------------------------------------------------------------------------
+    def testS3PostGIS(self):
+        """ PostGIS radius queries: connection per call vs. DAL connection """
+
+        settings = current.deployment_settings
+        if not settings.get_gis_spatialdb():
+            print "\nS3PostGIS: skipped (no spatial database)"
+            return
+
+        import math
+        import psycopg2
+        from s3.s3gis import RADIUS_EARTH, S3PostGIS
+
+        print ""
+        lat, lon, radius = 0.0, 0.0, 100
+
+        def connect():
+            # Previous implementation: new connection for every call
+            dbsettings = settings.database
+            connection = psycopg2.connect("dbname=%s user=%s password=%s host=%s port=%s" % \
+                                          (dbsettings.database,
+                                           dbsettings.username,
+                                           dbsettings.password,
+                                           dbsettings.host,
+                                           dbsettings.port or "5432"))
+            try:
+                cursor = connection.cursor()
+                cursor.execute("SELECT id FROM gis_location WHERE ST_DWithin(ST_GeomFromText('POINT (%s %s)', 4326), the_geom, %s);" % \
+                               (lon, lat, math.degrees(float(radius) / RADIUS_EARTH)))
+                return cursor.fetchall()
+            finally:
+                connection.close()
+
+        postgis = S3PostGIS()
+        def pooled():
+            return postgis.radius(lat, lon, radius)
+
+        for name, query in (("connection per call", connect),
+                            ("DAL connection, prepared", pooled)):
+            mlt = timeit.Timer(query).timeit(number=100) / 100
+            print "PostGIS radius query (%s) = %s ms" % (name, mlt * 1000)
+
+    # -------------------------------------------------------------------------
+    def testGISUpdateLocationTree(self):
+        """ Location tree: per-record vs. bulk update (GADM-like import) """
+
+        db = current.db
+        table = current.s3db.gis_location
+
+        print ""
+        from s3.s3gis import GIS
+
+        # Synthetic admin areas: 1 L0, 30 L1, 900 L2 polygons as
+        # inserted by import_gadm1 (WKT only, no path/Lx/centroid)
+        polygon = "POLYGON((%(x)s %(y)s,%(x1)s %(y)s,%(x1)s %(y1)s,%(x)s %(y1)s,%(x)s %(y)s))"
+        def square(x, y, size):
+            return polygon % dict(x=x, y=y, x1=x + size, y1=y + size)
+        try:
+            L0 = table.insert(name="Benchmark L0", level="L0",
+                              gis_feature_type=3, wkt=square(0, 0, 30))
+            levels = [[L0], [], []]
+            for i in xrange(30):
+                L1 = table.insert(name="Benchmark L1 %s" % i, level="L1",
+                                  parent=L0, gis_feature_type=3,
+                                  wkt=square(i, 0, 1))
+                levels[1].append(L1)
+                for j in xrange(30):
+                    levels[2].append(
+                        table.insert(name="Benchmark L2 %s-%s" % (i, j),
+                                     level="L2", parent=L1,
+                                     gis_feature_type=3,
+                                     wkt=square(i, j / 30.0, 1 / 30.0)))
+            ids = [i for level in levels for i in level]
+
+            def reset():
+                db(table.id.belongs(ids)).update(path=None, lat=None, lon=None,
+                                                 lat_min=None, lat_max=None,
+                                                 lon_min=None, lon_max=None,
+                                                 L0=None, L1=None, L2=None)
+
+            reset()
+            start = time.time()
+            update_location_tree = GIS.update_location_tree
+            for level in levels:
+                for record_id in level:
+                    update_location_tree({"id": record_id})
+            duration = time.time() - start
+            print "GIS.update_location_tree (per record) = %s ms (=%s rec/sec)" % \
+                  (duration * 1000, int(len(ids) / duration))
+
+            reset()
+            start = time.time()
+            updated = GIS.update_location_tree_bulk([L0])
+            duration = time.time() - start
+            print "GIS.update_location_tree_bulk = %s ms (=%s rec/sec)" % \
+                  (duration * 1000, int(len(ids) / duration))
+            self.assertEqual(updated, len(ids))
+        finally:
+            db.rollback()
+
+    # -------------------------------------------------------------------------
+    def testS3PivotTableAggregate(self):
+        """ S3PivotTable: aggregation from records vs. GROUP BY in the DB """
+
+        db = current.db
+        s3db = current.s3db
+
+        print ""
+        from s3.s3fields import s3_meta_fields
+
+        tablename = "s3pivottable_benchmark"
+        table = db.define_table(tablename,
+                                Field("region"),
+                                Field("category"),
+                                Field("value", "integer"),
+                                *s3_meta_fields())
+        try:
+            # Synthetic table: 20k records, 20 regions x 10 categories
+            for i in xrange(20000):
+                table.insert(region="Region %s" % (i % 20),
+                             category="Category %s" % (i % 10),
+                             value=i % 100)
+            db.commit()
+
+            resource = s3db.resource(tablename)
+            for layer in (("value", "sum"),
+                          ("value", "avg"),
+                          ("category", "count")):
+
+                start = time.time()
+                pt = resource.pivottable("region", "category", [layer])
+                expected = pt.json()
+                duration = time.time() - start
+                print "S3PivotTable %s(%s) from records = %s ms" % \
+                      (layer[1], layer[0], duration * 1000)
+
+                start = time.time()
+                pt = resource.pivottable("region", "category", [layer],
+                                         records=False)
+                output = pt.json()
+                duration = time.time() - start
+                print "S3PivotTable %s(%s) with GROUP BY = %s ms" % \
+                      (layer[1], layer[0], duration * 1000)
+
+                self.assertEqual(pt.records, None)
+                self.assertEqual(output, expected)
+        finally:
+            db.rollback()
+            table.drop()
+            db.commit()
+
+    # -------------------------------------------------------------------------
+    def testS3ImportJobDeduplicate(self):
+        """ S3ImportJob: per-item vs. batch deduplication """
+
+        db = current.db
+        s3db = current.s3db
+        auth = current.auth
+
+        from lxml import etree
+        from s3.s3import import S3ImportJob
+
+        print ""
+        tablename = "stats_demographic"
+        resource = s3db.resource(tablename)
+
+        # 1000 records, every other one already in the DB
+        numrecords = 1000
+        xmlstr = "<s3xml>%s</s3xml>" % "".join(
+                    ["""<resource name="%s" uuid="BENCHMARK-%s">
+<data field="name">Benchmark Demographic %s</data>
+</resource>""" % (tablename, i, i) for i in xrange(numrecords)])
+
+        index = S3ImportJob.__dict__["_index"]
+        bulk = s3db.get_config(tablename, "bulk_deduplicate")
+        auth.override = True
+        try:
+            for i in xrange(0, numrecords, 2):
+                tree = etree.ElementTree(etree.fromstring(
+                        """<s3xml><resource name="%s">
+<data field="name">Benchmark Demographic %s</data>
+</resource></s3xml>""" % (tablename, i)))
+                resource.import_xml(tree)
+            db.commit()
+
+            def per_item():
+                # One lookup per item: no index, no bulk resolver
+                S3ImportJob._index = lambda self, table: None
+                s3db.configure(tablename, bulk_deduplicate=None)
+                try:
+                    resource.import_xml(etree.ElementTree(
+                                            etree.fromstring(xmlstr)))
+                finally:
+                    S3ImportJob._index = index
+                    s3db.configure(tablename, bulk_deduplicate=bulk)
+
+            def batch():
+                resource.import_xml(etree.ElementTree(
+                                        etree.fromstring(xmlstr)))
+
+            for method, name in ((per_item, "per item"),
+                                 (batch, "batch")):
+                start = time.time()
+                method()
+                duration = time.time() - start
+                db.rollback()
+                print "S3ImportJob deduplication %s = %s ms (=%s items/sec)" % \
+                      (name, duration * 1000, int(numrecords / duration))
+        finally:
+            auth.override = False
+            db.rollback()
+            table = s3db[tablename]
+            db(table.name.like("Benchmark Demographic %")).delete()
+            db.commit()
+
+    # -------------------------------------------------------------------------
+    def testS3ImportJobLookahead(self):
+        """ S3ImportJob: reference resolution in large trees """
+
+        from lxml import etree
+        from s3.s3import import S3ImportJob
+
+        print ""
+
+        # Offices referencing organisations and locations further down
+        # in the tree, so every reference must be looked up in the tree
+        for numrecords in (500, 1000, 2000):
+            xmlstr = "<s3xml>%s%s</s3xml>" % (
+                "".join(["""<resource name="org_office">
+<data field="name">Benchmark Office %s</data>
+<reference field="organisation_id" resource="org_organisation" tuid="ORG%s"/>
+<reference field="location_id" resource="gis_location" tuid="LOC%s"/>
+</resource>""" % (i, i % 100, i) for i in xrange(numrecords)]),
+                "".join(["""<resource name="org_organisation" tuid="ORG%s">
+<data field="name">Benchmark Organisation %s</data>
+</resource>""" % (i, i) for i in xrange(100)] +
+                        ["""<resource name="gis_location" tuid="LOC%s">
+<data field="name">Benchmark Location %s</data>
+</resource>""" % (i, i) for i in xrange(numrecords)]))
+            tree = etree.ElementTree(etree.fromstring(xmlstr))
+
+            job = S3ImportJob(current.s3db.org_office, tree=tree)
+            start = time.time()
+            for element in tree.getroot().findall("resource"):
+                job.add_item(element=element)
+            duration = time.time() - start
+
+            stats = job.reference_stats()
+            print "S3ImportJob.add_item (%s offices) = %s ms (=%s rec/sec)" % \
+                  (numrecords, duration * 1000, int(numrecords / duration))
+            print "Reference resolution: %s" % stats
+            self.assertEqual(stats["unresolved"], 0)
+            current.db.rollback()
+
+    # -------------------------------------------------------------------------
+    def testS3ImportJobBulkInsert(self):
+        """ S3ImportJob: per-record vs. bulk insert of new records """
+
+        db = current.db
+        s3db = current.s3db
+        auth = current.auth
+
+        from lxml import etree
+
+        print ""
+        # Table with super-entity and bulk deduplication (without bulk
+        # resolver, items would have to be inserted one at a time to
+        # find duplicates within the import)
+        tablename = "stats_demographic"
+        resource = s3db.resource(tablename)
+
+        numrecords = 1000
+        xmlstr = "<s3xml>%s</s3xml>" % "".join(
+                    ["""<resource name="%s">
+<data field="name">Benchmark Demographic %s</data>
+</resource>""" % (tablename, i) for i in xrange(numrecords)])
+
+        auth.override = True
+        try:
+            for bulk_insert in (False, True):
+                s3db.configure(tablename, bulk_insert=bulk_insert)
+                tree = etree.ElementTree(etree.fromstring(xmlstr))
+                start = time.time()
+                resource.import_xml(tree)
+                duration = time.time() - start
+                db.rollback()
+                print "S3ImportJob commit %s = %s ms (=%s rec/sec)" % \
+                      (bulk_insert and "bulk insert" or "per record",
+                       duration * 1000, int(numrecords / duration))
+        finally:
+            s3db.configure(tablename, bulk_insert=False)
+            auth.override = False
+            db.rollback()
+
+    # -------------------------------------------------------------------------
+    def testPRAncestorLookup(self):
+        """ OU ancestor/descendant lookups: search vs. materialised """
+
+        db = current.db
+        s3db = current.s3db
+        auth = current.auth
+
+        print ""
+        otable = s3db.org_organisation
+
+        auth.override = True
+        try:
+            # Synthetic OU tree: 6 levels, 4 branches per node (1365 nodes)
+            start = time.time()
+            root = None
+            level = []
+            for depth in xrange(6):
+                nodes = []
+                for parent in (level or [None]):
+                    for i in xrange(4 if parent else 1):
+                        org = Storage(name="Benchmark OU %s-%s" % (depth, i))
+                        org.update(id=otable.insert(**org))
+                        s3db.update_super(otable, org)
+                        pe_id = s3db.pr_get_pe_id(otable, org.id)
+                        if parent:
+                            s3db.pr_add_affiliation(parent, pe_id,
+                                                    role="BenchmarkOU")
+                        else:
+                            root = pe_id
+                        nodes.append(pe_id)
+                level = nodes
+            leaves = level
+            print "pr_add_affiliation incl. ancestor update = %s ms/node" % \
+                  ((time.time() - start) * 1000 / 1365)
+
+            start = time.time()
+            s3db.pr_rebuild_ancestors()
+            print "pr_rebuild_ancestors = %s ms" % ((time.time() - start) * 1000)
+
+            def search():
+                return s3db.pr_get_descendants([root])
+            def lookup():
+                return s3db.pr_descendants([root])
+            for name, method in (("search", search), ("materialised", lookup)):
+                mlt = timeit.Timer(method).timeit(number=10) / 10
+                print "Descendants of root (%s) = %s ms" % (name, mlt * 1000)
+
+            def path():
+                return [s3db.pr_get_path(leaf) for leaf in leaves[:100]]
+            def ancestors():
+                return [s3db.pr_get_ancestors(leaf) for leaf in leaves[:100]]
+            for name, method in (("path", path), ("materialised", ancestors)):
+                mlt = timeit.Timer(method).timeit(number=10) / 10
+                print "Ancestors of 100 leaves (%s) = %s ms" % (name, mlt * 1000)
+        finally:
+            auth.override = False
+            db.rollback()
+
+    # -------------------------------------------------------------------------
+    def testS3ResourceExportComponentQueries(self):
+        """ S3Resource.export_tree: queries per exported record """
+
+        db = current.db
+        s3db = current.s3db
+        auth = current.auth
+
+        print ""
+        otable = s3db.org_organisation
+        ftable = s3db.org_office
+
+        auth.override = True
+        try:
+            # Organisations with 3 offices each
+            org_ids = []
+            for i in xrange(1000):
+                org = Storage(name="Benchmark Export Org %s" % i)
+                org.update(id=otable.insert(**org))
+                s3db.update_super(otable, org)
+                org_ids.append(org.id)
+                for j in xrange(3):
+                    office = Storage(name="Benchmark Export Office %s-%s" % (i, j),
+                                     organisation_id=org.id)
+                    office.update(id=ftable.insert(**office))
+                    s3db.update_super(ftable, office)
+
+            # Count the queries
+            adapter = db._adapter
+            execute = adapter.execute
+            counter = [0]
+            def counting(*args, **kwargs):
+                counter[0] += 1
+                return execute(*args, **kwargs)
+
+            for numrecords in (100, 1000):
+                resource = s3db.resource("org_organisation",
+                                         id=org_ids[:numrecords],
+                                         components=["office"])
+                counter[0] = 0
+                adapter.execute = counting
+                try:
+                    start = time.time()
+                    resource.export_tree(mcomponents=["org_office"],
+                                         dereference=False)
+                    duration = time.time() - start
+                finally:
+                    adapter.execute = execute
+                print "S3Resource.export_tree (%s records, 3 components each) = " \
+                      "%s queries, %s ms" % \
+                      (numrecords, counter[0], duration * 1000)
+        finally:
+            auth.override = False
+            db.rollback()
+
+    # -------------------------------------------------------------------------
+    def testS3GeoJSONEncoder(self):
+        """ GeoJSON export of a Feature Layer: XSLT vs. native """
+
+        db = current.db
+        s3db = current.s3db
+        auth = current.auth
+        request = current.request
+        settings = current.deployment_settings
+
+        print ""
+        gtable = s3db.gis_location
+        ftable = s3db.org_office
+
+        stylesheet = os.path.join(request.folder,
+                                  "static", "formats", "geojson", "export.xsl")
+
+        numrecords = 20000
+        format = auth.permission.format
+        gis_settings = settings.gis
+        settings.gis = Storage(gis_settings)
+
+        auth.override = True
+        try:
+            org_id = s3db.org_organisation.insert(name="Benchmark GeoJSON Org")
+            office_ids = []
+            for i in xrange(numrecords):
+                location_id = gtable.insert(name="Benchmark GeoJSON Location %s" % i,
+                                            lat=(i % 180) - 90 + i / 1e5,
+                                            lon=(i % 360) - 180 + i / 1e5)
+                office_ids.append(
+                    ftable.insert(name="Benchmark GeoJSON Office %s" % i,
+                                  organisation_id=org_id,
+                                  location_id=location_id))
+
+            auth.permission.format = "geojson"
+            settings.gis.max_features = numrecords
+
+            output = {}
+            for native in (False, True):
+                settings.gis.geojson_native = native
+                resource = s3db.resource("org_office", id=office_ids)
+                start = time.time()
+                output[native] = resource.export_xml(stylesheet=stylesheet,
+                                                     as_json=True)
+                duration = time.time() - start
+                print "GeoJSON export of %s features (%s) = %s ms" % \
+                      (numrecords, native and "native" or "XSLT", duration * 1000)
+            self.assertEqual(output[True], output[False])
+        finally:
+            auth.permission.format = format
+            settings.gis = gis_settings
+            auth.override = False
+            db.rollback()
+
 # =============================================================================
 def run_suite(*test_classes):
     """ Run the test suite """
@@ -11,7 +11,7 @@ from gluon import *
 from gluon.storage import Storage
 from gluon.dal import Row
 
-from s3.s3data import S3DataTable
+from s3.s3data import S3DataTable, S3PivotCube
 
 # =============================================================================
 class S3DataTableTests(unittest.TestCase):
@@ -94,6 +94,69 @@ class S3DataTableTests(unittest.TestCase):
 
         current.auth.override = False
 
+# =============================================================================
+class S3PivotCubeTests(unittest.TestCase):
+    """ Tests for the columnar pivot table cube """
+
+    # -------------------------------------------------------------------------
+    def setUp(self):
+
+        # Records with a numeric, a string and a list fact, record 3
+        # appears in two columns (expanded list:type dimension)
+        self.records = Storage({1: {"value": 4, "name": "A", "tags": [1, 2]},
+                                2: {"value": None, "name": "B", "tags": None},
+                                3: {"value": 1.5, "name": "A", "tags": [2]},
+                                4: {"value": 2, "name": "A", "tags": [3]},
+                                })
+        self.items = [{"id": 1, "row": "X", "col": "a"},
+                      {"id": 2, "row": "X", "col": "b"},
+                      {"id": 3, "row": "Y", "col": "a"},
+                      {"id": 3, "row": "Y", "col": "b"},
+                      {"id": 4, "row": "X", "col": "a"},
+                      ]
+        self.extract = lambda row, fact: row[fact]
+
+    # -------------------------------------------------------------------------
+    def testCube(self):
+        """ Test dimension encoding and records per cell """
+
+        cube = S3PivotCube(self.records, self.items,
+                           "id", "row", "col", self.extract)
+
+        self.assertEqual(cube.rnames, ["X", "Y"])
+        self.assertEqual(cube.cnames, ["a", "b"])
+        self.assertEqual(cube.cell_records(0, 0), [1, 4])
+        self.assertEqual(cube.cell_records(0, 1), [2])
+        self.assertEqual(cube.cell_records(1, 0), [3])
+        self.assertEqual(cube.cell_records(1, 1), [3])
+
+    # -------------------------------------------------------------------------
+    def testAggregate(self):
+        """ Test aggregation layers """
+
+        cube = S3PivotCube(self.records, self.items,
+                           "id", "row", "col", self.extract)
+        aggregate = cube.aggregate
+
+        self.assertEqual(aggregate("value", "sum"),
+                         ([[6, 0], [1.5, 1.5]], [6, 3.0], [7.5, 1.5], 9.0))
+        self.assertEqual(aggregate("value", "min"),
+                         ([[2, None], [1.5, 1.5]], [2, 1.5], [1.5, 1.5], 1.5))
+        self.assertEqual(aggregate("value", "avg"),
+                         ([[3.0, 0.0], [1.5, 1.5]], [3.0, 1.5], [2.5, 1.5], 2.25))
+        self.assertEqual(aggregate("name", "count"),
+                         ([[1, 1], [1, 1]], [2, 2], [2, 2], 4))
+        self.assertEqual(aggregate("tags", "count"),
+                         ([[3, 0], [1, 1]], [3, 2], [4, 1], 5))
+
+        # Same results as from the lists of values
+        for fact in ("value", "name", "tags"):
+            for method in ("count", "sum", "min", "max", "avg"):
+                if fact != "value" and method != "count":
+                    continue
+                self.assertEqual(aggregate(fact, method),
+                                 cube._aggregate_values(fact, method))
+
 # =============================================================================
 def run_suite(*test_classes):
     """ Run the test suite """
@@ -111,6 +174,7 @@ if __name__ == "__main__":
 
     run_suite(
         S3DataTableTests,
+        S3PivotCubeTests,
     )
 
 # END ========================================================================
\ No newline at end of file
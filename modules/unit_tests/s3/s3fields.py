@@ -25,6 +25,12 @@ class S3RepresentTests(unittest.TestCase):
 
         current.auth.override = True
 
+        # These tests check the lookups of each instance, so must
+        # not use the shared cache
+        base = current.deployment_settings.base
+        self.cache_size = base.get("represent_cache_size")
+        base.represent_cache_size = 0
+
         s3db = current.s3db
 
         otable = s3db.org_organisation
@@ -300,7 +306,143 @@ class S3RepresentTests(unittest.TestCase):
 
         current.db.rollback()
         current.auth.override = False
+
+        base = current.deployment_settings.base
+        if self.cache_size is None:
+            base.pop("represent_cache_size", None)
+        else:
+            base.represent_cache_size = self.cache_size
         
+# =============================================================================
+class S3RepresentCacheTests(unittest.TestCase):
+    """ Test the shared representation cache """
+
+    # -------------------------------------------------------------------------
+    def setUp(self):
+
+        current.auth.override = True
+
+        base = current.deployment_settings.base
+        self.cache_size = base.get("represent_cache_size")
+        base.represent_cache_size = 100
+
+        represent_cache.clear()
+        represent_cache.reset_stats()
+
+        otable = current.s3db.org_organisation
+        self.id1 = otable.insert(name="Represent Cache Test Organisation1")
+        self.id2 = otable.insert(name="Represent Cache Test Organisation2")
+
+    # -------------------------------------------------------------------------
+    def testSharedLookup(self):
+        """ Test sharing of representations between instances """
+
+        id1, id2 = self.id1, self.id2
+
+        r = S3Represent(lookup="org_organisation")
+        result = r.bulk([id1, id2])
+        self.assertEqual(result[id1], "Represent Cache Test Organisation1")
+        self.assertEqual(r.queries, 1)
+
+        # Another instance with the same parameters uses the cache
+        r = S3Represent(lookup="org_organisation")
+        result = r.bulk([id1, id2])
+        self.assertEqual(result[id2], "Represent Cache Test Organisation2")
+        self.assertEqual(r.queries, 0)
+
+        stats = represent_cache.stats()
+        self.assertEqual(stats["hits"], 2)
+        self.assertEqual(stats["misses"], 2)
+        self.assertEqual(stats["hit_rate"], 0.5)
+        self.assertEqual(stats["tables"]["org_organisation"]["hits"], 2)
+
+        # Different parameters require a separate lookup
+        r = S3Represent(lookup="org_organisation", labels="%(name)s!")
+        self.assertEqual(r(id1), "Represent Cache Test Organisation1!")
+        self.assertEqual(r.queries, 1)
+
+        # Callable labels are not cached unless requested
+        labels = lambda row: row.name.upper()
+        r = S3Represent(lookup="org_organisation", labels=labels)
+        r(id1)
+        self.assertEqual(r.rkey, None)
+        r = S3Represent(lookup="org_organisation", labels=labels, cache=True)
+        r(id1)
+        self.assertNotEqual(r.rkey, None)
+
+        # Not cached if disabled for the instance
+        r = S3Represent(lookup="org_organisation", cache=False)
+        r(id1)
+        self.assertEqual(r.queries, 1)
+
+    # -------------------------------------------------------------------------
+    def testInvalidation(self):
+        """ Test invalidation by changes in the lookup table """
+
+        db = current.db
+        otable = current.s3db.org_organisation
+        id1, id2 = self.id1, self.id2
+
+        r = S3Represent(lookup="org_organisation")
+        r.bulk([id1, id2])
+
+        # Update
+        db(otable.id == id1).update(name="Represent Cache Test Renamed")
+        r = S3Represent(lookup="org_organisation")
+        result = r.bulk([id1, id2])
+        self.assertEqual(result[id1], "Represent Cache Test Renamed")
+        self.assertEqual(result[id2], "Represent Cache Test Organisation2")
+        self.assertEqual(r.queries, 1)
+
+        # Deletion
+        db(otable.id == id2).delete()
+        r = S3Represent(lookup="org_organisation")
+        self.assertEqual(r(id2), r.default)
+        self.assertEqual(r.queries, 1)
+
+        self.assertEqual(represent_cache.stats()["invalidations"], 2)
+
+    # -------------------------------------------------------------------------
+    def testPolicy(self):
+        """ Test LRU and TTL policies """
+
+        cache = S3RepresentCache(size=2, ttl=300)
+        rkey = ("test_table", None, "id")
+
+        cache.put(rkey, {1: "A", 2: "B"})
+        self.assertEqual(cache.get(rkey, [1]), {1: "A"})
+
+        # 2 is least recently used
+        cache.put(rkey, {3: "C"})
+        self.assertEqual(cache.get(rkey, [1, 2, 3]), {1: "A", 3: "C"})
+        self.assertEqual(cache.stats()["evictions"], 1)
+
+        # Invalidation
+        cache.invalidate("test_table", [1])
+        self.assertEqual(cache.get(rkey, [1, 3]), {3: "C"})
+        cache.invalidate("test_table")
+        self.assertEqual(cache.get(rkey, [3]), {})
+        self.assertEqual(cache.stats()["size"], 0)
+
+        # Expired entries
+        cache.ttl = -1
+        cache.put(rkey, {1: "A"})
+        self.assertEqual(cache.get(rkey, [1]), {})
+        self.assertEqual(cache.stats()["expirations"], 1)
+
+    # -------------------------------------------------------------------------
+    def tearDown(self):
+
+        current.db.rollback()
+        current.auth.override = False
+
+        represent_cache.clear()
+        base = current.deployment_settings.base
+        if self.cache_size is None:
+            base.pop("represent_cache_size", None)
+        else:
+            base.represent_cache_size = self.cache_size
+
 # =============================================================================
 class S3ExtractLazyFKRepresentationTests(unittest.TestCase):
     """ Test lazy representation of foreign keys in datatables """
@@ -1055,6 +1197,7 @@ if __name__ == "__main__":
 
     run_suite(
         S3RepresentTests,
+        S3RepresentCacheTests,
         S3ExtractLazyFKRepresentationTests,
         S3ExportLazyFKRepresentationTests,
     )
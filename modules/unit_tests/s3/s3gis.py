@@ -0,0 +1,487 @@
+# -*- coding: utf-8 -*-
+#
+# s3gis unit tests
+#
+# To run this script use:
+# python web2py.py -S eden -M -R applications/eden/modules/unit_tests/s3/s3gis.py
+#
+import json
+import os
+import unittest
+
+from gluon import *
+from s3.s3gis import GIS, S3GeoJSONCache, S3GeoJSONEncoder, S3SpatialIndex
+from s3.s3xml import S3XMLFormat
+
+# =============================================================================
+class S3SpatialIndexTests(unittest.TestCase):
+    """ Test the spatial index for databases without spatial extensions """
+
+    # -------------------------------------------------------------------------
+    def setUp(self):
+
+        current.auth.override = True
+
+        settings = current.deployment_settings
+        self.spatial_index = settings.gis.get("spatial_index")
+        settings.gis.spatial_index = True
+        self.instance = S3SpatialIndex.instance
+
+    # -------------------------------------------------------------------------
+    def testSearch(self):
+        """ Test index operations """
+
+        index = S3SpatialIndex(cellsize=1.0)
+        index.add(1, (10.5, 20.5, 10.5, 20.5))
+        index.add(2, (11.5, 20.5, 12.5, 21.5))
+        index.add(3, (-179.5, 0.0, -179.5, 0.0))
+        # Spans more than MAX_CELLS cells
+        index.add(4, (0.0, 0.0, 40.0, 40.0))
+        self.assertEqual(index.large, set([4]))
+
+        self.assertEqual(index.search(10.0, 20.0, 11.0, 21.0), set([1, 4]))
+        self.assertEqual(index.search(12.0, 21.0, 13.0, 22.0), set([2, 4]))
+        self.assertEqual(index.search(50.0, 50.0, 60.0, 60.0), set())
+
+        # Bounding box across the 180th meridian
+        self.assertEqual(index.search(179.0, -1.0, -179.0, 1.0), set([3]))
+
+        # Move and remove
+        index.add(1, (50.5, 50.5, 50.5, 50.5))
+        self.assertEqual(index.search(10.0, 20.0, 11.0, 21.0), set([4]))
+        self.assertEqual(index.search(50.0, 50.0, 60.0, 60.0), set([1]))
+        index.remove(1)
+        index.remove(4)
+        self.assertEqual(index.search(-180.0, -90.0, 180.0, 90.0),
+                         set([2, 3]))
+
+    # -------------------------------------------------------------------------
+    def testQuery(self):
+        """ Test build, refresh and spatial queries with the index """
+
+        db = current.db
+        gis = current.gis
+        table = current.s3db.gis_location
+
+        location_id = table.insert(name="Spatial Index Test Location",
+                                   lat=-45.3, lon=170.7,
+                                   lat_min=-45.3, lat_max=-45.3,
+                                   lon_min=170.7, lon_max=170.7)
+        index = S3SpatialIndex.build()
+        self.assertTrue(location_id in
+                        index.search(170.0, -46.0, 171.0, -45.0))
+
+        # Use this index
+        index.changes = 0
+        S3SpatialIndex.instance = index
+
+        query = gis.query_features_by_bbox(170.0, -46.0, 171.0, -45.0)
+        rows = db(query).select(table.id)
+        self.assertTrue(location_id in [row.id for row in rows])
+
+        rows = gis.get_features_in_radius(-45.3, 170.71, 5)
+        self.assertTrue(location_id in [row.id for row in rows])
+
+        # Location added by another process (not yet in the index)
+        other_id = table.insert(name="Spatial Index Other Location",
+                                lat=-45.4, lon=170.8,
+                                lat_min=-45.4, lat_max=-45.4,
+                                lon_min=170.8, lon_max=170.8)
+        self.assertFalse(other_id in index.bounds)
+        query = gis.query_features_by_bbox(170.0, -46.0, 171.0, -45.0)
+        rows = db(query).select(table.id)
+        self.assertTrue(other_id in [row.id for row in rows])
+
+        # Moved location
+        db(table.id == location_id).update(lat=-45.3, lon=-170.7,
+                                           lat_min=-45.3, lat_max=-45.3,
+                                           lon_min=-170.7, lon_max=-170.7)
+        S3SpatialIndex.update(location_id)
+        query = gis.query_features_by_bbox(170.0, -46.0, 171.0, -45.0)
+        self.assertEqual(db(query & (table.id == location_id)).count(), 0)
+        self.assertTrue(location_id in
+                        index.search(-171.0, -46.0, -170.0, -45.0))
+
+        # Changes not notified to the index are caught up with
+        db(table.id == location_id).update(deleted=True)
+        index.refresh()
+        self.assertFalse(location_id in index.bounds)
+
+    # -------------------------------------------------------------------------
+    def tearDown(self):
+
+        current.db.rollback()
+        current.auth.override = False
+
+        settings = current.deployment_settings
+        if self.spatial_index is None:
+            settings.gis.pop("spatial_index", None)
+        else:
+            settings.gis.spatial_index = self.spatial_index
+        S3SpatialIndex.instance = self.instance
+
+# =============================================================================
+class UpdateLocationTreeBulkTests(unittest.TestCase):
+    """ Test the bulk update of the location tree """
+
+    # -------------------------------------------------------------------------
+    def setUp(self):
+
+        current.auth.override = True
+
+        table = current.s3db.gis_location
+        insert = table.insert
+
+        self.L0 = insert(name="Bulk Country", level="L0",
+                         lat=10.0, lon=20.0)
+        self.L1 = insert(name="Bulk Province", level="L1",
+                         parent=self.L0,
+                         wkt="POLYGON((21 11,23 11,23 13,21 13,21 11))",
+                         gis_feature_type=3)
+        self.L2 = insert(name="Bulk District", level="L2",
+                         parent=self.L1)
+        self.L3 = insert(name="Bulk Village", level="L3",
+                         parent=self.L2,
+                         lat=11.5, lon=21.5)
+        self.site = insert(name="Bulk Site", parent=self.L3)
+
+    # -------------------------------------------------------------------------
+    def testTree(self):
+        """ Test paths, Lx names, inherited Lat/Lon and bounds """
+
+        db = current.db
+        table = current.s3db.gis_location
+
+        updated = GIS.update_location_tree_bulk([self.L1])
+        self.assertEqual(updated, 5)
+
+        rows = db(table.id.belongs([self.L0, self.L1, self.L2, self.L3,
+                                    self.site])).select().as_dict()
+        L0, L1, L2, L3, site = self.L0, self.L1, self.L2, self.L3, self.site
+
+        self.assertEqual(rows[L0]["path"], str(L0))
+        self.assertEqual(rows[L0]["L0"], "Bulk Country")
+
+        # Centroid & bounds of the polygon
+        row = rows[L1]
+        self.assertEqual(row["path"], "%s/%s" % (L0, L1))
+        self.assertEqual(row["L0"], "Bulk Country")
+        self.assertEqual(row["L1"], "Bulk Province")
+        self.assertFalse(row["inherited"])
+        self.assertAlmostEqual(row["lat"], 12.0)
+        self.assertAlmostEqual(row["lon"], 22.0)
+        self.assertAlmostEqual(row["lon_min"], 21.0)
+        self.assertAlmostEqual(row["lat_max"], 13.0)
+
+        # Lat/Lon inherited from the polygon's centroid
+        row = rows[L2]
+        self.assertEqual(row["path"], "%s/%s/%s" % (L0, L1, L2))
+        self.assertEqual(row["L1"], "Bulk Province")
+        self.assertEqual(row["L2"], "Bulk District")
+        self.assertTrue(row["inherited"])
+        self.assertAlmostEqual(row["lat"], 12.0)
+        self.assertEqual(row["wkt"], "POINT(22.0 12.0)")
+
+        # Own Lat/Lon
+        row = rows[L3]
+        self.assertFalse(row["inherited"])
+        self.assertEqual(row["lat"], 11.5)
+        self.assertEqual(row["wkt"], "POINT(21.5 11.5)")
+
+        # Specific location
+        row = rows[site]
+        self.assertEqual(row["path"], "%s/%s/%s/%s/%s" % (L0, L1, L2, L3, site))
+        self.assertEqual(row["L3"], "Bulk Village")
+        self.assertEqual(row["L4"], None)
+        self.assertTrue(row["inherited"])
+        self.assertEqual(row["lon"], 21.5)
+
+        # Nothing left to do
+        self.assertEqual(GIS.update_location_tree_bulk([L0]), 0)
+
+        # Renaming a location updates the Lx names of all descendants
+        db(table.id == L2).update(name="Bulk District 2")
+        self.assertEqual(GIS.update_location_tree_bulk([L2]), 3)
+        row = db(table.id == site).select(table.L2, limitby=(0, 1)).first()
+        self.assertEqual(row.L2, "Bulk District 2")
+
+    # -------------------------------------------------------------------------
+    def tearDown(self):
+
+        current.db.rollback()
+        current.auth.override = False
+
+# =============================================================================
+class S3SimplifiedGeometryTests(unittest.TestCase):
+    """ Test precomputed simplified geometries and the GeoJSON cache """
+
+    # -------------------------------------------------------------------------
+    def setUp(self):
+
+        current.auth.override = True
+
+        settings = current.deployment_settings
+        self.simplify_tiers = settings.gis.get("simplify_tiers")
+        settings.gis.simplify_tiers = [0.01, 0.001]
+
+        self.wkt = "POLYGON((0 0,0.5 0.0001,1 0,1 1,0 1,0 0))"
+        self.location_id = current.s3db.gis_location.insert(
+                                name="Simplified Test Location",
+                                gis_feature_type=3,
+                                wkt=self.wkt)
+
+    # -------------------------------------------------------------------------
+    def testSimplified(self):
+        """ Test generation, lookup and regeneration of simplified polygons """
+
+        db = current.db
+        s3db = current.s3db
+        table = s3db.gis_location
+        stable = s3db.gis_location_simplified
+        location_id = self.location_id
+        query = (stable.location_id == location_id)
+
+        # Generated on demand, for all tiers
+        geojsons = GIS.get_simplified([location_id], 0.01)
+        self.assertEqual(geojsons[location_id],
+                         GIS.simplify(self.wkt,
+                                      tolerance=0.01,
+                                      output="geojson"))
+        self.assertEqual(db(query).count(), 2)
+
+        # Nearest tier which isn't coarser than the tolerance
+        geojsons = GIS.get_simplified([location_id], 0.005)
+        self.assertEqual(geojsons[location_id],
+                         GIS.simplify(self.wkt,
+                                      tolerance=0.001,
+                                      output="geojson"))
+        self.assertEqual(GIS.get_simplified([location_id], 0.0001), None)
+
+        # Regenerated on update
+        wkt = "POLYGON((0 0,2 0,2 2,0 2,0 0))"
+        db(table.id == location_id).update(wkt=wkt)
+        GIS.update_simplified([location_id])
+        geojsons = GIS.get_simplified([location_id], 0.01)
+        self.assertEqual(geojsons[location_id],
+                         GIS.simplify(wkt, tolerance=0.01, output="geojson"))
+        self.assertEqual(db(query).count(), 2)
+
+    # -------------------------------------------------------------------------
+    def testGeoJSONCache(self):
+        """ Test the versioned GeoJSON cache and ETags """
+
+        cache = S3GeoJSONCache("unit_test", 1)
+        cache.put({1: "{}", 2: "[]"})
+        self.assertEqual(cache.get(), {1: "{}", 2: "[]"})
+
+        # New version
+        cache = S3GeoJSONCache("unit_test", 2)
+        self.assertEqual(cache.get(), None)
+
+        env = current.request.env
+        if_none_match = env.http_if_none_match
+        try:
+            env.http_if_none_match = cache.etag()
+            self.assertRaises(HTTP, cache.check_etag)
+            env.http_if_none_match = S3GeoJSONCache("unit_test", 1).etag()
+            cache.check_etag()
+            self.assertEqual(current.response.headers["ETag"], cache.etag())
+        finally:
+            env.http_if_none_match = if_none_match
+            current.response.headers.pop("ETag", None)
+            os.remove(cache.path())
+
+    # -------------------------------------------------------------------------
+    def tearDown(self):
+
+        current.db.rollback()
+        current.auth.override = False
+
+        settings = current.deployment_settings
+        if self.simplify_tiers is None:
+            settings.gis.pop("simplify_tiers", None)
+        else:
+            settings.gis.simplify_tiers = self.simplify_tiers
+
+# =============================================================================
+class GISGetMarkersTests(unittest.TestCase):
+    """ Test bulk lookup of per-feature markers """
+
+    # -------------------------------------------------------------------------
+    def setUp(self):
+
+        current.auth.override = True
+
+        s3db = current.s3db
+        mtable = s3db.gis_marker
+        ftable = s3db.org_office
+
+        for name in ("markers_test_a", "markers_test_b"):
+            mtable.insert(name=name, image="%s.png" % name,
+                          height=20, width=10)
+        self.office_ids = [ftable.insert(name="Markers Test Office %s" % i)
+                           for i in xrange(6)]
+
+    # -------------------------------------------------------------------------
+    def testGetMarkers(self):
+        """ Test one query for all markers instead of one per feature """
+
+        db = current.db
+        office_ids = self.office_ids
+        resource = current.s3db.resource("org_office", id=office_ids)
+        resource.load()
+
+        def marker_fn(record):
+            index = office_ids.index(record.id)
+            if index == 5:
+                # Marker dict
+                return {"image": "legacy.png", "height": 1, "width": 1}
+            elif index == 4:
+                # Unknown marker
+                return "markers_test_x"
+            return "markers_test_%s" % ("a", "b")[index % 2]
+
+        adapter = db._adapter
+        execute = adapter.execute
+        counter = [0]
+        def counting(*args, **kwargs):
+            counter[0] += 1
+            return execute(*args, **kwargs)
+        adapter.execute = counting
+        try:
+            markers = GIS.get_markers(resource, marker_fn)
+        finally:
+            adapter.execute = execute
+
+        self.assertTrue(counter[0] <= 1)
+        self.assertEqual(markers[office_ids[0]].image, "markers_test_a.png")
+        self.assertEqual(markers[office_ids[1]].image, "markers_test_b.png")
+        self.assertEqual(markers[office_ids[2]].image, "markers_test_a.png")
+        self.assertEqual(markers[office_ids[3]].height, 20)
+        self.assertEqual(markers[office_ids[4]], None)
+        self.assertEqual(markers[office_ids[5]]["image"], "legacy.png")
+
+    # -------------------------------------------------------------------------
+    def tearDown(self):
+
+        current.db.rollback()
+        current.auth.override = False
+
+# =============================================================================
+class S3GeoJSONEncoderTests(unittest.TestCase):
+    """ Test the native GeoJSON serializer against the XSLT export """
+
+    # -------------------------------------------------------------------------
+    def setUp(self):
+
+        current.auth.override = True
+
+        s3db = current.s3db
+        gtable = s3db.gis_location
+        ftable = s3db.org_office
+
+        self.format = current.auth.permission.format
+        current.auth.permission.format = "geojson"
+
+        self.office_ids = []
+        for i, latlon in enumerate(((10.5, 20.25), (-5.0, 100.125), None)):
+            if latlon:
+                lat, lon = latlon
+                location_id = gtable.insert(name="GeoJSON Test Location %s" % i,
+                                            lat=lat,
+                                            lon=lon)
+            else:
+                location_id = None
+            self.office_ids.append(
+                ftable.insert(name="GeoJSON Test Office %s" % i,
+                              location_id=location_id))
+
+        self.stylesheet = os.path.join(current.request.folder,
+                                       "static", "formats", "geojson",
+                                       "export.xsl")
+
+    # -------------------------------------------------------------------------
+    def export(self, ids, native, pretty_print=False):
+        """ Export the offices as GeoJSON """
+
+        settings = current.deployment_settings
+        geojson_native = settings.gis.get("geojson_native")
+        settings.gis.geojson_native = native
+        try:
+            resource = current.s3db.resource("org_office", id=ids)
+            return resource.export_xml(stylesheet=self.stylesheet,
+                                       as_json=True,
+                                       pretty_print=pretty_print)
+        finally:
+            if geojson_native is None:
+                settings.gis.pop("geojson_native", None)
+            else:
+                settings.gis.geojson_native = geojson_native
+
+    # -------------------------------------------------------------------------
+    def testEncode(self):
+        """ Test that the output is the same as with XSLT """
+
+        export = self.export
+        ids = self.office_ids
+        for subset in (ids, ids[:1], ids[2:], ids[:2]):
+            for pretty_print in (False, True):
+                self.assertEqual(export(subset, True, pretty_print),
+                                 export(subset, False, pretty_print))
+
+        output = json.loads(export(ids, True))
+        self.assertEqual(output["type"], "FeatureCollection")
+        features = output["features"]
+        self.assertEqual(len(features), 2)
+        self.assertEqual(features[0]["geometry"]["coordinates"],
+                         ["20.2500", "10.5000"])
+
+    # -------------------------------------------------------------------------
+    def testFallback(self):
+        """ Test that unsupported resources are left to the stylesheet """
+
+        xmlformat = S3XMLFormat(self.stylesheet)
+        resource = current.s3db.resource("gis_location")
+        encoder = S3GeoJSONEncoder(resource, xmlformat)
+        self.assertEqual(encoder.encode(), None)
+
+    # -------------------------------------------------------------------------
+    def testParseAttributes(self):
+        """ Test parsing of attributes strings """
+
+        parse = S3GeoJSONEncoder.parse_attributes
+        self.assertEqual(parse("[name]=[Office  A],[type]=[ 1 ]"),
+                         [("name", "Office A"), ("type", "1")])
+        self.assertEqual(parse("[name]=[A, B]"), [("name", "A, B")])
+
+    # -------------------------------------------------------------------------
+    def tearDown(self):
+
+        current.db.rollback()
+        current.auth.override = False
+        current.auth.permission.format = self.format
+
+# =============================================================================
+def run_suite(*test_classes):
+    """ Run the test suite """
+
+    loader = unittest.TestLoader()
+    suite = unittest.TestSuite()
+    for test_class in test_classes:
+        tests = loader.loadTestsFromTestCase(test_class)
+        suite.addTests(tests)
+    if suite is not None:
+        unittest.TextTestRunner(verbosity=2).run(suite)
+    return
+
+if __name__ == "__main__":
+
+    run_suite(
+        S3SpatialIndexTests,
+        UpdateLocationTreeBulkTests,
+        S3SimplifiedGeometryTests,
+        GISGetMarkersTests,
+        S3GeoJSONEncoderTests,
+    )
+
+# END ========================================================================
@@ -0,0 +1,530 @@
+# -*- coding: utf-8 -*-
+#
+# S3Hierarchy Unit Tests
+#
+# To run this script use:
+# python web2py.py -S eden -M -R applications/eden/modules/unit_tests/s3/s3hierarchy.py
+#
+import unittest
+
+from gluon import *
+from s3 import s3hierarchy
+from s3.s3fields import s3_meta_fields
+from s3.s3hierarchy import S3Hierarchy
+from s3.s3resource import S3FieldSelector
+
+# =============================================================================
+class S3HierarchyTests(unittest.TestCase):
+    """ Base class for hierarchy tests, defines a test table """
+
+    tablename = "s3hierarchy_test"
+
+    # -------------------------------------------------------------------------
+    @classmethod
+    def setUpClass(cls):
+
+        db = current.db
+        tablename = cls.tablename
+        db.define_table(tablename,
+                        Field("name"),
+                        Field("category"),
+                        Field("parent", "reference %s" % tablename),
+                        *s3_meta_fields())
+
+    # -------------------------------------------------------------------------
+    @classmethod
+    def tearDownClass(cls):
+
+        db = current.db
+        db.rollback()
+        try:
+            db[cls.tablename].drop()
+        except:
+            pass
+        db.commit()
+
+    # -------------------------------------------------------------------------
+    def setUp(self):
+
+        current.auth.override = True
+
+        s3db = current.s3db
+        tablename = self.tablename
+        s3db.configure(tablename, hierarchy=("parent", "category"))
+
+        table = s3db[tablename]
+        self.a = table.insert(name="A", category="X")
+        self.b = table.insert(name="B", category="Y", parent=self.a)
+        self.c = table.insert(name="C", category="Y", parent=self.a)
+        self.d = table.insert(name="D", category="Z", parent=self.b)
+
+        current.model.hierarchies.pop(tablename, None)
+
+    # -------------------------------------------------------------------------
+    def tearDown(self):
+
+        current.db.rollback()
+        current.model.hierarchies.pop(self.tablename, None)
+        current.s3db.clear_config(self.tablename)
+        current.auth.override = False
+
+    # -------------------------------------------------------------------------
+    def snapshot(self, h):
+        """ Copy the nodes of a hierarchy for comparison """
+
+        return dict((k, (v["p"], v["c"], set(v["s"])))
+                    for k, v in h.nodes.items())
+
+    # -------------------------------------------------------------------------
+    def rebuild(self):
+        """ Rebuild the hierarchy from the table, return its nodes """
+
+        tablename = self.tablename
+        current.model.hierarchies.pop(tablename, None)
+        S3Hierarchy.dirty(tablename)
+        h = S3Hierarchy(tablename)
+        return self.snapshot(h), set(h.roots)
+
+# =============================================================================
+class S3HierarchyIncrementalTests(S3HierarchyTests):
+    """ Tests for incremental hierarchy updates """
+
+    # -------------------------------------------------------------------------
+    def testInsert(self):
+        """ Test inserts update the loaded hierarchy """
+
+        table = current.s3db[self.tablename]
+
+        h = S3Hierarchy(self.tablename)
+        self.assertEqual(h.children(self.a), set([self.b, self.c]))
+
+        e = table.insert(name="E", category="Z", parent=self.c)
+        self.assertEqual(h.children(self.c), set([e]))
+        self.assertEqual(h.path(e), [self.a, self.c, e])
+        self.assertEqual(h.category(e), "Z")
+
+        f = table.insert(name="F", category="X")
+        self.assertTrue(f in h.roots)
+
+        nodes, roots = self.snapshot(h), set(h.roots)
+        self.assertEqual((nodes, roots), self.rebuild())
+
+    # -------------------------------------------------------------------------
+    def testUpdate(self):
+        """ Test updates of parent and category move nodes """
+
+        db = current.db
+        table = current.s3db[self.tablename]
+
+        h = S3Hierarchy(self.tablename)
+
+        # Move D from B to C
+        db(table.id == self.d).update(parent=self.c)
+        self.assertEqual(h.children(self.b), set())
+        self.assertEqual(h.children(self.c), set([self.d]))
+        self.assertEqual(h.path(self.d), [self.a, self.c, self.d])
+
+        # Make B a root node
+        db(table.id == self.b).update(parent=None, category="X")
+        self.assertTrue(self.b in h.roots)
+        self.assertEqual(h.children(self.a), set([self.c]))
+        self.assertEqual(h.category(self.b), "X")
+
+        nodes, roots = self.snapshot(h), set(h.roots)
+        self.assertEqual((nodes, roots), self.rebuild())
+
+    # -------------------------------------------------------------------------
+    def testDelete(self):
+        """ Test (soft and hard) deletions remove nodes """
+
+        db = current.db
+        table = current.s3db[self.tablename]
+
+        h = S3Hierarchy(self.tablename)
+
+        # Soft-delete a leaf node
+        db(table.id == self.c).update(deleted=True)
+        self.assertFalse(self.c in h.nodes)
+        self.assertEqual(h.children(self.a), set([self.b]))
+
+        # Hard-delete a leaf node
+        db(table.id == self.d).delete()
+        self.assertFalse(self.d in h.nodes)
+        self.assertEqual(h.children(self.b), set())
+
+        nodes, roots = self.snapshot(h), set(h.roots)
+        self.assertEqual((nodes, roots), self.rebuild())
+
+    # -------------------------------------------------------------------------
+    def testDeltas(self):
+        """ Test changes are stored as deltas and applied when loading """
+
+        db = current.db
+        s3db = current.s3db
+        table = s3db[self.tablename]
+        tablename = self.tablename
+
+        # Store the hierarchy
+        nodes, roots = self.rebuild()
+
+        # Make changes without the hierarchy being loaded
+        current.model.hierarchies.pop(tablename, None)
+        e = table.insert(name="E", category="Z", parent=self.c)
+        db(table.id == self.d).update(parent=self.c)
+        db(table.id == self.b).update(deleted=True)
+
+        dtable = s3db.s3_hierarchy_delta
+        query = (dtable.tablename == tablename)
+        self.assertEqual(db(query).count(), 3)
+
+        # Stored hierarchy must not be marked dirty
+        htable = s3db.s3_hierarchy
+        row = db(htable.tablename == tablename).select(htable.dirty,
+                                                       limitby=(0, 1)).first()
+        self.assertFalse(row.dirty)
+
+        # Load stored hierarchy + deltas
+        h = S3Hierarchy(tablename)
+        self.assertEqual(h.children(self.c), set([self.d, e]))
+        self.assertFalse(self.b in h.nodes)
+
+        nodes, roots = self.snapshot(h), set(h.roots)
+        self.assertEqual((nodes, roots), self.rebuild())
+
+    # -------------------------------------------------------------------------
+    def testCompaction(self):
+        """ Test compaction of stored deltas """
+
+        db = current.db
+        s3db = current.s3db
+        table = s3db[self.tablename]
+        tablename = self.tablename
+
+        self.rebuild()
+
+        compact = s3hierarchy.COMPACT
+        s3hierarchy.COMPACT = 2
+        try:
+            current.model.hierarchies.pop(tablename, None)
+            table.insert(name="E", category="Z", parent=self.c)
+            table.insert(name="F", category="Z", parent=self.c)
+
+            dtable = s3db.s3_hierarchy_delta
+            query = (dtable.tablename == tablename)
+            self.assertEqual(db(query).count(), 2)
+
+            h = S3Hierarchy(tablename)
+            self.assertEqual(len(h.children(self.c)), 2)
+            self.assertEqual(db(query).count(), 0)
+
+            # Compacted hierarchy loads without deltas
+            current.model.hierarchies.pop(tablename, None)
+            h = S3Hierarchy(tablename)
+            self.assertEqual(len(h.children(self.c)), 2)
+        finally:
+            s3hierarchy.COMPACT = compact
+
+# =============================================================================
+class S3HierarchyCacheTests(S3HierarchyTests):
+    """ Tests for the shared hierarchy cache """
+
+    # -------------------------------------------------------------------------
+    def setUp(self):
+
+        super(S3HierarchyCacheTests, self).setUp()
+
+        settings = current.deployment_settings
+        self.backend = settings.base.get("hierarchy_cache")
+        settings.base.hierarchy_cache = "ram"
+
+        self.key = "s3hierarchy_%s" % self.tablename
+        current.cache.ram(self.key, None)
+
+    # -------------------------------------------------------------------------
+    def tearDown(self):
+
+        current.cache.ram(self.key, None)
+
+        settings = current.deployment_settings
+        if self.backend is None:
+            settings.base.pop("hierarchy_cache", None)
+        else:
+            settings.base.hierarchy_cache = self.backend
+
+        super(S3HierarchyCacheTests, self).tearDown()
+
+    # -------------------------------------------------------------------------
+    def cached(self):
+        """ Get the cached hierarchy data """
+
+        return current.cache.ram(self.key, lambda: None, time_expire=None)
+
+    # -------------------------------------------------------------------------
+    def version(self):
+        """ Get the current version of the stored hierarchy """
+
+        htable = current.s3db.s3_hierarchy
+        query = (htable.tablename == self.tablename)
+        row = current.db(query).select(htable.version,
+                                       limitby=(0, 1)).first()
+        return row.version if row else None
+
+    # -------------------------------------------------------------------------
+    def testCacheLoad(self):
+        """ Test stored hierarchies are cached with their version """
+
+        nodes, roots = self.rebuild()
+
+        # Load from the database
+        current.model.hierarchies.pop(self.tablename, None)
+        h = S3Hierarchy(self.tablename)
+        self.assertEqual(self.snapshot(h), nodes)
+
+        data = self.cached()
+        self.assertNotEqual(data, None)
+        self.assertEqual(data[0], self.version())
+
+        # Subsequent loads (e.g. in other requests) use the cache
+        marker = {"p": None, "c": None, "s": set()}
+        data[2][0] = marker
+        current.model.hierarchies.pop(self.tablename, None)
+        h = S3Hierarchy(self.tablename)
+        self.assertTrue(h.nodes[0] is marker)
+
+    # -------------------------------------------------------------------------
+    def testInvalidationByDelta(self):
+        """ Test changes to the stored hierarchy invalidate the cache """
+
+        db = current.db
+        table = current.s3db[self.tablename]
+
+        self.rebuild()
+        current.model.hierarchies.pop(self.tablename, None)
+        h = S3Hierarchy(self.tablename)
+        version = self.cached()[0]
+
+        # Change in another request
+        current.model.hierarchies.pop(self.tablename, None)
+        db(table.id == self.d).update(parent=self.c)
+        self.assertEqual(self.version(), version + 1)
+
+        # Cache is outdated, next load must apply the change
+        current.model.hierarchies.pop(self.tablename, None)
+        h = S3Hierarchy(self.tablename)
+        self.assertEqual(h.parent(self.d), self.c)
+        self.assertEqual(self.cached()[0], self.version())
+
+    # -------------------------------------------------------------------------
+    def testInvalidationByDirty(self):
+        """ Test marking the hierarchy dirty bypasses the cache """
+
+        db = current.db
+        table = current.s3db[self.tablename]
+
+        self.rebuild()
+        current.model.hierarchies.pop(self.tablename, None)
+        S3Hierarchy(self.tablename).nodes
+
+        # Make a change which is not tracked, then mark dirty
+        current.model.hierarchies.pop(self.tablename, None)
+        table._after_update, after_update = [], table._after_update
+        try:
+            db(table.id == self.d).update(parent=self.c)
+        finally:
+            table._after_update = after_update
+        S3Hierarchy.dirty(self.tablename)
+
+        current.model.hierarchies.pop(self.tablename, None)
+        h = S3Hierarchy(self.tablename)
+        self.assertEqual(h.parent(self.d), self.c)
+
+    # -------------------------------------------------------------------------
+    def testCacheIsolation(self):
+        """ Test changes in a request do not modify the cached nodes """
+
+        db = current.db
+        table = current.s3db[self.tablename]
+
+        self.rebuild()
+        current.model.hierarchies.pop(self.tablename, None)
+        h = S3Hierarchy(self.tablename)
+        cached_nodes = self.cached()[2]
+        children = set(cached_nodes[self.b]["s"])
+
+        # Move a node in this request
+        db(table.id == self.d).update(parent=self.c)
+        self.assertEqual(h.parent(self.d), self.c)
+        self.assertEqual(cached_nodes[self.b]["s"], children)
+        self.assertEqual(cached_nodes[self.d]["p"], self.b)
+
+        # Labels are not written into cached nodes
+        h.label(self.a, represent=lambda node_id: "Label")
+        self.assertEqual(h.label(self.a), "Label")
+        self.assertFalse("l" in cached_nodes[self.a])
+
+    # -------------------------------------------------------------------------
+    def testCacheDisabled(self):
+        """ Test loading without cache """
+
+        current.deployment_settings.base.hierarchy_cache = False
+
+        nodes, roots = self.rebuild()
+        current.model.hierarchies.pop(self.tablename, None)
+        h = S3Hierarchy(self.tablename)
+        self.assertEqual(self.snapshot(h), nodes)
+        self.assertEqual(self.cached(), None)
+
+# =============================================================================
+class S3HierarchyClosureTests(S3HierarchyTests):
+    """ Tests for the closure index """
+
+    # -------------------------------------------------------------------------
+    def setUp(self):
+
+        super(S3HierarchyClosureTests, self).setUp()
+
+        current.s3db.configure(self.tablename, hierarchy_closure=True)
+
+    # -------------------------------------------------------------------------
+    def closure(self):
+        """ Get the stored closure index as set of tuples """
+
+        ctable = current.s3db.s3_hierarchy_closure
+        query = (ctable.tablename == self.tablename)
+        rows = current.db(query).select(ctable.ancestor,
+                                        ctable.descendant,
+                                        ctable.depth)
+        return set((row.ancestor, row.descendant, row.depth) for row in rows)
+
+    # -------------------------------------------------------------------------
+    def expected(self, h):
+        """ Compute the closure from the nodes of a hierarchy """
+
+        result = set()
+        for node_id in h.nodes:
+            path = h.path(node_id)
+            depth = len(path) - 1
+            for i, ancestor_id in enumerate(path):
+                result.add((ancestor_id, node_id, depth - i))
+        return result
+
+    # -------------------------------------------------------------------------
+    def testBuild(self):
+        """ Test the closure index is built when storing the hierarchy """
+
+        a, b, c, d = self.a, self.b, self.c, self.d
+
+        self.rebuild()
+        closure = self.closure()
+        self.assertEqual(closure, set([(a, a, 0), (b, b, 0),
+                                       (c, c, 0), (d, d, 0),
+                                       (a, b, 1), (a, c, 1),
+                                       (b, d, 1), (a, d, 2),
+                                       ]))
+
+    # -------------------------------------------------------------------------
+    def testIncremental(self):
+        """ Test the closure index is updated along with the deltas """
+
+        db = current.db
+        table = current.s3db[self.tablename]
+
+        self.rebuild()
+        current.model.hierarchies.pop(self.tablename, None)
+
+        e = table.insert(name="E", category="Z", parent=self.d)
+        db(table.id == self.b).update(parent=self.c)
+        db(table.id == self.c).update(category="X")
+        f = table.insert(name="F", category="X")
+        db(table.id == self.d).update(parent=f)
+        db(table.id == self.a).update(deleted=True)
+
+        current.model.hierarchies.pop(self.tablename, None)
+        h = S3Hierarchy(self.tablename)
+        self.assertEqual(self.closure(), self.expected(h))
+        self.assertEqual(h.path(e), [f, self.d, e])
+
+    # -------------------------------------------------------------------------
+    def testSubtreeQuery(self):
+        """ Test subtree queries """
+
+        db = current.db
+        table = current.s3db[self.tablename]
+
+        self.rebuild()
+        h = S3Hierarchy(self.tablename)
+
+        def subtree(node_ids, inclusive=True):
+            query = h.subtree_query(table.id, node_ids, inclusive=inclusive)
+            return set(row.id for row in db(query).select(table.id))
+
+        # Using the closure index
+        query = h.subtree_query(table.id, self.b)
+        self.assertTrue("s3_hierarchy_closure" in str(query))
+        self.assertEqual(subtree(self.b), set([self.b, self.d]))
+        self.assertEqual(subtree(self.a, inclusive=False),
+                         set([self.b, self.c, self.d]))
+        self.assertEqual(subtree([str(self.c), self.d]),
+                         set([self.c, self.d]))
+
+        # Without closure index
+        current.s3db.configure(self.tablename, hierarchy_closure=False)
+        query = h.subtree_query(table.id, self.b)
+        self.assertFalse("s3_hierarchy_closure" in str(query))
+        self.assertEqual(subtree(self.b), set([self.b, self.d]))
+
+    # -------------------------------------------------------------------------
+    def testTypeOf(self):
+        """ Test TYPEOF filters """
+
+        self.rebuild()
+
+        resource = current.s3db.resource(self.tablename)
+        query = S3FieldSelector("parent").typeof(self.b)
+        resource.add_filter(query)
+        rows = resource.select(["id"], as_rows=True)
+        self.assertEqual(set(row.id for row in rows), set([self.d]))
+
+        resource = current.s3db.resource(self.tablename,
+                                         vars={"~.id__typeof": str(self.b)})
+        rows = resource.select(["id"], as_rows=True)
+        self.assertEqual(set(row.id for row in rows), set([self.b, self.d]))
+
+    # -------------------------------------------------------------------------
+    def testParents(self):
+        """ Test parents lookup """
+
+        a, b, c, d = self.a, self.b, self.c, self.d
+
+        self.rebuild()
+        h = S3Hierarchy(self.tablename)
+
+        expected = {d: b, b: a, a: None, c: a}
+        self.assertEqual(h.parents([d, c]), expected)
+
+        # Without closure index
+        current.s3db.configure(self.tablename, hierarchy_closure=False)
+        self.assertEqual(h.parents([d, c]), expected)
+
+# =============================================================================
+def run_suite(*test_classes):
+    """ Run the test suite """
+
+    loader = unittest.TestLoader()
+    suite = unittest.TestSuite()
+    for test_class in test_classes:
+        tests = loader.loadTestsFromTestCase(test_class)
+        suite.addTests(tests)
+    if suite is not None:
+        unittest.TextTestRunner(verbosity=2).run(suite)
+    return
+
+if __name__ == "__main__":
+
+    run_suite(
+        S3HierarchyIncrementalTests,
+        S3HierarchyCacheTests,
+        S3HierarchyClosureTests,
+    )
+
+# END ========================================================================
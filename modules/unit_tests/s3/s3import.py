@@ -384,6 +384,257 @@ class FailedReferenceTests(unittest.TestCase):
         current.db.rollback()
         current.auth.override = False
 
+# =============================================================================
+class BatchDeduplicationTests(unittest.TestCase):
+    """ Test batch deduplication of import items """
+
+    # -------------------------------------------------------------------------
+    def setUp(self):
+
+        current.auth.override = True
+
+        xmlstr = """
+<s3xml>
+    <resource name="stats_demographic" uuid="BDTestDemographic1">
+        <data field="name">BDTestDemographic1</data>
+    </resource>
+</s3xml>"""
+
+        from lxml import etree
+        tree = etree.ElementTree(etree.fromstring(xmlstr))
+        current.s3db.resource("stats_demographic").import_xml(tree)
+
+    # -------------------------------------------------------------------------
+    def testBatchDeduplication(self):
+        """ Test batch deduplication with UIDs and bulk resolver """
+
+        xmlstr = """
+<s3xml>
+    <resource name="stats_demographic" uuid="BDTestDemographic1">
+        <data field="name">BDTestDemographic1</data>
+        <data field="description">UID match</data>
+    </resource>
+    <resource name="stats_demographic">
+        <data field="name">bdtestdemographic1</data>
+        <data field="description">Resolver match</data>
+    </resource>
+    <resource name="stats_demographic">
+        <data field="name">BDTestDemographic2</data>
+    </resource>
+    <resource name="stats_demographic">
+        <data field="name">BDTestDemographic2</data>
+        <data field="description">Duplicate within the import</data>
+    </resource>
+</s3xml>"""
+
+        from lxml import etree
+        tree = etree.ElementTree(etree.fromstring(xmlstr))
+
+        db = current.db
+        s3db = current.s3db
+
+        resource = s3db.resource("stats_demographic")
+        resource.import_xml(tree)
+        self.assertEqual(resource.error, None)
+
+        table = resource.table
+        query = (table.name.lower().like("bdtestdemographic%")) & \
+                (table.deleted != True)
+        rows = db(query).select(table.name,
+                                table.description,
+                                orderby=table.name)
+        self.assertEqual(len(rows), 2)
+        self.assertEqual(rows[0].name.lower(), "bdtestdemographic1")
+        self.assertEqual(rows[0].description, "Resolver match")
+        self.assertEqual(rows[1].name, "BDTestDemographic2")
+        self.assertEqual(rows[1].description, "Duplicate within the import")
+
+    # -------------------------------------------------------------------------
+    def tearDown(self):
+
+        current.db.rollback()
+        current.auth.override = False
+
+# =============================================================================
+class ReferenceIndexTests(unittest.TestCase):
+    """ Test the element index for reference resolution """
+
+    # -------------------------------------------------------------------------
+    def setUp(self):
+
+        current.auth.override = True
+
+    # -------------------------------------------------------------------------
+    def testReferenceIndex(self):
+        """ Test lookup of referenced elements in the tree """
+
+        xmlstr = """
+<s3xml>
+    <resource name="org_office">
+        <data field="name">RITestOffice1</data>
+        <reference field="organisation_id" resource="org_organisation" tuid="RIORG"/>
+        <reference field="location_id" resource="gis_location" tuid="RILOCATION"/>
+    </resource>
+    <resource name="org_office">
+        <data field="name">RITestOffice2</data>
+        <reference field="organisation_id" resource="org_organisation" tuid="RIORG"/>
+    </resource>
+    <resource name="org_organisation" tuid="RIORG">
+        <data field="name">RITestOrg</data>
+    </resource>
+    <resource name="gis_location" tuid="RILOCATION">
+        <data field="name">RITestLocation</data>
+    </resource>
+</s3xml>"""
+
+        from lxml import etree
+        tree = etree.ElementTree(etree.fromstring(xmlstr))
+
+        from s3.s3import import S3ImportJob
+
+        table = current.s3db.org_office
+        job = S3ImportJob(table, tree=tree)
+        for element in tree.getroot().findall("resource"):
+            job.add_item(element=element)
+
+        # All resource elements are indexed
+        self.assertEqual(len(job.index_elements(tree.getroot())), 2)
+
+        # References are resolved to items of the job
+        items = [item for item in job.items.values()
+                      if item.tablename == "org_office"]
+        self.assertEqual(len(items), 2)
+        for item in items:
+            for reference in item.references:
+                entry = reference.entry
+                self.assertNotEqual(entry.element, None)
+                self.assertTrue(entry.item_id in job.items)
+
+        stats = job.reference_stats()
+        self.assertEqual(stats["lookups"], 3)
+        self.assertEqual(stats["elements"], 2)
+        self.assertEqual(stats["directory"], 1)
+        self.assertEqual(stats["unresolved"], 0)
+
+    # -------------------------------------------------------------------------
+    def tearDown(self):
+
+        current.db.rollback()
+        current.auth.override = False
+
+# =============================================================================
+class BulkInsertTests(unittest.TestCase):
+    """ Test bulk inserts of new records """
+
+    # -------------------------------------------------------------------------
+    def setUp(self):
+
+        current.auth.override = True
+        current.s3db.configure("org_organisation", bulk_insert=True)
+
+    # -------------------------------------------------------------------------
+    def testBulkInsert(self):
+        """ Test bulk insert with super-entity links and references """
+
+        xmlstr = """
+<s3xml>
+    <resource name="org_organisation" uuid="BITestOrg1">
+        <data field="name">BITestOrg1</data>
+    </resource>
+    <resource name="org_organisation" uuid="BITestOrg2">
+        <data field="name">BITestOrg2</data>
+    </resource>
+    <resource name="org_office">
+        <data field="name">BITestOffice</data>
+        <reference field="organisation_id" resource="org_organisation" uuid="BITestOrg3"/>
+    </resource>
+    <resource name="org_organisation" uuid="BITestOrg3">
+        <data field="name">BITestOrg3</data>
+    </resource>
+</s3xml>"""
+
+        from lxml import etree
+        tree = etree.ElementTree(etree.fromstring(xmlstr))
+
+        db = current.db
+        s3db = current.s3db
+
+        resource = s3db.resource("org_organisation")
+        resource.import_xml(tree)
+        self.assertEqual(resource.error, None)
+
+        # All organisations are linked to their person entity
+        table = s3db.org_organisation
+        query = (table.uuid.belongs(("BITestOrg1",
+                                     "BITestOrg2",
+                                     "BITestOrg3")))
+        rows = db(query).select(table.id, table.uuid, table.pe_id)
+        self.assertEqual(len(rows), 3)
+        etable = s3db.pr_pentity
+        for row in rows:
+            self.assertNotEqual(row.pe_id, None)
+            query = (etable.pe_id == row.pe_id)
+            entity = db(query).select(etable.instance_type,
+                                      limitby=(0, 1)).first()
+            self.assertEqual(entity.instance_type, "org_organisation")
+
+        # The office references the bulk-inserted organisation
+        otable = s3db.org_office
+        office = db(otable.name == "BITestOffice").select(otable.organisation_id,
+                                                          limitby=(0, 1)).first()
+        org3 = [row for row in rows if row.uuid == "BITestOrg3"][0]
+        self.assertEqual(office.organisation_id, org3.id)
+
+    # -------------------------------------------------------------------------
+    def testBulkInsertDuplicates(self):
+        """ Test bulk insert of elements with the same UID or name """
+
+        xmlstr = """
+<s3xml>
+    <resource name="org_organisation" uuid="BITestOrg4">
+        <data field="name">BITestOrg4</data>
+    </resource>
+    <resource name="org_organisation" uuid="BITestOrg4">
+        <data field="name">BITestOrg4</data>
+        <data field="acronym">BIT4</data>
+    </resource>
+    <resource name="org_organisation">
+        <data field="name">BITestOrg5</data>
+    </resource>
+    <resource name="org_organisation">
+        <data field="name">BITestOrg5</data>
+        <data field="acronym">BIT5</data>
+    </resource>
+</s3xml>"""
+
+        from lxml import etree
+        tree = etree.ElementTree(etree.fromstring(xmlstr))
+
+        db = current.db
+        s3db = current.s3db
+
+        resource = s3db.resource("org_organisation")
+        resource.import_xml(tree)
+        self.assertEqual(resource.error, None)
+
+        # The later elements update the records of the earlier ones
+        table = s3db.org_organisation
+        query = (table.name.belongs(("BITestOrg4", "BITestOrg5"))) & \
+                (table.deleted != True)
+        rows = db(query).select(table.name,
+                                table.acronym,
+                                orderby=table.name)
+        self.assertEqual(len(rows), 2)
+        self.assertEqual(rows[0].acronym, "BIT4")
+        self.assertEqual(rows[1].acronym, "BIT5")
+
+    # -------------------------------------------------------------------------
+    def tearDown(self):
+
+        current.db.rollback()
+        current.auth.override = False
+        current.s3db.configure("org_organisation", bulk_insert=False)
+
 # =============================================================================
 def run_suite(*test_classes):
     """ Run the test suite """
@@ -405,6 +656,9 @@ if __name__ == "__main__":
         ComponentDisambiguationTests,
         PostParseTests,
         FailedReferenceTests,
+        BatchDeduplicationTests,
+        ReferenceIndexTests,
+        BulkInsertTests,
     )
 
 # END ========================================================================
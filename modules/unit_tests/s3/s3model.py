@@ -6,6 +6,7 @@
 # python web2py.py -S eden -M -R applications/eden/tests/unit_tests/modules/s3/s3model.py
 #
 import unittest
+from gluon import *
 from gluon.dal import Query
 
 # =============================================================================
@@ -13,6 +14,57 @@ class S3ModelTests(unittest.TestCase):
 
     pass
 
+# =============================================================================
+class InsertRowsTests(unittest.TestCase):
+    """ Test multi-row inserts """
+
+    # -------------------------------------------------------------------------
+    def testInsertRows(self):
+        """ Test the record IDs are returned in the order of the rows """
+
+        db = current.db
+        s3db = current.s3db
+        table = s3db.org_organisation_type
+
+        rows = [{"name": "IRTestType%s" % i} for i in xrange(5)]
+        # Different set of fields
+        rows[3]["comments"] = "Test"
+
+        ids = s3db.insert_rows(table, rows)
+        self.assertEqual(len(ids), 5)
+        for row, record_id in zip(rows, ids):
+            record = db(table.id == record_id).select(table.name,
+                                                      limitby=(0, 1)).first()
+            self.assertEqual(record.name, row["name"])
+
+    # -------------------------------------------------------------------------
+    def testInsertRowsErrors(self):
+        """ Test records which can not be inserted are reported """
+
+        db = current.db
+        s3db = current.s3db
+        table = s3db.org_organisation_type
+
+        table.insert(name="IRTestType0")
+
+        rows = [{"name": "IRTestType%s" % i} for i in xrange(3)]
+        errors = {}
+        ids = s3db.insert_rows(table, rows, errors=errors)
+        self.assertEqual(ids[0], None)
+        self.assertEqual(errors.keys(), [0])
+        for row, record_id in zip(rows[1:], ids[1:]):
+            record = db(table.id == record_id).select(table.name,
+                                                      limitby=(0, 1)).first()
+            self.assertEqual(record.name, row["name"])
+
+        query = (table.name.like("IRTestType%"))
+        self.assertEqual(db(query).count(), 3)
+
+    # -------------------------------------------------------------------------
+    def tearDown(self):
+
+        current.db.rollback()
+
 # =============================================================================
 def run_suite(*test_classes):
     """ Run the test suite """
@@ -30,6 +82,7 @@ if __name__ == "__main__":
 
     run_suite(
         S3ModelTests,
+        InsertRowsTests,
     )
 
 # END ========================================================================
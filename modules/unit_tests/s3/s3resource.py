@@ -7,6 +7,7 @@
 #
 import unittest
 import datetime
+from cStringIO import StringIO
 from lxml import etree
 from gluon import *
 from gluon.storage import Storage
@@ -1590,6 +1591,78 @@ class ResourceDataAccessTests(unittest.TestCase):
         resource.add_filter(query)
         self.assertEqual(resource.count(), 1)
 
+    # -------------------------------------------------------------------------
+    def testIterSelect(self):
+        """ Test paged extraction with iterselect """
+
+        s3db = current.s3db
+
+        otable = s3db.org_organisation
+        for i in xrange(5):
+            otable.insert(name="ISTestOrg%s" % i)
+        names = ["ISTestOrg%s" % i for i in xrange(5)]
+        query = (S3FieldSelector("name").like("ISTestOrg%"))
+        colname = "org_organisation.name"
+
+        # Paged by primary key, ID not in the result unless requested
+        resource = s3db.resource("org_organisation", filter=query)
+        pages = list(resource.iterselect(["name"], pagesize=2))
+        self.assertEqual(len(pages), 3)
+        self.assertEqual([len(page["rows"]) for page in pages], [2, 2, 1])
+        rows = [row for page in pages for row in page["rows"]]
+        self.assertEqual([row[colname] for row in rows], names)
+        self.assertFalse("org_organisation.id" in rows[0])
+        rfields = pages[0]["rfields"]
+        self.assertEqual([rfield.colname for rfield in rfields], [colname])
+
+        # Resource filter is not changed by paging
+        self.assertEqual(resource.count(), 5)
+
+        # Paged by offset
+        pages = resource.iterselect(["id", "name"],
+                                    pagesize=2,
+                                    orderby=~otable.name)
+        rows = [row for page in pages for row in page["rows"]]
+        self.assertEqual([row[colname] for row in rows],
+                         list(reversed(names)))
+        self.assertTrue("org_organisation.id" in rows[0])
+
+        # As rows, page size equals number of records
+        pages = list(resource.iterselect(["name"], pagesize=5, as_rows=True))
+        self.assertEqual(len(pages), 2)
+        self.assertEqual(len(pages[0]), 5)
+        self.assertEqual(len(pages[1]), 0)
+
+    # -------------------------------------------------------------------------
+    def testAggregate(self):
+        """ Test grouped aggregation in the database """
+
+        s3db = current.s3db
+
+        otable = s3db.org_organisation
+        ftable = s3db.org_office
+        org1 = otable.insert(name="AGTestOrg1")
+        org2 = otable.insert(name="AGTestOrg2")
+        ftable.insert(name="AGTestOffice1", organisation_id=org2)
+        ftable.insert(name="AGTestOffice2", organisation_id=org1)
+        ftable.insert(name="AGTestOffice3", organisation_id=org2)
+        query = (S3FieldSelector("name").like("AGTestOffice%"))
+
+        # Grouped by a field in the referenced table, ordered by first record
+        resource = s3db.resource("org_office", filter=query)
+        result = resource.aggregate(["organisation_id$name"],
+                                    [("id", "count"),
+                                     ("name", "min"),
+                                     ("name", "max")])
+        self.assertEqual(result,
+                         [("AGTestOrg2", 2, "AGTestOffice1", "AGTestOffice3"),
+                          ("AGTestOrg1", 1, "AGTestOffice2", "AGTestOffice2")])
+
+        # Fields in components can not be aggregated in the database
+        resource = s3db.resource("org_organisation")
+        self.assertEqual(resource.aggregate(["office.name"],
+                                            [("id", "count")]), None)
+
     # -------------------------------------------------------------------------
     @classmethod
     def tearDownClass(cls):
@@ -2027,6 +2100,73 @@ class ResourceExportTests(unittest.TestCase):
             current.db.rollback()
             auth.override = False
 
+    # -------------------------------------------------------------------------
+    def testExportXMLStream(self):
+        """ Test incremental XML/JSON export produces the same output """
+
+        auth = current.auth
+        manager = current.manager
+        s3db = current.s3db
+
+        auth.override = True
+
+        xmlstr = """
+<s3xml>
+    <resource name="org_office_type" uuid="STRT1">
+        <data field="name">StreamExportType1</data>
+    </resource>
+    <resource name="org_organisation" uuid="STRO1">
+        <data field="name">StreamExportOrganisation1</data>
+        <resource name="org_office" uuid="STRF1">
+            <data field="name">StreamExportOffice1</data>
+            <reference field="office_type_id" resource="org_office_type" uuid="STRT1"/>
+        </resource>
+        <resource name="org_office" uuid="STRF2">
+            <data field="name">StreamExportOffice2</data>
+        </resource>
+    </resource>
+    <resource name="org_organisation" uuid="STRO2">
+        <data field="name">StreamExportOrganisation2</data>
+    </resource>
+    <resource name="org_organisation" uuid="STRO3">
+        <data field="name">StreamExportOrganisation3 &amp; &lt;Partners&gt;</data>
+        <resource name="org_office" uuid="STRF3">
+            <data field="name">StreamExportOffice3 äöü</data>
+            <reference field="office_type_id" resource="org_office_type" uuid="STRT1"/>
+        </resource>
+    </resource>
+</s3xml>"""
+
+        pagesize = manager.PAGESIZE
+        try:
+            xmltree = etree.ElementTree(etree.fromstring(xmlstr))
+            resource = s3db.resource("org_organisation")
+            resource.import_xml(xmltree)
+
+            # Multiple pages
+            manager.PAGESIZE = 2
+
+            uids = ["STRO1", "STRO2", "STRO3"]
+            for as_json in (False, True):
+                for pretty_print in (False, True):
+                    resource = s3db.resource("org_organisation", uid=uids)
+                    expected = resource.export_xml(mcomponents=["org_office"],
+                                                   as_json=as_json,
+                                                   pretty_print=pretty_print)
+
+                    resource = s3db.resource("org_organisation", uid=uids)
+                    stream = StringIO()
+                    output = resource.export_xml(mcomponents=["org_office"],
+                                                 as_json=as_json,
+                                                 pretty_print=pretty_print,
+                                                 stream=stream)
+                    self.assertTrue(output is stream)
+                    self.assertEqual(stream.getvalue(), expected)
+        finally:
+            manager.PAGESIZE = pagesize
+            current.db.rollback()
+            auth.override = False
+
 # =============================================================================
 class ResourceImportTests(unittest.TestCase):
     """ Test XML imports into resources """
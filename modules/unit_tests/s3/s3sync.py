@@ -438,6 +438,404 @@ class ImportMergeWithoutExistingRecords(unittest.TestCase):
         current.auth.override = False
         current.db.rollback()
 
+# =============================================================================
+class PaginatedExportTests(unittest.TestCase):
+    """ Test keyset pagination of sync exports """
+
+    def setUp(self):
+
+        current.auth.override = True
+
+        xmlstr = """<s3xml>%s</s3xml>""" % "".join(
+                    ["""<resource name="org_organisation" uuid="TESTSYNCPAGEORG%s">
+<data field="name">TestSyncPageOrg%s</data>
+</resource>""" % (i, i) for i in xrange(5)])
+
+        xmltree = etree.ElementTree(etree.fromstring(xmlstr))
+        resource = current.s3db.resource("org_organisation")
+        resource.import_xml(xmltree)
+
+    def testPaginatedExport(self):
+        """ Test that paged exports deliver each record exactly once """
+
+        from s3.s3sync import S3Sync
+
+        s3db = current.s3db
+        table = s3db.org_organisation
+        uids = ["TESTSYNCPAGEORG%s" % i for i in xrange(5)]
+
+        exported = []
+        cursor = True
+        pages = 0
+        while cursor:
+            resource = s3db.resource("org_organisation", uid=uids)
+            tree = resource.export_xml(limit=2,
+                                       cursor=cursor,
+                                       dereference=False,
+                                       as_tree=True)
+            for element in tree.getroot().findall("resource"):
+                exported.append(element.get("uuid"))
+            pages += 1
+
+            # Transmit the cursor as the peer would
+            string = S3Sync.encode_cursor(resource.cursor)
+            if string:
+                cursor = S3Sync.decode_cursor(string)
+                self.assertEqual(cursor, resource.cursor)
+            else:
+                cursor = None
+
+        self.assertEqual(pages, 3)
+        self.assertEqual(sorted(exported), sorted(uids))
+
+    def testDecodeCursor(self):
+        """ Test decoding of invalid or empty cursors """
+
+        from s3.s3sync import S3Sync
+
+        self.assertEqual(S3Sync.decode_cursor(""), True)
+        self.assertEqual(S3Sync.decode_cursor("invalid"), True)
+
+    def tearDown(self):
+
+        current.auth.override = False
+        current.db.rollback()
+
+# =============================================================================
+class SyncTransportTests(unittest.TestCase):
+    """ Test compression and conditional requests for sync transport """
+
+    def testAcceptsEncoding(self):
+        """ Test parsing of Accept-Encoding headers """
+
+        from s3.s3sync import S3Sync
+        accepts = S3Sync.accepts_encoding
+
+        self.assertTrue(accepts("gzip"))
+        self.assertTrue(accepts("deflate, gzip;q=0.5"))
+        self.assertTrue(accepts("*"))
+        self.assertFalse(accepts(None))
+        self.assertFalse(accepts("deflate"))
+        self.assertFalse(accepts("gzip;q=0"))
+        self.assertFalse(accepts("*, gzip;q=0"))
+
+    def testCompression(self):
+        """ Test compression and decompression of message bodies """
+
+        import zlib
+        from s3.s3sync import S3Sync
+
+        data = "<s3xml>%s</s3xml>" % ("<resource/>" * 100)
+
+        compressed = S3Sync.compress(data)
+        self.assertTrue(len(compressed) < len(data))
+        self.assertEqual(S3Sync.decompress(compressed, "gzip"), data)
+
+        self.assertEqual(S3Sync.decompress(zlib.compress(data), "deflate"),
+                         data)
+        self.assertEqual(S3Sync.decompress(data, None), data)
+        self.assertRaises(ValueError, S3Sync.decompress, data, "br")
+
+    def testHTTPDate(self):
+        """ Test formatting and parsing of HTTP dates """
+
+        import datetime
+        from s3.s3sync import S3Sync
+
+        dt = datetime.datetime(2013, 5, 17, 14, 30, 12)
+        value = S3Sync.http_date(dt)
+        self.assertEqual(value, "Fri, 17 May 2013 14:30:12 GMT")
+        self.assertEqual(S3Sync.parse_http_date(value), dt)
+        self.assertEqual(S3Sync.parse_http_date("invalid"), None)
+
+    def testChanged(self):
+        """ Test detection of changes since a date """
+
+        import datetime
+        from s3.s3sync import S3Sync
+
+        current.auth.override = True
+        try:
+            s3db = current.s3db
+            resource = s3db.resource("org_organisation")
+            resource.import_xml(etree.ElementTree(etree.fromstring(
+                """<s3xml><resource name="org_organisation" uuid="TESTSYNCCHANGEDORG">
+<data field="name">TestSyncChangedOrg</data>
+</resource></s3xml>""")))
+
+            table = s3db.org_organisation
+            row = current.db(table.uuid == "TESTSYNCCHANGEDORG") \
+                         .select(table.modified_on, limitby=(0, 1)).first()
+            mtime = row.modified_on
+
+            resource = s3db.resource("org_organisation",
+                                     uid="TESTSYNCCHANGEDORG")
+            one_second = datetime.timedelta(seconds=1)
+            self.assertTrue(S3Sync.changed(resource, mtime - one_second))
+            self.assertFalse(S3Sync.changed(resource, mtime + one_second))
+        finally:
+            current.auth.override = False
+            current.db.rollback()
+
+# =============================================================================
+class SyncTaskSchedulingTests(unittest.TestCase):
+    """ Test dependency ordering of sync tasks """
+
+    def testTaskGroups(self):
+        """ Test grouping of tasks by foreign key dependencies """
+
+        from gluon.storage import Storage
+        from s3.s3sync import S3Sync
+
+        tasks = [Storage(id=1, resource_name="org_office"),
+                 Storage(id=2, resource_name="org_organisation"),
+                 Storage(id=3, resource_name="gis_location"),
+                 Storage(id=4, resource_name="org_organisation")]
+
+        groups = S3Sync.task_groups(tasks)
+        position = {}
+        for index, group in enumerate(groups):
+            names = [task.resource_name for task in group]
+            # No two tasks for the same resource in the same group
+            self.assertEqual(len(names), len(set(names)))
+            for task in group:
+                position[task.id] = index
+
+        self.assertEqual(sorted(position.keys()), [1, 2, 3, 4])
+        # Offices reference organisations and locations
+        self.assertTrue(position[1] > position[2])
+        self.assertTrue(position[1] > position[4])
+        self.assertTrue(position[1] > position[3])
+        # Independent resources are grouped together
+        self.assertEqual(position[2], position[3])
+
+    def testMaxWorkers(self):
+        """ Test tasks run sequentially unless enough workers are active """
+
+        from s3.s3sync import S3Sync
+
+        settings = current.deployment_settings
+        max_workers = settings.sync.get("max_workers")
+        try:
+            settings.sync.max_workers = 1
+            self.assertEqual(S3Sync.max_workers(), 1)
+
+            # No scheduler workers active
+            settings.sync.max_workers = 4
+            table = current.db.scheduler_worker
+            current.db(table.id > 0).delete()
+            self.assertEqual(S3Sync.max_workers(), 1)
+        finally:
+            if max_workers is None:
+                settings.sync.pop("max_workers", None)
+            else:
+                settings.sync.max_workers = max_workers
+            current.db.rollback()
+
+# =============================================================================
+class SyncReconciliationTests(unittest.TestCase):
+    """ Test checksum-based reconciliation between two local databases """
+
+    def setUp(self):
+
+        import datetime
+        from gluon.dal import DAL, Field
+
+        now = datetime.datetime(2013, 6, 1, 12, 0, 0)
+        self.now = now
+
+        # Two local databases with the same 2000 records
+        dbs = []
+        for i in xrange(2):
+            db = DAL("sqlite:memory")
+            db.define_table("sync_item",
+                            Field("uuid"),
+                            Field("modified_on", "datetime"))
+            for j in xrange(2000):
+                db.sync_item.insert(uuid="urn:uuid:test-item-%04d" % j,
+                                    modified_on=now)
+            dbs.append(db)
+        self.dbs = dbs
+
+    def checksum(self, db):
+        """ Helper to compute the checksums for a database """
+
+        from s3.s3sync import S3SyncChecksum
+
+        rows = db(db.sync_item.id > 0).select(db.sync_item.uuid,
+                                              db.sync_item.modified_on)
+        return S3SyncChecksum((row.uuid, row.modified_on) for row in rows)
+
+    def testIdentical(self):
+        """ Test that identical databases have no differing buckets """
+
+        from s3.s3sync import S3SyncChecksum
+
+        local, remote = [self.checksum(db) for db in self.dbs]
+        self.assertEqual(S3SyncChecksum.diff(local, remote.checksums), [])
+
+    def testReconcile(self):
+        """ Test that only the differing buckets need to be transferred """
+
+        import datetime
+        from s3.s3sync import S3SyncChecksum
+
+        local_db, remote_db = self.dbs
+        table = remote_db.sync_item
+
+        # Modify some remote records without advancing modified_on
+        # beyond the local records (as with clock skew), add and remove some
+        changed = set()
+        earlier = self.now - datetime.timedelta(days=1)
+        for j in (3, 511, 1999):
+            uid = "urn:uuid:test-item-%04d" % j
+            remote_db(table.uuid == uid).update(modified_on=earlier)
+            changed.add(uid)
+        for j in (2000, 2001):
+            uid = "urn:uuid:test-item-%04d" % j
+            table.insert(uuid=uid, modified_on=self.now)
+            changed.add(uid)
+        uid = "urn:uuid:test-item-0042"
+        remote_db(table.uuid == uid).delete()
+        changed.add(uid)
+
+        local, remote = self.checksum(local_db), self.checksum(remote_db)
+
+        requests = []
+        def remote_checksums(prefixes):
+            requests.append(prefixes)
+            return remote.checksums(prefixes)
+
+        buckets = S3SyncChecksum.diff(local, remote_checksums)
+        self.assertTrue(len(buckets) > 0)
+        self.assertTrue(len(requests) > 1)
+
+        # All differences are in the differing buckets
+        differing = set(local.uids(buckets)) | set(remote.uids(buckets))
+        self.assertTrue(changed <= differing)
+
+        # ...which are only a small part of the table
+        self.assertTrue(len(differing) < 200)
+
+        # Transfer the differing records (remote wins)
+        ltable = local_db.sync_item
+        for uid in differing:
+            row = remote_db(table.uuid == uid).select(table.modified_on,
+                                                      limitby=(0, 1)).first()
+            local_db(ltable.uuid == uid).delete()
+            if row:
+                ltable.insert(uuid=uid, modified_on=row.modified_on)
+
+        # Now both databases are in sync
+        local = self.checksum(local_db)
+        self.assertEqual(S3SyncChecksum.diff(local, remote.checksums), [])
+
+    def tearDown(self):
+
+        self.dbs = None
+
+# =============================================================================
+class SyncReconciliationExportTests(unittest.TestCase):
+    """ Test the transfer of differing buckets through S3XML """
+
+    def setUp(self):
+
+        import datetime
+
+        current.auth.override = True
+
+        uids = ["TESTSYNCRECORG%03d" % i for i in xrange(200)]
+        xmlstr = """<s3xml>%s</s3xml>""" % "".join(
+                    ["""<resource name="org_organisation" uuid="%s">
+<data field="name">TestSyncRecOrg%03d</data>
+</resource>""" % (uid, i) for i, uid in enumerate(uids)])
+
+        xmltree = etree.ElementTree(etree.fromstring(xmlstr))
+        resource = current.s3db.resource("org_organisation")
+        resource.import_xml(xmltree)
+        self.assertEqual(resource.error, None)
+
+        # Same modification date for all records
+        now = datetime.datetime(2013, 6, 1, 12, 0, 0)
+        table = resource.table
+        current.db(table.uuid.belongs(uids)).update(modified_on=now)
+
+        self.uids = uids
+        self.now = now
+
+    def testReconcileExport(self):
+        """ Test that the differing buckets are moved by export/import """
+
+        import datetime
+        from s3.s3sync import S3SyncChecksum
+
+        db = current.db
+        s3db = current.s3db
+        table = s3db.org_organisation
+        uids = self.uids
+        export_uid = current.xml.export_uid
+
+        # Current state = remote state: checksums and full S3XML export
+        resource = s3db.resource("org_organisation",
+                                 uid=uids, include_deleted=True)
+        remote = S3SyncChecksum.from_resource(resource)
+        tree = resource.export_xml(dereference=False, as_tree=True)
+        elements = dict((element.get("uuid"), element)
+                        for element in tree.getroot().findall("resource"))
+        self.assertEqual(len(elements), len(uids))
+
+        # Turn it into the local state: records changed later than the
+        # remote (clock skew) and records missing locally (restored backup)
+        changed = {}
+        later = self.now + datetime.timedelta(hours=1)
+        for i in (7, 99):
+            uid = uids[i]
+            db(table.uuid == uid).update(name="TestSyncRecOutdated%s" % i,
+                                         modified_on=later)
+            changed[uid] = "TestSyncRecOrg%03d" % i
+        for i in (150, 151):
+            uid = uids[i]
+            db(table.uuid == uid).delete()
+            changed[uid] = "TestSyncRecOrg%03d" % i
+
+        resource = s3db.resource("org_organisation",
+                                 uid=uids, include_deleted=True)
+        local = S3SyncChecksum.from_resource(resource)
+
+        # Find the differing buckets
+        buckets = S3SyncChecksum.diff(local, remote.checksums)
+        self.assertTrue(len(buckets) > 0)
+
+        # The remote exports only the records in these buckets
+        exported = remote.uids(buckets)
+        for uid in changed:
+            self.assertTrue(export_uid(uid) in exported)
+        self.assertTrue(len(exported) < len(uids))
+        root = etree.Element("s3xml")
+        for uid in exported:
+            root.append(elements[uid])
+
+        # Import them (remote wins)
+        resource = s3db.resource("org_organisation")
+        resource.import_xml(etree.ElementTree(root))
+        self.assertEqual(resource.error, None)
+
+        # Now both sides are in sync
+        resource = s3db.resource("org_organisation",
+                                 uid=uids, include_deleted=True)
+        local = S3SyncChecksum.from_resource(resource)
+        self.assertEqual(S3SyncChecksum.diff(local, remote.checksums), [])
+        rows = db(table.uuid.belongs(changed.keys())).select(table.uuid,
+                                                              table.name)
+        self.assertEqual(len(rows), len(changed))
+        for row in rows:
+            self.assertEqual(row.name, changed[row.uuid])
+
+    def tearDown(self):
+
+        current.auth.override = False
+        current.db.rollback()
+
 # =============================================================================
 def run_suite(*test_classes):
     """ Run the test suite """
@@ -459,7 +857,12 @@ if __name__ == "__main__":
         ImportMergeWithExistingRecords,
         ImportMergeWithExistingOriginal,
         ImportMergeWithExistingDuplicate,
-        ImportMergeWithoutExistingRecords
+        ImportMergeWithoutExistingRecords,
+        PaginatedExportTests,
+        SyncTransportTests,
+        SyncTaskSchedulingTests,
+        SyncReconciliationTests,
+        SyncReconciliationExportTests,
     )
 
 # END ========================================================================
@@ -0,0 +1,119 @@
+# -*- coding: utf-8 -*-
+#
+# S3TimePlot Unit Tests
+#
+# To run this script use:
+# python web2py.py -S eden -M -R applications/eden/modules/unit_tests/s3/s3timeplot.py
+#
+import unittest
+import datetime
+from calendar import timegm
+
+from gluon import *
+from gluon.storage import Storage
+
+from s3.s3timeplot import S3TimePlot
+
+# =============================================================================
+class S3TimePlotSeriesTests(unittest.TestCase):
+    """ Tests for the server-side aggregation of time plot series """
+
+    # -------------------------------------------------------------------------
+    def setUp(self):
+
+        dt = datetime.datetime
+        self.rows = [Storage(id=1,
+                             start=dt(2013, 1, 1, 10, 0),
+                             end=dt(2013, 1, 3, 9, 0)),
+                     # No end date: active until now
+                     Storage(id=2,
+                             start=dt(2013, 1, 1, 15, 0),
+                             end=None),
+                     # Starting and ending in the same interval
+                     Storage(id=3,
+                             start=dt(2013, 1, 2, 8, 0),
+                             end=dt(2013, 1, 2, 20, 0)),
+                     # No start date: active from the beginning
+                     Storage(id=4,
+                             start=None,
+                             end=None),
+                     ]
+
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def timestamp(*args):
+        """ Get the series timestamp for a date """
+
+        return timegm(datetime.datetime(*args).utctimetuple()) * 1000
+
+    # -------------------------------------------------------------------------
+    def testSlot(self):
+        """ Test the start of the interval for a date/time """
+
+        dt = datetime.datetime
+        slot = S3TimePlot.slot
+        value = dt(2013, 1, 3, 9, 45, 12)
+
+        self.assertEqual(slot(value, "hours"), dt(2013, 1, 3, 9, 0))
+        self.assertEqual(slot(value, "days"), dt(2013, 1, 3))
+        self.assertEqual(slot(value, "weeks"), dt(2012, 12, 31))
+        self.assertEqual(slot(value, "months"), dt(2013, 1, 1))
+        self.assertEqual(slot(value, "years"), dt(2013, 1, 1))
+
+        # Dates
+        self.assertEqual(slot(datetime.date(2013, 1, 3), "days"),
+                         dt(2013, 1, 3))
+
+        # No date
+        self.assertEqual(slot(None, "days"), None)
+
+    # -------------------------------------------------------------------------
+    def testSeries(self):
+        """ Test the number of active records per interval """
+
+        timestamp = self.timestamp
+        series = S3TimePlot.series(self.rows, "id", "start", "end", "days")
+
+        # Record 4 (no start date) is counted in all intervals
+        self.assertEqual(series, [[timestamp(2013, 1, 1), 3],
+                                  [timestamp(2013, 1, 2), 3],
+                                  [timestamp(2013, 1, 3), 2],
+                                  ])
+
+        # Without end date
+        series = S3TimePlot.series(self.rows, "id", "start", None, "days")
+        self.assertEqual(series, [[timestamp(2013, 1, 1), 3],
+                                  [timestamp(2013, 1, 2), 4],
+                                  ])
+
+    # -------------------------------------------------------------------------
+    def testSeriesWithoutStart(self):
+        """ Test series of records without start date """
+
+        rows = [row for row in self.rows if not row.start]
+        series = S3TimePlot.series(rows, "id", "start", "end", "days")
+        self.assertEqual(series, [[0, 1]])
+
+        series = S3TimePlot.series([], "id", "start", "end", "days")
+        self.assertEqual(series, [])
+
+# =============================================================================
+def run_suite(*test_classes):
+    """ Run the test suite """
+
+    loader = unittest.TestLoader()
+    suite = unittest.TestSuite()
+    for test_class in test_classes:
+        tests = loader.loadTestsFromTestCase(test_class)
+        suite.addTests(tests)
+    if suite is not None:
+        unittest.TextTestRunner(verbosity=2).run(suite)
+    return
+
+if __name__ == "__main__":
+
+    run_suite(
+        S3TimePlotSeriesTests,
+    )
+
+# END ========================================================================
@@ -5,6 +5,9 @@
 # To run this script use:
 # python web2py.py -S eden -M -R applications/eden/tests/unit_tests/modules/s3/s3xml.py
 #
+import os
+import shutil
+import tempfile
 import unittest
 from gluon import *
 from gluon.contrib import simplejson as json
@@ -16,7 +19,7 @@ except:
 
 from lxml import etree
 
-from s3.s3xml import S3XMLFormat
+from s3.s3xml import S3XMLFormat, S3XSLTCache, xslt_cache
 
 # =============================================================================
 class S3TreeBuilderTests(unittest.TestCase):
@@ -263,6 +266,133 @@ class S3XMLFormatTests(unittest.TestCase):
         self.assertEqual(len(root), 0)
         self.assertEqual(root.text, "Test")
 
+# =============================================================================
+class S3XSLTCacheTests(unittest.TestCase):
+    """ Test the cache for compiled XSLT stylesheets """
+
+    # -------------------------------------------------------------------------
+    def setUp(self):
+
+        self.folder = tempfile.mkdtemp()
+
+        self.include = os.path.join(self.folder, "include.xsl")
+        self.write(self.include, """<?xml version="1.0"?>
+<xsl:stylesheet
+    xmlns:xsl="http://www.w3.org/1999/XSL/Transform" version="1.0">
+    <xsl:template name="text">Test</xsl:template>
+</xsl:stylesheet>""")
+
+        self.path = os.path.join(self.folder, "export.xsl")
+        self.write(self.path, """<?xml version="1.0"?>
+<xsl:stylesheet
+    xmlns:xsl="http://www.w3.org/1999/XSL/Transform" version="1.0"
+    xmlns:s3="http://eden.sahanafoundation.org/wiki/S3">
+
+    <xsl:output method="xml"/>
+    <xsl:include href="include.xsl"/>
+
+    <s3:fields tables="ANY" select="location_id,site_id"/>
+
+    <xsl:template match="/">
+        <test><xsl:call-template name="text"/></test>
+    </xsl:template>
+</xsl:stylesheet>""")
+
+        self.tree = etree.ElementTree(etree.fromstring("<s3xml/>"))
+
+    def tearDown(self):
+
+        shutil.rmtree(self.folder)
+
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def write(path, contents):
+
+        f = open(path, "w")
+        f.write(contents)
+        f.close()
+
+    # -------------------------------------------------------------------------
+    def testCacheEntry(self):
+        """ Test compiled stylesheets are cached and re-used """
+
+        cache = S3XSLTCache()
+
+        entry = cache.get(self.path)
+        self.assertTrue(entry.transformer is not None)
+        self.assertTrue(self.include in entry.mtimes)
+
+        result = entry.transformer(self.tree)
+        self.assertEqual(result.getroot().text, "Test")
+
+        self.assertTrue(cache.get(self.path) is entry)
+
+        stats = cache.stats()
+        self.assertEqual(stats["size"], 1)
+        self.assertEqual(stats["hits"], 1)
+        self.assertEqual(stats["misses"], 1)
+        self.assertEqual(stats["saved_time"], entry.duration)
+
+    # -------------------------------------------------------------------------
+    def testInvalidation(self):
+        """ Test modified stylesheets (incl. includes) get re-compiled """
+
+        cache = S3XSLTCache()
+
+        entry = cache.get(self.path)
+
+        # Modify the included stylesheet
+        mtime = entry.mtimes[self.include]
+        os.utime(self.include, (mtime + 10, mtime + 10))
+
+        self.assertFalse(cache.get(self.path) is entry)
+
+        stats = cache.stats()
+        self.assertEqual(stats["size"], 1)
+        self.assertEqual(stats["hits"], 0)
+        self.assertEqual(stats["misses"], 2)
+        self.assertEqual(stats["invalidations"], 1)
+
+    # -------------------------------------------------------------------------
+    def testInvalidStylesheet(self):
+        """ Test stylesheets which can't be compiled are not cached """
+
+        self.write(self.path, "<xsl:stylesheet/>")
+
+        cache = S3XSLTCache()
+        self.assertRaises(etree.LxmlError, cache.get, self.path)
+        self.assertEqual(cache.stats()["size"], 0)
+
+        xml = current.xml
+        self.assertEqual(xml.transform(self.tree, self.path), None)
+        self.assertNotEqual(xml.error, None)
+
+    # -------------------------------------------------------------------------
+    def testXMLFormat(self):
+        """ Test S3XMLFormat uses the cached stylesheet and field maps """
+
+        xslt_cache.reset_stats()
+
+        xmlformat = S3XMLFormat(self.path)
+        include, exclude = xmlformat.get_fields("org_office")
+        self.assertEqual(set(include), set(["location_id", "site_id"]))
+        self.assertEqual(exclude, [])
+        self.assertFalse(xmlformat.streaming)
+
+        xmlformat = S3XMLFormat(self.path)
+        self.assertTrue(xmlformat.tree is xslt_cache.get(self.path).tree)
+        self.assertTrue("org_office" in xmlformat.info["fields"])
+        self.assertEqual(xmlformat.get_fields("org_office"), (include, exclude))
+
+        result = xmlformat.transform(self.tree)
+        self.assertEqual(result.getroot().text, "Test")
+
+        stats = xslt_cache.stats()
+        self.assertEqual(stats["misses"], 1)
+        self.assertEqual(stats["hits"], 2)
+
+        xslt_cache.clear()
+
 # =============================================================================
 def run_suite(*test_classes):
     """ Run the test suite """
@@ -282,6 +412,7 @@ if __name__ == "__main__":
         S3TreeBuilderTests,
         S3JSONMessageTests,
         S3XMLFormatTests,
+        S3XSLTCacheTests,
     )
 
 # END ========================================================================
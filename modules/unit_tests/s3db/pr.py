@@ -144,6 +144,150 @@ class PRTests(unittest.TestCase):
         current.db.rollback()
         current.auth.override = False
 
+# =============================================================================
+class MaterialisedAncestorTests(unittest.TestCase):
+    """ Tests for materialised OU ancestors (pr_ancestor) """
+
+    # -------------------------------------------------------------------------
+    def setUp(self):
+        """ Set up organisation records """
+
+        s3db = current.s3db
+
+        current.auth.override = True
+
+        otable = s3db.org_organisation
+        orgs = []
+        org_ids = []
+        for i in xrange(4):
+            org = Storage(name="Test Ancestor Organisation %s" % i)
+            org_id = otable.insert(**org)
+            org.update(id=org_id)
+            s3db.update_super(otable, org)
+            orgs.append(s3db.pr_get_pe_id("org_organisation", org_id))
+            org_ids.append(org_id)
+        self.orgs = orgs
+        self.org_ids = org_ids
+
+        # Make sure the ancestors are materialised
+        s3db.pr_rebuild_ancestors()
+
+    # -------------------------------------------------------------------------
+    def testAncestorsAndDescendants(self):
+        """ Test that ancestors/descendants follow affiliation changes """
+
+        s3db = current.s3db
+        org0, org1, org2, org3 = self.orgs
+
+        # org0 => org1 => org2, org0 => org3
+        s3db.pr_add_affiliation(org0, org1, role="TestOrgUnit")
+        s3db.pr_add_affiliation(org1, org2, role="TestOrgUnit")
+        s3db.pr_add_affiliation(org0, org3, role="TestOrgUnit")
+
+        ancestors = s3db.pr_get_ancestors(org2)
+        self.assertEqual(set(ancestors), set([str(org0), str(org1)]))
+
+        descendants = s3db.pr_descendants([org0, org1])
+        self.assertEqual(set(descendants[org0]), set([org1, org2, org3]))
+        self.assertEqual(descendants[org1], [org2])
+        self.assertFalse(org2 in descendants)
+
+        # Move org1 (with org2) under org3
+        s3db.pr_remove_affiliation(org0, org1, role="TestOrgUnit")
+        s3db.pr_add_affiliation(org3, org1, role="TestOrgUnit")
+
+        ancestors = s3db.pr_get_ancestors(org2)
+        self.assertEqual(set(ancestors),
+                         set([str(org0), str(org1), str(org3)]))
+
+        descendants = s3db.pr_descendants([org3])
+        self.assertEqual(set(descendants[org3]), set([org1, org2]))
+
+        # Non-OU roles do not count
+        s3db.pr_add_affiliation(org2, org0, role="TestPartner", role_type=9)
+        ancestors = s3db.pr_get_ancestors(org0)
+        self.assertEqual(ancestors, [])
+
+    # -------------------------------------------------------------------------
+    def testRebuild(self):
+        """ Test that a rebuild gives the same result as updates """
+
+        db = current.db
+        s3db = current.s3db
+        org0, org1, org2, org3 = self.orgs
+
+        s3db.pr_add_affiliation(org0, org1, role="TestOrgUnit")
+        s3db.pr_add_affiliation(org1, org2, role="TestOrgUnit")
+
+        ctable = s3db.pr_ancestor
+        query = (ctable.pe_id.belongs([org0, org1, org2]))
+        fields = [ctable.pe_id, ctable.ancestor_id]
+        before = set((row.pe_id, row.ancestor_id)
+                     for row in db(query).select(*fields))
+
+        s3db.pr_rebuild_ancestors()
+        after = set((row.pe_id, row.ancestor_id)
+                    for row in db(query).select(*fields))
+
+        self.assertEqual(before, after)
+        self.assertTrue((org2, org0) in after)
+
+        # All entities are materialised after a rebuild
+        query = (ctable.pe_id == org3)
+        rows = db(query).select(*fields)
+        self.assertEqual([(row.pe_id, row.ancestor_id) for row in rows],
+                         [(org3, org3)])
+
+    # -------------------------------------------------------------------------
+    def testNotMaterialised(self):
+        """ Test lookups before the ancestors have been materialised """
+
+        db = current.db
+        s3db = current.s3db
+        org0, org1, org2, org3 = self.orgs
+
+        ctable = s3db.pr_ancestor
+        db(ctable.id > 0).delete()
+
+        s3db.pr_add_affiliation(org0, org1, role="TestOrgUnit")
+        s3db.pr_add_affiliation(org1, org2, role="TestOrgUnit")
+
+        ancestors = s3db.pr_get_ancestors(org2)
+        self.assertEqual(set(ancestors), set([str(org0), str(org1)]))
+
+        descendants = s3db.pr_descendants([org0])
+        self.assertEqual(set(descendants[org0]), set([org1, org2]))
+
+        # Not rebuilt within the request
+        self.assertTrue(db(ctable.id > 0).isempty())
+
+    # -------------------------------------------------------------------------
+    def testDeleteEntity(self):
+        """ Test that the ancestors of deleted entities are removed """
+
+        db = current.db
+        s3db = current.s3db
+        org0, org1, org2, org3 = self.orgs
+
+        s3db.pr_add_affiliation(org0, org1, role="TestOrgUnit")
+        s3db.pr_add_affiliation(org1, org2, role="TestOrgUnit")
+
+        resource = s3db.resource("org_organisation", id=self.org_ids[1])
+        resource.delete()
+
+        ctable = s3db.pr_ancestor
+        query = (ctable.pe_id == org1) | (ctable.ancestor_id == org1)
+        self.assertTrue(db(query).isempty())
+
+        ancestors = s3db.pr_get_ancestors(org2)
+        self.assertEqual(ancestors, [])
+
+    # -------------------------------------------------------------------------
+    def tearDown(self):
+
+        current.db.rollback()
+        current.auth.override = False
+
 # =============================================================================
 class PersonDeduplicateTests(unittest.TestCase):
     """ PR Tests """
@@ -513,6 +657,7 @@ if __name__ == "__main__":
 
     run_suite(
         PRTests,
+        MaterialisedAncestorTests,
         PersonDeduplicateTests,
         SavedSearchTests,
     )
@@ -45,6 +45,8 @@ settings.base.template = "default"
 #settings.database.pool_size = 30
 # Do we have a spatial DB available? (currently supports PostGIS. Spatialite to come.)
 #settings.gis.spatialdb = True
+# Otherwise, uncomment to use a spatial index of the locations (kept in the cache folder)
+#settings.gis.spatial_index = True
 
 # Base settings
 #settings.base.system_name = T("Sahana Eden Humanitarian Management Platform")
@@ -123,6 +125,16 @@ settings.frontpage.rss = [
 # Enable session store in Memcache to allow sharing of sessions across instances
 #settings.base.session_memcache = '127.0.0.1:11211'
 
+# Cache to share object hierarchies between requests: "ram" (per process, default),
+# "disk" (shared between processes), "memcache" (shared between instances) or False
+#settings.base.hierarchy_cache = "disk"
+
+# Number of field representations (e.g. of organisations, locations or persons)
+# to share between requests in each process (0 to disable), and how long they
+# remain valid (in seconds)
+#settings.base.represent_cache_size = 10000
+#settings.base.represent_cache_ttl = 300
+
 # Instance Name - for management scripts
 #settings.base.instance_name = "test"
 
@@ -401,6 +401,7 @@ settings.ui.customize_cms_post = customize_cms_post
 def org_office_marker_fn(record):
     """
         Function to decide which Marker to use for Offices
+        - returns the Marker name, GIS.get_markers() looks them up in bulk
         @ToDo: Legend
         @ToDo: Use Symbology
     """
@@ -409,7 +410,7 @@ def org_office_marker_fn(record):
     otable = db.org_organisation
     organisation = db(otable.id == record.organisation_id).select(otable.name,
                                                                   limitby=(0, 1)).first()
-    
+    marker = None
     if organisation:
         name = organisation.name
         if name == "City National Bank":
@@ -422,16 +423,6 @@ def org_office_marker_fn(record):
             name = name.replace(" ", "")
         marker = name
 
-    mtable = db.gis_marker
-    try:
-        marker = db(mtable.name == marker).select(mtable.image,
-                                                  mtable.height,
-                                                  mtable.width,
-                                                  cache=current.s3db.cache,
-                                                  limitby=(0, 1)
-                                                  ).first()
-    except:
-        marker = None
     return marker
 
 # -----------------------------------------------------------------------------
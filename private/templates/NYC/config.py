@@ -203,12 +203,12 @@ settings.org.site_address_autocomplete = True
 def facility_marker_fn(record):
     """
         Function to decide which Marker to use for Facilities Map
+        - returns the Marker name, GIS.get_markers() looks them up in bulk
         @ToDo: Legend
         @ToDo: Use Symbology
     """
 
     db = current.db
-    s3db = current.s3db
     table = db.org_facility_type
     ltable = db.org_site_facility_type
     query = (ltable.site_id == record.site_id) & \
@@ -245,21 +245,6 @@ def facility_marker_fn(record):
             # Low
             marker = "%s_green" % marker
 
-    mtable = db.gis_marker
-    try:
-        marker = db(mtable.name == marker).select(mtable.image,
-                                                  mtable.height,
-                                                  mtable.width,
-                                                  cache=s3db.cache,
-                                                  limitby=(0, 1)
-                                                  ).first()
-    except:
-        marker = db(mtable.name == "office").select(mtable.image,
-                                                    mtable.height,
-                                                    mtable.width,
-                                                    cache=s3db.cache,
-                                                    limitby=(0, 1)
-                                                    ).first()
     return marker
 
 def customize_org_facility(**attr):
@@ -66,6 +66,7 @@ settings.security.policy = 4 # Controller & Function ACLs
 def hospital_marker_fn(record):
     """
         Function to decide which Marker to use for Hospital Map
+        - returns the Marker name, GIS.get_markers() looks them up in bulk
         @ToDo: Legend
         @ToDo: Use Symbology
     """
@@ -89,12 +90,6 @@ def hospital_marker_fn(record):
             # Compromised
             marker = "%s_yellow" % marker
 
-    mtable = db.gis_marker
-    marker = db(mtable.name == marker).select(mtable.image,
-                                              mtable.height,
-                                              mtable.width,
-                                              cache=s3db.cache,
-                                              limitby=(0, 1)).first()
     return marker
 
 def customize_hms_hospital(**attr):
@@ -41,6 +41,18 @@ settings = current.deployment_settings
 # Enable Guided Tours
 settings.base.guided_tour = True
 
+# Write large XML/JSON exports incrementally into a temporary file
+# (rather than building them in memory)
+#settings.base.xml_export_stream = True
+
+# Share field representations (e.g. organisation, location and person
+# names) between requests in each process. Changes are visible at once
+# only in the process which made them, other processes (e.g. other
+# workers of a multi-process web server) may show outdated names until
+# the cached representations expire (represent_cache_ttl, in seconds)
+#settings.base.represent_cache_size = 10000
+#settings.base.represent_cache_ttl = 300
+
 # Authentication settings
 # These settings should be changed _after_ the 1st (admin) user is
 # registered in order to secure the deployment
@@ -198,6 +210,8 @@ settings.L10n.decimal_separator = "."
 #settings.gis.countries = ["US"]
 # Uncomment to pass Addresses imported from CSV to a Geocoder to try and automate Lat/Lon
 #settings.gis.geocode_imported_addresses = "google"
+# Uncomment to always produce the GeoJSON for Feature Layers with XSLT (e.g. for debugging the stylesheet)
+#settings.gis.geojson_native = False
 # Hide the Map-based selection tool in the Location Selector
 #settings.gis.map_selector = False
 # Hide LatLon boxes in the Location Selector
@@ -250,12 +264,18 @@ settings.L10n.decimal_separator = "."
 #settings.gis.scaleline = False
 # Uncomment to modify the Simplify Tolerance
 #settings.gis.simplify_tolerance = 0.001
+# Uncomment to change the tolerances at which simplified Polygons are precomputed
+# (or set to [] to simplify on every map request instead)
+#settings.gis.simplify_tiers = [0.01, 0.005, 0.00125, 0.000625, 0.0003125, 0.00015625]
 # Uncomment to hide the Zoom control
 #settings.gis.zoomcontrol = False
 
 # Messaging Settings
 # If you wish to use a parser.py in another folder than "default"
 #settings.msg.parser = "mytemplatefolder"
+# Uncomment to process update notifications in-process, in batches of
+# this number of subscriptions per task (instead of one request per subscription)
+#settings.msg.notify_batch = 500
 
 # Use 'soft' deletes
 #settings.security.archive_not_delete = False
@@ -614,6 +634,14 @@ settings.L10n.decimal_separator = "."
 # Uncomment this to use vehicles when responding to Incident Reports
 #settings.irs.vehicle = True
 
+# -----------------------------------------------------------------------------
+# Synchronization
+# Number of records per page in sync pulls (0 to pull everything at once)
+#settings.sync.pull_page_size = 500
+# Maximum number of sync tasks per repository to run concurrently
+# (in scheduler workers, tasks for independent resources only)
+#settings.sync.max_workers = 4
+
 # -----------------------------------------------------------------------------
 # Save Search Widget
 # New S3Filter
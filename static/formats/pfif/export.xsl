@@ -1,7 +1,9 @@
 <?xml version="1.0"?>
 <xsl:stylesheet
     xmlns:xsl="http://www.w3.org/1999/XSL/Transform" version="1.0"
-    xmlns:pfif="http://zesty.ca/pfif/1.2">
+    xmlns:pfif="http://zesty.ca/pfif/1.2"
+    xmlns:s3="http://eden.sahanafoundation.org/wiki/S3"
+    exclude-result-prefixes="s3">
 
     <!-- **********************************************************************
 
@@ -32,6 +34,8 @@
 
     *********************************************************************** -->
     <xsl:output method="xml"/>
+    <!-- Can be applied per chunk of records (incremental export) -->
+    <s3:streaming/>
     <xsl:include href="../xml/commons.xsl"/>
     <xsl:include href="../xml/countries.xsl"/>
 
@@ -103,7 +103,8 @@
                 old_selected = [];
             }
 
-            var nodes = this.tree.jstree('get_checked', null, true)
+            // Top-most checked nodes only (descendants are included server-side)
+            var nodes = this.tree.jstree('get_checked', null, false);
                 
             $(nodes).each(function() {
                 var id = $(this).attr('id');
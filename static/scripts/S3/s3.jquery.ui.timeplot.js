@@ -55,7 +55,14 @@
         _renderChart: function(data, method) {
 
             var el = this.element,
+                d;
+
+            if (data.series) {
+                // Series aggregated by the server
+                d = data.series;
+            } else {
                 d = this._aggregateSeries(data, method);
+            }
 
             var placeholder = $(el).find('.tp-chart').first()
             var chart = jQuery.plot(placeholder, [d], {
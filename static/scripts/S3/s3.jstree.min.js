@@ -221,6 +221,6 @@ s&&(a+=".jstree .jstree-wholerow a { display:block; height:18px; margin:0; paddi
 e)},this)):this.model_done(f.getChildren(),e)}},defaults:{object:!1,id_prefix:!1,async:!1},_fn:{model_done:function(a,c){var f=[],g=this._get_settings(),l=this;b.isArray(a)||(a=[a]);b.each(a,function(a,c){var d=c.getProps()||{};d.attr=c.getAttr()||{};c.getChildrenCount()&&(d.state="closed");d.data=c.getName();b.isArray(d.data)||(d.data=[d.data]);l.data.types&&b.isFunction(c.getType)&&(d.attr[g.types.type_attr]=c.getType());d.attr.id&&g.model.id_prefix&&(d.attr.id=g.model.id_prefix+d.attr.id);d.metadata||
 (d.metadata={});d.metadata.jstree_model=c;f.push(d)});c.call(null,f)}}})})(jQuery)}})();
 (function(q,t){var s=0;q.widget("s3.hierarchicalopts",{options:{selected:null},_create:function(){var b=q(this.element);this.treeID=b.attr("id")+"-tree";this.input=b.find(".s3-hierarchy-input").first();this.tree=b.find(".s3-hierarchy-tree").first();this.id=s;s+=1},_init:function(){this.refresh()},_destroy:function(){},refresh:function(){this._unbindEvents();var b=[],a=this.options.selected;if(a)for(var c=this.treeID,d=0,e=a.length;d<e;d++)b.push(c+"-"+a[d]);q.jstree._themes=S3.Ap.concat("/static/styles/jstree/");
-theme=(rtl="ltr"==q("body").css("direction")?!1:!0)?"default-rtl":"default";this.tree.jstree({core:{animation:100,rtl:rtl},themes:{theme:theme,icons:!1},ui:{initially_select:b},checkbox:{override_ui:!0},plugins:["themes","html_data","ui","checkbox","sort"]});this._bindEvents()},_updateSelectedNodes:function(b){b=this.input.val();var a=[];b=b?JSON.parse(b):[];var c=this.tree.jstree("get_checked",null,!0);q(c).each(function(){var b=q(this).attr("id");b&&(b=parseInt(b.split("-").pop()))&&a.push(b)});
+theme=(rtl="ltr"==q("body").css("direction")?!1:!0)?"default-rtl":"default";this.tree.jstree({core:{animation:100,rtl:rtl},themes:{theme:theme,icons:!1},ui:{initially_select:b},checkbox:{override_ui:!0},plugins:["themes","html_data","ui","checkbox","sort"]});this._bindEvents()},_updateSelectedNodes:function(b){b=this.input.val();var a=[];b=b?JSON.parse(b):[];var c=this.tree.jstree("get_checked",null,!1);q(c).each(function(){var b=q(this).attr("id");b&&(b=parseInt(b.split("-").pop()))&&a.push(b)});
 var c=!1,d=q(a).not(b).get();d.length?c=!0:(d=q(b).not(a).get(),d.length&&(c=!0));this.input.val(JSON.stringify(a));c&&q(this.element).trigger("select.s3hierarchy");return!0},set:function(b){this.tree.jstree("uncheck_all");if(b)for(var a=0,c=b.length;a<c;a++)node=q("#"+this.treeID+"-"+b[a]),this.tree.jstree("check_node",node)},get:function(){var b=this.input.val();return b?JSON.parse(b):[]},reset:function(){this.tree.jstree("uncheck_all");this._updateSelectedNodes()},_bindEvents:function(){var b=
 this;q(this.tree).bind("check_node.jstree",function(a,c){b._updateSelectedNodes()}).bind("uncheck_node.jstree",function(a,c){b._updateSelectedNodes()});return!0},_unbindEvents:function(){q(this.tree).unbind("check_node.jstree").unbind("uncheck_node.jstree");return!0}})})(jQuery);
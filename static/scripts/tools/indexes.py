@@ -37,3 +37,46 @@ try:
 except:
     # Index already present
     pass
+# Used by the spatial index (S3SpatialIndex) to catch up with changes
+field = "modified_on"
+try:
+    db.executesql("CREATE INDEX %s_%s__idx on %s(%s);" % (tablename, field, tablename, field))
+except:
+    # Index already present
+    pass
+
+tablename = "gis_location_simplified"
+field = "location_id"
+try:
+    db.executesql("CREATE INDEX %s_%s__idx on %s(%s);" % (tablename, field, tablename, field))
+except:
+    # Index already present
+    pass
+
+tablename = "s3_hierarchy_closure"
+field = "ancestor"
+try:
+    db.executesql("CREATE INDEX %s__idx on %s(%s);" % (field, tablename, field))
+except:
+    # Index already present
+    pass
+field = "descendant"
+try:
+    db.executesql("CREATE INDEX %s__idx on %s(%s);" % (field, tablename, field))
+except:
+    # Index already present
+    pass
+
+tablename = "pr_ancestor"
+field = "pe_id"
+try:
+    db.executesql("CREATE INDEX %s_%s__idx on %s(%s);" % (tablename, field, tablename, field))
+except:
+    # Index already present
+    pass
+field = "ancestor_id"
+try:
+    db.executesql("CREATE INDEX %s_%s__idx on %s(%s);" % (tablename, field, tablename, field))
+except:
+    # Index already present
+    pass